@@ -0,0 +1,129 @@
+# services/api/app/chunking.py
+"""
+Chunker en streaming para la ingesta de conocimiento.
+
+- Lee el archivo línea a línea (nunca el documento entero en memoria).
+- Corta en límites de oración y en encabezados Markdown (un encabezado siempre
+  abre chunk nuevo y no arrastra solape de la sección anterior).
+- El tamaño se mide en tokens del modelo (app.tokens), no en caracteres; una
+  oración más larga que el máximo se parte por palabras, nunca a mitad de palabra.
+- Determinista: mismo archivo → mismos chunks → mismos ids (hash de contenido).
+"""
+from __future__ import annotations
+
+import re
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from .tokens import token_counter
+
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s+\S")
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+_MAX_PARAGRAPH_CHARS = 64 * 1024  # párrafos sin línea en blanco: se procesan por tramos
+
+
+def _sentences(text: str) -> List[str]:
+    return [" ".join(s.split()) for s in _SENTENCE_END.split(text) if s.strip()]
+
+
+def iter_units(lines: Iterable[str]) -> Iterator[Tuple[str, bool]]:
+    """(texto, es_encabezado) por cada oración o encabezado, en orden."""
+    para: List[str] = []
+    size = 0
+    for line in lines:
+        stripped = line.strip()
+        if _HEADING.match(line) or not stripped:
+            if para:
+                for s in _sentences(" ".join(para)):
+                    yield s, False
+                para, size = [], 0
+            if stripped:
+                yield " ".join(stripped.split()), True
+            continue
+        para.append(stripped)
+        size += len(stripped)
+        if size > _MAX_PARAGRAPH_CHARS:
+            # conserva la última oración (puede seguir en la próxima línea)
+            *done, tail = _sentences(" ".join(para)) or [""]
+            for s in done:
+                yield s, False
+            para, size = [tail], len(tail)
+    if para:
+        for s in _sentences(" ".join(para)):
+            yield s, False
+
+
+def _fit(text: str, max_tokens: int, count: Callable[[str], int]) -> Iterator[Tuple[str, int]]:
+    """Parte una oración demasiado larga en tramos de palabras completas."""
+    n = count(text)
+    if n <= max_tokens:
+        yield text, n
+        return
+    words: List[str] = []
+    total = 0
+    for w in text.split(" "):
+        wn = count(" " + w)
+        if words and total + wn > max_tokens:
+            yield " ".join(words), total
+            words, total = [], 0
+        words.append(w)
+        total += wn
+    if words:
+        yield " ".join(words), total
+
+
+def chunk_lines(
+    lines: Iterable[str],
+    max_tokens: int = 300,
+    overlap_tokens: int = 50,
+    count: Optional[Callable[[str], int]] = None,
+) -> Iterator[str]:
+    """Genera chunks de ≤ max_tokens con ~overlap_tokens de oraciones repetidas entre vecinos."""
+    count = count or token_counter()
+    cur: List[Tuple[str, int]] = []
+    cur_tokens = 0
+    fresh = False    # hay cuerpo nuevo (no solo solape/encabezados) en `cur`
+    overlap = 0      # cuántos elementos iniciales de `cur` son solape del chunk anterior
+
+    def overlap_tail() -> List[Tuple[str, int]]:
+        tail: List[Tuple[str, int]] = []
+        total = 0
+        for s, n in reversed(cur):
+            if total + n > overlap_tokens:
+                break
+            tail.insert(0, (s, n))
+            total += n
+        return tail
+
+    for text, heading in iter_units(lines):
+        if heading:
+            if fresh:
+                yield " ".join(s for s, _ in cur)
+                cur, cur_tokens, fresh = [], 0, False
+            else:  # sección nueva: el solape de la anterior no aplica
+                cur_tokens -= sum(n for _, n in cur[:overlap])
+                del cur[:overlap]
+            overlap = 0
+        for piece, n in _fit(text, max_tokens, count):
+            if cur_tokens + n > max_tokens and fresh:
+                yield " ".join(s for s, _ in cur)
+                cur = overlap_tail()
+                cur_tokens = sum(x for _, x in cur)
+                overlap, fresh = len(cur), False
+            while cur and cur_tokens + n > max_tokens:  # el solape no debe desbordar
+                cur_tokens -= cur.pop(0)[1]
+                overlap = max(0, overlap - 1)
+            cur.append((piece, n))
+            cur_tokens += n
+            fresh = fresh or not heading
+    if fresh:
+        yield " ".join(s for s, _ in cur)
+
+
+def chunk_file(
+    path: str,
+    max_tokens: int = 300,
+    overlap_tokens: int = 50,
+    count: Optional[Callable[[str], int]] = None,
+) -> Iterator[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        yield from chunk_lines(f, max_tokens, overlap_tokens, count)
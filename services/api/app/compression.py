@@ -0,0 +1,207 @@
+# services/api/app/compression.py
+"""
+Compresión de respuestas consciente del streaming (reemplaza GZipMiddleware).
+
+  - Cuerpos completos (JSON de /chat/plan, /llm/complete...) ≥ min_size: se
+    negocia Accept-Encoding en orden zstd > br > gzip según lo que esté
+    instalado (`zstandard`, `brotli`; gzip siempre).
+  - Streams (NDJSON, SSE, texto): gzip con Z_SYNC_FLUSH tras cada evento. El
+    cliente recibe cada delta en cuanto sale del generador; la ventana de
+    deflate se comparte entre eventos, así que las claves JSON repetidas
+    cuestan pocos bytes. El GZipMiddleware de Starlette < 0.46 (el de
+    fastapi==0.114) escribe en un GzipFile sin flush y retiene los deltas
+    chicos hasta juntar un bloque.
+  - `X-Stream-Encoding: identity` en el request (o COMPRESSION_STREAMS=false)
+    deja los streams sin comprimir: útil para clientes que parsean NDJSON a
+    mano o proxies que re-bufferizan contenido comprimido.
+
+ASGI puro, como metrics/tracing: BaseHTTPMiddleware rompe el streaming.
+"""
+from __future__ import annotations
+
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import anyio.to_thread
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:  # pragma: no cover - depende del entorno
+    HAS_BROTLI = False
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:  # pragma: no cover - depende del entorno
+    HAS_ZSTD = False
+
+# niveles para contenido dinámico: br 11 / gzip 9 cuestan ms por respuesta a cambio de ~2-5% menos bytes
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+THREAD_MIN_SIZE = 256 * 1024  # cuerpos más grandes se comprimen fuera del event loop
+
+# ya comprimidos o binarios: no se tocan
+EXCLUDED_TYPES = ("image/", "audio/", "video/", "font/", "application/zip", "application/gzip", "application/grpc")
+
+STREAM_OPT_OUT = b"x-stream-encoding"
+
+
+def _gzip(body: bytes) -> bytes:
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(body) + c.flush()
+
+
+def _codecs() -> Dict[str, Callable[[bytes], bytes]]:
+    codecs: Dict[str, Callable[[bytes], bytes]] = {}
+    if HAS_ZSTD:
+        zc = zstandard.ZstdCompressor(level=ZSTD_LEVEL)  # thread-safe para compress() de una pasada
+        codecs["zstd"] = zc.compress
+    if HAS_BROTLI:
+        codecs["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    codecs["gzip"] = _gzip
+    return codecs
+
+
+CODECS = _codecs()  # orden = preferencia del servidor
+
+
+def negotiate(accept_encoding: str, available: Tuple[str, ...] = tuple(CODECS)) -> Optional[str]:
+    """Codec preferido por el servidor entre los aceptados (q > 0) por el cliente; None = identity."""
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip()] = q
+    wildcard = accepted.get("*", 0.0)
+    for codec in available:
+        if accepted.get(codec, wildcard) > 0:
+            return codec
+    return None
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> bytes:
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return b""
+
+
+class CompressionMiddleware:
+    """
+    `app.add_middleware(CompressionMiddleware, minimum_size=800)`. El stream se
+    detecta por `more_body` en el primer chunk del cuerpo, no por content-type.
+    """
+
+    def __init__(self, app: Any, minimum_size: int = 800, streams: bool = True):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.streams = streams
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = scope.get("headers") or ()
+        accept = _header(headers, b"accept-encoding").decode("latin-1")
+        codec = negotiate(accept)
+        if codec is None:
+            await self.app(scope, receive, send)
+            return
+        stream_ok = (
+            self.streams
+            and _header(headers, STREAM_OPT_OUT).strip().lower() != b"identity"
+            and negotiate(accept, ("gzip",)) is not None  # los streams van siempre en gzip
+        )
+        await _Responder(self.app, send, codec, self.minimum_size, stream_ok)(scope, receive)
+
+
+class _Responder:
+    __slots__ = ("app", "send", "codec", "minimum_size", "stream_ok", "start", "passthrough", "deflate")
+
+    def __init__(self, app: Any, send: Any, codec: str, minimum_size: int, stream_ok: bool):
+        self.app = app
+        self.send = send
+        self.codec = codec
+        self.minimum_size = minimum_size
+        self.stream_ok = stream_ok
+        self.start: Optional[Dict[str, Any]] = None
+        self.passthrough = False
+        self.deflate: Any = None  # compresor gzip del stream
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any) -> None:
+        await self.app(scope, receive, self.on_send)
+
+    async def on_send(self, message: Dict[str, Any]) -> None:
+        kind = message["type"]
+        if kind == "http.response.start":
+            headers = message.get("headers") or []
+            ctype = _header(headers, b"content-type").decode("latin-1").lower()
+            self.passthrough = (
+                message["status"] in (204, 206, 304)
+                or bool(_header(headers, b"content-encoding"))
+                or ctype.startswith(EXCLUDED_TYPES)
+            )
+            if self.passthrough:
+                await self.send(message)
+            else:
+                self.start = message  # los headers dependen del primer chunk del cuerpo
+            return
+        if kind != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more = message.get("more_body", False)
+        if self.deflate is not None:  # stream en curso
+            out = self.deflate.compress(body)
+            out += self.deflate.flush(zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH)
+            await self.send({"type": "http.response.body", "body": out, "more_body": more})
+            return
+        if self.start is None:  # stream sin comprimir (X-Stream-Encoding: identity)
+            await self.send(message)
+            return
+
+        start, self.start = self.start, None
+        if more:
+            if not self.stream_ok:
+                await self.send(start)
+                await self.send(message)
+                return
+            self.deflate = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            await self.send(self._headers(start, "gzip", None))
+            await self.send({"type": "http.response.body",
+                             "body": self.deflate.compress(body) + self.deflate.flush(zlib.Z_SYNC_FLUSH),
+                             "more_body": True})
+            return
+        if len(body) < self.minimum_size:
+            await self.send(start)
+            await self.send(message)
+            return
+        compress = CODECS[self.codec]
+        if len(body) >= THREAD_MIN_SIZE:
+            out = await anyio.to_thread.run_sync(compress, body)
+        else:
+            out = compress(body)
+        await self.send(self._headers(start, self.codec, len(out)))
+        await self.send({"type": "http.response.body", "body": out, "more_body": False})
+
+    @staticmethod
+    def _headers(start: Dict[str, Any], codec: str, length: Optional[int]) -> Dict[str, Any]:
+        headers = [(k, v) for k, v in start.get("headers") or () if k.lower() not in (b"content-length", b"vary")]
+        vary = _header(start.get("headers") or [], b"vary")
+        if b"accept-encoding" not in vary.lower():
+            vary = vary + b", Accept-Encoding" if vary else b"Accept-Encoding"
+        headers.append((b"vary", vary))
+        headers.append((b"content-encoding", codec.encode()))
+        if length is not None:
+            headers.append((b"content-length", str(length).encode()))
+        return {**start, "headers": headers}
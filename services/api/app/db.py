@@ -1,3 +1,4 @@
+from functools import lru_cache
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
@@ -19,3 +20,17 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def create_schema() -> list:
+    """Crea las tablas de app.models que falten (idempotente). Paso de deploy, no de arranque."""
+    from . import models  # noqa: F401 - registra los modelos en Base.metadata
+
+    Base.metadata.create_all(bind=engine)
+    return sorted(Base.metadata.tables)
+
+
+@lru_cache(maxsize=1)
+def ensure_schema() -> list:
+    """create_schema() una sola vez por proceso: deploys sin paso de migración (Vercel, dev)."""
+    return create_schema()
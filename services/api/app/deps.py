@@ -1,17 +1,130 @@
-from typing import Optional
-from openai import OpenAI
-from supabase import Client, create_client
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from fastapi import Request
 
 from .settings import get_settings
+from .metering import UsageMeter
+from .rate_limit import AdmissionController
+from .session_memory import SessionMemory
+from .single_flight import SingleFlight
+
+if TYPE_CHECKING:  # openai / supabase / numpy se importan recién al primer uso
+    from openai import AsyncOpenAI
+    from supabase import Client
+    from .semantic_cache import SemanticCache
+    from .summarizer import RollingSummarizer
+    from .vector_index import VectorIndex
 
 settings = get_settings()
 
 # OpenAI
-openai_client = OpenAI(api_key=settings.OPENAI_API_KEY)
 OPENAI_MODEL = settings.OPENAI_MODEL
 EMBED_MODEL = settings.EMBED_MODEL
 
-# Supabase (opcional)
-supabase: Optional[Client] = None
-if settings.SUPABASE_URL and settings.SUPABASE_SERVICE_ROLE_KEY:
-    supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_ROLE_KEY)
+
+@lru_cache(maxsize=1)
+def get_supabase() -> Optional[Client]:
+    """Cliente Supabase (opcional), creado en la primera llamada: `supabase` cuesta ~160 ms de import."""
+    if not (settings.SUPABASE_URL and settings.SUPABASE_SERVICE_ROLE_KEY):
+        return None
+    from supabase import create_client
+
+    return create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_ROLE_KEY)
+
+
+# --------- Recursos perezosos en app.state ---------
+def _lazy(state: Any, name: str, build: Callable[[], Any]) -> Any:
+    # sin await entre el chequeo y la asignación: un solo build por proceso
+    try:
+        return getattr(state, name)
+    except AttributeError:
+        value = build()
+        setattr(state, name, value)
+        return value
+
+
+def openai_client(state: Any) -> AsyncOpenAI:
+    def build() -> AsyncOpenAI:
+        from openai import AsyncOpenAI
+        from .http_clients import get_client
+
+        base = os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+        return AsyncOpenAI(api_key=state.settings.OPENAI_API_KEY, base_url=base, http_client=get_client(base))
+
+    return _lazy(state, "openai", build)
+
+
+def semantic_cache(state: Any) -> Optional[SemanticCache]:
+    def build() -> Optional[SemanticCache]:
+        from .semantic_cache import build_semantic_cache
+
+        return build_semantic_cache(state.settings)
+
+    return _lazy(state, "semantic_cache", build)
+
+
+def vector_index(state: Any) -> Optional[VectorIndex]:
+    def build() -> Optional[VectorIndex]:
+        s = state.settings
+        if s.RAG_BACKEND == "supabase":
+            return None
+        from .vector_index import load_index
+
+        return load_index(s.VECTOR_INDEX_PATH, nprobe=s.VECTOR_INDEX_NPROBE)
+
+    return _lazy(state, "vector_index", build)
+
+
+def summarizer(state: Any) -> Optional[RollingSummarizer]:
+    def build() -> Optional[RollingSummarizer]:
+        from .summarizer import build_summarizer
+
+        # el cliente OpenAI se resuelve en el primer resumen, no al crear el summarizer
+        return build_summarizer(state.settings, state.session_memory, lambda: openai_client(state))
+
+    return _lazy(state, "summarizer", build)
+
+
+# --------- Dependencias FastAPI ---------
+def get_async_openai(request: Request) -> AsyncOpenAI:
+    """Cliente AsyncOpenAI compartido (creado en el primer request que lo usa)."""
+    return openai_client(request.app.state)
+
+
+def get_semantic_cache(request: Request) -> Optional[SemanticCache]:
+    """Caché semántica de /llm (None si SEMANTIC_CACHE_ENABLED=false)."""
+    return semantic_cache(request.app.state)
+
+
+def get_vector_index(request: Request) -> Optional[VectorIndex]:
+    """Índice vectorial local (None → RAG vía RPC match_knowledge en Supabase)."""
+    return vector_index(request.app.state)
+
+
+def get_session_memory(request: Request) -> SessionMemory:
+    """Memoria de conversación del agente (creada en el lifespan de app.main)."""
+    return request.app.state.session_memory
+
+
+def get_summarizer(request: Request) -> Optional[RollingSummarizer]:
+    """Resumen incremental del agente (None si AGENT_SUMMARY_ENABLED=false)."""
+    return summarizer(request.app.state)
+
+
+def get_admission(request: Request) -> Optional[AdmissionController]:
+    """Buckets RPM/TPM por proveedor:modelo + cola por usuario (None si RATE_LIMIT_ENABLED=false)."""
+    return getattr(request.app.state, "admission", None)
+
+
+def get_meter(request: Request) -> Optional[UsageMeter]:
+    """Medición de tokens y cuotas por usuario (None si METERING_ENABLED=false)."""
+    return getattr(request.app.state, "meter", None)
+
+
+def get_single_flight(request: Request) -> Optional[SingleFlight]:
+    """Coalescing de llamadas/streams idénticos en vuelo (None si SINGLE_FLIGHT_ENABLED=false)."""
+    return getattr(request.app.state, "single_flight", None)
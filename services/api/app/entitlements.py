@@ -0,0 +1,203 @@
+# services/api/app/entitlements.py
+"""
+Caché de entitlements por user_id para GET /billing/summary (billing.py).
+
+  - L1 en proceso: LRU con TTL corto (ENTITLEMENT_CACHE_TTL_S, 30 s). Cubre
+    el polling del frontend en cada carga de página.
+  - L2 opcional en Redis (ENTITLEMENT_CACHE_BACKEND=redis + REDIS_URL):
+    {prefix}:{user_id} con ENTITLEMENT_REDIS_TTL_S, compartido entre réplicas.
+  - Invalidación precisa: los webhooks de Stripe (customer.subscription.*) y
+    de PayPal (verify_subscription, BILLING.SUBSCRIPTION.*) llaman a
+    `invalidate(user_id)`: borra L1 y L2. Otras réplicas pueden servir su L1
+    hasta que venza el TTL corto.
+  - "Sin suscripción" también se guarda (la mayoría de usuarios son free), y
+    la fila del plan free se carga una sola vez (`free_plan`) hasta que un
+    webhook de precios/planes la invalide.
+
+Las lecturas a Supabase son síncronas: el loader corre en el threadpool y las
+misses concurrentes del mismo usuario comparten una sola consulta
+(single_flight). Una carga que se cruza con una invalidación no se guarda.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from .single_flight import SingleFlight
+
+logger = logging.getLogger("chatmig.entitlements")
+
+Loader = Callable[[str], Optional[Dict[str, Any]]]  # síncrono (cliente Supabase); None = sin suscripción
+
+_MISS = object()
+
+
+@dataclass
+class EntitlementStats:
+    hits: int = 0          # servidos desde L1
+    redis_hits: int = 0    # servidos desde L2 (y copiados a L1)
+    misses: int = 0        # fueron a Supabase (o esperaron una carga en vuelo)
+    loads: int = 0         # consultas reales a Supabase
+    invalidations: int = 0
+    stale_loads: int = 0   # cargas descartadas por una invalidación concurrente
+
+    def as_dict(self) -> Dict[str, Any]:
+        total = self.hits + self.redis_hits + self.misses
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "stale_loads": self.stale_loads,
+            "hit_rate": round((self.hits + self.redis_hits) / total, 4) if total else None,
+        }
+
+
+class EntitlementCache:
+    def __init__(
+        self,
+        ttl_s: float = 30.0,
+        max_entries: int = 10000,
+        redis_url: Optional[str] = None,
+        redis_ttl_s: int = 300,
+        prefix: str = "chatmig:ent",
+    ):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.redis_ttl_s = redis_ttl_s
+        self.prefix = prefix
+        self._local: "OrderedDict[str, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self._free: Optional[Dict[str, Any]] = None
+        self._epoch = 0  # sube con cada invalidación
+        self._flights = SingleFlight()
+        self._r = None
+        if redis_url:
+            import redis.asyncio as aioredis
+
+            self._r = aioredis.from_url(redis_url)
+        self.stats = EntitlementStats()
+
+    def _k(self, user_id: str) -> str:
+        return f"{self.prefix}:{user_id}"
+
+    def _put_local(self, user_id: str, value: Optional[Dict[str, Any]]) -> None:
+        if self.ttl_s <= 0:  # ENTITLEMENT_CACHE_TTL_S=0: sin L1
+            return
+        self._local[user_id] = (time.monotonic() + self.ttl_s, value)
+        self._local.move_to_end(user_id)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+    def _get_local(self, user_id: str) -> Any:
+        item = self._local.get(user_id)
+        if item is None:
+            return _MISS
+        if item[0] <= time.monotonic():
+            del self._local[user_id]
+            return _MISS
+        self._local.move_to_end(user_id)
+        return item[1]
+
+    async def _get_redis(self, user_id: str) -> Any:
+        if self._r is None:
+            return _MISS
+        try:
+            raw = await self._r.get(self._k(user_id))
+        except Exception as e:
+            logger.warning("[entitlements] redis get falló: %s", e)
+            return _MISS
+        return _MISS if raw is None else json.loads(raw)
+
+    async def _set_redis(self, user_id: str, value: Optional[Dict[str, Any]]) -> None:
+        if self._r is None:
+            return
+        try:
+            await self._r.set(self._k(user_id), json.dumps(value, default=str), ex=self.redis_ttl_s)
+        except Exception as e:
+            logger.warning("[entitlements] redis set falló: %s", e)
+
+    async def get(self, user_id: str, loader: Loader) -> Optional[Dict[str, Any]]:
+        """Fila de v_entitlements del usuario, o None si no tiene suscripción (→ plan free)."""
+        value = self._get_local(user_id)
+        if value is not _MISS:
+            self.stats.hits += 1
+            return value
+        value = await self._get_redis(user_id)
+        if value is not _MISS:
+            self.stats.redis_hits += 1
+            self._put_local(user_id, value)
+            return value
+        self.stats.misses += 1
+        # la época en la clave: tras una invalidación nadie se suma a la carga vieja
+        return await self._flights.do(f"{user_id}:{self._epoch}", lambda: self._load(user_id, loader))
+
+    async def _load(self, user_id: str, loader: Loader) -> Optional[Dict[str, Any]]:
+        epoch = self._epoch
+        self.stats.loads += 1
+        value = await run_in_threadpool(loader, user_id)
+        if epoch != self._epoch:
+            self.stats.stale_loads += 1  # un webhook cambió algo mientras leíamos: no se guarda
+            return value
+        self._put_local(user_id, value)
+        await self._set_redis(user_id, value)
+        return value
+
+    async def invalidate(self, user_id: Optional[str]) -> None:
+        if not user_id:
+            return
+        self._epoch += 1
+        self.stats.invalidations += 1
+        self._local.pop(user_id, None)
+        if self._r is not None:
+            try:
+                await self._r.delete(self._k(user_id))
+            except Exception as e:
+                logger.warning("[entitlements] redis delete falló: %s", e)
+
+    async def free_plan(self, loader: Callable[[], Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Fila de `plans` id='free': una sola consulta por proceso (hasta invalidate_plans)."""
+        if self._free is None:
+            self._free = await run_in_threadpool(loader) or {}
+        return self._free
+
+    def invalidate_plans(self) -> None:
+        self._free = None
+
+    async def aclose(self) -> None:
+        if self._r is not None:
+            await self._r.aclose()
+
+
+def free_plan_summary(plan: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Fila `plans` id='free' con la forma de /billing/summary; única forma guardada en `free_plan`."""
+    plan = plan or {}
+    return {
+        "plan_id": "free",
+        "plan_name": plan.get("name") or "Free",
+        "quota_messages": plan.get("quota_messages"),
+        "quota_tokens": plan.get("quota_tokens"),
+        "remaining_messages": plan.get("quota_messages"),
+        "remaining_tokens": plan.get("quota_tokens"),
+        "model_allowlist": plan.get("model_allowlist") or [],
+        "features": plan.get("features") or {},
+    }
+
+
+@lru_cache(maxsize=1)
+def get_entitlements() -> EntitlementCache:
+    """Instancia compartida por billing.py y payments/paypal.py (config por env, como esos módulos)."""
+    return EntitlementCache(
+        ttl_s=float(os.getenv("ENTITLEMENT_CACHE_TTL_S", "30")),
+        max_entries=int(os.getenv("ENTITLEMENT_CACHE_MAX_ENTRIES", "10000")),
+        redis_url=os.getenv("REDIS_URL") if os.getenv("ENTITLEMENT_CACHE_BACKEND", "memory") == "redis" else None,
+        redis_ttl_s=int(os.getenv("ENTITLEMENT_REDIS_TTL_S", "300")),
+    )
@@ -0,0 +1,160 @@
+# services/api/app/http_clients.py
+"""
+Registro de clientes HTTP salientes: un httpx.AsyncClient con pool por host
+(origin), reutilizado por todo el proceso y cerrado en el lifespan.
+
+Uso:
+    from app.http_clients import get_client
+    r = await get_client(url).post(url, json=payload, timeout=20)
+
+Cada request pasa por un transport que cuenta si reutilizó una conexión del
+pool (hit) o tuvo que abrir una nueva (miss), y cuánto esperó hasta poder
+enviar headers (adquirir conexión del pool + TCP/TLS si hubo miss).
+"""
+from __future__ import annotations
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger("chatmig.http")
+
+try:  # HTTP/2 requiere el extra `httpx[http2]` (paquete h2)
+    import h2  # noqa: F401
+    HAS_HTTP2 = True
+except Exception:
+    HAS_HTTP2 = False
+
+
+@dataclass
+class PoolStats:
+    requests: int = 0
+    hits: int = 0
+    misses: int = 0
+    wait_s: float = 0.0
+    max_wait_s: float = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / self.requests, 4) if self.requests else None,
+            "avg_wait_ms": round(1000 * self.wait_s / self.requests, 3) if self.requests else None,
+            "max_wait_ms": round(1000 * self.max_wait_s, 3),
+        }
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    """Envuelve el transport del pool y usa la extensión `trace` de httpcore para medir reuso."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, stats: PoolStats):
+        self._inner = inner
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        t0 = time.perf_counter()
+        state = {"connected": False, "wait": None}
+        upstream_trace = request.extensions.get("trace")
+
+        async def trace(name: str, info: dict) -> None:
+            if name == "connection.connect_tcp.started":
+                state["connected"] = True
+            elif state["wait"] is None and name.endswith("send_request_headers.started"):
+                state["wait"] = time.perf_counter() - t0
+            if upstream_trace is not None:
+                await upstream_trace(name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        try:
+            return await self._inner.handle_async_request(request)
+        finally:
+            wait = state["wait"] if state["wait"] is not None else time.perf_counter() - t0
+            s = self._stats
+            s.requests += 1
+            if state["connected"]:
+                s.misses += 1
+            else:
+                s.hits += 1
+            s.wait_s += wait
+            if wait > s.max_wait_s:
+                s.max_wait_s = wait
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class HTTPClientRegistry:
+    def __init__(self) -> None:
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, PoolStats] = {}
+        self.configure()
+
+    def configure(
+        self,
+        *,
+        max_connections: int = 100,
+        max_keepalive: int = 20,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        read_timeout: Optional[float] = 120.0,
+        pool_timeout: float = 10.0,
+        http2: bool = True,
+    ) -> None:
+        """Fija límites/timeouts. Aplica a los clientes que se creen a partir de ahora."""
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout, read=read_timeout, write=connect_timeout, pool=pool_timeout
+        )
+        self.http2 = http2 and HAS_HTTP2
+
+    def configure_from_settings(self, settings: Any) -> None:
+        self.configure(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive=settings.HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+            connect_timeout=settings.HTTP_CONNECT_TIMEOUT,
+            read_timeout=settings.HTTP_READ_TIMEOUT,
+            pool_timeout=settings.HTTP_POOL_TIMEOUT,
+            http2=settings.HTTP2_ENABLED,
+        )
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        u = httpx.URL(url)
+        return f"{u.scheme}://{u.host}:{u.port or (443 if u.scheme == 'https' else 80)}"
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        """Cliente compartido para el host de `url` (se crea la primera vez)."""
+        origin = self._origin(url)
+        c = self._clients.get(origin)
+        if c is None or c.is_closed:
+            stats = self._stats.setdefault(origin, PoolStats())
+            inner = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+            c = httpx.AsyncClient(transport=_MeteredTransport(inner, stats), timeout=self.timeout)
+            self._clients[origin] = c
+            logger.info("[http] pool abierto para %s (http2=%s)", origin, self.http2)
+        return c
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {origin: s.as_dict() for origin, s in self._stats.items()}
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for origin, c in clients.items():
+            await c.aclose()
+            logger.info("[http] pool cerrado %s · %s", origin, self._stats[origin].as_dict())
+
+
+registry = HTTPClientRegistry()
+
+
+def get_client(url: str) -> httpx.AsyncClient:
+    return registry.client(url)
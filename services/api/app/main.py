@@ -5,11 +5,18 @@ import logging
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 
+from . import metrics, tracing
+from .compression import CompressionMiddleware
 from .settings import get_settings
+from .deps import get_supabase
+from .http_clients import registry as http_registry
+from .metering import build_meter
+from .rate_limit import build_admission
+from .session_memory import build_session_memory
+from .single_flight import SingleFlight
 from .routers import health, chat, abtest, progress
 
 # Routers opcionales (no rompen si faltan)
@@ -29,7 +36,7 @@ except Exception:
 
 # Agente específico de ChatMig (opcional, pero recomendado)
 try:
-    from .routes.agent_chatmig import router as agent_chatmig_router
+    from .routers.agent_chatmig import router as agent_chatmig_router
     HAS_CHATMIG_AGENT = True
 except Exception:
     HAS_CHATMIG_AGENT = False
@@ -52,10 +59,46 @@ tags_metadata = [
 async def lifespan(app: FastAPI):
     settings = get_settings()
     app.state.settings = settings
+    http_registry.configure_from_settings(settings)
+    # AsyncOpenAI, caché semántica, índice vectorial y summarizer se crean en el
+    # primer request que los usa (app.deps): el arranque en frío no importa
+    # openai / numpy / tiktoken.
+    app.state.session_memory = build_session_memory(settings)
+    app.state.admission = build_admission(settings)
+    app.state.single_flight = SingleFlight() if settings.SINGLE_FLIGHT_ENABLED else None
+    app.state.meter = build_meter(settings, get_supabase)  # Supabase se crea en el primer volcado
+    metrics.configure(settings.METRICS_ENABLED)
+    if metrics.enabled():
+        metrics.preallocate(app, [("openai", settings.OPENAI_MODEL)])
+        metrics.register_session_memory(app.state.session_memory)
+    elif settings.METRICS_ENABLED:
+        logger.warning("[ChatMig] prometheus_client no instalado: /metrics desactivado")
     logger.info("[ChatMig] API arrancando · modelo=%s", settings.OPENAI_MODEL)
     try:
         yield
     finally:
+        await http_registry.aclose()  # cierra también el transport de AsyncOpenAI
+        cache = getattr(app.state, "semantic_cache", None)
+        if cache is not None:
+            logger.info("[ChatMig] caché semántica · %s", cache.stats())
+            if hasattr(cache, "aclose"):
+                await cache.aclose()
+        memory = app.state.session_memory
+        logger.info("[ChatMig] memoria de sesión · %s", memory.stats())
+        summarizer = getattr(app.state, "summarizer", None)
+        if summarizer is not None:
+            logger.info("[ChatMig] resumen de conversación · %s", summarizer.stats.as_dict())
+        if hasattr(memory, "aclose"):
+            await memory.aclose()
+        if app.state.single_flight is not None:
+            logger.info("[ChatMig] coalescing · %s", app.state.single_flight.stats.as_dict())
+        if app.state.meter is not None:
+            await app.state.meter.aclose()  # vuelca lo pendiente
+            logger.info("[ChatMig] medición · %s", app.state.meter.stats.as_dict())
+        if app.state.admission is not None:
+            logger.info("[ChatMig] admisión · %s", app.state.admission.stats())
+            await app.state.admission.aclose()
+        tracing.shutdown()
         logger.info("[ChatMig] API detenido")
 
 app = FastAPI(
@@ -66,9 +109,13 @@ app = FastAPI(
 )
 
 # Middlewares
-app.add_middleware(GZipMiddleware, minimum_size=800)
-
 settings = get_settings()
+# streams: flush por evento (GZipMiddleware retenía los deltas chicos en el buffer del compresor)
+app.add_middleware(CompressionMiddleware, minimum_size=settings.COMPRESSION_MIN_SIZE, streams=settings.COMPRESSION_STREAMS)
+app.add_middleware(metrics.MetricsMiddleware)  # envuelve a la compresión: mide hasta el último byte ya comprimido
+
+if tracing.configure_from_settings(settings):  # apagado: ni siquiera se agrega el middleware
+    app.add_middleware(tracing.TracingMiddleware)
 allow_origins: List[str] = settings.ALLOWED_ORIGINS or []
 app.add_middleware(
     CORSMiddleware,
@@ -83,6 +130,11 @@ app.add_middleware(
 async def root():
     return {"status": "ok", "service": "ChatMig API", "version": "1.1.0"}
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    # async: el scrape corre en el event loop (lee la memoria de sesión sin carreras con los requests)
+    return metrics.metrics_response()
+
 # Routers
 app.include_router(health.router)
 app.include_router(chat.router)                 # /chat (plan, etc.)
@@ -107,7 +159,8 @@ app.include_router(progress.router)
 # Handlers de error
 @app.exception_handler(HTTPException)
 async def http_exception_handler(_: Request, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+    # headers: p.ej. Retry-After de los 429 de admisión
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=getattr(exc, "headers", None))
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(_: Request, exc: RequestValidationError):
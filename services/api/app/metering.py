@@ -0,0 +1,507 @@
+# services/api/app/metering.py
+"""
+Medición de tokens por usuario y cuotas diarias (/llm, /chat, /agent y el
+stream multi-proveedor de main.py).
+
+Por request:
+  1. `enforce(meter, request, route)` antes de cualquier llamada upstream:
+     compara contadores en memoria con la cuota del usuario → 429 con
+     Retry-After hasta la medianoche UTC. Sin E/S: la cuota del plan y el
+     consumo previo del día se cargan en segundo plano la primera vez que se
+     ve al usuario (mientras tanto rige la cuota por defecto).
+  2. El `Charge` del request queda en un ContextVar y `prompt_cache.record`
+     (por donde pasan los bloques usage de todos los proveedores) le pasa el
+     usage. Si no llega (stream cortado, request sumado a un single-flight,
+     hit de la caché semántica) se cuenta con el tokenizer local: prompt
+     estimado para la admisión + texto entregado.
+  3. `settle(...)` / `metered(...)` (streams; también si el cliente se va)
+     suma tokens y 1 mensaje a los contadores locales (con
+     METERING_BACKEND=redis, HINCRBY compartido entre réplicas) y a un
+     pendiente por (usuario, día).
+
+Los pendientes se vuelcan a Supabase cada METERING_FLUSH_S en un RPC por lote
+(`usage_increment`: upsert que suma sobre usage_counters, ver
+src/supabase/migrations/2025xxxx_usage_metering.sql); si falla, vuelven al
+pendiente y se reintentan en el siguiente ciclo (una fila que falla sola se
+descarta tras `max_flush_attempts`). Usuarios anónimos (ip:...) y headers
+x-sb-user-id que no son UUID se limitan por IP pero no se persisten. Los
+contadores locales son un LRU de `max_users` y se podan cada `prune_s`.
+
+Cuotas: quota_tokens / quota_messages del plan (v_entitlements o la fila
+'free' de plans, vía app.entitlements), por día como usage_counters. Sin plan
+o sin Supabase: QUOTA_DAILY_TOKENS / QUOTA_DAILY_MESSAGES (0 = sin límite).
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import datetime as dt
+import json
+import logging
+import math
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from .entitlements import EntitlementCache, free_plan_summary, get_entitlements
+from .rate_limit import user_key
+from .tokens import count_tokens
+
+if TYPE_CHECKING:
+    from .prompt_cache import Usage
+
+logger = logging.getLogger("chatmig.metering")
+
+_CURRENT: contextvars.ContextVar[Optional["Charge"]] = contextvars.ContextVar("chatmig_charge", default=None)
+
+
+@dataclass(frozen=True)
+class Quota:
+    tokens: int = 0    # por día; 0 = sin límite
+    messages: int = 0
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+@dataclass
+class Charge:
+    """Consumo de un request; se liquida una sola vez."""
+
+    user: str
+    route: str
+    prompt_tokens: int = 0             # estimación local (la misma de la admisión)
+    model: Optional[str] = None
+    usage: Optional[Usage] = None      # bloque usage del proveedor: gana sobre la estimación
+    parts: List[Any] = field(default_factory=list)  # lo entregado: texto o líneas NDJSON
+    settled: bool = False
+
+    def add(self, item: Any) -> None:
+        self.parts.append(item)  # hot path: se tokeniza solo si no llega usage
+
+    def tokens(self) -> Tuple[int, int]:
+        if self.usage is not None:
+            return self.usage.prompt_tokens, self.usage.completion_tokens
+        return self.prompt_tokens, count_tokens(_delivered_text(self.parts), self.model)
+
+
+def _delivered_text(parts: List[Any]) -> str:
+    out: List[str] = []
+    for part in parts:
+        if isinstance(part, str):
+            out.append(part)
+            continue
+        for line in bytes(part).splitlines():  # NDJSON: solo los eventos delta
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(obj, dict) and obj.get("type") == "delta":
+                out.append(str(obj.get("content") or ""))
+    return "".join(out)
+
+
+def report(usage: Optional[Usage]) -> None:
+    """Hook de prompt_cache.record: usage del proveedor para el request en curso."""
+    charge = _CURRENT.get()
+    if charge is not None and usage is not None and not charge.settled:
+        charge.usage = usage
+
+
+def _persistable(user: str) -> bool:
+    """Solo ids de Supabase Auth (UUID) van a usage_counters; el RPC castea a uuid."""
+    try:
+        return str(uuid.UUID(user)) == user.lower()
+    except ValueError:
+        return False
+
+
+def meter_key(request: Request) -> str:
+    """user_key con x-sb-user-id validado: un header que no es UUID cuenta como su IP (solo local)."""
+    user = user_key(request)
+    if user.startswith("ip:") or _persistable(user):
+        return user
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def _today() -> str:
+    return dt.datetime.now(dt.timezone.utc).date().isoformat()
+
+
+def _until_midnight() -> float:
+    now = dt.datetime.now(dt.timezone.utc)
+    tomorrow = dt.datetime.combine(now.date() + dt.timedelta(days=1), dt.time(), tzinfo=dt.timezone.utc)
+    return (tomorrow - now).total_seconds()
+
+
+@dataclass
+class MeterStats:
+    checks: int = 0
+    rejected: int = 0
+    settled: int = 0
+    provider_usage: int = 0   # liquidados con el usage del proveedor
+    estimated: int = 0        # liquidados con el tokenizer local
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    flushes: int = 0
+    flushed_rows: int = 0
+    flush_errors: int = 0
+    dropped_rows: int = 0     # filas descartadas tras `max_flush_attempts` RPCs fallidos
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "checks": self.checks,
+            "rejected": self.rejected,
+            "settled": self.settled,
+            "provider_usage": self.provider_usage,
+            "estimated": self.estimated,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+            "dropped_rows": self.dropped_rows,
+            "rows_per_flush": round(self.flushed_rows / self.flushes, 1) if self.flushes else None,
+        }
+
+
+class UsageMeter:
+    def __init__(
+        self,
+        default_quota: Quota = Quota(),
+        *,
+        supabase: Callable[[], Any] = lambda: None,
+        entitlements: Optional[EntitlementCache] = None,
+        flush_s: float = 5.0,
+        max_batch: int = 500,
+        quota_ttl_s: float = 60.0,
+        max_users: int = 100_000,
+        prune_s: float = 60.0,
+        max_flush_attempts: int = 5,
+        redis_url: Optional[str] = None,
+        prefix: str = "chatmig:usage",
+    ):
+        self.default_quota = default_quota
+        self.flush_s = flush_s
+        self.max_batch = max_batch
+        self.quota_ttl_s = quota_ttl_s
+        self.max_users = max_users
+        self.prune_s = prune_s
+        self.max_flush_attempts = max_flush_attempts
+        self.prefix = prefix
+        self._supabase = supabase
+        self._entitlements = entitlements
+        self._used: "OrderedDict[str, List[Any]]" = OrderedDict()  # user → [día, tokens, mensajes] (LRU)
+        self._quotas: Dict[str, Tuple[float, Quota]] = {}        # user → (vence, cuota)
+        self._pending: Dict[Tuple[str, str], List[int]] = {}     # (user, día) → [prompt, completion, mensajes]
+        self._failures: Dict[Tuple[str, str], int] = {}         # (user, día) → RPCs fallidos seguidos
+        self._next_prune = time.monotonic() + prune_s
+        self._loading: Set[str] = set()
+        self._tasks: Set["asyncio.Task[None]"] = set()
+        self._flusher: Optional["asyncio.Task[None]"] = None
+        self._persist = True  # pasa a False si no hay Supabase: no se acumulan pendientes
+        self._r = None
+        if redis_url:
+            import redis.asyncio as aioredis
+
+            self._r = aioredis.from_url(redis_url)
+        self.stats = MeterStats()
+
+    # --------- hot path ---------
+    def _usage_today(self, user: str) -> List[Any]:
+        day = _today()
+        used = self._used.get(user)
+        if used is None or used[0] != day:
+            used = self._used[user] = [day, 0, 0]
+            if self._r is not None or _persistable(user):
+                self._spawn(self._load_baseline(user, day))
+            while len(self._used) > self.max_users:  # uno por IP/usuario distinto: acotado
+                self._used.popitem(last=False)
+        self._used.move_to_end(user)
+        return used
+
+    def _quota(self, user: str) -> Quota:
+        item = self._quotas.get(user)
+        if (item is None or item[0] <= time.monotonic()) and user not in self._loading:
+            self._loading.add(user)
+            self._spawn(self._load_quota(user))
+        return item[1] if item is not None else self.default_quota
+
+    def check(self, user: str) -> None:
+        """O(1) y sin await: solo contadores y cuotas ya en memoria. QuotaExceeded si no hay saldo."""
+        self.stats.checks += 1
+        if time.monotonic() >= self._next_prune:
+            self._prune()  # con o sin persistencia: días viejos y cuotas vencidas
+        used = self._usage_today(user)
+        quota = self._quota(user)
+        if quota.tokens and used[1] >= quota.tokens:
+            self.stats.rejected += 1
+            raise QuotaExceeded(_until_midnight(), f"{used[1]}/{quota.tokens} tokens hoy")
+        if quota.messages and used[2] >= quota.messages:
+            self.stats.rejected += 1
+            raise QuotaExceeded(_until_midnight(), f"{used[2]}/{quota.messages} mensajes hoy")
+
+    async def settle(self, charge: Charge) -> None:
+        if charge.settled:
+            return
+        charge.settled = True
+        prompt, completion = charge.tokens()
+        st = self.stats
+        st.settled += 1
+        st.prompt_tokens += prompt
+        st.completion_tokens += completion
+        if charge.usage is not None:
+            st.provider_usage += 1
+        else:
+            st.estimated += 1
+        user, total = charge.user, prompt + completion
+        logger.debug("[metering] %s %s: %d+%d tokens (%s)", charge.route, user, prompt, completion,
+                     "usage" if charge.usage is not None else "tokenizer")
+        used = self._usage_today(user)
+        used[1] += total
+        used[2] += 1
+        if self._persist and _persistable(user):
+            p = self._pending.setdefault((user, used[0]), [0, 0, 0])
+            p[0] += prompt
+            p[1] += completion
+            p[2] += 1
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(self._flush_loop())
+        if self._r is not None:
+            key = f"{self.prefix}:{used[0]}:{user}"
+            try:
+                pipe = self._r.pipeline(transaction=False)
+                pipe.hincrby(key, "tokens", total)
+                pipe.hincrby(key, "messages", 1)
+                pipe.expire(key, 2 * 86400)
+                tokens, messages, _ = await pipe.execute()
+                used[1], used[2] = max(used[1], int(tokens)), max(used[2], int(messages))  # totales de todas las réplicas
+            except Exception as e:
+                logger.warning("[metering] redis hincrby falló: %s", e)
+
+    # --------- cargas en segundo plano ---------
+    def _spawn(self, coro: Any) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # sin Supabase se lanza (no se devuelve None): la caché es la de billing.py y no debe guardar nada
+    def _load_entitlement(self, user: str) -> Optional[Dict[str, Any]]:
+        sb = self._supabase()
+        if sb is None:
+            raise LookupError("sin Supabase")
+        rows = sb.table("v_entitlements").select("*").eq("user_id", user).execute().data
+        return rows[0] if rows else None
+
+    def _load_free_plan(self) -> Dict[str, Any]:
+        sb = self._supabase()
+        if sb is None:
+            raise LookupError("sin Supabase")
+        rows = sb.table("plans").select("*").eq("id", "free").limit(1).execute().data
+        return free_plan_summary(rows[0] if rows else None)  # misma forma que /billing/summary
+
+    async def _load_quota(self, user: str) -> None:
+        quota = self.default_quota
+        try:
+            if self._entitlements is not None and _persistable(user):
+                ent = await self._entitlements.get(user, self._load_entitlement)
+                if ent is None:
+                    ent = await self._entitlements.free_plan(self._load_free_plan)
+                quota = Quota(
+                    tokens=int(ent.get("quota_tokens") or self.default_quota.tokens),
+                    messages=int(ent.get("quota_messages") or self.default_quota.messages),
+                )
+        except LookupError:
+            pass  # sin Supabase: cuota por defecto
+        except Exception as e:
+            logger.warning("[metering] cuota de %s no disponible, uso la por defecto: %s", user, e)
+        finally:
+            self._loading.discard(user)
+        self._quotas[user] = (time.monotonic() + self.quota_ttl_s, quota)
+
+    def _read_counters(self, user: str, day: str) -> Tuple[int, int]:
+        sb = self._supabase()
+        if sb is None:
+            return 0, 0
+        rows = (sb.table("usage_counters").select("tokens_used,messages_used")
+                .eq("user_id", user).eq("day", day).limit(1).execute().data)
+        if not rows:
+            return 0, 0
+        return int(rows[0].get("tokens_used") or 0), int(rows[0].get("messages_used") or 0)
+
+    async def _load_baseline(self, user: str, day: str) -> None:
+        """Consumo del día ya registrado (otro proceso, reinicio) sumado a los contadores locales."""
+        try:
+            if self._r is not None:
+                tokens, messages = await self._r.hmget(f"{self.prefix}:{day}:{user}", "tokens", "messages")
+                tokens, messages = int(tokens or 0), int(messages or 0)
+                used = self._used.get(user)
+                if used is not None and used[0] == day:
+                    used[1], used[2] = max(used[1], tokens), max(used[2], messages)
+                return
+            tokens, messages = await run_in_threadpool(self._read_counters, user, day)
+        except Exception as e:
+            logger.warning("[metering] consumo previo de %s no disponible: %s", user, e)
+            return
+        used = self._used.get(user)
+        if used is not None and used[0] == day:
+            used[1] += tokens
+            used[2] += messages
+
+    # --------- volcado por lotes ---------
+    async def _flush_loop(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.flush_s)
+            await self.flush()
+
+    def _write(self, rows: List[Dict[str, Any]]) -> bool:
+        sb = self._supabase()
+        if sb is None:
+            return False
+        sb.rpc("usage_increment", {"rows": rows}).execute()
+        return True
+
+    async def flush(self) -> int:
+        """
+        Vuelca los pendientes en RPCs de hasta `max_batch` filas; devuelve las filas escritas.
+
+        Si un lote falla entero, sus filas quedan "en observación" y el próximo
+        volcado las manda de a una. Una fila sola que falla mientras otras sí se
+        escriben cuenta un intento; a los `max_flush_attempts` se descarta (log de
+        error) en vez de bloquear el resto. Dos fallos seguidos sin ningún éxito
+        se toman como Supabase caído: todo vuelve al pendiente sin contar intentos.
+        """
+        batch, self._pending = self._pending, {}
+        fresh = [k for k in batch if k not in self._failures]
+        suspects = sorted((k for k in batch if k in self._failures), key=self._failures.__getitem__)
+        groups = [fresh[i:i + self.max_batch] for i in range(0, len(fresh), self.max_batch)]
+        groups += [[k] for k in suspects]
+        written, up, streak, failed = 0, False, 0, []
+        for n, group in enumerate(groups):
+            rows = [{"user_id": u, "day": d, "prompt_tokens": batch[(u, d)][0],
+                     "completion_tokens": batch[(u, d)][1], "messages": batch[(u, d)][2]} for u, d in group]
+            try:
+                if not await run_in_threadpool(self._write, rows):
+                    self._persist = False  # sin Supabase: los contadores quedan solo en memoria / Redis
+                    return written
+            except Exception as e:
+                self.stats.flush_errors += 1
+                streak += 1
+                if len(group) > 1 or (not up and streak >= 2):
+                    logger.warning("[metering] volcado de %d filas falló, se reintenta: %s", len(rows), e)
+                    for k in group:
+                        self._failures.setdefault(k, 0)
+                    self._requeue(batch, failed + [k for g in groups[n:] for k in g])
+                    return written
+                failed.append(group[0])
+                continue
+            up, streak = True, 0
+            for k in group:
+                self._failures.pop(k, None)
+            self.stats.flushes += 1
+            self.stats.flushed_rows += len(rows)
+            written += len(rows)
+        for k in failed:  # Supabase respondió: el problema es la fila
+            self._failures[k] += 1
+            if self._failures[k] >= self.max_flush_attempts:
+                del self._failures[k]
+                self.stats.dropped_rows += 1
+                logger.error("[metering] fila de uso %s/%s descartada tras %d intentos: %s",
+                             k[0], k[1], self.max_flush_attempts, batch[k])
+            else:
+                self._requeue(batch, [k])
+        return written
+
+    def _requeue(self, batch: Dict[Tuple[str, str], List[int]], keys: List[Tuple[str, str]]) -> None:
+        for k in keys:  # vuelven al pendiente (sumando lo llegado mientras tanto)
+            p = self._pending.setdefault(k, [0, 0, 0])
+            for j in range(3):
+                p[j] += batch[k][j]
+
+    def _prune(self) -> None:
+        day, now = _today(), time.monotonic()
+        self._next_prune = now + self.prune_s
+        for user in [u for u, used in self._used.items() if used[0] != day]:
+            del self._used[user]
+        for user in [u for u, (exp, _) in self._quotas.items() if exp <= now]:
+            del self._quotas[user]
+
+    async def aclose(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._pending:
+            await self.flush()
+        if self._r is not None:
+            await self._r.aclose()
+
+
+# --------- helpers para las rutas ---------
+def enforce(meter: Optional[UsageMeter], request: Request, route: str,
+            prompt_tokens: int = 0, model: Optional[str] = None) -> Optional[Charge]:
+    """429 + Retry-After si el usuario agotó su cuota; si no, abre el Charge del request."""
+    if meter is None:
+        return None
+    user = meter_key(request)
+    try:
+        meter.check(user)
+    except QuotaExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Cuota diaria agotada: {e.reason}",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    charge = Charge(user, route, prompt_tokens, model)
+    _CURRENT.set(charge)  # visible para las tareas creadas desde acá (single-flight, hedge)
+    return charge
+
+
+async def settle(meter: Optional[UsageMeter], charge: Optional[Charge], text: Optional[str] = None) -> None:
+    """Respuestas no-stream: `text` = lo entregado (fallback si no hubo usage)."""
+    if meter is None or charge is None:
+        return
+    if text:
+        charge.add(text)
+    await meter.settle(charge)
+
+
+def metered(meter: Optional[UsageMeter], charge: Optional[Charge], source: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """Envuelve el stream del request: guarda lo entregado y liquida al terminar o cortarse."""
+    if meter is None or charge is None:
+        return source
+    return _metered(meter, charge, source)
+
+
+async def _metered(meter: UsageMeter, charge: Charge, source: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    try:
+        async for item in source:
+            charge.add(item)
+            yield item
+    finally:
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        await meter.settle(charge)
+
+
+def build_meter(settings: Any, supabase: Callable[[], Any]) -> Optional[UsageMeter]:
+    if not settings.METERING_ENABLED:
+        return None
+    return UsageMeter(
+        Quota(settings.QUOTA_DAILY_TOKENS, settings.QUOTA_DAILY_MESSAGES),
+        supabase=supabase,
+        entitlements=get_entitlements(),
+        flush_s=settings.METERING_FLUSH_S,
+        max_batch=settings.METERING_FLUSH_MAX_ROWS,
+        redis_url=settings.REDIS_URL if settings.METERING_BACKEND == "redis" else None,
+    )
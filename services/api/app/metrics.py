@@ -0,0 +1,357 @@
+# services/api/app/metrics.py
+"""
+Métricas Prometheus (GET /metrics).
+
+  - chatmig_http_request_duration_seconds{route,method,status}: latencia por
+    plantilla de ruta (/llm/complete/stream, no la URL cruda) hasta el último
+    byte; en streams incluye toda la generación.
+  - chatmig_llm_ttft_seconds / chatmig_llm_tokens_per_second{provider,model}:
+    por stream upstream (vía prompt_cache.UsageTracker.done).
+  - chatmig_rag_latency_seconds{stage,backend}: embedding y búsqueda (índice
+    local o RPC match_knowledge).
+  - chatmig_streams_in_flight{route}: streams abiertos hacia el cliente.
+  - chatmig_upstream_errors_total{provider,kind}: kind ∈ ERROR_KINDS.
+  - chatmig_agent_sessions / _messages / _bytes: memoria de sesión, leída al
+    momento del scrape (cero costo en el request).
+  - chatmig_oauth_token_refreshes{provider,source} y
+    chatmig_oauth_token_refresh_seconds{provider}: renovaciones del token
+    OAuth (app.oauth_tokens); source=fetch llamó al proveedor, shared lo tomó
+    de Redis.
+  - chatmig_summary_prompt_tokens{kind}: tokens de prompt por turno del agente;
+    kind=sent lo enviado, saved lo que el resumen evitó reenviar.
+  - chatmig_summary_folds{result}: pliegues del resumen; result ∈ FOLD_RESULTS.
+
+Pensado para el hot path: los hijos de cada label set se crean una vez y se
+guardan en un dict (`.labels()` valida y arma la tupla en cada llamada), y
+nada se toca por chunk: los contadores por chunk son atributos del tracker
+del stream y se observan una sola vez al terminar. Cada observe() de
+prometheus_client toma un lock propio, así que queda 1-2 por request.
+
+prometheus_client es opcional: sin él (o con METRICS_ENABLED=false) todo es
+no-op y /metrics responde 503.
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    from prometheus_client import disable_created_metrics
+    from prometheus_client.core import GaugeMetricFamily
+    disable_created_metrics()  # sin series *_created: la mitad de líneas por scrape
+    HAS_PROMETHEUS = True
+except ImportError:  # pragma: no cover - depende del entorno
+    HAS_PROMETHEUS = False
+
+UNMATCHED = "<unmatched>"
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+ERROR_KINDS = ("timeout", "connect", "rate_limit", "http_4xx", "http_5xx", "stream", "other")
+FOLD_RESULTS = ("ok", "conflict", "error")
+
+# buckets: latencias de API (ms a minutos de stream), TTFT y ritmo de generación
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30)
+TPS_BUCKETS = (5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+RAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class _Noop:
+    def observe(self, amount: float) -> None:
+        pass
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+
+_NOOP = _Noop()
+
+
+class _Family:
+    """Hijos de un metric con labels, creados una vez por combinación."""
+
+    __slots__ = ("metric", "children", "off")
+
+    def __init__(self, metric: Any):
+        self.metric = metric
+        self.children: Dict[Tuple[str, ...], Any] = {}
+        self.off = metric is None
+
+    def __call__(self, *labels: str) -> Any:
+        if self.off:
+            return _NOOP
+        child = self.children.get(labels)
+        if child is None:
+            child = self.children[labels] = self.metric.labels(*labels)
+        return child
+
+
+REGISTRY = CollectorRegistry() if HAS_PROMETHEUS else None
+
+
+def _metric(kind: str, name: str, doc: str, labels: Tuple[str, ...], **kw: Any) -> _Family:
+    if not HAS_PROMETHEUS:
+        return _Family(None)
+    cls = {"histogram": Histogram, "counter": Counter, "gauge": Gauge}[kind]
+    return _Family(cls(name, doc, labels, registry=REGISTRY, **kw))
+
+
+http_duration = _metric(
+    "histogram", "chatmig_http_request_duration_seconds", "Latencia por ruta hasta el último byte",
+    ("route", "method", "status"), buckets=HTTP_BUCKETS,
+)
+llm_ttft = _metric(
+    "histogram", "chatmig_llm_ttft_seconds", "Tiempo hasta el primer delta del proveedor",
+    ("provider", "model"), buckets=TTFT_BUCKETS,
+)
+llm_tps = _metric(
+    "histogram", "chatmig_llm_tokens_per_second", "Tokens de salida por segundo tras el primer delta",
+    ("provider", "model"), buckets=TPS_BUCKETS,
+)
+llm_tokens = _metric(
+    "counter", "chatmig_llm_completion_tokens", "Tokens de salida de streams completos", ("provider", "model"),
+)
+rag_latency = _metric(
+    "histogram", "chatmig_rag_latency_seconds", "Latencia de recuperación RAG",
+    ("stage", "backend"), buckets=RAG_BUCKETS,
+)
+streams_in_flight = _metric(
+    "gauge", "chatmig_streams_in_flight", "Streams abiertos hacia el cliente", ("route",),
+)
+upstream_errors = _metric(
+    "counter", "chatmig_upstream_errors", "Errores de llamadas a proveedores por tipo", ("provider", "kind"),
+)
+oauth_refreshes = _metric(
+    "counter", "chatmig_oauth_token_refreshes", "Renovaciones de token OAuth por origen", ("provider", "source"),
+)
+oauth_refresh_latency = _metric(
+    "histogram", "chatmig_oauth_token_refresh_seconds", "Latencia del endpoint de token OAuth",
+    ("provider",), buckets=RAG_BUCKETS,
+)
+summary_tokens = _metric(
+    "counter", "chatmig_summary_prompt_tokens", "Tokens de prompt del agente enviados y ahorrados por el resumen",
+    ("kind",),
+)
+summary_folds = _metric(
+    "counter", "chatmig_summary_folds", "Pliegues del resumen de sesión por resultado", ("result",),
+)
+
+_enabled = HAS_PROMETHEUS
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def configure(on: bool) -> None:
+    """METRICS_ENABLED=false: todos los hijos pasan a no-op."""
+    global _enabled
+    _enabled = on and HAS_PROMETHEUS
+    for fam in (http_duration, llm_ttft, llm_tps, llm_tokens, rag_latency, streams_in_flight, upstream_errors,
+                oauth_refreshes, oauth_refresh_latency, summary_tokens, summary_folds):
+        fam.off = not _enabled
+
+
+# --------- Preasignación ---------
+_ROUTES: Dict[Any, str] = {}  # endpoint → plantilla de ruta
+
+
+def preallocate(app: Any, providers: Iterable[Tuple[str, str]] = ()) -> None:
+    """
+    Crea de antemano los hijos de cada ruta×método×status y de cada
+    proveedor×modelo conocido: el primer request no paga `.labels()` y las
+    series aparecen en /metrics (en 0) desde el arranque.
+    """
+    for route in getattr(app, "routes", ()):
+        endpoint = getattr(route, "endpoint", None)
+        path = getattr(route, "path", None)
+        if endpoint is None or path is None:
+            continue
+        _ROUTES[endpoint] = path
+        if not getattr(route, "include_in_schema", True):
+            continue  # /docs, /openapi.json, /metrics: se crean si alguien los pide
+        for method in getattr(route, "methods", None) or ("GET",):
+            if method == "HEAD":
+                continue
+            for status in ("2xx", "4xx", "5xx"):
+                http_duration(path, method, status)
+    for provider, model in providers:
+        llm_ttft(provider, model)
+        llm_tps(provider, model)
+        llm_tokens(provider, model)
+        for kind in ERROR_KINDS:
+            upstream_errors(provider, kind)
+    for stage, backend in (("embed", "openai"), ("search", "local"), ("search", "supabase")):
+        rag_latency(stage, backend)
+    for kind in ("sent", "saved"):
+        summary_tokens(kind)
+    for result in FOLD_RESULTS:
+        summary_folds(result)
+
+
+def route_of(scope: Dict[str, Any]) -> str:
+    # Starlette deja `endpoint` en el scope al resolver la ruta (mismo dict que ve el middleware)
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return UNMATCHED
+    path = _ROUTES.get(endpoint)
+    if path is None:
+        route = scope.get("route")
+        path = _ROUTES[endpoint] = getattr(route, "path", None) or getattr(endpoint, "__name__", UNMATCHED)
+    return path
+
+
+class MetricsMiddleware:
+    """ASGI puro (no BaseHTTPMiddleware: ese bufferiza y rompe el streaming)."""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not _enabled:
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_status(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            http_duration(route_of(scope), scope["method"], STATUS_CLASSES[min(max(status // 100, 1), 5) - 1]).observe(
+                time.perf_counter() - t0
+            )
+
+
+# --------- Hot path ---------
+def observe_stream(provider: str, model: Optional[str], ttft: Optional[float], tokens: int, gen_s: float) -> None:
+    """Un stream upstream completo: TTFT y tokens/s desde el primer delta."""
+    model = model or "default"
+    if ttft is not None:
+        llm_ttft(provider, model).observe(ttft)
+    if tokens:
+        llm_tokens(provider, model).inc(tokens)
+        if tokens > 1 and gen_s > 0:
+            llm_tps(provider, model).observe(tokens / gen_s)
+
+
+def status_kind(status: int) -> str:
+    if status == 429:
+        return "rate_limit"
+    return "http_5xx" if status >= 500 else "http_4xx"
+
+
+def error_kind(exc: BaseException) -> str:
+    """Clase de error acotada (labels fijos): timeout, connect, 429, 4xx, 5xx, error en el stream, otro."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status_kind(status)
+    name = type(exc).__name__
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in name:
+        return "timeout"  # httpx.*Timeout, openai.APITimeoutError
+    if "Connect" in name or isinstance(exc, ConnectionError):
+        return "connect"  # httpx.ConnectError, openai.APIConnectionError
+    if name == "ProviderStreamError":
+        msg = str(exc)
+        if msg[:5] == "HTTP " and msg[5:8].isdigit():  # iter_deltas: "HTTP <status>: ..."
+            return status_kind(int(msg[5:8]))
+        return "stream"
+    return "other"
+
+
+def upstream_error(provider: str, exc: BaseException) -> None:
+    upstream_errors(provider, error_kind(exc)).inc()
+
+
+def observe_token_refresh(provider: str, source: str, seconds: Optional[float] = None) -> None:
+    oauth_refreshes(provider, source).inc()
+    if seconds is not None:
+        oauth_refresh_latency(provider).observe(seconds)
+
+
+def observe_summary_turn(prompt_tokens: int, saved_tokens: int) -> None:
+    summary_tokens("sent").inc(prompt_tokens)
+    if saved_tokens:
+        summary_tokens("saved").inc(saved_tokens)
+
+
+def summary_fold(result: str) -> None:
+    summary_folds(result).inc()
+
+
+class RagTimer:
+    """`with RagTimer("search", "local"):` → observa la duración del bloque si no falló."""
+
+    __slots__ = ("child", "t0")
+
+    def __init__(self, stage: str, backend: str):
+        self.child = rag_latency(stage, backend)
+
+    def __enter__(self) -> "RagTimer":
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: Any, *exc: Any) -> None:
+        if exc_type is None:  # los errores van a chatmig_upstream_errors_total
+            self.child.observe(time.perf_counter() - self.t0)
+
+
+# --------- Scrape ---------
+class _SessionMemoryCollector:
+    """Sesiones, mensajes y bytes guardados; se calcula en el scrape, no en el request."""
+
+    def __init__(self, memory: Any):
+        self.memory = memory
+
+    def collect(self):
+        sessions = GaugeMetricFamily("chatmig_agent_sessions", "Sesiones del agente en memoria", labels=["backend"])
+        messages = GaugeMetricFamily("chatmig_agent_session_messages", "Mensajes guardados", labels=["backend"])
+        size = GaugeMetricFamily("chatmig_agent_session_bytes", "Bytes de contenido guardados (UTF-8 aprox.)",
+                                 labels=["backend"])
+        backend = type(self.memory).__name__
+        usage = getattr(self.memory, "usage", None)
+        if usage is not None:  # solo el backend en proceso: Redis/SQL se miden en su propio servidor
+            n_sessions, n_messages, n_bytes = usage()
+            sessions.add_metric([backend], n_sessions)
+            messages.add_metric([backend], n_messages)
+            size.add_metric([backend], n_bytes)
+        yield sessions
+        yield messages
+        yield size
+
+
+_memory_collector: Optional[Any] = None
+
+
+def register_session_memory(memory: Any) -> None:
+    global _memory_collector
+    if not HAS_PROMETHEUS:
+        return
+    if _memory_collector is not None:
+        REGISTRY.unregister(_memory_collector)
+    _memory_collector = _SessionMemoryCollector(memory)
+    REGISTRY.register(_memory_collector)
+
+
+def render() -> Tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def metrics_response() -> Any:
+    from fastapi.responses import PlainTextResponse, Response
+
+    if not _enabled:
+        return PlainTextResponse("métricas desactivadas (METRICS_ENABLED=false o sin prometheus_client)", 503)
+    body, content_type = render()
+    return Response(body, media_type=content_type)
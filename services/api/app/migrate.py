@@ -0,0 +1,16 @@
+# services/api/app/migrate.py
+"""
+Migración explícita del esquema: `python -m app.migrate` (una vez por deploy,
+antes de levantar la API). Los routers ya no crean tablas al importarse, así
+que el arranque en frío no abre la base ni carga SQLAlchemy.
+"""
+from .db import DATABASE_URL, create_schema
+
+
+def main() -> None:
+    tables = create_schema()
+    print(f"[db] {DATABASE_URL.split('@')[-1]} · tablas: {', '.join(tables)}")
+
+
+if __name__ == "__main__":
+    main()
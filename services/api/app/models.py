@@ -17,3 +17,17 @@ class ConversationExample(Base):
     message = Column(String, nullable=False)
     label = Column(Integer, default=0)  # 1 si éxito, 0 si no
     p_success = Column(Float, default=0.5)
+
+class AgentMessage(Base):
+    __tablename__ = "agent_messages"
+    id = Column(Integer, primary_key=True)
+    session_id = Column(String, nullable=False, index=True)
+    role = Column(String, nullable=False)
+    content = Column(String, nullable=False)
+    created_at = Column(Float, nullable=False, index=True)  # epoch (s), para TTL
+
+class AgentSummary(Base):
+    __tablename__ = "agent_summaries"
+    session_id = Column(String, primary_key=True)
+    content = Column(String, nullable=False)  # app.session_memory.Summary serializado
+    updated_at = Column(Float, nullable=False, index=True)
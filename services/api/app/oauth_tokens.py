@@ -0,0 +1,228 @@
+# services/api/app/oauth_tokens.py
+"""
+Token OAuth (client_credentials) compartido: hoy el de PayPal (payments/paypal.py).
+
+  - Single-flight: con el token vencido, los requests concurrentes esperan un
+    asyncio.Lock y solo el primero llama al endpoint de token; el resto
+    reusa el resultado.
+  - Renovación proactiva: pasado `refresh_at` (expires_in - refresh_ahead_s,
+    nunca antes de la mitad de la vida) `get` devuelve el token vigente y
+    lanza una sola renovación en segundo plano. Si falla, se reintenta en el
+    próximo `get` y el token sigue sirviendo hasta `exp - skew_s`.
+  - Redis opcional (PAYPAL_TOKEN_BACKEND=redis + REDIS_URL): el token vive en
+    {prefix}:{name} para todos los workers/réplicas. Para renovar se toma un
+    lock distribuido (SET NX PX). Quien no lo gana espera a que aparezca el
+    token nuevo; si no aparece en `lock_wait_s`, pide uno propio.
+  - Métricas: chatmig_oauth_token_refreshes{provider,source} y
+    chatmig_oauth_token_refresh_seconds{provider} en app.metrics, más
+    `stats` para /healthz/paypal_token.
+
+Los tiempos de vencimiento son de reloj (time.time()) porque se comparten
+entre procesos.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from . import metrics
+
+logger = logging.getLogger("chatmig.oauth")
+
+Fetch = Callable[[], Awaitable[Tuple[str, float]]]  # → (access_token, expires_in en segundos)
+
+
+@dataclass(frozen=True)
+class Token:
+    value: str
+    exp: float          # vence (reloj)
+    refresh_at: float   # desde acá se renueva en segundo plano
+
+    def dumps(self) -> str:
+        return json.dumps({"value": self.value, "exp": self.exp, "refresh_at": self.refresh_at})
+
+    @classmethod
+    def loads(cls, raw: Any) -> Optional["Token"]:
+        return cls(**json.loads(raw)) if raw else None
+
+
+@dataclass
+class TokenStats:
+    gets: int = 0
+    refreshes: int = 0         # llamadas reales al endpoint de token
+    shared: int = 0            # tokens tomados de Redis (los renovó otra réplica)
+    proactive: int = 0         # renovaciones en segundo plano antes del vencimiento
+    waited: int = 0            # callers que esperaron una renovación en curso
+    failures: int = 0
+    refresh_s_total: float = 0.0
+    refresh_s_max: float = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "gets": self.gets,
+            "refreshes": self.refreshes,
+            "shared": self.shared,
+            "proactive": self.proactive,
+            "waited": self.waited,
+            "failures": self.failures,
+            "refresh_ms_avg": round(1000 * self.refresh_s_total / self.refreshes, 1) if self.refreshes else None,
+            "refresh_ms_max": round(1000 * self.refresh_s_max, 1),
+        }
+
+
+class TokenManager:
+    def __init__(
+        self,
+        name: str,
+        fetch: Fetch,
+        *,
+        skew_s: float = 30.0,
+        refresh_ahead_s: float = 300.0,
+        redis_url: Optional[str] = None,
+        prefix: str = "chatmig:oauth",
+        lock_ttl_s: float = 15.0,
+        lock_wait_s: float = 10.0,
+    ):
+        self.name = name
+        self.skew_s = skew_s
+        self.refresh_ahead_s = refresh_ahead_s
+        self.lock_ttl_s = lock_ttl_s
+        self.lock_wait_s = lock_wait_s
+        self._fetch = fetch
+        self._key = f"{prefix}:{name}"
+        self._token: Optional[Token] = None
+        self._lock = asyncio.Lock()
+        self._background: Optional["asyncio.Task[None]"] = None
+        self._r = None
+        if redis_url:
+            import redis.asyncio as aioredis
+
+            self._r = aioredis.from_url(redis_url)
+        self.stats = TokenStats()
+
+    def _usable(self, tok: Optional[Token], now: float) -> bool:
+        return tok is not None and now < tok.exp - self.skew_s
+
+    async def get(self) -> str:
+        self.stats.gets += 1
+        tok, now = self._token, time.time()
+        if self._usable(tok, now):
+            if now >= tok.refresh_at and (self._background is None or self._background.done()):
+                self._background = asyncio.create_task(self._refresh_ahead(tok))
+            return tok.value
+        if self._lock.locked():
+            self.stats.waited += 1
+        async with self._lock:
+            tok = self._token
+            if not self._usable(tok, time.time()):  # quien tenía el lock ya lo renovó
+                tok = await self._refresh()
+            return tok.value
+
+    async def invalidate(self, value: Optional[str] = None) -> None:
+        """Tras un 401: descarta el token (si sigue siendo `value`) para que el próximo get renueve."""
+        if self._token is not None and (value is None or self._token.value == value):
+            self._token = None
+            if self._r is not None:
+                try:
+                    raw = await self._r.get(self._key)
+                    shared = Token.loads(raw)
+                    if shared is not None and (value is None or shared.value == value):
+                        await self._r.delete(self._key)
+                except Exception as e:
+                    logger.warning("[oauth] %s: redis delete falló: %s", self.name, e)
+
+    async def _refresh_ahead(self, seen: Token) -> None:
+        try:
+            async with self._lock:
+                if self._token is not seen:  # otro camino ya lo renovó
+                    return
+                self.stats.proactive += 1
+                await self._refresh()
+        except Exception as e:
+            logger.warning("[oauth] %s: renovación anticipada falló (el token vigente sigue): %s", self.name, e)
+
+    # --------- bajo self._lock ---------
+    async def _refresh(self) -> Token:
+        if self._r is None:
+            return await self._fetch_new()
+        shared = await self._read_shared()
+        if shared is not None and time.time() < shared.refresh_at:
+            return self._adopt(shared)
+        owner = uuid.uuid4().hex
+        if await self._try_lock(owner):
+            try:
+                return await self._fetch_new()
+            finally:
+                await self._unlock(owner)
+        # otra réplica está renovando: esperar su token
+        deadline = time.monotonic() + self.lock_wait_s
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            shared = await self._read_shared()
+            if shared is not None and time.time() < shared.refresh_at:
+                return self._adopt(shared)
+        logger.warning("[oauth] %s: sin token compartido tras %.0fs, pido uno propio", self.name, self.lock_wait_s)
+        return await self._fetch_new()
+
+    def _adopt(self, tok: Token) -> Token:
+        self.stats.shared += 1
+        metrics.observe_token_refresh(self.name, "shared")
+        self._token = tok
+        return tok
+
+    async def _fetch_new(self) -> Token:
+        t0 = time.perf_counter()
+        try:
+            value, expires_in = await self._fetch()
+        except Exception:
+            self.stats.failures += 1
+            raise
+        elapsed = time.perf_counter() - t0
+        st = self.stats
+        st.refreshes += 1
+        st.refresh_s_total += elapsed
+        st.refresh_s_max = max(st.refresh_s_max, elapsed)
+        metrics.observe_token_refresh(self.name, "fetch", elapsed)
+        now = time.time()
+        life = float(expires_in)
+        tok = Token(value, now + life, now + max(life - self.refresh_ahead_s, life / 2))
+        self._token = tok
+        if self._r is not None:
+            try:
+                await self._r.set(self._key, tok.dumps(), px=max(1, int(1000 * (life - self.skew_s))))
+            except Exception as e:
+                logger.warning("[oauth] %s: redis set falló: %s", self.name, e)
+        return tok
+
+    async def _read_shared(self) -> Optional[Token]:
+        try:
+            return Token.loads(await self._r.get(self._key))
+        except Exception as e:
+            logger.warning("[oauth] %s: redis get falló: %s", self.name, e)
+            return None
+
+    async def _try_lock(self, owner: str) -> bool:
+        try:
+            return bool(await self._r.set(f"{self._key}:lock", owner, nx=True, px=int(1000 * self.lock_ttl_s)))
+        except Exception as e:
+            logger.warning("[oauth] %s: redis lock falló, renuevo sin lock: %s", self.name, e)
+            return True
+
+    async def _unlock(self, owner: str) -> None:
+        try:
+            current = await self._r.get(f"{self._key}:lock")
+            if current is not None and (current.decode() if isinstance(current, bytes) else current) == owner:
+                await self._r.delete(f"{self._key}:lock")  # solo el dueño; si venció, lo libera el PX
+        except Exception as e:
+            logger.warning("[oauth] %s: redis unlock falló: %s", self.name, e)
+
+    async def aclose(self) -> None:
+        if self._background is not None:
+            self._background.cancel()
+        if self._r is not None:
+            await self._r.aclose()
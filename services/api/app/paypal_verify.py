@@ -0,0 +1,158 @@
+# services/api/app/paypal_verify.py
+"""
+Verificación local de la firma de webhooks de PayPal (payments/paypal.py).
+
+PayPal firma `transmission_id|transmission_time|webhook_id|crc32(body)` (CRC32
+decimal sin signo del cuerpo crudo) con la clave del certificado en
+`paypal-cert-url`. Acá:
+
+  - La URL del certificado tiene que ser https y de un host permitido
+    (PAYPAL_CERT_HOSTS; por defecto api.paypal.com / api.sandbox.paypal.com
+    y sus variantes api-m). Si no, se rechaza sin descargar nada.
+  - Los certificados se cachean por URL (LRU acotado) hasta su not_valid_after
+    o `ttl_s`, lo que venza antes. Descargas concurrentes de la misma URL
+    comparten un solo GET (single_flight). Un certificado fuera de vigencia
+    no se acepta.
+  - `verify` devuelve False solo si la firma no coincide. Si la verificación
+    local no es posible (sin `cryptography`, algoritmo desconocido, descarga
+    fallida) lanza LocalVerifyUnavailable y el webhook cae al
+    verify-webhook-signature remoto.
+"""
+from __future__ import annotations
+
+import base64
+import datetime as dt
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .single_flight import SingleFlight
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    HAS_CRYPTOGRAPHY = True
+except ImportError:  # pragma: no cover - depende del entorno
+    HAS_CRYPTOGRAPHY = False
+
+logger = logging.getLogger("chatmig.paypal_verify")
+
+DEFAULT_CERT_HOSTS = ("api.paypal.com", "api-m.paypal.com", "api.sandbox.paypal.com", "api-m.sandbox.paypal.com")
+
+_HASHES = {"SHA256withRSA": "SHA256", "SHA1withRSA": "SHA1", "SHA512withRSA": "SHA512"}
+
+Fetcher = Callable[[str], Awaitable[bytes]]
+
+
+class CertNotAllowed(Exception):
+    """paypal-cert-url fuera de la allowlist: la firma se da por inválida."""
+
+
+class LocalVerifyUnavailable(Exception):
+    """No se puede verificar localmente: usar la verificación remota."""
+
+
+def signed_message(transmission_id: str, transmission_time: str, webhook_id: str, body: bytes) -> bytes:
+    return f"{transmission_id}|{transmission_time}|{webhook_id}|{zlib.crc32(body) & 0xFFFFFFFF}".encode()
+
+
+@dataclass
+class VerifyStats:
+    verified: int = 0
+    invalid: int = 0
+    unavailable: int = 0       # cayeron a la verificación remota
+    cert_hits: int = 0
+    cert_fetches: int = 0
+    rejected_hosts: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.__dict__)
+
+
+class PayPalVerifier:
+    def __init__(
+        self,
+        fetch: Fetcher,
+        *,
+        allowed_hosts: Iterable[str] = DEFAULT_CERT_HOSTS,
+        max_certs: int = 32,
+        ttl_s: float = 24 * 3600,
+    ):
+        self._fetch = fetch
+        self.allowed_hosts = frozenset(h.strip().lower() for h in allowed_hosts if h.strip())
+        self.max_certs = max_certs
+        self.ttl_s = ttl_s
+        self._certs: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()  # url → (vence, certificado)
+        self._flights = SingleFlight()
+        self.stats = VerifyStats()
+
+    def _check_url(self, url: str) -> None:
+        parts = urlsplit(url or "")
+        if parts.scheme != "https" or (parts.hostname or "").lower() not in self.allowed_hosts or parts.port not in (None, 443):
+            self.stats.rejected_hosts += 1
+            raise CertNotAllowed(f"paypal-cert-url no permitido: {url!r}")
+
+    async def _load(self, url: str) -> Any:
+        self.stats.cert_fetches += 1
+        try:
+            pem = await self._fetch(url)
+            cert = x509.load_pem_x509_certificate(pem)
+        except Exception as e:
+            raise LocalVerifyUnavailable(f"certificado {url}: {e}") from e
+        now = dt.datetime.now(dt.timezone.utc)
+        if not (cert.not_valid_before_utc <= now < cert.not_valid_after_utc):
+            raise CertNotAllowed(f"certificado fuera de vigencia: {url}")
+        expires = time.monotonic() + min(self.ttl_s, (cert.not_valid_after_utc - now).total_seconds())
+        self._certs[url] = (expires, cert)
+        self._certs.move_to_end(url)
+        while len(self._certs) > self.max_certs:
+            self._certs.popitem(last=False)
+        return cert
+
+    async def certificate(self, url: str) -> Any:
+        self._check_url(url)
+        item = self._certs.get(url)
+        if item is not None and item[0] > time.monotonic():
+            self.stats.cert_hits += 1
+            self._certs.move_to_end(url)
+            return item[1]
+        self._certs.pop(url, None)
+        return await self._flights.do(url, lambda: self._load(url))
+
+    async def verify(self, headers: Mapping[str, Optional[str]], body: bytes, webhook_id: str) -> bool:
+        """True/False según la firma; CertNotAllowed cuenta como False."""
+        if not HAS_CRYPTOGRAPHY:
+            self.stats.unavailable += 1
+            raise LocalVerifyUnavailable("cryptography no instalado")
+        algo = _HASHES.get(headers.get("paypal-auth-algo") or "")
+        tid, ttime, sig = (headers.get("paypal-transmission-id"), headers.get("paypal-transmission-time"),
+                           headers.get("paypal-transmission-sig"))
+        if algo is None:
+            self.stats.unavailable += 1
+            raise LocalVerifyUnavailable(f"auth_algo no soportado: {headers.get('paypal-auth-algo')!r}")
+        if not (tid and ttime and sig):
+            self.stats.invalid += 1
+            return False
+        try:
+            cert = await self.certificate(headers.get("paypal-cert-url") or "")
+        except CertNotAllowed as e:
+            logger.warning("[paypal] %s", e)
+            self.stats.invalid += 1
+            return False
+        except LocalVerifyUnavailable:
+            self.stats.unavailable += 1
+            raise
+        try:
+            cert.public_key().verify(base64.b64decode(sig), signed_message(tid, ttime, webhook_id, body),
+                                     padding.PKCS1v15(), getattr(hashes, algo)())
+        except (InvalidSignature, ValueError, TypeError):
+            self.stats.invalid += 1
+            return False
+        self.stats.verified += 1
+        return True
@@ -0,0 +1,213 @@
+# services/api/app/prompt_cache.py
+"""
+Medición del prompt caching del proveedor.
+
+OpenAI cachea solo (prefijos ≥1024 tokens idénticos); Anthropic necesita
+marcadores `cache_control`; Gemini 2.x tiene caché implícita. En todos los
+casos el ahorro depende de que el prefijo sea estable: PROMPT_LAYOUT=
+static_first pone todo lo fijo primero (ver routers y main.py).
+
+Por ruta:proveedor se acumula lo que reporta el bloque `usage`:
+  - prompt_tokens / cached_tokens (lecturas de caché) / cache_write_tokens.
+  - TTFT medio de requests con y sin hit de caché (ttft_reduction).
+  - est_input_cost_saved: ahorro estimado sobre el costo de input a precio
+    lleno (descuento de lectura por proveedor, recargo de escritura Anthropic).
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+
+from . import metering, metrics
+
+# fracción del precio de input que se ahorra por token leído de caché / que se paga de más al escribir
+CACHE_READ_DISCOUNT = {"openai": 0.5, "anthropic": 0.9, "google": 0.75}
+CACHE_WRITE_PREMIUM = {"anthropic": 0.25}
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+@dataclass
+class Usage:
+    prompt_tokens: int = 0       # input total (incluye lo leído/escrito en caché)
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def openai_usage(usage: Any) -> Optional[Usage]:
+    """Bloque `usage` de OpenAI/Mistral (dict o objeto del SDK)."""
+    if usage is None:
+        return None
+    if hasattr(usage, "model_dump"):
+        usage = usage.model_dump()
+    details = usage.get("prompt_tokens_details") or {}
+    return Usage(
+        prompt_tokens=usage.get("prompt_tokens") or 0,
+        cached_tokens=details.get("cached_tokens") or 0,
+        completion_tokens=usage.get("completion_tokens") or 0,
+    )
+
+
+def anthropic_usage(usage: Dict[str, Any]) -> Usage:
+    """`usage` de Anthropic: input_tokens NO incluye lecturas ni escrituras de caché."""
+    read = usage.get("cache_read_input_tokens") or 0
+    write = usage.get("cache_creation_input_tokens") or 0
+    return Usage(
+        prompt_tokens=(usage.get("input_tokens") or 0) + read + write,
+        cached_tokens=read,
+        cache_write_tokens=write,
+        completion_tokens=usage.get("output_tokens") or 0,
+    )
+
+
+def gemini_usage(meta: Dict[str, Any]) -> Usage:
+    return Usage(
+        prompt_tokens=meta.get("promptTokenCount") or 0,
+        cached_tokens=meta.get("cachedContentTokenCount") or 0,
+        completion_tokens=meta.get("candidatesTokenCount") or 0,
+    )
+
+
+@dataclass
+class RouteCacheStats:
+    provider: str
+    requests: int = 0
+    reported: int = 0      # requests cuyo stream trajo bloque usage
+    cache_hits: int = 0    # requests con cached_tokens > 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    completion_tokens: int = 0
+    _ttft_hit: float = 0.0
+    _n_hit: int = 0
+    _ttft_miss: float = 0.0
+    _n_miss: int = 0
+
+    def add(self, usage: Optional[Usage], ttft_s: Optional[float]) -> None:
+        self.requests += 1
+        hit = False
+        if usage is not None:
+            self.reported += 1
+            hit = usage.cached_tokens > 0
+            self.cache_hits += hit
+            self.prompt_tokens += usage.prompt_tokens
+            self.cached_tokens += usage.cached_tokens
+            self.cache_write_tokens += usage.cache_write_tokens
+            self.completion_tokens += usage.completion_tokens
+        if ttft_s is not None:
+            if hit:
+                self._ttft_hit += ttft_s
+                self._n_hit += 1
+            else:
+                self._ttft_miss += ttft_s
+                self._n_miss += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        hit_ms = 1000 * self._ttft_hit / self._n_hit if self._n_hit else None
+        miss_ms = 1000 * self._ttft_miss / self._n_miss if self._n_miss else None
+        saved = (
+            self.cached_tokens * CACHE_READ_DISCOUNT.get(self.provider, 0.0)
+            - self.cache_write_tokens * CACHE_WRITE_PREMIUM.get(self.provider, 0.0)
+        )
+        return {
+            "requests": self.requests,
+            "reported": self.reported,
+            "cache_hits": self.cache_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else None,
+            "avg_ttft_ms_hit": round(hit_ms, 1) if hit_ms is not None else None,
+            "avg_ttft_ms_miss": round(miss_ms, 1) if miss_ms is not None else None,
+            "ttft_reduction": round(1 - hit_ms / miss_ms, 4) if hit_ms is not None and miss_ms else None,
+            "est_input_cost_saved": round(saved / self.prompt_tokens, 4) if self.prompt_tokens else None,
+        }
+
+
+_STATS: Dict[str, RouteCacheStats] = {}
+
+
+def route_stats(route: str, provider: str) -> RouteCacheStats:
+    key = f"{route}:{provider}"
+    st = _STATS.get(key)
+    if st is None:
+        st = _STATS[key] = RouteCacheStats(provider)
+    return st
+
+
+def record(route: str, provider: str, usage: Optional[Usage], ttft_s: Optional[float] = None) -> None:
+    route_stats(route, provider).add(usage, ttft_s)
+    metering.report(usage)  # el mismo usage liquida la cuota del request en curso
+
+
+def stats() -> Dict[str, Any]:
+    return {key: st.as_dict() for key, st in _STATS.items()}
+
+
+class UsageTracker:
+    """
+    Un request: TTFT desde la creación hasta el primer delta y el usage que
+    llegue por el stream. `feed` sirve de `on_event` para app.sse.iter_deltas.
+    Solo se registra si el stream terminó (un corte no trae usage). Al
+    terminar también alimenta los histogramas TTFT / tokens/s de app.metrics.
+    """
+
+    def __init__(self, route: str, provider: str, model: Optional[str] = None):
+        self.route = route
+        self.provider = provider
+        self.model = model
+        self.usage: Optional[Usage] = None
+        self.ttft: Optional[float] = None
+        self.deltas = 0
+        self._t0 = time.monotonic()
+
+    def feed(self, event: str, obj: Dict[str, Any]) -> None:
+        if self.provider == "anthropic":
+            kind = obj.get("type") or event
+            if kind == "message_start":
+                self.usage = anthropic_usage((obj.get("message") or {}).get("usage") or {})
+            elif kind == "message_delta" and self.usage is not None:
+                self.usage.completion_tokens = (obj.get("usage") or {}).get("output_tokens") or 0
+        elif self.provider == "google":
+            if obj.get("usageMetadata"):
+                self.usage = gemini_usage(obj["usageMetadata"])  # acumulado: vale el último
+        elif obj.get("usage"):
+            self.usage = openai_usage(obj["usage"])
+
+    def first_token(self) -> None:
+        # se llama en cada delta: solo atributos, nada de locks por chunk
+        self.deltas += 1
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self._t0
+
+    def done(self) -> None:
+        record(self.route, self.provider, self.usage, self.ttft)
+        tokens = self.usage.completion_tokens if self.usage is not None and self.usage.completion_tokens else self.deltas
+        gen_s = time.monotonic() - self._t0 - self.ttft if self.ttft is not None else 0.0
+        metrics.observe_stream(self.provider, self.model, self.ttft, tokens, gen_s)
+
+    async def tracked(self, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        async for text in deltas:
+            self.first_token()
+            yield text
+        self.done()
+
+
+def anthropic_cached_payload(system: str, contents: list) -> Dict[str, Any]:
+    """
+    `system` como bloque con cache_control (prefijo fijo) y un segundo marcador
+    en el último turno previo al mensaje nuevo: en una conversación el prefijo
+    [system + historial] se lee de caché en el turno siguiente. Anthropic
+    ignora los marcadores si el prefijo no llega al mínimo cacheable.
+    """
+    payload: Dict[str, Any] = {}
+    if system:
+        payload["system"] = [{"type": "text", "text": system, "cache_control": EPHEMERAL}]
+    if len(contents) >= 2:
+        prev = contents[-2]
+        prev["content"] = [*prev["content"][:-1], {**prev["content"][-1], "cache_control": EPHEMERAL}]
+    payload["messages"] = contents
+    return payload
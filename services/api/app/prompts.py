@@ -0,0 +1,136 @@
+# services/api/app/prompts.py
+"""
+Plantillas de prompt (app/promps/*.txt) y bloques de estilo memoizados.
+
+  - Las plantillas se leen y validan una vez al importar (campos `{nombre}`
+    de str.format); sin campos son prefijos estables: el mismo string en
+    cada request, así el proveedor puede reutilizar su caché de prompt.
+  - Los bloques de estilo dependen solo de los campos del estilo: se
+    renderizan una vez por combinación y se guardan en un LRU acotado
+    (los estilos reales son unos pocos: defaults + presets del front).
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from operator import attrgetter
+from pathlib import Path
+from string import Formatter
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+PROMPTS_DIR = Path(__file__).resolve().parent / "promps"
+STYLE_CACHE_SIZE = 512
+
+
+class Template:
+    __slots__ = ("name", "text", "fields")
+
+    def __init__(self, name: str, text: str):
+        fields = set()
+        for _, field, spec, conv in Formatter().parse(text):
+            if field is None:
+                continue
+            if not field.isidentifier() or spec or conv:
+                raise ValueError(f"plantilla {name}: campo no soportado {{{field}}}")
+            fields.add(field)
+        self.name = name
+        self.text = text
+        self.fields: FrozenSet[str] = frozenset(fields)
+
+    def render(self, **values: Any) -> str:
+        if not self.fields:
+            return self.text
+        return self.text.format_map(values)
+
+
+def load_template(name: str, directory: Path = PROMPTS_DIR) -> Template:
+    """Lee `<name>.txt` tal cual (sin el salto de línea final del archivo)."""
+    text = (directory / f"{name}.txt").read_text(encoding="utf-8")
+    if text.endswith("\n"):
+        text = text[:-1]
+    return Template(name, text)
+
+
+TEMPLATES: Dict[str, Template] = {
+    p.stem: load_template(p.stem) for p in sorted(PROMPTS_DIR.glob("*.txt"))
+}
+
+# Prefijos estables (system prompts sin variables)
+LLM_SYSTEM = TEMPLATES["llm_system"].render()
+CHATMIG_SYSTEM = TEMPLATES["chatmig_system"].render()
+AGENT_SYSTEM = TEMPLATES["agent_system"].render()
+PLAN_RULES = TEMPLATES["plan_rules"].render()  # /plan con PROMPT_LAYOUT=static_first
+
+
+# --------- Guías de estilo (/llm y /chat/complete_stream) ---------
+STYLE_FIELDS = ("tone", "use_emojis", "length_words", "format", "audience", "language", "guidelines")
+StyleKey = Tuple[Any, ...]
+
+RISK_RESPECT = "Señala riesgos/banderas rojas y cómo gestionarlas con respeto."
+RISK_OFFICIAL = "Señala riesgos/limitaciones y cómo verificarlos con la autoridad oficial."
+
+
+# style_key(s) -> tupla hashable con los campos que afectan al texto (StyleIn de cualquier router)
+style_key = attrgetter(*STYLE_FIELDS)
+
+
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def style_guides(key: StyleKey, default_length: Optional[int] = None, risk: str = RISK_RESPECT) -> str:
+    tone, use_emojis, length_words, fmt, audience, language, guidelines = key
+    lines: list[str] = []
+    length = length_words or default_length
+    if length:
+        lines.append(f"Extensión objetivo: ~{length} palabras (±20%).")
+    if fmt:
+        lines.append(f"Estructura: usa {fmt}; evita relleno y repeticiones.")
+    if tone:
+        lines.append(f"Tono: {tone}.")
+    if audience:
+        lines.append(f"Audiencia: {audience}.")
+    if language:
+        lines.append(f"Idioma: {language}.")
+    if use_emojis is not None:
+        lines.append("Incluye emojis con moderación." if use_emojis else "No incluyas emojis.")
+    if guidelines:
+        lines.append(guidelines)
+    # Imprescindibles
+    lines.append("Explica el porqué de cada paso y da 1–2 ejemplos concretos.")
+    lines.append(risk)
+    return "\n".join(lines)
+
+
+# --------- /chat/plan ---------
+PLAN_FIELDS = ("persona", "tone", "dialect", "use_emojis", "summary_words", "script_words", "max_bullets")
+_plan_key = attrgetter(*PLAN_FIELDS)
+
+
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def _plan_render(template: str, key: StyleKey) -> str:
+    values = dict(zip(PLAN_FIELDS, key))
+    values["emojis"] = "pocos y pertinentes" if values.pop("use_emojis") else "no usar"
+    return TEMPLATES[template].render(**values)
+
+
+def plan_system(style: Any) -> str:
+    """System de /plan con el estilo intercalado (layout legacy)."""
+    return _plan_render("plan_system", _plan_key(style))
+
+
+def plan_style(style: Any) -> str:
+    """Solo la parte variable de /plan; va después de PLAN_RULES (layout static_first)."""
+    return _plan_render("plan_style", _plan_key(style))
+
+
+# --------- Agente ---------
+@lru_cache(maxsize=STYLE_CACHE_SIZE)
+def agent_style(tone: str, audience: str, length_words: str, guidelines: str) -> str:
+    return TEMPLATES["agent_style"].render(
+        tone=tone, audience=audience, length_words=length_words, guidelines=guidelines
+    )
+
+
+def stats() -> Dict[str, Any]:
+    out = {}
+    for name, fn in (("style_guides", style_guides), ("plan", _plan_render), ("agent_style", agent_style)):
+        info = fn.cache_info()
+        out[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+    return out
@@ -0,0 +1,301 @@
+# services/api/app/provider_router.py
+"""
+Enrutado entre proveedores LLM con failover por latencia y hedging.
+
+Por proveedor se lleva:
+  - EWMA del time-to-first-token (TTFT) y una ventana de muestras para el p95.
+  - Circuit breaker: tras `failure_threshold` fallos seguidos queda abierto
+    `open_s` segundos; luego deja pasar un intento (half-open) que lo cierra o
+    lo vuelve a abrir.
+
+`ProviderRouter.stream(primary, ...)`:
+  - Failover: si el proveedor falla ANTES del primer delta, se pasa al
+    siguiente (ordenados por EWMA). Después del primer delta ya no se cambia.
+  - Hedging (opcional): si el primario no dio el primer delta dentro de su p95
+    de TTFT, se arranca un backup; el primero que emite gana y el otro se
+    cancela (la cancelación cierra su stream HTTP).
+
+Un 4xx del proveedor (salvo 408/429) es culpa del request (modelo
+inexistente, payload inválido): se propaga tal cual, sin failover y sin
+contar contra el circuito; si no, unos pocos requests con un `model`
+inventado abrirían el circuito para todos.
+
+Un proveedor es cualquier `fn(conv, model, system) -> AsyncIterator[item]`.
+Los intentos escriben en una cola acotada (`queue_size`): si el cliente lee
+lento, el bombeo se frena y el stream HTTP del proveedor también
+(backpressure), en vez de acumular la respuesta entera en memoria.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import metrics
+
+logger = logging.getLogger("chatmig.router")
+
+StreamFn = Callable[[List[dict], Optional[str], str], AsyncIterator[Any]]
+
+
+class NoProviderAvailable(RuntimeError):
+    pass
+
+
+@dataclass
+class ProviderHealth:
+    name: str
+    alpha: float = 0.2
+    failure_threshold: int = 5
+    open_s: float = 30.0
+    ewma_ttft: Optional[float] = None
+    samples: Deque[float] = field(default_factory=lambda: deque(maxlen=200))
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    hedges_won: int = 0
+    hedges_lost: int = 0
+    opened_at: Optional[float] = None
+    _probing: bool = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.open_s:
+            return "half_open"
+        return "open"
+
+    def available(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        return state == "half_open" and not self._probing
+
+    def begin(self) -> None:
+        if self.state == "half_open":
+            self._probing = True  # un solo intento de prueba a la vez
+
+    def record_ttft(self, ttft: float) -> None:
+        self.samples.append(ttft)
+        self.ewma_ttft = ttft if self.ewma_ttft is None else self.alpha * ttft + (1 - self.alpha) * self.ewma_ttft
+
+    def record_success(self) -> None:
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning("[router] circuito abierto para %s (%d fallos seguidos)", self.name, self.consecutive_failures)
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Intento cancelado (perdió el hedge o se fue el cliente): no cuenta como éxito ni fallo."""
+        self._probing = False
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < 10:
+            return None
+        xs = sorted(self.samples)
+        return xs[min(len(xs) - 1, int(0.95 * len(xs)))]
+
+    def as_dict(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            "state": self.state,
+            "ewma_ttft_ms": round(1000 * self.ewma_ttft, 1) if self.ewma_ttft is not None else None,
+            "p95_ttft_ms": round(1000 * p95, 1) if p95 is not None else None,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "hedges_won": self.hedges_won,
+            "hedges_lost": self.hedges_lost,
+        }
+
+
+_END = object()
+
+
+def caller_error(exc: BaseException) -> bool:
+    """4xx por el request (no 408/429): otro proveedor no lo arregla y el proveedor no está caído."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+class _Attempt:
+    """Un stream de proveedor bombeado a una cola compartida desde su propia tarea."""
+
+    def __init__(self, name: str, agen: AsyncIterator[Any], queue: "asyncio.Queue[Tuple[str, Any, Any]]"):
+        self.name = name
+        self.started = time.monotonic()
+        self.task = asyncio.create_task(self._pump(agen, queue))
+
+    async def _pump(self, agen: AsyncIterator[Any], queue: "asyncio.Queue[Tuple[str, Any, Any]]") -> None:
+        try:
+            async for item in agen:
+                await queue.put((self.name, item, None))
+            await queue.put((self.name, _END, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.upstream_error(self.name, e)
+            await queue.put((self.name, _END, e))
+        finally:
+            aclose = getattr(agen, "aclose", None)
+            if aclose is not None:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+
+    async def cancel(self) -> None:
+        self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+
+
+class ProviderRouter:
+    def __init__(
+        self,
+        providers: Dict[str, StreamFn],
+        *,
+        failure_threshold: int = 5,
+        open_s: float = 30.0,
+        hedge_default_s: float = 2.0,
+        hedge_min_s: float = 0.25,
+        hedge_max_s: float = 8.0,
+        queue_size: int = 64,
+    ):
+        self.providers = dict(providers)
+        self.health = {
+            name: ProviderHealth(name, failure_threshold=failure_threshold, open_s=open_s) for name in providers
+        }
+        self.hedge_default_s = hedge_default_s
+        self.hedge_min_s = hedge_min_s
+        self.hedge_max_s = hedge_max_s
+        self.queue_size = queue_size
+
+    def candidates(self, primary: str, failover: bool = True) -> List[str]:
+        """Primario primero (si su circuito lo permite) y luego el resto por EWMA de TTFT."""
+        if primary not in self.providers:
+            raise NoProviderAvailable(f"Provider no configurado: {primary}")
+        order = [primary]
+        if failover:
+            rest = [n for n in self.providers if n != primary]
+            rest.sort(key=lambda n: self.health[n].ewma_ttft if self.health[n].ewma_ttft is not None else self.hedge_default_s)
+            order += rest
+        return [n for n in order if self.health[n].available()]
+
+    def hedge_deadline(self, name: str) -> float:
+        p95 = self.health[name].p95()
+        if p95 is None:
+            return self.hedge_default_s
+        return min(self.hedge_max_s, max(self.hedge_min_s, p95))
+
+    async def stream(
+        self,
+        primary: str,
+        conv: List[dict],
+        model: Optional[str],
+        system: str,
+        *,
+        failover: bool = True,
+        hedge: bool = False,
+    ) -> AsyncIterator[Any]:
+        """Items del proveedor ganador. `model` aplica solo al primario (los backups usan su modelo por defecto)."""
+        pending = self.candidates(primary, failover)
+        if not pending:
+            raise NoProviderAvailable(f"Sin proveedores disponibles (circuito abierto: {primary})")
+        queue: "asyncio.Queue[Tuple[str, Any, Any]]" = asyncio.Queue(maxsize=self.queue_size)
+        attempts: Dict[str, _Attempt] = {}
+        last_error: Optional[BaseException] = None
+        winner: Optional[str] = None
+
+        def start_next() -> Optional[str]:
+            while pending:
+                name = pending.pop(0)
+                h = self.health[name]
+                if not h.available():
+                    continue
+                h.begin()
+                attempts[name] = _Attempt(
+                    name, self.providers[name](conv, model if name == primary else None, system), queue
+                )
+                return name
+            return None
+
+        current = start_next()
+        hedge = hedge and failover
+        hedge_at = time.monotonic() + self.hedge_deadline(current) if hedge else None
+        try:
+            while attempts:
+                timeout = None
+                if winner is None and hedge_at is not None:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    name, item, err = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_at = None  # un solo backup por request
+                    backup = start_next()
+                    if backup:
+                        logger.info("[router] hedge: %s sin primer delta, arrancando %s", current, backup)
+                    continue
+                if winner is not None and name != winner:
+                    continue  # restos de un perdedor ya cancelado
+                att = attempts.get(name)
+                if att is None:
+                    continue
+                h = self.health[name]
+                if item is _END:
+                    del attempts[name]
+                    if err is None:
+                        if winner is None:  # terminó sin emitir nada
+                            h.record_ttft(time.monotonic() - att.started)
+                        h.record_success()
+                        return
+                    if caller_error(err):
+                        h.release()  # ni éxito ni fallo del proveedor
+                        raise err
+                    h.record_failure()
+                    last_error = err
+                    if winner is not None:
+                        raise err  # ya se enviaron deltas: no se puede cambiar de proveedor
+                    logger.warning("[router] %s falló antes del primer delta: %s", name, err)
+                    if not attempts:
+                        current = start_next()
+                        if current is None:
+                            raise err
+                        if hedge and hedge_at is not None:
+                            hedge_at = time.monotonic() + self.hedge_deadline(current)
+                    continue
+                if winner is None:
+                    winner = name
+                    h.record_ttft(time.monotonic() - att.started)
+                    for other in [n for n in attempts if n != name]:  # carrera de hedge: cancela al perdedor
+                        self.health[other].release()
+                        self.health[other].hedges_lost += 1
+                        h.hedges_won += 1
+                        await attempts.pop(other).cancel()
+                yield item
+            if last_error is not None:
+                raise last_error
+        finally:
+            for name, att in attempts.items():
+                self.health[name].release()
+                await att.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: h.as_dict() for name, h in self.health.items()}
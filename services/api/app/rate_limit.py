@@ -0,0 +1,327 @@
+# services/api/app/rate_limit.py
+"""
+Control de admisión hacia los proveedores LLM.
+
+Por cada entrada de `limits` ("openai:gpt-4o", "openai:*", "*") hay un
+"carril" con:
+  - Dos token buckets: requests/min (RPM) y tokens/min (TPM). Cada request
+    consume 1 del primero y (prompt estimado + max_tokens) del segundo, como
+    cuentan los proveedores.
+  - Una cola justa por usuario (x-sb-user-id, o IP si no viene): los que
+    esperan se despachan en round-robin entre usuarios, así que una ráfaga de
+    un usuario no bloquea al resto. Cola acotada por usuario y por carril.
+  - Si la cola está llena o la espera estimada supera `max_wait_s` → 429 con
+    Retry-After en vez de reventar contra el 429 del proveedor.
+
+Buckets en proceso por defecto; con RATE_LIMIT_BACKEND=redis se comparten
+entre réplicas (script Lua atómico sobre ambos buckets). La cola es siempre
+local a cada réplica.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Optional
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger("chatmig.ratelimit")
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+@dataclass(frozen=True)
+class Limits:
+    rpm: float
+    tpm: float
+
+
+class LocalBuckets:
+    """RPM + TPM en memoria; capacidad = un minuto de cuota (ráfaga máxima)."""
+
+    def __init__(self, limits: Limits):
+        self.limits = limits
+        self._r = float(limits.rpm)
+        self._t = float(limits.tpm)
+        self._ts = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        dt = now - self._ts
+        self._ts = now
+        self._r = min(self.limits.rpm, self._r + dt * self.limits.rpm / 60.0)
+        self._t = min(self.limits.tpm, self._t + dt * self.limits.tpm / 60.0)
+
+    async def try_take(self, tokens: int) -> float:
+        """0 si admitió (y consumió); si no, segundos hasta que alcance."""
+        self._refill()
+        need_t = min(tokens, self.limits.tpm)  # un request más grande que la cuota pasaría nunca
+        if self._r >= 1 and self._t >= need_t:
+            self._r -= 1
+            self._t -= need_t
+            return 0.0
+        return max((1 - self._r) * 60.0 / self.limits.rpm, (need_t - self._t) * 60.0 / self.limits.tpm)
+
+    def estimate(self, requests: int, tokens: int) -> float:
+        """Espera estimada para que entren `requests`/`tokens` más (incluye lo encolado)."""
+        self._refill()
+        return max(0.0, (requests - self._r) * 60.0 / self.limits.rpm, (tokens - self._t) * 60.0 / self.limits.tpm)
+
+
+_LUA_TAKE = """
+local now_s = redis.call('TIME')
+local now = tonumber(now_s[1]) + tonumber(now_s[2]) / 1e6
+local need = {1, tonumber(ARGV[1])}
+local cap = {tonumber(ARGV[2]), tonumber(ARGV[3])}
+local lvl = {}
+for i = 1, 2 do
+  local v = redis.call('HMGET', KEYS[i], 't', 'ts')
+  local t = tonumber(v[1]) or cap[i]
+  local ts = tonumber(v[2]) or now
+  lvl[i] = math.min(cap[i], t + math.max(0, now - ts) * cap[i] / 60)
+end
+local wait = 0
+for i = 1, 2 do
+  if lvl[i] < need[i] then wait = math.max(wait, (need[i] - lvl[i]) * 60 / cap[i]) end
+end
+for i = 1, 2 do
+  if wait == 0 then lvl[i] = lvl[i] - need[i] end
+  redis.call('HSET', KEYS[i], 't', tostring(lvl[i]), 'ts', tostring(now))
+  redis.call('EXPIRE', KEYS[i], 120)
+end
+return {tostring(wait), tostring(lvl[1]), tostring(lvl[2])}
+"""
+
+
+class RedisBuckets:
+    """Mismos buckets pero en Redis (compartidos entre réplicas). Si Redis falla, admite."""
+
+    def __init__(self, client: Any, key: str, limits: Limits):
+        self.limits = limits
+        self._redis = client
+        self._keys = [f"chatmig:rl:{key}:rpm", f"chatmig:rl:{key}:tpm"]
+        self._script = client.register_script(_LUA_TAKE)
+        self._r = float(limits.rpm)  # último nivel observado (para estimar Retry-After)
+        self._t = float(limits.tpm)
+
+    async def try_take(self, tokens: int) -> float:
+        need_t = min(tokens, self.limits.tpm)
+        try:
+            wait, r, t = await self._script(keys=self._keys, args=[need_t, self.limits.rpm, self.limits.tpm])
+        except Exception as e:
+            logger.warning("[ratelimit] redis falló, admitiendo sin límite: %s", e)
+            return 0.0
+        self._r, self._t = float(r), float(t)
+        return float(wait)
+
+    def estimate(self, requests: int, tokens: int) -> float:
+        return max(0.0, (requests - self._r) * 60.0 / self.limits.rpm, (tokens - self._t) * 60.0 / self.limits.tpm)
+
+
+@dataclass
+class _Waiter:
+    fut: "asyncio.Future[None]"
+    tokens: int
+
+
+class Lane:
+    def __init__(self, key: str, buckets: Any, per_user: int, max_queue: int, max_wait_s: float):
+        self.key = key
+        self.buckets = buckets
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.max_wait_s = max_wait_s
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()  # orden = turno round-robin
+        self._size = 0
+        self._queued_tokens = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+        # métricas
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.wait_s = 0.0
+        self.max_wait_seen_s = 0.0
+
+    async def acquire(self, user: str, tokens: int) -> float:
+        """Espera su turno y devuelve los segundos en cola; RateLimited si no hay lugar."""
+        t0 = time.monotonic()
+        if not self._size and await self.buckets.try_take(tokens) == 0:
+            self.admitted += 1
+            return 0.0
+        est = self.buckets.estimate(self._size + 1, self._queued_tokens + tokens)
+        q = self._queues.get(user)
+        if self._size >= self.max_queue:
+            self.rejected += 1
+            raise RateLimited(max(1.0, est), f"cola llena para {self.key}")
+        if q is not None and len(q) >= self.per_user:
+            self.rejected += 1
+            raise RateLimited(max(1.0, est), f"demasiadas solicitudes en cola para este usuario ({self.key})")
+        if est > self.max_wait_s:
+            self.rejected += 1
+            raise RateLimited(est, f"espera estimada {est:.0f}s para {self.key}")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        if q is None:
+            q = self._queues[user] = deque()
+        q.append(waiter)
+        self._size += 1
+        self._queued_tokens += tokens
+        self.queued += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await waiter.fut  # si el cliente se va, la cancelación marca el future y el dispatcher lo descarta
+        waited = time.monotonic() - t0
+        self.admitted += 1
+        self.wait_s += waited
+        self.max_wait_seen_s = max(self.max_wait_seen_s, waited)
+        return waited
+
+    def _pop(self, user: str, q: Deque[_Waiter]) -> _Waiter:
+        w = q.popleft()
+        self._size -= 1
+        self._queued_tokens -= w.tokens
+        if q:
+            self._queues.move_to_end(user)  # siguiente usuario
+        else:
+            del self._queues[user]
+        return w
+
+    async def _dispatch(self) -> None:
+        while self._queues:
+            user, q = next(iter(self._queues.items()))
+            head = q[0]
+            if head.fut.done():  # cancelado mientras esperaba
+                self._pop(user, q)
+                continue
+            wait = await self.buckets.try_take(head.tokens)
+            if wait > 0:
+                await asyncio.sleep(min(wait, 1.0))
+                continue
+            self._pop(user, q)
+            if not head.fut.done():
+                head.fut.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue": self._size,
+            "users_waiting": len(self._queues),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(1000 * self.wait_s / self.queued, 1) if self.queued else None,
+            "max_wait_ms": round(1000 * self.max_wait_seen_s, 1),
+        }
+
+
+class AdmissionController:
+    """
+    limits: {"openai:gpt-4o-mini": {"rpm": .., "tpm": ..}, "openai:*": {..}, "*": {..}}
+    (se usa la entrada más específica; sin entrada → sin límite).
+
+    El carril es el de la entrada que coincide, no el del modelo pedido: todos
+    los modelos que caen en "openai:*" comparten buckets. El modelo viene del
+    cliente, así que un nombre inventado no abre un carril (ni buckets) nuevo.
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, Dict[str, float]],
+        *,
+        per_user: int = 4,
+        max_queue: int = 200,
+        max_wait_s: float = 30.0,
+        redis_url: Optional[str] = None,
+    ):
+        self.limits = {k: Limits(float(v["rpm"]), float(v["tpm"])) for k, v in limits.items()}
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.max_wait_s = max_wait_s
+        self._redis = None
+        if redis_url:
+            import redis.asyncio as aioredis
+
+            self._redis = aioredis.from_url(redis_url)
+        self._lanes: Dict[str, Lane] = {}  # entrada de `limits` → carril (acotado por la config)
+
+    def _lane(self, provider: str, model: str) -> Optional[Lane]:
+        name = next((k for k in (f"{provider}:{model}", f"{provider}:*", "*") if k in self.limits), None)
+        if name is None:
+            return None
+        lane = self._lanes.get(name)
+        if lane is None:
+            lim = self.limits[name]
+            buckets = RedisBuckets(self._redis, name, lim) if self._redis is not None else LocalBuckets(lim)
+            lane = self._lanes[name] = Lane(name, buckets, self.per_user, self.max_queue, self.max_wait_s)
+        return lane
+
+    async def acquire(self, provider: str, model: str, user: str, tokens: int) -> float:
+        lane = self._lane(provider, model)
+        if lane is None:
+            return 0.0
+        return await lane.acquire(user, tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {lane.key: lane.stats() for lane in self._lanes.values()}
+
+    async def aclose(self) -> None:
+        if self._redis is not None:
+            await self._redis.aclose()
+
+
+def user_key(request: Request) -> str:
+    uid = request.headers.get("x-sb-user-id")
+    if uid:
+        return uid
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+async def admit(
+    admission: Optional[AdmissionController], request: Request, provider: str, model: str, tokens: int
+) -> float:
+    """Espera turno o responde 429 + Retry-After. Devuelve los segundos en cola."""
+    if admission is None:
+        return 0.0
+    try:
+        return await admission.acquire(provider, model, user_key(request), tokens)
+    except RateLimited as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Demasiadas solicitudes: {e.reason}",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+
+
+def parse_limits(raw: Optional[str]) -> Dict[str, Dict[str, float]]:
+    """RATE_LIMITS_JSON → limits; si es inválido, warning y sin límites (no tumba el arranque)."""
+    try:
+        limits = json.loads(raw or "{}")
+        for lim in limits.values():
+            float(lim["rpm"]), float(lim["tpm"])
+        return limits
+    except (ValueError, TypeError, KeyError, AttributeError):
+        logger.warning("[ratelimit] RATE_LIMITS_JSON inválido; sin límites")
+        return {}
+
+
+def build_admission(settings: Any) -> Optional[AdmissionController]:
+    if not settings.RATE_LIMIT_ENABLED:
+        return None
+    limits = parse_limits(settings.RATE_LIMITS_JSON)
+    redis_url = settings.REDIS_URL if settings.RATE_LIMIT_BACKEND == "redis" else None
+    return AdmissionController(
+        limits,
+        per_user=settings.RATE_LIMIT_QUEUE_PER_USER,
+        max_queue=settings.RATE_LIMIT_QUEUE_MAX,
+        max_wait_s=settings.RATE_LIMIT_MAX_WAIT_S,
+        redis_url=redis_url,
+    )
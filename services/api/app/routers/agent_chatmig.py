@@ -1,45 +1,63 @@
 # app/routes/agent_chatmig.py
 from __future__ import annotations
+import asyncio
 import os
 import time
-from typing import Any, Dict, List, Optional
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import httpx
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from .. import metrics
+from ..deps import get_admission, get_meter, get_session_memory, get_summarizer
+from ..http_clients import get_client
+from ..metering import UsageMeter, enforce, metered, settle
+from ..prompts import AGENT_SYSTEM, agent_style
+from ..prompt_cache import UsageTracker, openai_usage, record as record_usage
+from ..rate_limit import AdmissionController, admit
+from ..session_memory import Message, SessionMemory, Summary, trim_to_budget
+from ..summarizer import RollingSummarizer, message_tokens, summary_message
+from ..settings import get_settings
+from ..sse import ProviderStreamError, iter_deltas, ndjson_delta, ndjson_done, ndjson_error, openai_text
+from ..stream_guard import guard_disconnect
+from ..tokens import token_counter
 
 router = APIRouter(prefix="/agent", tags=["agent-chatmig"])
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_URL = (os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/") + "/chat/completions"
 
 if not OPENAI_API_KEY:
     # No explotamos aquí para no romper el arranque;
     # devolvemos 500 cuando llamen al endpoint sin API key.
     pass
 
-# ===== Memoria simple en RAM por sesión =====
-_MEM: Dict[str, List[Dict[str, str]]] = {}
-_MAX_TURNS = 12  # últimos 12 mensajes (user/assistant)
+# ===== Memoria por sesión (backend en app.session_memory, ver AGENT_MEMORY_*) =====
+_HISTORY_MAX_TOKENS = get_settings().AGENT_HISTORY_MAX_TOKENS
+_COMPLETION_TOKENS = get_settings().RATE_LIMIT_COMPLETION_TOKENS
+_LAYOUT = get_settings().PROMPT_LAYOUT
+
+@lru_cache(maxsize=1)
+def _counter() -> Callable[[str], int]:
+    return token_counter(OPENAI_MODEL)  # tiktoken + BPE en el primer request, no en el import
 
 def sys_prompt() -> str:
-    return (
-        "Eres **ChatMig**, un asistente experto en migración para países de "
-        "LatAm hacia EEUU/España/Europa. Respondes en español, con tono claro, "
-        "empático y directo. Das:\n"
-        "- requisitos/documentos\n- costos aproximados\n- tiempos estimados\n"
-        "- pasos accionables (checklist)\n"
-        "Incluye una cita corta entre «» si aporta valor. Evita relleno."
-    )
+    return AGENT_SYSTEM  # app/promps/agent_system.txt
 
-def build_messages(session_id: Optional[str], user_text: str, style: Dict[str, Any]) -> List[Dict[str, str]]:
-    messages: List[Dict[str, str]] = [{"role": "system", "content": sys_prompt()}]
+async def load_history(memory: SessionMemory, session_id: Optional[str]) -> Tuple[List[Message], Optional[Summary]]:
+    """Resumen acumulado (si hay) + turnos recientes recortados al presupuesto de tokens."""
+    if not session_id:
+        return [], None
+    history, summary = await asyncio.gather(memory.history(session_id), memory.summary(session_id))
+    recent = trim_to_budget(history, _HISTORY_MAX_TOKENS, _counter())
+    return ([summary_message(summary)] if summary else []) + recent, summary
 
-    # memoria previa
-    if session_id and session_id in _MEM:
-        messages.extend(_MEM[session_id][-(_MAX_TURNS):])
+def build_messages(history: List[Message], user_text: str, style: Dict[str, Any]) -> List[Dict[str, str]]:
+    messages: List[Dict[str, str]] = [{"role": "system", "content": sys_prompt()}]
 
     # estilo opcional (no forzamos, solo sugerimos)
     tone = style.get("tone") or "claro, empático y directo"
@@ -50,24 +68,31 @@ def build_messages(session_id: Optional[str], user_text: str, style: Dict[str, A
         "Usa «» para 1 cita útil. Evita relleno."
     )
 
-    style_msg = (
-        f"Estilo: tono={tone}; audiencia={audience}; largo≈{length_words} palabras. "
-        f"Instrucciones: {guidelines}"
-    )
-    messages.append({"role": "system", "content": style_msg})
+    style_msg = agent_style(str(tone), str(audience), str(length_words), str(guidelines))  # LRU por estilo
+    if _LAYOUT == "static_first":
+        # system + estilo + memoria previa: entre turnos de la sesión el prefijo se repite (caché del proveedor)
+        messages.append({"role": "system", "content": style_msg})
+        messages.extend(history)
+    else:
+        messages.extend(history)
+        messages.append({"role": "system", "content": style_msg})
 
     messages.append({"role": "user", "content": user_text})
     return messages
 
-def remember(session_id: Optional[str], user: str, assistant: str) -> None:
+async def remember(memory: SessionMemory, session_id: Optional[str], user: str, assistant: str) -> None:
     if not session_id:
         return
-    conv = _MEM.setdefault(session_id, [])
-    conv.append({"role": "user", "content": user})
-    conv.append({"role": "assistant", "content": assistant})
-    # recorta memoria
-    if len(conv) > 2 * _MAX_TURNS:
-        _MEM[session_id] = conv[-(2 * _MAX_TURNS):]
+    await memory.append(session_id, [
+        {"role": "user", "content": user},
+        {"role": "assistant", "content": assistant},
+    ])
+
+def _fold_later(summarizer: Optional[RollingSummarizer], session_id: Optional[str]) -> Optional[BackgroundTask]:
+    """Pliegue del historial tras enviar la respuesta (fuera del camino del request)."""
+    if summarizer is None or not session_id:
+        return None
+    return BackgroundTask(summarizer.maybe_fold, session_id)
 
 # ===== Schemas =====
 class AgentRequest(BaseModel):
@@ -77,11 +102,24 @@ class AgentRequest(BaseModel):
 
 # ===== Respuesta no-stream =====
 @router.post("/complete")
-async def agent_complete(req: AgentRequest):
+async def agent_complete(
+    req: AgentRequest,
+    request: Request,
+    memory: SessionMemory = Depends(get_session_memory),
+    summarizer: Optional[RollingSummarizer] = Depends(get_summarizer),
+    admission: Optional[AdmissionController] = Depends(get_admission),
+    meter: Optional[UsageMeter] = Depends(get_meter),
+):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY no configurada")
 
-    messages = build_messages(req.session_id, req.query, req.style)
+    history, summary = await load_history(memory, req.session_id)
+    messages = build_messages(history, req.query, req.style)
+    prompt_tokens = message_tokens(messages, _counter())
+    charge = enforce(meter, request, "agent", prompt_tokens, OPENAI_MODEL)
+    await admit(admission, request, "openai", OPENAI_MODEL, prompt_tokens + _COMPLETION_TOKENS)
+    if summarizer is not None and req.session_id:
+        summarizer.record(req.session_id, messages, summary)
 
     payload = {
         "model": OPENAI_MODEL,
@@ -92,65 +130,87 @@ async def agent_complete(req: AgentRequest):
 
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.post(OPENAI_URL, json=payload, headers=headers)
-        if r.status_code != 200:
-            raise HTTPException(status_code=500, detail=f"LLM error: {r.text}")
-
-        data = r.json()
-        answer = data["choices"][0]["message"]["content"].strip()
-        remember(req.session_id, req.query, answer)
-        return JSONResponse({"answer": answer})
+    t0 = time.monotonic()
+    try:
+        r = await get_client(OPENAI_URL).post(OPENAI_URL, json=payload, headers=headers, timeout=30.0)
+    except Exception as e:
+        metrics.upstream_error("openai", e)
+        raise
+    if r.status_code != 200:
+        metrics.upstream_errors("openai", metrics.status_kind(r.status_code)).inc()
+        raise HTTPException(status_code=500, detail=f"LLM error: {r.text}")
+
+    data = r.json()
+    record_usage("agent", "openai", openai_usage(data.get("usage")), time.monotonic() - t0)
+    answer = data["choices"][0]["message"]["content"].strip()
+    await settle(meter, charge, answer)
+    await remember(memory, req.session_id, req.query, answer)
+    return JSONResponse({"answer": answer}, background=_fold_later(summarizer, req.session_id))
 
 # ===== Respuesta stream (NDJSON deltas) =====
 @router.post("/complete/stream")
-async def agent_complete_stream(req: AgentRequest):
+async def agent_complete_stream(
+    req: AgentRequest,
+    request: Request,
+    memory: SessionMemory = Depends(get_session_memory),
+    summarizer: Optional[RollingSummarizer] = Depends(get_summarizer),
+    admission: Optional[AdmissionController] = Depends(get_admission),
+    meter: Optional[UsageMeter] = Depends(get_meter),
+):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY no configurada")
 
-    messages = build_messages(req.session_id, req.query, req.style)
+    history, summary = await load_history(memory, req.session_id)
+    messages = build_messages(history, req.query, req.style)
+    prompt_tokens = message_tokens(messages, _counter())
+    charge = enforce(meter, request, "agent_stream", prompt_tokens, OPENAI_MODEL)
+    await admit(admission, request, "openai", OPENAI_MODEL, prompt_tokens + _COMPLETION_TOKENS)
+    if summarizer is not None and req.session_id:
+        summarizer.record(req.session_id, messages, summary)
 
     payload = {
         "model": OPENAI_MODEL,
         "temperature": 0.2,
         "messages": messages,
         "stream": True,
+        "stream_options": {"include_usage": True},  # usage final con cached_tokens
     }
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
 
     async def gen():
         acc = []
         sent_any = False
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", OPENAI_URL, json=payload, headers=headers) as resp:
-                if resp.status_code != 200:
-                    detail = await resp.aread()
-                    yield f'{{"type":"error","error":{detail.decode("utf-8")!s}}}\n'
-                    return
-                async for line in resp.aiter_lines():
-                    if not line:
-                        continue
-                    if line.startswith("data: "):
-                        chunk = line[6:].strip()
-                    else:
-                        chunk = line.strip()
-                    if chunk == "[DONE]":
-                        break
-                    try:
-                        obj = httpx.Response(200, content=chunk).json()
-                    except Exception:
-                        continue
-                    for choice in obj.get("choices", []):
-                        delta = choice.get("delta", {}).get("content")
-                        if delta:
-                            acc.append(delta)
-                            sent_any = True
-                            yield f'{{"type":"delta","content":{delta.__repr__()}}}\n'
+        track = UsageTracker("agent_stream", "openai", OPENAI_MODEL)
+        try:
+            async with get_client(OPENAI_URL).stream("POST", OPENAI_URL, json=payload, headers=headers) as resp:
+                async for delta in track.tracked(iter_deltas(resp, openai_text, on_event=track.feed)):
+                    acc.append(delta)
+                    sent_any = True
+                    yield ndjson_delta(delta)
+        except ProviderStreamError as e:
+            metrics.upstream_error("openai", e)
+            yield ndjson_error(str(e))
+            return
+        except Exception as e:
+            metrics.upstream_error("openai", e)
+            raise
         # cierre
         full = "".join(acc).strip()
         if sent_any:
-            yield '{"type":"done"}\n'
+            yield ndjson_done()
         if full:
-            remember(req.session_id, req.query, full)
+            await remember(memory, req.session_id, req.query, full)
+
+    return StreamingResponse(
+        guard_disconnect(request, metered(meter, charge, gen()), "agent"),
+        media_type="application/x-ndjson",
+        background=_fold_later(summarizer, req.session_id),
+    )
 
-    return StreamingResponse(gen(), media_type="application/x-ndjson")
+# ===== Estado de memoria/resumen =====
+@router.get("/stats")
+async def agent_stats(
+    memory: SessionMemory = Depends(get_session_memory),
+    summarizer: Optional[RollingSummarizer] = Depends(get_summarizer),
+):
+    return {"memory": memory.stats(), "summary": summarizer.stats.as_dict() if summarizer else None}
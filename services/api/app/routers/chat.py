@@ -1,14 +1,25 @@
 # app/routers/chat.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from pydantic import BaseModel, Field
-from typing import Literal, Optional, Dict, Any
+from typing import TYPE_CHECKING, Literal, Optional, Dict, Any
 import json
-from openai import OpenAI
+import time
+from functools import lru_cache
+from app import metrics
 from app.settings import get_settings
+from app.deps import get_async_openai, get_admission, get_meter, get_single_flight
+from app.metering import UsageMeter, enforce, settle
+from app.prompts import PLAN_RULES, plan_style, plan_system
+from app.prompt_cache import openai_usage, record as record_usage
+from app.rate_limit import AdmissionController, admit
+from app.single_flight import SingleFlight, coalesce, flight_key
+from app.tokens import count_message_tokens
+
+if TYPE_CHECKING:  # openai se importa al crear el cliente (app.deps), no al cargar el router
+    from openai import AsyncOpenAI
 
 router = APIRouter()
 settings = get_settings()
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
 class StyleConfig(BaseModel):
     persona: str = "coach cálido y ético"
@@ -29,25 +40,21 @@ class PlanInput(BaseModel):
     style: Optional[StyleConfig] = None
     format: Optional[Literal["json","markdown"]] = None  # override rápido
 
-def build_style() -> StyleConfig:
+@lru_cache(maxsize=4)
+def _default_style(raw: str) -> StyleConfig:
     try:
-        base = json.loads(settings.DEFAULT_STYLE_JSON)
+        base = json.loads(raw)
     except Exception:
         base = {}
     return StyleConfig(**base)
 
-def build_system(style: StyleConfig) -> str:
-    return f"""
-Eres ChatSed, un {style.persona}.
-Filosofía: empático, directo, sin manipulación, respeto y consentimiento. Lenguaje claro y breve.
-Tono: {style.tone}. Dialecto: {style.dialect}. Emojis: {"pocos y pertinentes" if style.use_emojis else "no usar"}.
-
-FORMATO:
-- Si format=json: responde SOLO JSON con llaves: summary (<= {style.summary_words} palabras), steps (lista {style.max_bullets} bullets, cada bullet corto), script (<= {style.script_words} palabras), ab (obj con A y B, 1 línea cada uno), flags (obj con verde/amarillo/rojo), metric_of_the_day, task, p_success (0-1), drivers (lista corta).
-- Si format=markdown: Encabezado “Plan”, bullets (máx {style.max_bullets}), “Script”, “A/B” y “Banderas”. Nada de preámbulos innecesarios.
+def build_style() -> StyleConfig:
+    # DEFAULT_STYLE_JSON se parsea/valida una sola vez: instancia compartida, no mutar
+    return _default_style(settings.DEFAULT_STYLE_JSON)
 
-Evita clichés y presión. Sé práctico y amable. No des consejos médicos/legales. 
-"""
+def build_system(style: StyleConfig) -> str:
+    # plantilla app/promps/plan_system.txt, memoizada por estilo
+    return plan_system(style)
 
 def build_user(goal: str, ctx: Dict[str, Any], draft: Optional[str], style: StyleConfig, out_format: str) -> str:
     ch = ctx.get("channel","chat")
@@ -59,28 +66,60 @@ Instrucciones de salida: format={out_format}
 """
 
 @router.post("/plan")
-def plan(body: PlanInput):
+async def plan(
+    body: PlanInput,
+    request: Request,
+    client: "AsyncOpenAI" = Depends(get_async_openai),
+    admission: Optional[AdmissionController] = Depends(get_admission),
+    flights: Optional[SingleFlight] = Depends(get_single_flight),
+    meter: Optional[UsageMeter] = Depends(get_meter),
+):
     # estilo final: defaults + overrides
     base_style = build_style()
     if body.style:
         base_style = StyleConfig(**{**base_style.model_dump(), **body.style.model_dump(exclude_unset=True)})
     if body.format:
-        base_style.format = body.format
+        base_style = base_style.model_copy(update={"format": body.format})
 
-    system = build_system(base_style)
     user = build_user(body.goal, body.context, body.message_draft, base_style, base_style.format)
+    if settings.PROMPT_LAYOUT == "static_first":
+        # reglas fijas primero (prefijo cacheable), estilo aparte
+        messages = [
+            {"role":"system","content": PLAN_RULES},
+            {"role":"system","content": plan_style(base_style)},
+            {"role":"user","content": user}
+        ]
+    else:
+        messages = [
+            {"role":"system","content": build_system(base_style)},
+            {"role":"user","content": user}
+        ]
+
+    prompt_tokens = count_message_tokens(messages, settings.OPENAI_MODEL)
+    charge = enforce(meter, request, "plan", prompt_tokens, settings.OPENAI_MODEL)  # cuota antes del modelo
 
+    async def call():
+        # solo el primero de un grupo de requests idénticos pasa por admisión y llama al modelo
+        await admit(admission, request, "openai", settings.OPENAI_MODEL, prompt_tokens + base_style.max_tokens)
+        t0 = time.monotonic()
+        try:
+            resp = await client.chat.completions.create(
+                model=settings.OPENAI_MODEL,
+                messages=messages,
+                temperature=base_style.temperature,
+                max_tokens=base_style.max_tokens,
+            )
+        except Exception as e:
+            metrics.upstream_error("openai", e)
+            raise
+        record_usage("plan", "openai", openai_usage(resp.usage), time.monotonic() - t0)  # sin stream: TTFT = latencia
+        return resp
+
+    key = flight_key(settings.OPENAI_MODEL, messages, base_style.temperature, base_style.max_tokens)
     try:
-        resp = client.chat.completions.create(
-            model=settings.OPENAI_MODEL,
-            messages=[
-                {"role":"system","content": system},
-                {"role":"user","content": user}
-            ],
-            temperature=base_style.temperature,
-            max_tokens=base_style.max_tokens,
-        )
+        resp = await coalesce(flights, key, call)  # el 429 de admisión sale por `except HTTPException`
         text = resp.choices[0].message.content.strip()
+        await settle(meter, charge, text)
 
         if base_style.format == "json":
             try:
@@ -1,24 +1,28 @@
 # services/api/app/routers/chat_stream.py
-from typing import Optional, Literal, Iterable
+from typing import TYPE_CHECKING, Optional, Literal, AsyncIterator
 import os
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
-from ..deps import openai_client, OPENAI_MODEL
+from .. import metrics
+from ..deps import get_admission, get_async_openai, get_meter, get_single_flight, OPENAI_MODEL
+from ..metering import UsageMeter, enforce, metered
+from ..prompts import CHATMIG_SYSTEM, RISK_OFFICIAL, style_guides, style_key
+from ..prompt_cache import UsageTracker, openai_usage
+from ..rate_limit import AdmissionController, admit
+from ..single_flight import SingleFlight, fan_out, flight_key
+from ..stream_guard import guard_disconnect
+from ..tokens import count_message_tokens
+
+if TYPE_CHECKING:  # openai se importa al crear el cliente (app.deps), no al cargar el router
+    from openai import AsyncOpenAI
 
 router = APIRouter(prefix="/chat", tags=["chatmig"])
 
 # ===== Env & defaults (controlar desde .env) =====
-SYSTEM_PROMPT = os.getenv(
-    "CHATMIG_SYSTEM_PROMPT",
-    (
-        "Eres ChatMig, asesor migratorio claro y empático. Respondes en español neutro, "
-        "das pasos operativos, requisitos, documentos, costos orientativos y tiempos. "
-        "Indica riesgos/limitaciones y cómo verificarlos oficialmente. Sin relleno."
-    ),
-)
+SYSTEM_PROMPT = os.getenv("CHATMIG_SYSTEM_PROMPT") or CHATMIG_SYSTEM  # app/promps/chatmig_system.txt
 DEFAULT_LENGTH_WORDS = int(os.getenv("CHATMIG_DEFAULT_LENGTH_WORDS", "1000"))
 TEMPERATURE = float(os.getenv("CHATMIG_TEMPERATURE", "0.4"))
 MAX_TOKENS = int(os.getenv("CHATMIG_MAX_TOKENS", "4096"))
@@ -38,52 +42,52 @@ class ChatIn(BaseModel):
     style: Optional[StyleIn] = None
 
 # --------- Helpers ---------
-def _style_block(s: Optional[StyleIn]) -> str:
-    # Fallback a 1000 palabras y ES si no viene estilo
-    if not s:
-        s = StyleIn(length_words=DEFAULT_LENGTH_WORDS, language="es")
+# Fallback a 1000 palabras y ES si no viene estilo
+_DEFAULT_STYLE_KEY = style_key(StyleIn(length_words=DEFAULT_LENGTH_WORDS, language="es"))
 
-    lines: list[str] = []
-    length = s.length_words or DEFAULT_LENGTH_WORDS
-    lines.append(f"Extensión objetivo: ~{length} palabras (±20%).")
-    if s.format:
-        lines.append(f"Estructura: usa {s.format}; evita relleno y repeticiones.")
-    if s.tone:
-        lines.append(f"Tono: {s.tone}.")
-    if s.audience:
-        lines.append(f"Audiencia: {s.audience}.")
-    if s.language:
-        lines.append(f"Idioma: {s.language}.")
-    if s.use_emojis is not None:
-        lines.append("Incluye emojis con moderación." if s.use_emojis else "No incluyas emojis.")
-    if s.guidelines:
-        lines.append(s.guidelines)
-
-    # Imprescindibles
-    lines.append("Explica el porqué de cada paso y da 1–2 ejemplos concretos.")
-    lines.append("Señala riesgos/limitaciones y cómo verificarlos con la autoridad oficial.")
-    return "Guías de estilo:\n" + "\n".join(lines)
+def _style_block(s: Optional[StyleIn]) -> str:
+    key = style_key(s) if s else _DEFAULT_STYLE_KEY
+    return "Guías de estilo:\n" + style_guides(key, DEFAULT_LENGTH_WORDS, RISK_OFFICIAL)
 
-def _stream_llm(messages: list[dict]) -> Iterable[str]:
+async def _stream_llm(client: "AsyncOpenAI", messages: list[dict]) -> AsyncIterator[str]:
     """Emite texto plano en streaming para que el front concatene directamente."""
     try:
-        resp = openai_client.chat.completions.create(
+        track = UsageTracker("chat_stream", "openai", OPENAI_MODEL)
+        resp = await client.chat.completions.create(
             model=OPENAI_MODEL,
             messages=messages,
             temperature=TEMPERATURE,
             max_tokens=MAX_TOKENS,
             stream=True,
+            stream_options={"include_usage": True},  # chunk final sin choices con usage (cached_tokens)
         )
-        for chunk in resp:
-            delta = getattr(chunk.choices[0].delta, "content", None) or ""
-            if delta:
-                yield delta
+        try:
+            async for chunk in resp:
+                if chunk.usage is not None:
+                    track.usage = openai_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = getattr(chunk.choices[0].delta, "content", None) or ""
+                if delta:
+                    track.first_token()
+                    yield delta
+        finally:
+            await resp.close()  # cierre anticipado (cliente desconectado) aborta la generación
+        track.done()
     except Exception as e:
+        metrics.upstream_error("openai", e)
         yield f"\n\n[ChatMig] {type(e).__name__}: {str(e)}"
 
 # --------- Endpoint: texto plano en streaming ---------
 @router.post("/complete_stream", response_class=PlainTextResponse)
-def complete_stream(body: ChatIn):
+async def complete_stream(
+    body: ChatIn,
+    request: Request,
+    client: "AsyncOpenAI" = Depends(get_async_openai),
+    admission: Optional[AdmissionController] = Depends(get_admission),
+    flights: Optional[SingleFlight] = Depends(get_single_flight),
+    meter: Optional[UsageMeter] = Depends(get_meter),
+):
     q = (body.query or "").strip()
     if not q:
         raise HTTPException(status_code=400, detail="Empty query")
@@ -93,5 +97,14 @@ def complete_stream(body: ChatIn):
     if style_msg:
         messages.append({"role": "system", "content": style_msg})
     messages.append({"role": "user", "content": q})
+    key = flight_key(OPENAI_MODEL, messages, TEMPERATURE, MAX_TOKENS)
+    prompt_tokens = count_message_tokens(messages, OPENAI_MODEL)
+    charge = enforce(meter, request, "chat_stream", prompt_tokens, OPENAI_MODEL)  # la cuota del usuario sí se gasta
+    if flights is None or not flights.in_flight(key):  # sumarse a un stream en vuelo no gasta cuota del proveedor
+        await admit(admission, request, "openai", OPENAI_MODEL, prompt_tokens + MAX_TOKENS)
+    source = metered(meter, charge, fan_out(flights, key, lambda: _stream_llm(client, messages)))
 
-    return StreamingResponse(_stream_llm(messages), media_type="text/plain; charset=utf-8")
+    return StreamingResponse(
+        guard_disconnect(request, source, "chat_stream", max_tokens=MAX_TOKENS),
+        media_type="text/plain; charset=utf-8",
+    )
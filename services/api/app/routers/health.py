@@ -1,7 +1,43 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+
+from ..http_clients import registry
+from .. import prompt_cache, stream_guard
 
 router = APIRouter()
 
 @router.get("/healthz")
 def healthz():
     return {"ok": True}
+
+@router.get("/healthz/http")
+def http_pool_stats():
+    # hits = requests que reutilizaron conexión; misses = TCP/TLS nuevo
+    return registry.stats()
+
+@router.get("/healthz/streams")
+def stream_stats():
+    # streams cortados por desconexión del cliente y tokens/tiempo upstream ahorrados
+    return stream_guard.stats()
+
+@router.get("/healthz/ratelimit")
+def ratelimit_stats(request: Request):
+    # por proveedor:modelo: cola actual, admitidas/encoladas/rechazadas (429) y espera media/máxima
+    admission = getattr(request.app.state, "admission", None)
+    return admission.stats() if admission is not None else {}
+
+@router.get("/healthz/coalescing")
+def coalescing_stats(request: Request):
+    # saved_upstream_calls = requests idénticos que se sumaron a una llamada/stream en vuelo
+    flights = getattr(request.app.state, "single_flight", None)
+    return flights.stats.as_dict() if flights is not None else {}
+
+@router.get("/healthz/metering")
+def metering_stats(request: Request):
+    # liquidaciones con usage del proveedor vs tokenizer local, 429 por cuota y volcados por lote
+    meter = getattr(request.app.state, "meter", None)
+    return meter.stats.as_dict() if meter is not None else {}
+
+@router.get("/healthz/prompt_cache")
+def prompt_cache_stats():
+    # por ruta:proveedor: tokens leídos de caché, TTFT con/sin hit y ahorro estimado de input
+    return prompt_cache.stats()
@@ -1,14 +1,33 @@
 # services/api/app/routers/llm.py
 from __future__ import annotations
 
-import json
-from typing import List, Optional, Literal, Iterable
+import asyncio
+import time
+from typing import TYPE_CHECKING, List, Optional, Literal, AsyncIterator, Iterator
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
-from ..deps import supabase, openai_client, OPENAI_MODEL, EMBED_MODEL
+from .. import metrics, tracing
+from ..deps import (
+    get_supabase, get_async_openai, get_admission, get_meter, get_semantic_cache, get_single_flight, get_vector_index,
+    settings, OPENAI_MODEL, EMBED_MODEL,
+)
+from ..prompts import LLM_SYSTEM, RISK_RESPECT, style_guides, style_key
+from ..prompt_cache import UsageTracker, openai_usage, record as record_usage
+from ..metering import UsageMeter, enforce, metered, settle
+from ..rate_limit import AdmissionController, admit
+from ..single_flight import SingleFlight, coalesce, fan_out, flight_key
+from ..sse import ndjson_line
+from ..stream_guard import guard_disconnect
+from ..tokens import count_message_tokens
+
+if TYPE_CHECKING:  # solo anotaciones: openai y numpy se cargan con el primer request (app.deps)
+    from openai import AsyncOpenAI
+    from ..semantic_cache import SemanticCache
+    from ..vector_index import VectorIndex
 
 router = APIRouter(prefix="/llm", tags=["llm"])
 
@@ -39,134 +58,296 @@ class ChatOut(BaseModel):
     retrieved: List[Chunk] = Field(default_factory=list)
 
 
-SYSTEM_PROMPT = (
-    "Eres ChatSed, coach de comunicación y seducción ética. "
-    "Da consejos claros, respeta consentimiento y límites, evita manipulación. "
-    "Si hay señales rojas, señálalas y recomienda cómo actuar con respeto. "
-    "Responde en español de forma didáctica, concreta y empática."
-)
+CHUNK_TOKENS_EST = 300  # tokens por fragmento de contexto (para admitir antes de recuperar)
+
+SYSTEM_PROMPT = LLM_SYSTEM  # app/promps/llm_system.txt
 
 # --------- Helpers ---------
-def _jsonl(obj: dict) -> str:
-    return json.dumps(obj, ensure_ascii=False) + "\n"
+def _jsonl(obj: dict) -> bytes:
+    return ndjson_line(obj)
 
 
 def _style_block(s: Optional[StyleIn]) -> str:
     if not s:
         return ""
-    lines: list[str] = []
-    if s.length_words:
-        lines.append(f"Extensión objetivo: ~{s.length_words} palabras (±20%).")
-    if s.format:
-        lines.append(f"Estructura: usa {s.format}; evita relleno y repeticiones.")
-    if s.tone:
-        lines.append(f"Tono: {s.tone}.")
-    if s.audience:
-        lines.append(f"Audiencia: {s.audience}.")
-    if s.language:
-        lines.append(f"Idioma: {s.language}.")
-    if s.use_emojis is not None:
-        lines.append("Incluye emojis con moderación." if s.use_emojis else "No incluyas emojis.")
-    if s.guidelines:
-        lines.append(s.guidelines)
-    # Imprescindibles
-    lines.append("Explica el porqué de cada paso y da 1–2 ejemplos concretos.")
-    lines.append("Señala riesgos/banderas rojas y cómo gestionarlas con respeto.")
-    return "\n".join(lines)
-
-
-def _retrieve_context(q: str, k: int) -> tuple[list[dict], str]:
+    return style_guides(style_key(s), None, RISK_RESPECT)
+
+
+def _namespace(style: str, k: int) -> str:
+    from ..semantic_cache import namespace  # el módulo trae numpy: fuera del import del router
+
+    return namespace(OPENAI_MODEL, style, k)
+
+
+def _match_knowledge(query_vec: list[float], k: int) -> list[dict]:
+    sb = get_supabase()
+    if sb is None:
+        raise ValueError("sin índice local ni Supabase configurado")
+    return sb.rpc("match_knowledge", {"query_embedding": query_vec, "match_count": k}).execute().data or []
+
+
+async def _embed_query(client: AsyncOpenAI, q: str) -> Optional[list[float]]:
+    """Embedding de la consulta (None si falla; RAG y caché se saltan)."""
+    try:
+        with tracing.span("rag.embed", {"llm.model": EMBED_MODEL}), metrics.RagTimer("embed", "openai"):
+            emb = await client.embeddings.create(model=EMBED_MODEL, input=q)
+        return emb.data[0].embedding
+    except Exception as e:
+        metrics.upstream_error("openai", e)
+        return None
+
+
+async def _retrieve_context(
+    client: AsyncOpenAI,
+    q: str,
+    k: int,
+    query_vec: Optional[list[float]] = None,
+    index: Optional[VectorIndex] = None,
+) -> tuple[list[dict], str]:
     """
-    Hace embedding + RPC en Supabase y devuelve:
+    Hace embedding (si no viene ya calculado) + búsqueda y devuelve:
       - filas crudas (dicts con content/similarity)
       - contexto concatenado legible
+    Busca en el índice local si está cargado; si no, RPC `match_knowledge` en Supabase.
     Si falla, devuelve vacío sin romper flujo.
     """
+    if query_vec is None:
+        query_vec = await _embed_query(client, q)
     try:
-        emb = openai_client.embeddings.create(model=EMBED_MODEL, input=q)
-        query_vec = emb.data[0].embedding
-
-        rpc = supabase.rpc(
-            "match_knowledge",
-            {"query_embedding": query_vec, "match_count": k},
-        ).execute()
-        rows = rpc.data or []
+        if query_vec is None:
+            raise ValueError("sin embedding")
+        if index is not None and index.dim == len(query_vec):
+            # producto punto en NumPy (libera el GIL): threadpool para no frenar el loop
+            with tracing.span("rag.search", {"rag.backend": "local", "rag.k": k}), metrics.RagTimer("search", "local"):
+                rows = await run_in_threadpool(index.search, query_vec, k)
+        else:
+            # El cliente de Supabase es síncrono (y su import, pesado): fuera del event loop
+            with tracing.span("rag.search", {"rag.backend": "supabase", "rag.k": k}), \
+                    metrics.RagTimer("search", "supabase"):
+                rows = await run_in_threadpool(_match_knowledge, query_vec, k)
     except Exception:
         rows = []
 
-    ctx_texts = [r.get("content", "") for r in rows]
-    context = "\n\n".join([f"[Contexto #{i+1}] {c}" for i, c in enumerate(ctx_texts)])
+    with tracing.span("rag.context", {"rag.rows": len(rows)}):
+        ctx_texts = [r.get("content", "") for r in rows]
+        context = "\n\n".join([f"[Contexto #{i+1}] {c}" for i, c in enumerate(ctx_texts)])
     return rows, context
 
 
+def _chunks(rows: list[dict]) -> list[dict]:
+    return [
+        {"content": r.get("content", ""), "similarity": float(r.get("similarity", 0))}
+        for r in rows
+    ]
+
+
+def _replay_deltas(answer: str, size: int = 64) -> Iterator[str]:
+    """Trocea una respuesta cacheada en deltas (cortando en espacios) para el stream NDJSON."""
+    i = 0
+    while i < len(answer):
+        j = answer.find(" ", i + size)
+        j = len(answer) if j == -1 else j + 1
+        yield answer[i:j]
+        i = j
+
+
 # --------- Endpoint JSON (fallback/compat) ---------
 @router.post("/complete", response_model=ChatOut)
-def complete(body: ChatIn):
+async def complete(
+    body: ChatIn,
+    request: Request,
+    client: AsyncOpenAI = Depends(get_async_openai),
+    cache: Optional[SemanticCache] = Depends(get_semantic_cache),
+    index: Optional[VectorIndex] = Depends(get_vector_index),
+    admission: Optional[AdmissionController] = Depends(get_admission),
+    flights: Optional[SingleFlight] = Depends(get_single_flight),
+    meter: Optional[UsageMeter] = Depends(get_meter),
+):
     q = (body.query or "").strip()
     if not q:
         raise HTTPException(status_code=400, detail="Empty query")
+    charge = enforce(meter, request, "llm", model=OPENAI_MODEL)  # antes del embedding (ya es upstream)
 
     k = max(1, min(body.top_k or 5, 24))
-    rows, context = _retrieve_context(q, k)
-    retrieved = [
-        Chunk(content=r.get("content", ""), similarity=float(r.get("similarity", 0)))
-        for r in rows
-    ]
+    style = _style_block(body.style)
+    ns = _namespace(style, k)
+    query_vec = await _embed_query(client, q)
+    if cache is not None and query_vec is not None:
+        hit = await cache.get(query_vec, ns)
+        if hit is not None:
+            await settle(meter, charge, hit.answer)  # hit: solo los tokens entregados
+            return ChatOut(answer=hit.answer, retrieved=[Chunk(**c) for c in hit.retrieved])
+
+    rows, context = await _retrieve_context(client, q, k, query_vec, index)
+    chunks = _chunks(rows)
 
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": f"Guías de estilo:\n{_style_block(body.style)}"},
+        {"role": "system", "content": f"Guías de estilo:\n{style}"},
         {"role": "system", "content": f"Contexto externo (puede estar incompleto):\n{context}"},
         {"role": "user", "content": q},
     ]
-    try:
-        resp = openai_client.chat.completions.create(
-            model=OPENAI_MODEL, messages=messages, temperature=0.4
-        )
-        answer = resp.choices[0].message.content
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LLM error: {type(e).__name__}") from e
 
-    return ChatOut(answer=answer, retrieved=retrieved)
+    prompt_tokens = count_message_tokens(messages, OPENAI_MODEL)
+    if charge is not None:
+        charge.prompt_tokens = prompt_tokens
+
+    async def call() -> str:
+        # una sola llamada (y un solo put en caché) por grupo de requests idénticos en vuelo
+        await admit(admission, request, "openai", OPENAI_MODEL, prompt_tokens + settings.RATE_LIMIT_COMPLETION_TOKENS)
+        t0 = time.monotonic()
+        try:
+            with tracing.span("llm.complete", {"llm.provider": "openai", "llm.model": OPENAI_MODEL}):
+                resp = await client.chat.completions.create(
+                    model=OPENAI_MODEL, messages=messages, temperature=0.4
+                )
+            answer = resp.choices[0].message.content
+        except Exception as e:
+            metrics.upstream_error("openai", e)
+            raise HTTPException(status_code=500, detail=f"LLM error: {type(e).__name__}") from e
+        record_usage("llm", "openai", openai_usage(resp.usage), time.monotonic() - t0)
+        if cache is not None and query_vec is not None and answer:
+            await cache.put(query_vec, ns, answer, chunks)
+        return answer
+
+    answer = await coalesce(flights, flight_key(OPENAI_MODEL, messages, 0.4), call)
+    await settle(meter, charge, answer)
+    return ChatOut(answer=answer, retrieved=[Chunk(**c) for c in chunks])
 
 
 # --------- Endpoint STREAMING NDJSON (recomendado) ---------
 @router.post("/complete/stream")
-def complete_stream(body: ChatIn):
+async def complete_stream(
+    body: ChatIn,
+    request: Request,
+    client: AsyncOpenAI = Depends(get_async_openai),
+    cache: Optional[SemanticCache] = Depends(get_semantic_cache),
+    index: Optional[VectorIndex] = Depends(get_vector_index),
+    admission: Optional[AdmissionController] = Depends(get_admission),
+    flights: Optional[SingleFlight] = Depends(get_single_flight),
+    meter: Optional[UsageMeter] = Depends(get_meter),
+):
     q = (body.query or "").strip()
     if not q:
         raise HTTPException(status_code=400, detail="Empty query")
+    charge = enforce(meter, request, "llm_stream", model=OPENAI_MODEL)  # antes del embedding (ya es upstream)
+
+    # Pipeline: el embedding arranca ya (antes de abrir la respuesta) y, mientras
+    # viaja, se arma la parte fija del prompt. TTFT ≈ embed + RPC + 1er token del LLM.
+    t0 = time.perf_counter()
+    embed_task = asyncio.create_task(_embed_query(client, q))
 
     k = max(1, min(body.top_k or 5, 24))
+    style = _style_block(body.style)
+    ns = _namespace(style, k)
+    prefix = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": f"Guías de estilo:\n{style}"},
+    ]
+    est = count_message_tokens([*prefix, {"role": "user", "content": q}], OPENAI_MODEL) + k * CHUNK_TOKENS_EST
+    try:
+        query_vec = await embed_task
+    finally:
+        embed_task.cancel()  # no-op si terminó; libera la llamada si el cliente se fue
+    embed_ms = round((time.perf_counter() - t0) * 1000, 1)
 
-    def iter_events() -> Iterable[str]:
-        # 1) Recuperación
-        rows, context = _retrieve_context(q, k)
-        chunks = [
-            {"content": r.get("content", ""), "similarity": float(r.get("similarity", 0))}
-            for r in rows
-        ]
-        # Emitimos fuentes primero
+    # 0) Caché semántica antes de la admisión (igual que /complete): un hit no
+    # consume cupo del proveedor ni puede recibir 429.
+    hit = await cache.get(query_vec, ns) if cache is not None and query_vec is not None else None
+
+    # Admisión antes de abrir el stream (después ya no se puede responder 429);
+    # el contexto aún no existe: se estima con k fragmentos.
+    queued_s = 0.0
+    if hit is None:
+        queued_s = await admit(admission, request, "openai", OPENAI_MODEL, est + settings.RATE_LIMIT_COMPLETION_TOKENS)
+
+    async def iter_events() -> AsyncIterator[bytes]:
+        timings: dict[str, float] = {"queue_ms": round(queued_s * 1000, 1)} if queued_s else {}
+        timings["embed_ms"] = embed_ms
+
+        def mark(phase: str) -> None:
+            timings[f"{phase}_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+        def done(**extra) -> bytes:
+            mark("total")
+            return _jsonl({"type": "done", **extra, "timings": timings})
+
+        # Hit: se reproduce con el mismo protocolo (retrieved → delta* → done)
+        if hit is not None:
+            yield _jsonl({"type": "retrieved", "chunks": hit.retrieved})
+            mark("retrieve")
+            for i, piece in enumerate(_replay_deltas(hit.answer)):
+                if i == 0:
+                    mark("first_token")
+                yield _jsonl({"type": "delta", "content": piece})
+            yield done(cached=True)
+            return
+
+        # 1) Recuperación: las fuentes salen en cuanto vuelve la búsqueda
+        if charge is not None:
+            charge.prompt_tokens = est  # sin usage del proveedor, se cobra la estimación de la admisión
+        rows, context = await _retrieve_context(client, q, k, query_vec, index)
+        chunks = _chunks(rows)
+        mark("retrieve")
         yield _jsonl({"type": "retrieved", "chunks": chunks})
 
         # 2) LLM stream
         messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "system", "content": f"Guías de estilo:\n{_style_block(body.style)}"},
+            *prefix,
             {"role": "system", "content": f"Contexto externo (puede estar incompleto):\n{context}"},
             {"role": "user", "content": q},
         ]
+        async def upstream() -> AsyncIterator[str]:
+            # compartido por los requests idénticos en vuelo (fan-out); lo corre el primero
+            track = UsageTracker("llm_stream", "openai", OPENAI_MODEL)
+            acc: list[str] = []
+            with tracing.span("llm.stream", {"llm.provider": "openai", "llm.model": OPENAI_MODEL}, current=False) as sp:
+                try:
+                    stream = await client.chat.completions.create(
+                        model=OPENAI_MODEL, messages=messages, temperature=0.4, stream=True,
+                        stream_options={"include_usage": True},  # chunk final sin choices con usage (cached_tokens)
+                    )
+                except Exception as e:
+                    metrics.upstream_error("openai", e)
+                    raise
+                try:
+                    async for chunk in stream:
+                        if chunk.usage is not None:
+                            track.usage = openai_usage(chunk.usage)
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content or ""
+                        if delta:
+                            if not acc:
+                                sp.add_event("first_token")
+                            track.first_token()
+                            acc.append(delta)
+                            yield delta
+                except Exception as e:
+                    metrics.upstream_error("openai", e)
+                    raise
+                finally:
+                    await stream.close()  # cierre anticipado (se fueron todos los clientes) aborta la generación
+                    sp.set_attribute("llm.output_deltas", track.deltas)
+            track.done()
+            # solo respuestas completas (sin error) entran en caché
+            if cache is not None and query_vec is not None and acc:
+                await cache.put(query_vec, ns, "".join(acc), chunks)
+
+        deltas = fan_out(flights, flight_key(OPENAI_MODEL, messages, 0.4), upstream)
+        first = True
         try:
-            stream = openai_client.chat.completions.create(
-                model=OPENAI_MODEL, messages=messages, temperature=0.4, stream=True
-            )
-            for chunk in stream:
-                delta = chunk.choices[0].delta.content or ""
-                if delta:
-                    yield _jsonl({"type": "delta", "content": delta})
-            yield _jsonl({"type": "done"})
+            async for delta in deltas:
+                if first:
+                    mark("first_token")
+                    first = False
+                yield _jsonl({"type": "delta", "content": delta})
+            yield done()
         except Exception as e:
             yield _jsonl({"type": "error", "error": f"{type(e).__name__}: {str(e)}"})
-            yield _jsonl({"type": "done"})
+            yield done()
+        finally:
+            await deltas.aclose()
 
-    return StreamingResponse(iter_events(), media_type="application/x-ndjson")
+    return StreamingResponse(guard_disconnect(request, metered(meter, charge, iter_events()), "llm"),
+                             media_type="application/x-ndjson")
@@ -1,18 +1,27 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from ..db import get_db, Base, engine
-from ..models import ProgressLog
+from .. import tracing
 from ..schemas import ProgressLogRequest
 
 router = APIRouter()
 
-# Crear tablas si no existen (simple para demo)
-Base.metadata.create_all(bind=engine)
+
+def _db():
+    # SQLAlchemy (~150 ms de import) se carga con el primer /log, no al arrancar.
+    # Las tablas las crea `python -m app.migrate`; donde no hay ese paso (Vercel),
+    # el primer /log las crea (memoizado, create_all es idempotente).
+    from ..db import ensure_schema, get_db
+
+    ensure_schema()
+    yield from get_db()
+
 
 @router.post("/log")
-def log_progress(req: ProgressLogRequest, db: Session = Depends(get_db)):
+def log_progress(req: ProgressLogRequest, db=Depends(_db)):
+    from ..models import ProgressLog
+
     entry = ProgressLog(kpi=req.kpi, note=req.note or "")
-    db.add(entry)
-    db.commit()
-    db.refresh(entry)
+    with tracing.span("db.insert", {"db.system": db.bind.dialect.name, "db.collection.name": ProgressLog.__tablename__}):
+        db.add(entry)
+        db.commit()
+        db.refresh(entry)
     return {"ok": True, "id": entry.id}
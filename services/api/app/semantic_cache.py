@@ -0,0 +1,291 @@
+# services/api/app/semantic_cache.py
+"""
+Caché semántica de respuestas para /llm.
+
+La clave es el embedding de la consulta (el mismo que ya calculamos para RAG)
+dentro de un namespace = hash(modelo + bloque de estilo + top_k). Hay hit cuando
+la similitud coseno con alguna entrada del namespace supera el umbral.
+
+Backends:
+  - MemorySemanticCache: en proceso, LRU + TTL, vectores en una matriz NumPy
+    preasignada por namespace (filas libres reutilizables).
+  - RedisSemanticCache: compartida entre workers/réplicas (hash por entrada con
+    EXPIRE + ZSET por namespace ordenado por último acceso para el LRU).
+"""
+from __future__ import annotations
+
+import abc
+import hashlib
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("chatmig.semcache")
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    retrieved: List[Dict[str, Any]] = field(default_factory=list)
+    similarity: float = 1.0
+
+
+def namespace(*parts: Any) -> str:
+    """Namespace estable a partir de lo que condiciona la respuesta (modelo, estilo, k...)."""
+    return hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+
+
+def _unit(vec: Sequence[float]) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+
+def _best(mat: np.ndarray, q: np.ndarray) -> Tuple[int, float]:
+    sims = mat @ q
+    i = int(np.argmax(sims))
+    return i, float(sims[i])
+
+
+class SemanticCache(abc.ABC):
+    def __init__(self, threshold: float, ttl_s: int, max_entries: int):
+        self.threshold = threshold
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    async def get(self, vec: Sequence[float], ns: str) -> Optional[CachedAnswer]:
+        """La entrada vigente más parecida del namespace si supera el umbral; cuenta hit/miss."""
+
+    @abc.abstractmethod
+    async def put(self, vec: Sequence[float], ns: str, answer: str, retrieved: List[Dict[str, Any]]) -> None:
+        """Guarda la respuesta con TTL `ttl_s`, desalojando por LRU por encima de `max_entries`."""
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else None}
+
+    def _count(self, hit: Optional[CachedAnswer]) -> Optional[CachedAnswer]:
+        if hit is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return hit
+
+
+@dataclass
+class _Entry:
+    ns: str
+    slot: int
+    answer: str
+    retrieved: List[Dict[str, Any]]
+    expires: float
+
+
+class _Slots:
+    """
+    Vectores de un namespace en una matriz preasignada: las filas liberadas
+    vuelven a una lista libre y `valid` marca las ocupadas. Agregar o desalojar
+    es O(dim); la matriz solo se copia al duplicar la capacidad (hasta `max_cap`).
+    """
+
+    def __init__(self, dim: int, capacity: int, max_cap: int):
+        self.max_cap = max_cap
+        self.mat = np.zeros((capacity, dim), dtype=np.float32)
+        self.expires = np.zeros(capacity)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.keys: List[Optional[str]] = [None] * capacity
+        self.free: List[int] = list(range(capacity - 1, -1, -1))
+        self.size = 0
+
+    def add(self, key: str, vec: np.ndarray, expires: float) -> int:
+        if not self.free:
+            self._grow()
+        slot = self.free.pop()
+        self.mat[slot] = vec
+        self.expires[slot] = expires
+        self.valid[slot] = True
+        self.keys[slot] = key
+        self.size += 1
+        return slot
+
+    def remove(self, slot: int) -> None:
+        self.valid[slot] = False
+        self.keys[slot] = None
+        self.free.append(slot)
+        self.size -= 1
+
+    def _grow(self) -> None:
+        cap = len(self.keys)
+        new = max(cap + 1, min(2 * cap, self.max_cap))
+        self.mat = np.concatenate([self.mat, np.zeros((new - cap, self.mat.shape[1]), dtype=np.float32)])
+        self.expires = np.concatenate([self.expires, np.zeros(new - cap)])
+        self.valid = np.concatenate([self.valid, np.zeros(new - cap, dtype=bool)])
+        self.keys += [None] * (new - cap)
+        self.free = list(range(new - 1, cap - 1, -1))
+
+
+class MemorySemanticCache(SemanticCache):
+    def __init__(self, threshold: float, ttl_s: int, max_entries: int):
+        super().__init__(threshold, ttl_s, max_entries)
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()  # orden = LRU
+        self._pools: Dict[str, _Slots] = {}                         # ns -> vectores
+
+    def _drop(self, key: str) -> None:
+        e = self._entries.pop(key, None)
+        if e is None:
+            return
+        pool = self._pools[e.ns]
+        pool.remove(e.slot)
+        if not pool.size:
+            del self._pools[e.ns]
+
+    async def get(self, vec: Sequence[float], ns: str) -> Optional[CachedAnswer]:
+        pool = self._pools.get(ns)
+        if pool is not None:
+            # vencidas fuera antes de comparar: una vencida muy parecida no tapa a una vigente
+            for j in np.flatnonzero(pool.valid & (pool.expires < time.time())):
+                self._drop(pool.keys[j])
+            pool = self._pools.get(ns)
+        if pool is None:
+            return self._count(None)
+        sims = pool.mat @ _unit(vec)
+        sims[~pool.valid] = -np.inf
+        i = int(np.argmax(sims))
+        sim = float(sims[i])
+        if sim < self.threshold:
+            return self._count(None)
+        key = pool.keys[i]
+        e = self._entries[key]
+        self._entries.move_to_end(key)
+        return self._count(CachedAnswer(e.answer, e.retrieved, sim))
+
+    async def put(self, vec: Sequence[float], ns: str, answer: str, retrieved: List[Dict[str, Any]]) -> None:
+        while len(self._entries) >= self.max_entries:
+            self._drop(next(iter(self._entries)))
+        v = _unit(vec)
+        pool = self._pools.get(ns)
+        if pool is None:
+            pool = self._pools[ns] = _Slots(v.shape[0], min(64, self.max_entries), self.max_entries)
+        key = uuid.uuid4().hex
+        expires = time.time() + self.ttl_s
+        self._entries[key] = _Entry(ns, pool.add(key, v, expires), answer, retrieved, expires)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisSemanticCache(SemanticCache):
+    """
+    Por namespace:
+      {prefix}:{ns}:lru        ZSET id -> último acceso (LRU + pertenencia)
+      {prefix}:{ns}:{id}       HASH vec(float32 bytes)/answer/retrieved, con EXPIRE=ttl
+    Los vectores se espejan en memoria local por id para no traerlos en cada lookup,
+    y la matriz apilada se reutiliza mientras el conjunto de ids vivos no cambie.
+    """
+
+    def __init__(self, url: str, threshold: float, ttl_s: int, max_entries: int, prefix: str = "chatmig:semcache"):
+        super().__init__(threshold, ttl_s, max_entries)
+        import redis.asyncio as aioredis
+
+        self._r = aioredis.from_url(url)
+        self._prefix = prefix
+        self._vecs: Dict[str, Dict[str, np.ndarray]] = {}  # ns -> id -> vector
+        self._mats: Dict[str, Tuple[List[str], np.ndarray]] = {}  # ns -> (ids, matriz apilada)
+
+    def _k(self, ns: str, suffix: str) -> str:
+        return f"{self._prefix}:{ns}:{suffix}"
+
+    async def get(self, vec: Sequence[float], ns: str) -> Optional[CachedAnswer]:
+        try:
+            ids = [i.decode() for i in await self._r.zrange(self._k(ns, "lru"), 0, -1)]
+            if not ids:
+                return self._count(None)
+            # el espejo local solo conserva ids que siguen en el ZSET (otras réplicas desalojan)
+            prev = self._vecs.get(ns, {})
+            local = self._vecs[ns] = {i: prev[i] for i in ids if i in prev}
+            missing = [i for i in ids if i not in local]
+            if missing:
+                pipe = self._r.pipeline()
+                for i in missing:
+                    pipe.hget(self._k(ns, i), "vec")
+                for i, raw in zip(missing, await pipe.execute()):
+                    if raw:
+                        local[i] = np.frombuffer(raw, dtype=np.float32)
+            live = [i for i in ids if i in local]
+            if not live:
+                return self._count(None)
+            # el orden del ZSET cambia con cada hit; lo que invalida la matriz es el conjunto
+            cached = self._mats.get(ns)
+            if cached is None or len(cached[0]) != len(live) or not set(cached[0]).issuperset(live):
+                cached = self._mats[ns] = (live, np.stack([local[i] for i in live]))
+            live, mat = cached
+            q = _unit(vec)
+            while live:
+                best, sim = _best(mat, q)
+                if sim < self.threshold:
+                    return self._count(None)
+                key = live[best]
+                answer, retrieved = await self._r.hmget(self._k(ns, key), "answer", "retrieved")
+                if answer is not None:
+                    await self._r.zadd(self._k(ns, "lru"), {key: time.time()})
+                    return self._count(CachedAnswer(answer.decode(), json.loads(retrieved or b"[]"), sim))
+                # expiró por TTL: fuera del espejo y del ZSET, y se prueba la siguiente más parecida
+                local.pop(key, None)
+                live, mat = live[:best] + live[best + 1:], np.delete(mat, best, axis=0)
+                self._mats[ns] = (live, mat)
+                await self._r.zrem(self._k(ns, "lru"), key)
+            return self._count(None)
+        except Exception as e:
+            logger.warning("[semcache] redis get falló: %s", e)
+            return self._count(None)
+
+    async def put(self, vec: Sequence[float], ns: str, answer: str, retrieved: List[Dict[str, Any]]) -> None:
+        key = uuid.uuid4().hex
+        v = _unit(vec)
+        try:
+            pipe = self._r.pipeline()
+            pipe.hset(self._k(ns, key), mapping={
+                "vec": v.tobytes(),
+                "answer": answer,
+                "retrieved": json.dumps(retrieved, ensure_ascii=False),
+            })
+            pipe.expire(self._k(ns, key), self.ttl_s)
+            pipe.zadd(self._k(ns, "lru"), {key: time.time()})
+            pipe.expire(self._k(ns, "lru"), self.ttl_s)
+            pipe.zcard(self._k(ns, "lru"))
+            *_, size = await pipe.execute()
+            self._vecs.setdefault(ns, {})[key] = v
+            self._mats.pop(ns, None)
+            if size > self.max_entries:
+                evicted = await self._r.zpopmin(self._k(ns, "lru"), size - self.max_entries)
+                if evicted:
+                    await self._r.delete(*[self._k(ns, i.decode()) for i, _ in evicted])
+                    for i, _ in evicted:
+                        self._vecs.get(ns, {}).pop(i.decode(), None)
+        except Exception as e:
+            logger.warning("[semcache] redis put falló: %s", e)
+
+    async def aclose(self) -> None:
+        await self._r.aclose()
+
+
+def build_semantic_cache(settings: Any) -> Optional[SemanticCache]:
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
+    kwargs = dict(
+        threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+        ttl_s=settings.SEMANTIC_CACHE_TTL_S,
+        max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+    )
+    if settings.SEMANTIC_CACHE_BACKEND == "redis" and settings.REDIS_URL:
+        return RedisSemanticCache(settings.REDIS_URL, **kwargs)
+    return MemorySemanticCache(**kwargs)
@@ -0,0 +1,360 @@
+# services/api/app/session_memory.py
+"""
+Memoria de conversación por sesión para el agente ChatMig.
+
+Backends:
+  - MemorySessionMemory: en proceso, LRU con máximo de sesiones + TTL por
+    inactividad (memoria acotada aunque lleguen millones de session_id).
+  - RedisSessionMemory: lista capada por sesión (RPUSH + LTRIM + EXPIRE),
+    compartida entre workers/réplicas y persistente entre reinicios.
+  - SQLSessionMemory: tabla `agent_messages` vía app.db (SQLite o Postgres
+    según DATABASE_URL).
+
+Todos guardan como mucho `max_messages` por sesión; qué parte entra en el
+prompt lo decide `trim_to_budget` (presupuesto en tokens, no nº de turnos).
+Además cada sesión puede tener un `Summary` acumulado: `fold` reemplaza los
+mensajes más viejos por el resumen (ver app.summarizer), solo si siguen
+siendo exactamente los que se resumieron (compare-and-trim: un turno
+concurrente o el cap de max_messages pueden haberlos movido).
+"""
+from __future__ import annotations
+
+import abc
+import itertools
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("chatmig.memory")
+
+Message = Dict[str, str]
+
+
+def trim_to_budget(messages: List[Message], max_tokens: int, count: Callable[[str], int]) -> List[Message]:
+    """Los mensajes más recientes que caben en `max_tokens`; nunca empieza con una respuesta huérfana."""
+    total = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        n = 4 + count(messages[i].get("content") or "")  # ≈ overhead por mensaje
+        if total + n > max_tokens:
+            break
+        total += n
+        start = i
+    while start < len(messages) and messages[start].get("role") == "assistant":
+        start += 1
+    return messages[start:]
+
+
+@dataclass
+class Summary:
+    text: str
+    folded_messages: int = 0  # mensajes crudos absorbidos por el resumen (acumulado)
+    folded_tokens: int = 0    # tokens que esos mensajes ocuparían en el prompt
+
+    def dumps(self) -> str:
+        return json.dumps(self.__dict__, ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, raw: Any) -> Optional["Summary"]:
+        return cls(**json.loads(raw)) if raw else None
+
+
+class SessionMemory(abc.ABC):
+    def __init__(self, max_messages: int, ttl_s: int):
+        self.max_messages = max_messages
+        self.ttl_s = ttl_s
+
+    @abc.abstractmethod
+    async def history(self, session_id: str) -> List[Message]:
+        """Mensajes vigentes de la sesión, del más viejo al más nuevo (como mucho `max_messages`)."""
+
+    @abc.abstractmethod
+    async def append(self, session_id: str, messages: List[Message]) -> None:
+        """Agrega al final, recorta a `max_messages` y renueva el TTL."""
+
+    @abc.abstractmethod
+    async def clear(self, session_id: str) -> None:
+        """Borra mensajes y resumen de la sesión."""
+
+    @abc.abstractmethod
+    async def summary(self, session_id: str) -> Optional[Summary]:
+        """Resumen acumulado de la sesión, o None."""
+
+    @abc.abstractmethod
+    async def fold(self, session_id: str, old: List[Message], summary: Summary) -> bool:
+        """
+        Si el historial sigue empezando por `old`, lo descarta y guarda `summary`
+        en su lugar. Si no (turno concurrente, cap, otro worker ya plegó), no
+        toca nada y devuelve False.
+        """
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__, "max_messages": self.max_messages, "ttl_s": self.ttl_s}
+
+
+@dataclass
+class _Session:
+    expires: float
+    messages: Deque[Message] = field(default_factory=deque)
+    summary: Optional[Summary] = None
+
+
+class MemorySessionMemory(SessionMemory):
+    def __init__(self, max_sessions: int, max_messages: int, ttl_s: int):
+        super().__init__(max_messages, ttl_s)
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()  # orden = último uso
+        self.evicted = 0
+
+    def _evict(self, now: float) -> None:
+        # el TTL se renueva en cada uso, así que las sesiones vencidas están al principio
+        s = self._sessions
+        while s and (len(s) > self.max_sessions or next(iter(s.values())).expires < now):
+            s.popitem(last=False)
+            self.evicted += 1
+
+    def _live(self, session_id: str) -> Optional[_Session]:
+        sess = self._sessions.get(session_id)
+        if sess is not None and sess.expires < time.time():
+            del self._sessions[session_id]
+            self.evicted += 1
+            return None
+        return sess
+
+    async def history(self, session_id: str) -> List[Message]:
+        sess = self._live(session_id)
+        return list(sess.messages) if sess else []
+
+    async def summary(self, session_id: str) -> Optional[Summary]:
+        sess = self._live(session_id)
+        return sess.summary if sess else None
+
+    async def fold(self, session_id: str, old: List[Message], summary: Summary) -> bool:
+        sess = self._live(session_id)
+        if sess is None or list(itertools.islice(sess.messages, len(old))) != old:
+            return False
+        for _ in range(len(old)):
+            sess.messages.popleft()
+        sess.summary = summary
+        return True
+
+    async def append(self, session_id: str, messages: List[Message]) -> None:
+        now = time.time()
+        sess = self._sessions.pop(session_id, None)
+        if sess is None or sess.expires < now:
+            sess = _Session(0.0, deque(maxlen=self.max_messages))
+        sess.messages.extend(messages)
+        sess.expires = now + self.ttl_s
+        self._sessions[session_id] = sess
+        self._evict(now)
+
+    async def clear(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions, "evicted": self.evicted}
+
+    def usage(self) -> Tuple[int, int, int]:
+        """(sesiones, mensajes, bytes≈caracteres de contenido); O(mensajes), para /metrics."""
+        messages = chars = 0
+        for sess in list(self._sessions.values()):
+            messages += len(sess.messages)
+            chars += sum(len(m.get("content") or "") for m in sess.messages)
+            if sess.summary is not None:
+                chars += len(sess.summary.text)
+        return len(self._sessions), messages, chars
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class RedisSessionMemory(SessionMemory):
+    """
+    {prefix}:{session_id}          LIST de mensajes JSON, capada a max_messages, con EXPIRE=ttl
+    {prefix}:{session_id}:summary  Summary serializado, mismo TTL
+    """
+
+    # compare-and-trim atómico: la cabeza de la lista tiene que ser la que se resumió
+    FOLD_LUA = """
+    local n = #ARGV - 2
+    local head = redis.call('LRANGE', KEYS[1], 0, n - 1)
+    if #head ~= n then return 0 end
+    for i = 1, n do
+        if head[i] ~= ARGV[i + 2] then return 0 end
+    end
+    redis.call('LTRIM', KEYS[1], n, -1)
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+    return 1
+    """
+
+    def __init__(self, url: str, max_messages: int, ttl_s: int, prefix: str = "chatmig:mem"):
+        super().__init__(max_messages, ttl_s)
+        import redis.asyncio as aioredis
+
+        self._r = aioredis.from_url(url)
+        self._prefix = prefix
+        self._fold = self._r.register_script(self.FOLD_LUA)
+
+    def _k(self, session_id: str) -> str:
+        return f"{self._prefix}:{session_id}"
+
+    async def history(self, session_id: str) -> List[Message]:
+        try:
+            raw = await self._r.lrange(self._k(session_id), 0, -1)
+            return [json.loads(m) for m in raw]
+        except Exception as e:
+            logger.warning("[memory] redis history falló: %s", e)
+            return []
+
+    async def append(self, session_id: str, messages: List[Message]) -> None:
+        key = self._k(session_id)
+        try:
+            pipe = self._r.pipeline(transaction=True)
+            pipe.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.ttl_s)
+            pipe.expire(key + ":summary", self.ttl_s)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("[memory] redis append falló: %s", e)
+
+    async def clear(self, session_id: str) -> None:
+        try:
+            await self._r.delete(self._k(session_id), self._k(session_id) + ":summary")
+        except Exception as e:
+            logger.warning("[memory] redis clear falló: %s", e)
+
+    async def summary(self, session_id: str) -> Optional[Summary]:
+        try:
+            return Summary.loads(await self._r.get(self._k(session_id) + ":summary"))
+        except Exception as e:
+            logger.warning("[memory] redis summary falló: %s", e)
+            return None
+
+    async def fold(self, session_id: str, old: List[Message], summary: Summary) -> bool:
+        key = self._k(session_id)
+        try:
+            args = [summary.dumps(), self.ttl_s, *[json.dumps(m, ensure_ascii=False) for m in old]]
+            return bool(await self._fold(keys=[key, key + ":summary"], args=args))
+        except Exception as e:
+            logger.warning("[memory] redis fold falló: %s", e)
+            return False
+
+    async def aclose(self) -> None:
+        await self._r.aclose()
+
+
+class SQLSessionMemory(SessionMemory):
+    """
+    Filas en `agent_messages` y `agent_summaries` (app.models). Cada append recorta la
+    sesión a max_messages y renueva `updated_at` del resumen; las filas más viejas
+    que el TTL se purgan como mucho una vez por `purge_every_s`.
+    """
+
+    def __init__(self, max_messages: int, ttl_s: int, purge_every_s: float = 60.0):
+        super().__init__(max_messages, ttl_s)
+        from .db import SessionLocal, engine
+        from .models import AgentMessage, AgentSummary
+
+        AgentMessage.__table__.create(bind=engine, checkfirst=True)
+        AgentSummary.__table__.create(bind=engine, checkfirst=True)
+        self._Session = SessionLocal
+        self._Model = AgentMessage
+        self._Summary = AgentSummary
+        self._purge_every_s = purge_every_s
+        self._last_purge = 0.0
+
+    def _window(self, db: Any, session_id: str, lock: bool = False) -> List[Tuple[int, str, str]]:
+        """(id, role, content) de lo que ve `history`, del más viejo al más nuevo."""
+        M = self._Model
+        q = (
+            db.query(M.id, M.role, M.content)
+            .filter(M.session_id == session_id, M.created_at >= time.time() - self.ttl_s)
+            .order_by(M.id.desc())
+            .limit(self.max_messages)
+        )
+        return list(reversed((q.with_for_update() if lock else q).all()))
+
+    def _history(self, session_id: str) -> List[Message]:
+        with self._Session() as db:
+            rows = self._window(db, session_id)
+        return [{"role": r, "content": c} for _, r, c in rows]
+
+    def _append(self, session_id: str, messages: List[Message]) -> None:
+        M = self._Model
+        now = time.time()
+        with self._Session() as db:
+            db.add_all([M(session_id=session_id, role=m["role"], content=m["content"], created_at=now)
+                        for m in messages])
+            db.flush()
+            keep = (
+                db.query(M.id).filter(M.session_id == session_id)
+                .order_by(M.id.desc()).offset(self.max_messages - 1).limit(1).scalar()
+            )
+            if keep is not None:
+                db.query(M).filter(M.session_id == session_id, M.id < keep).delete(synchronize_session=False)
+            # el resumen vive lo que la sesión: cada turno le renueva el TTL (como EXPIRE en Redis)
+            S = self._Summary
+            db.query(S).filter(S.session_id == session_id).update({S.updated_at: now}, synchronize_session=False)
+            if now - self._last_purge > self._purge_every_s:
+                self._last_purge = now
+                db.query(M).filter(M.created_at < now - self.ttl_s).delete(synchronize_session=False)
+                db.query(S).filter(S.updated_at < now - self.ttl_s).delete(synchronize_session=False)
+            db.commit()
+
+    def _clear(self, session_id: str) -> None:
+        with self._Session() as db:
+            db.query(self._Model).filter(self._Model.session_id == session_id).delete(synchronize_session=False)
+            db.query(self._Summary).filter(self._Summary.session_id == session_id).delete(synchronize_session=False)
+            db.commit()
+
+    def _get_summary(self, session_id: str) -> Optional[Summary]:
+        S = self._Summary
+        with self._Session() as db:
+            row = db.get(S, session_id)
+            if row is None or row.updated_at < time.time() - self.ttl_s:
+                return None
+            return Summary.loads(row.content)
+
+    def _fold(self, session_id: str, old: List[Message], summary: Summary) -> bool:
+        M = self._Model
+        with self._Session() as db:
+            head = self._window(db, session_id, lock=True)[: len(old)]
+            if [{"role": r, "content": c} for _, r, c in head] != old:
+                return False
+            # por id, no "los n más viejos": lo que se resumió y nada más
+            db.query(M).filter(M.id.in_([i for i, _, _ in head])).delete(synchronize_session=False)
+            db.merge(self._Summary(session_id=session_id, content=summary.dumps(), updated_at=time.time()))
+            db.commit()
+            return True
+
+    async def history(self, session_id: str) -> List[Message]:
+        return await run_in_threadpool(self._history, session_id)
+
+    async def append(self, session_id: str, messages: List[Message]) -> None:
+        await run_in_threadpool(self._append, session_id, messages)
+
+    async def clear(self, session_id: str) -> None:
+        await run_in_threadpool(self._clear, session_id)
+
+    async def summary(self, session_id: str) -> Optional[Summary]:
+        return await run_in_threadpool(self._get_summary, session_id)
+
+    async def fold(self, session_id: str, old: List[Message], summary: Summary) -> bool:
+        return await run_in_threadpool(self._fold, session_id, old, summary)
+
+
+def build_session_memory(settings: Any) -> SessionMemory:
+    backend = settings.AGENT_MEMORY_BACKEND
+    kwargs = dict(max_messages=settings.AGENT_MEMORY_MAX_MESSAGES, ttl_s=settings.AGENT_MEMORY_TTL_S)
+    if backend == "redis" and settings.REDIS_URL:
+        return RedisSessionMemory(settings.REDIS_URL, **kwargs)
+    if backend == "sql":
+        return SQLSessionMemory(**kwargs)
+    return MemorySessionMemory(max_sessions=settings.AGENT_MEMORY_MAX_SESSIONS, **kwargs)
@@ -1,6 +1,6 @@
 # services/api/app/settings.py
 from functools import lru_cache
-from typing import Optional, List, Any, Union
+from typing import Optional, List, Any, Union, Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field, field_validator
 import json
@@ -16,6 +16,79 @@ class Settings(BaseSettings):
     SUPABASE_SERVICE_ROLE_KEY: Optional[str] = None
     SUPABASE_ANON_KEY: Optional[str] = None
 
+    # --- HTTP saliente (pool compartido por host: OpenAI, Anthropic, PayPal...) ---
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    HTTP_READ_TIMEOUT: Optional[float] = 120.0  # entre chunks de un stream
+    HTTP_POOL_TIMEOUT: float = 10.0
+    HTTP2_ENABLED: bool = True
+
+    # --- RAG: índice vectorial local (scripts/ingest_knowledge.py) con fallback a Supabase ---
+    RAG_BACKEND: Literal["auto", "supabase"] = "auto"  # auto = índice local si existe
+    VECTOR_INDEX_PATH: Optional[str] = "knowledge_index"
+    VECTOR_INDEX_NPROBE: int = 8  # listas exploradas en modo ivf
+
+    # --- Redis (opcional; ya está en docker-compose) ---
+    REDIS_URL: Optional[str] = None
+
+    # --- Caché semántica de respuestas de /llm ---
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_BACKEND: Literal["memory", "redis"] = "memory"
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95  # similitud coseno mínima para hit
+    SEMANTIC_CACHE_TTL_S: int = 3600
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 2000
+
+    # --- Memoria de sesión del agente ChatMig ---
+    AGENT_MEMORY_BACKEND: Literal["memory", "redis", "sql"] = "memory"  # sql = DATABASE_URL (app.db)
+    AGENT_MEMORY_MAX_SESSIONS: int = 10000  # solo backend memory (LRU)
+    AGENT_MEMORY_TTL_S: int = 86400         # inactividad antes de olvidar la sesión
+    AGENT_MEMORY_MAX_MESSAGES: int = 40     # tope almacenado por sesión
+    AGENT_HISTORY_MAX_TOKENS: int = 2000    # historial que entra en el prompt
+    AGENT_SUMMARY_ENABLED: bool = True      # resumen incremental en segundo plano
+    AGENT_SUMMARY_TRIGGER_TOKENS: int = 1500  # historial crudo que dispara el pliegue
+    AGENT_SUMMARY_KEEP_TOKENS: int = 500    # turnos recientes que quedan literales
+
+    # --- Coalescing: requests idénticos en vuelo comparten una sola llamada/stream upstream ---
+    SINGLE_FLIGHT_ENABLED: bool = True
+
+    # --- Control de admisión hacia los proveedores (RPM/TPM + cola justa por usuario) ---
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_BACKEND: Literal["memory", "redis"] = "memory"  # redis = buckets compartidos entre réplicas
+    # {"openai:gpt-4o-mini": {"rpm": 500, "tpm": 200000}, "openai:*": {...}, "*": {...}}; {} = sin límite
+    RATE_LIMITS_JSON: str = '{"*": {"rpm": 500, "tpm": 200000}}'
+    RATE_LIMIT_QUEUE_PER_USER: int = 4      # solicitudes en espera por usuario
+    RATE_LIMIT_QUEUE_MAX: int = 200         # solicitudes en espera por proveedor:modelo
+    RATE_LIMIT_MAX_WAIT_S: float = 30.0     # espera estimada mayor → 429 inmediato
+    RATE_LIMIT_COMPLETION_TOKENS: int = 1024  # salida estimada cuando la ruta no fija max_tokens
+
+    # --- Medición de tokens y cuotas diarias por usuario (app.metering) ---
+    METERING_ENABLED: bool = True
+    METERING_BACKEND: Literal["memory", "redis"] = "memory"  # redis = contadores compartidos entre réplicas
+    METERING_FLUSH_S: float = 5.0        # volcado por lotes a usage_counters (RPC usage_increment)
+    METERING_FLUSH_MAX_ROWS: int = 500   # filas por RPC
+    QUOTA_DAILY_TOKENS: int = 0          # sin plan o sin Supabase; 0 = sin límite
+    QUOTA_DAILY_MESSAGES: int = 0
+
+    # --- Orden del prompt ---
+    # static_first: todo lo fijo (system, reglas, estilo) antes de lo variable (historial, contexto),
+    # para que el proveedor reutilice su caché de prompt; legacy: orden/textos anteriores
+    PROMPT_LAYOUT: Literal["static_first", "legacy"] = "static_first"
+
+    # --- Compresión de respuestas (app.compression; zstd/br si están instalados, gzip siempre) ---
+    COMPRESSION_MIN_SIZE: int = 800   # cuerpos completos más chicos van sin comprimir
+    COMPRESSION_STREAMS: bool = True  # streams en gzip con flush por evento (opt-out: X-Stream-Encoding: identity)
+
+    # --- Métricas Prometheus en GET /metrics (requiere prometheus_client) ---
+    METRICS_ENABLED: bool = True
+
+    # --- Trazas OpenTelemetry (OTLP/HTTP; requiere opentelemetry-sdk + exporter otlp-proto-http) ---
+    TRACING_ENABLED: bool = False
+    OTEL_EXPORTER_OTLP_ENDPOINT: str = "http://localhost:4318"
+    OTEL_SERVICE_NAME: str = "chatmig-api"
+    TRACING_SAMPLE_RATIO: float = 0.1  # ParentBased: un traceparent muestreado siempre se sigue
+
     # --- CORS ---
     # Acepta CSV ("http://localhost:5173,http://127.0.0.1:5173")
     # o JSON (["http://localhost:5173","http://127.0.0.1:5173"])
@@ -0,0 +1,197 @@
+# services/api/app/single_flight.py
+"""
+Coalescing de requests idénticos concurrentes (single-flight).
+
+La clave es un hash de lo que realmente se manda al proveedor (mensajes ya
+armados, modelo, temperatura, max_tokens...). Mientras hay una llamada en
+vuelo con esa clave:
+  - `do(key, fn)`: los demás esperan el mismo resultado (o la misma excepción).
+  - `stream(key, factory)`: un solo stream upstream reparte sus items a N
+    suscriptores; quien llega tarde recibe primero lo ya emitido. Si se van
+    todos los suscriptores se cancela el upstream (igual que sin coalescing).
+
+La llamada corre en su propia tarea: si el primero se desconecta, los que
+esperan no pierden el resultado. Nada se guarda al terminar (eso es de la
+caché semántica): solo se comparte lo que está en vuelo.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger("chatmig.flight")
+
+T = TypeVar("T")
+
+
+def flight_key(*parts: Any) -> str:
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class FlightStats:
+    calls: int = 0       # llamadas upstream hechas por do()
+    coalesced: int = 0   # requests que se sumaron a una llamada en vuelo
+    streams: int = 0     # streams upstream abiertos por stream()
+    joined: int = 0      # suscriptores que se sumaron a un stream en vuelo
+
+    def as_dict(self) -> Dict[str, Any]:
+        total = self.calls + self.coalesced + self.streams + self.joined
+        saved = self.coalesced + self.joined
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "streams": self.streams,
+            "joined": self.joined,
+            "saved_upstream_calls": saved,
+            "saved_ratio": round(saved / total, 4) if total else None,
+        }
+
+
+class _Broadcast:
+    """Un stream upstream bombeado a un buffer compartido por los suscriptores."""
+
+    def __init__(self, source: AsyncIterator[Any], on_done: Callable[[], None]):
+        self.items: List[Any] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self._event = asyncio.Event()
+        self._on_done = on_done
+        self.task = asyncio.create_task(self._pump(source))
+        self.task.add_done_callback(lambda _: on_done())  # también si se cancela antes de arrancar
+
+    def _wake(self) -> None:
+        ev, self._event = self._event, asyncio.Event()
+        ev.set()
+
+    async def _pump(self, source: AsyncIterator[Any]) -> None:
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._wake()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._on_done()
+            self._wake()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+
+
+class _Subscription:
+    """
+    Iterador de un suscriptor. Cuenta desde que se crea (así el upstream no se
+    cancela entre `stream()` y el primer `__anext__`) y descuenta una sola vez:
+    al terminar, con error o cancelación, en `aclose()` o si se descarta sin
+    iterar.
+    """
+
+    def __init__(self, b: _Broadcast):
+        self._b = b
+        self._i = 0
+        self._left = False
+        b.subscribers += 1
+
+    def __aiter__(self) -> "_Subscription":
+        return self
+
+    async def __anext__(self) -> Any:
+        b = self._b
+        try:
+            while True:
+                if self._i < len(b.items):
+                    self._i += 1
+                    return b.items[self._i - 1]
+                if b.done:
+                    if b.error is not None:
+                        raise b.error
+                    raise StopAsyncIteration
+                await b._event.wait()
+        except BaseException:
+            self._leave()
+            raise
+
+    async def aclose(self) -> None:
+        self._leave()
+
+    def __del__(self) -> None:
+        self._leave()
+
+    def _leave(self) -> None:
+        if self._left:
+            return
+        self._left = True
+        b = self._b
+        b.subscribers -= 1
+        if b.subscribers == 0 and not b.done:
+            b.task.cancel()  # nadie escucha: cerrar el stream upstream
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[str, "asyncio.Task[Any]"] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self.stats = FlightStats()
+
+    def _forget_call(self, key: str, task: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # marcada como leída aunque todos se hayan ido
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget_call(key, t))
+            self.stats.calls += 1
+        else:
+            self.stats.coalesced += 1
+            logger.debug("[flight] %s… se suma a llamada en vuelo", key[:12])
+        return await asyncio.shield(task)
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls or key in self._streams
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        b = self._streams.get(key)
+        if b is None:
+            def forget() -> None:
+                if self._streams.get(key) is b:
+                    del self._streams[key]
+
+            b = _Broadcast(factory(), forget)
+            self._streams[key] = b
+            self.stats.streams += 1
+        else:
+            self.stats.joined += 1
+            logger.debug("[flight] %s… se suma a stream en vuelo (%d items ya emitidos)", key[:12], len(b.items))
+        return _Subscription(b)
+
+
+async def coalesce(flights: Optional[SingleFlight], key: str, fn: Callable[[], Awaitable[T]]) -> T:
+    """`flights.do(key, fn)`, o `fn()` directo si el coalescing está apagado."""
+    if flights is None:
+        return await fn()
+    return await flights.do(key, fn)
+
+
+def fan_out(flights: Optional[SingleFlight], key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+    """`flights.stream(key, factory)`, o `factory()` directo si el coalescing está apagado."""
+    if flights is None:
+        return factory()
+    return flights.stream(key, factory)
@@ -0,0 +1,200 @@
+# services/api/app/sse.py
+"""
+Decoder SSE incremental y codificador NDJSON compartidos por todos los streams
+hacia proveedores (OpenAI, Anthropic, Mistral, Gemini, agente ChatMig).
+
+- `SSEDecoder` trabaja sobre bytes crudos (`response.aiter_bytes()`): no decodifica
+  a texto hasta tener el evento completo, así que un carácter UTF-8 o un `\\r\\n`
+  partidos entre chunks no rompen nada. Sigue el formato de eventos de la spec
+  (líneas `data:` múltiples se unen con `\\n`, comentarios `:`, campo `event:`).
+- `iter_deltas(response, extractor)` → texto de cada delta, según el proveedor.
+- `ndjson_delta` / `ndjson_done` / `ndjson_line`: salida NDJSON con orjson si
+  está instalado (json stdlib si no).
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, List, NamedTuple, Optional
+
+logger = logging.getLogger("chatmig.sse")
+
+try:  # orjson es opcional: ~5-10x más rápido en dumps/loads
+    import orjson
+
+    def _loads(data: str) -> Any:
+        return orjson.loads(data)
+
+    def ndjson_line(obj: Any) -> bytes:
+        return orjson.dumps(obj) + b"\n"
+except Exception:
+    def _loads(data: str) -> Any:
+        return json.loads(data)
+
+    def ndjson_line(obj: Any) -> bytes:
+        return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def ndjson_delta(text: str) -> bytes:
+    return ndjson_line({"type": "delta", "content": text})
+
+
+def ndjson_done(**extra: Any) -> bytes:
+    return ndjson_line({"type": "done", **extra})
+
+
+def ndjson_error(error: str) -> bytes:
+    return ndjson_line({"type": "error", "error": error})
+
+
+class SSEEvent(NamedTuple):
+    event: str  # "message" si el evento no trae `event:`
+    data: str
+    id: Optional[str] = None
+
+
+class SSEDecoder:
+    """feed(bytes) → eventos completos; el resto queda en buffer hasta el próximo chunk."""
+
+    __slots__ = ("_buf", "_data", "_event", "_id", "_skip_lf")
+
+    def __init__(self) -> None:
+        self._buf = b""
+        self._data: List[bytes] = []
+        self._event: Optional[bytes] = None
+        self._id: Optional[bytes] = None
+        self._skip_lf = False  # el chunk anterior terminó en \r: un \n inicial es parte del mismo fin de línea
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        if self._skip_lf and chunk:
+            self._skip_lf = False
+            if chunk[:1] == b"\n":
+                chunk = chunk[1:]
+        buf = self._buf + chunk if self._buf else chunk
+        end = max(buf.rfind(b"\n"), buf.rfind(b"\r"))
+        if end < 0:
+            self._buf = buf
+            return []
+        if end == len(buf) - 1 and buf[end] == 13:  # \r al final: puede venir \n en el próximo chunk
+            self._skip_lf = True
+        self._buf = buf[end + 1:]
+        out: List[SSEEvent] = []
+        for line in buf[: end + 1].splitlines():
+            self._line(line, out)
+        return out
+
+    def flush(self) -> List[SSEEvent]:
+        """Fin del stream: procesa la última línea sin terminador y despacha lo pendiente."""
+        out: List[SSEEvent] = []
+        if self._buf:
+            self._line(self._buf, out)
+            self._buf = b""
+        self._line(b"", out)
+        return out
+
+    def _line(self, line: bytes, out: List[SSEEvent]) -> None:
+        if not line:
+            if self._data:
+                out.append(SSEEvent(
+                    self._event.decode("utf-8", "replace") if self._event else "message",
+                    b"\n".join(self._data).decode("utf-8", "replace"),
+                    self._id.decode("utf-8", "replace") if self._id is not None else None,
+                ))
+                self._data = []
+            self._event = None
+            return
+        if line[0] == 58:  # ":" comentario / keep-alive
+            return
+        field, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value
+        elif field == b"id":
+            self._id = value
+        # retry y campos desconocidos se ignoran (spec)
+
+
+class ProviderStreamError(RuntimeError):
+    """Error de un stream de proveedor; `status_code` si vino de la respuesta HTTP (no de un evento)."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+async def iter_sse(response: Any) -> AsyncIterator[SSEEvent]:
+    decoder = SSEDecoder()
+    async for chunk in response.aiter_bytes():
+        for evt in decoder.feed(chunk):
+            yield evt
+    for evt in decoder.flush():
+        yield evt
+
+
+# --------- Extractores por proveedor: evento SSE ya parseado → texto del delta ---------
+Extractor = Callable[[str, Any], Optional[str]]
+
+
+def openai_text(event: str, obj: Any) -> Optional[str]:
+    """OpenAI / Mistral / compatibles: choices[0].delta.content."""
+    if "error" in obj:
+        raise ProviderStreamError(str(obj["error"]))
+    choices = obj.get("choices") or ()
+    if not choices:
+        return None  # p.ej. chunk final de usage
+    return (choices[0].get("delta") or {}).get("content")
+
+
+def anthropic_text(event: str, obj: Any) -> Optional[str]:
+    """Anthropic Messages: solo content_block_delta/text_delta lleva texto."""
+    kind = obj.get("type") or event
+    if kind == "content_block_delta":
+        delta = obj.get("delta") or {}
+        return delta.get("text") if delta.get("type") == "text_delta" else None
+    if kind == "error":
+        raise ProviderStreamError(str(obj.get("error")))
+    return None
+
+
+def gemini_text(event: str, obj: Any) -> Optional[str]:
+    """Gemini streamGenerateContent?alt=sse: concatena las parts de texto del primer candidato."""
+    if "error" in obj:
+        raise ProviderStreamError(str(obj["error"]))
+    cands = obj.get("candidates") or ()
+    if not cands:
+        return None
+    parts = (cands[0].get("content") or {}).get("parts") or ()
+    return "".join(p.get("text") or "" for p in parts) or None
+
+
+async def iter_deltas(
+    response: Any, extract: Extractor, on_event: Optional[Callable[[str, Any], None]] = None
+) -> AsyncIterator[str]:
+    """
+    Texto de cada delta de un stream SSE de proveedor. Un status != 200 o un
+    evento de error del proveedor levantan ProviderStreamError; los eventos que
+    no son JSON se registran y se saltan. `on_event(event, obj)` ve todos los
+    eventos JSON (p.ej. para leer el bloque usage).
+    """
+    if response.status_code != 200:
+        body = await response.aread()
+        raise ProviderStreamError(f"HTTP {response.status_code}: {body[:500].decode('utf-8', 'replace')}",
+                                  status_code=response.status_code)
+    async for evt in iter_sse(response):
+        if evt.data == "[DONE]":
+            continue  # drenar hasta EOF: la conexión vuelve al pool
+        try:
+            obj = _loads(evt.data)
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            logger.debug("[sse] evento no JSON descartado: %.200s", evt.data)
+            continue
+        if on_event is not None:
+            on_event(evt.event, obj)
+        text = extract(evt.event, obj)
+        if text:
+            yield text
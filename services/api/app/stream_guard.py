@@ -0,0 +1,131 @@
+# services/api/app/stream_guard.py
+"""
+Corte de streams cuando el cliente se desconecta.
+
+`guard_disconnect(request, source, route)` envuelve el generador de un
+StreamingResponse: antes de reenviar cada chunk consulta
+`request.is_disconnected()` y, si el cliente ya no está, cierra `source`
+(aclose). Eso propaga el cierre hasta el `async with client.stream(...)` o el
+AsyncStream de OpenAI y aborta la generación upstream como mucho un chunk
+después de la desconexión (no dependemos de que el servidor ASGI cancele el
+generador por su cuenta).
+
+Métricas por ruta (GET /healthz/streams):
+  - cancelled / tokens_before_cancel: streams cortados y tokens ya generados.
+  - avoided_tokens: estimación de tokens que no se pidieron = largo medio de
+    los streams completos de la ruta (EWMA) − generados, acotado por max_tokens.
+  - time_saved_s: avoided_tokens / ritmo observado del stream cortado.
+Se cuenta ≈1 token por chunk (los proveedores envían un delta por token).
+Además mantiene el gauge chatmig_streams_in_flight{route} (app.metrics).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from fastapi import Request
+
+from . import metrics
+
+logger = logging.getLogger("chatmig.stream")
+
+
+@dataclass
+class RouteStreamStats:
+    started: int = 0
+    completed: int = 0
+    cancelled: int = 0
+    tokens_before_cancel: int = 0
+    avoided_tokens: float = 0.0
+    time_saved_s: float = 0.0
+    avg_tokens: Optional[float] = None  # EWMA de tokens de los streams completos
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "tokens_before_cancel": self.tokens_before_cancel,
+            "avoided_tokens": round(self.avoided_tokens),
+            "time_saved_s": round(self.time_saved_s, 3),
+            "avg_tokens": round(self.avg_tokens, 1) if self.avg_tokens is not None else None,
+        }
+
+
+_STATS: Dict[str, RouteStreamStats] = {}
+
+
+def route_stats(route: str) -> RouteStreamStats:
+    st = _STATS.get(route)
+    if st is None:
+        st = _STATS[route] = RouteStreamStats()
+    return st
+
+
+def stats() -> Dict[str, Any]:
+    return {route: st.as_dict() for route, st in _STATS.items()}
+
+
+def _record_cancel(st: RouteStreamStats, route: str, tokens: int, first: Optional[float],
+                   max_tokens: Optional[int]) -> None:
+    st.cancelled += 1
+    st.tokens_before_cancel += tokens
+    expected = st.avg_tokens if st.avg_tokens is not None else max_tokens
+    if expected is not None and max_tokens is not None:
+        expected = min(expected, max_tokens)
+    avoided = max(0.0, (expected or 0) - tokens)
+    saved = 0.0
+    if first is not None and tokens > 1:
+        rate = (tokens - 1) / max(1e-6, time.monotonic() - first)  # tokens/s tras el primero
+        saved = avoided / rate if rate > 0 else 0.0
+    st.avoided_tokens += avoided
+    st.time_saved_s += saved
+    logger.info("[stream] %s: cliente desconectado tras %d tokens · evitados≈%d (≈%.1fs)", route, tokens, avoided, saved)
+
+
+async def guard_disconnect(
+    request: Request,
+    source: AsyncIterator[Any],
+    route: str,
+    *,
+    max_tokens: Optional[int] = None,
+    count: Optional[Callable[[Any], int]] = None,
+) -> AsyncIterator[Any]:
+    st = route_stats(route)
+    st.started += 1
+    in_flight = metrics.streams_in_flight(route)
+    in_flight.inc()
+    tokens = 0
+    first: Optional[float] = None
+    finished = False
+    cancelled = False
+    try:
+        async for chunk in source:
+            if await request.is_disconnected():
+                cancelled = True
+                break
+            tokens += count(chunk) if count else 1
+            if first is None:
+                first = time.monotonic()
+            yield chunk
+        else:
+            finished = True
+    except (asyncio.CancelledError, GeneratorExit):
+        cancelled = True  # el servidor ASGI canceló el stream (desconexión detectada por él)
+        raise
+    finally:
+        in_flight.dec()
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception:
+                pass
+        if finished:
+            st.completed += 1
+            st.avg_tokens = tokens if st.avg_tokens is None else 0.1 * tokens + 0.9 * st.avg_tokens
+        elif cancelled:
+            _record_cancel(st, route, tokens, first, max_tokens)
@@ -0,0 +1,163 @@
+# services/api/app/summarizer.py
+"""
+Resumen incremental de la conversación del agente.
+
+Cuando el historial crudo de una sesión supera `trigger_tokens`, los turnos más
+viejos se pliegan en un único resumen (resumen previo + turnos nuevos → resumen
+nuevo) y solo quedan literales los últimos ~`keep_tokens`. Corre en segundo
+plano después de enviar la respuesta (BackgroundTask), nunca en el camino del
+request; el siguiente turno ya ve el historial compacto.
+
+El pliegue es condicional: `memory.fold` solo recorta si el historial sigue
+empezando por los mensajes que se resumieron. Si mientras el LLM resumía
+entró otro turno que movió la ventana (cap de max_messages) u otro worker ya
+plegó, se descarta el resumen (`fold_conflicts`) y se reintenta en el próximo
+turno. `_running` solo evita trabajo duplicado dentro del proceso.
+"""
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from . import metrics
+from .session_memory import Message, SessionMemory, Summary, trim_to_budget
+from .tokens import token_counter
+
+logger = logging.getLogger("chatmig.summary")
+
+Complete = Callable[[List[Message]], Awaitable[str]]
+
+SUMMARY_PROMPT = (
+    "Actualiza el resumen de una conversación entre un usuario y ChatMig (asistente de migración). "
+    "Conserva datos del usuario (país de origen, destino, tipo de visa, plazos, presupuesto, documentos), "
+    "decisiones tomadas y preguntas pendientes. Descarta saludos y relleno. "
+    "Responde solo con el resumen, en español, en viñetas, máximo {max_words} palabras."
+)
+
+
+def summary_message(summary: Summary) -> Message:
+    return {"role": "system", "content": f"Resumen de la conversación previa:\n{summary.text}"}
+
+
+def message_tokens(messages: List[Message], count: Callable[[str], int]) -> int:
+    return sum(4 + count(m.get("content") or "") for m in messages)
+
+
+@dataclass
+class SummaryStats:
+    turns: int = 0
+    prompt_tokens: int = 0
+    saved_tokens: int = 0
+    folds: int = 0
+    fold_conflicts: int = 0
+    fold_errors: int = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        raw = self.prompt_tokens + self.saved_tokens
+        return {
+            **self.__dict__,
+            "saved_ratio": round(self.saved_tokens / raw, 4) if raw else None,
+        }
+
+
+class RollingSummarizer:
+    def __init__(
+        self,
+        memory: SessionMemory,
+        complete: Complete,
+        count: Callable[[str], int],
+        trigger_tokens: int = 1500,
+        keep_tokens: int = 500,
+        max_words: int = 180,
+    ):
+        self.memory = memory
+        self.complete = complete
+        self.count = count
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.max_words = max_words
+        self.stats = SummaryStats()
+        self._running: Set[str] = set()  # un pliegue a la vez por sesión
+
+    def record(self, session_id: str, prompt: List[Message], summary: Optional[Summary]) -> None:
+        """Contabiliza el prompt de un turno y cuánto ahorró el resumen frente a reenviar los turnos crudos."""
+        prompt_tokens = message_tokens(prompt, self.count)
+        saved = 0
+        if summary is not None:
+            saved = max(0, summary.folded_tokens - message_tokens([summary_message(summary)], self.count))
+        s = self.stats
+        s.turns += 1
+        s.prompt_tokens += prompt_tokens
+        s.saved_tokens += saved
+        metrics.observe_summary_turn(prompt_tokens, saved)
+        if saved:
+            logger.info("[summary] sesión=%s prompt=%d tokens · ahorro=%d tokens (%d mensajes resumidos)",
+                        session_id, prompt_tokens, saved, summary.folded_messages)
+
+    async def maybe_fold(self, session_id: Optional[str]) -> None:
+        if not session_id or session_id in self._running:
+            return
+        self._running.add(session_id)
+        try:
+            history = await self.memory.history(session_id)
+            if message_tokens(history, self.count) <= self.trigger_tokens:
+                return
+            kept = trim_to_budget(history, self.keep_tokens, self.count)
+            old = history[: len(history) - len(kept)]
+            if not old:
+                return
+            prev = await self.memory.summary(session_id)
+            text = await self.complete(self._prompt(prev, old))
+            if not text.strip():
+                return
+            folded = Summary(
+                text=text.strip(),
+                folded_messages=(prev.folded_messages if prev else 0) + len(old),
+                folded_tokens=(prev.folded_tokens if prev else 0) + message_tokens(old, self.count),
+            )
+            if not await self.memory.fold(session_id, old, folded):
+                self.stats.fold_conflicts += 1
+                metrics.summary_fold("conflict")
+                logger.info("[summary] sesión=%s: el historial cambió mientras se resumía, se descarta", session_id)
+                return
+            self.stats.folds += 1
+            metrics.summary_fold("ok")
+            logger.info("[summary] sesión=%s: %d mensajes plegados (%d tokens → %d)", session_id, len(old),
+                        message_tokens(old, self.count), self.count(folded.text))
+        except Exception as e:
+            self.stats.fold_errors += 1
+            metrics.summary_fold("error")
+            logger.warning("[summary] sesión=%s: resumen falló: %s", session_id, e)
+        finally:
+            self._running.discard(session_id)
+
+    def _prompt(self, prev: Optional[Summary], old: List[Message]) -> List[Message]:
+        turns = "\n".join(f"{m['role']}: {m['content']}" for m in old)
+        body = f"Resumen actual:\n{prev.text}\n\n" if prev else ""
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_words=self.max_words)},
+            {"role": "user", "content": f"{body}Turnos nuevos:\n{turns}"},
+        ]
+
+
+def openai_complete(client: Callable[[], Any], model: str, max_tokens: int = 400) -> Complete:
+    """`complete` sobre el AsyncOpenAI compartido (`client()` lo crea en el primer resumen)."""
+    async def complete(messages: List[Message]) -> str:
+        r = await client().chat.completions.create(
+            model=model, messages=messages, temperature=0.2, max_tokens=max_tokens
+        )
+        return r.choices[0].message.content or ""
+    return complete
+
+
+def build_summarizer(settings: Any, memory: SessionMemory, client: Callable[[], Any]) -> Optional[RollingSummarizer]:
+    if not settings.AGENT_SUMMARY_ENABLED:
+        return None
+    return RollingSummarizer(
+        memory,
+        openai_complete(client, settings.OPENAI_MODEL),
+        token_counter(settings.OPENAI_MODEL),
+        trigger_tokens=settings.AGENT_SUMMARY_TRIGGER_TOKENS,
+        keep_tokens=settings.AGENT_SUMMARY_KEEP_TOKENS,
+    )
@@ -0,0 +1,47 @@
+# services/api/app/tokens.py
+"""
+Conteo de tokens: tiktoken si está instalado (y su BPE disponible), si no una
+estimación ~4 caracteres/token, suficiente para presupuestos y lotes.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Any, Callable, List, Optional
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: Optional[str]) -> Optional[Any]:
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("cl100k_base")
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None  # sin tiktoken o sin red para bajar el BPE: heurística
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        return estimate_tokens(text)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def token_counter(model: Optional[str] = None) -> Callable[[str], int]:
+    """Función de conteo ya resuelta (evita el lookup por llamada en bucles calientes)."""
+    enc = _encoding(model)
+    if enc is None:
+        return estimate_tokens
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[dict], model: Optional[str] = None) -> int:
+    """Aproximación de tokens de prompt para una lista de mensajes chat (≈4 de overhead c/u)."""
+    count = token_counter(model)
+    return sum(4 + count(str(m.get("content") or "")) for m in messages) + 2
@@ -0,0 +1,199 @@
+# services/api/app/tracing.py
+"""
+Trazas OpenTelemetry opcionales (OTLP/HTTP a un collector local).
+
+Spans:
+  - HTTP <método> <ruta>: uno por request (TracingMiddleware), continúa el
+    `traceparent` entrante.
+  - rag.embed / rag.search / rag.context: fases de _retrieve_context en /llm.
+  - llm.stream / llm.complete (/llm) y llm.<proveedor> (main.py): una llamada
+    al modelo; el evento `first_token` separa el TTFT del resto del stream.
+  - supabase.<op> (payments/paypal.py, billing.py) y db.<op> (progress.py).
+
+Configuración (Settings en app.main, env en main.py):
+  TRACING_ENABLED=true, OTEL_EXPORTER_OTLP_ENDPOINT=http://localhost:4318,
+  OTEL_SERVICE_NAME=chatmig-api, TRACING_SAMPLE_RATIO=0.1 (ParentBased:
+  si el request ya viene muestreado se respeta la decisión del padre).
+
+Apagado (default) o sin opentelemetry-sdk: no se agrega el middleware y
+`span()` devuelve siempre el mismo objeto no-op (no se toca el SDK ni el
+contexto).
+"""
+from __future__ import annotations
+
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from .metrics import route_of  # misma resolución endpoint → plantilla de ruta que /metrics
+
+logger = logging.getLogger("chatmig.tracing")
+
+try:
+    from opentelemetry import context, propagate, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+    HAS_OTEL = True
+except ImportError:  # pragma: no cover - depende del entorno
+    HAS_OTEL = False
+
+_tracer: Optional[Any] = None
+_provider: Optional[Any] = None
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    """Span del SDK como context manager; `current=False` no lo instala en el contexto."""
+
+    __slots__ = ("_span", "_token")
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]], current: bool, kind: Any = None):
+        self._span = _tracer.start_span(name, attributes=attributes, kind=kind or SpanKind.INTERNAL)
+        self._token = None
+        if current:
+            self._token = context.attach(trace.set_span_in_context(self._span))
+
+    def __enter__(self) -> Any:
+        return self._span
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            self._span.record_exception(exc)
+            self._span.set_status(Status(StatusCode.ERROR, type(exc).__name__))
+        if self._token is not None:
+            try:
+                context.detach(self._token)
+            except Exception:
+                pass  # generador cerrado desde otro contexto: el span igual se cierra
+        self._span.end()
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, attributes: Optional[Dict[str, Any]] = None, *, current: bool = True) -> Any:
+    """
+    `with span("rag.search", {"rag.backend": "local"}) as sp:`. En generadores
+    async (llm.*) usar `current=False`: el contexto no sobrevive entre yields.
+    """
+    if _tracer is None:
+        return NOOP_SPAN
+    return _Span(name, attributes, current)
+
+
+def configure(
+    enabled: bool,
+    endpoint: str = "http://localhost:4318",
+    sample_ratio: float = 0.1,
+    service_name: str = "chatmig-api",
+    exporter: Any = None,
+) -> bool:
+    """Instala el TracerProvider (una vez por proceso). Devuelve si quedó activo."""
+    global _tracer, _provider
+    if not enabled:
+        return False
+    if not HAS_OTEL:
+        logger.warning("[tracing] TRACING_ENABLED pero opentelemetry-sdk no está instalado")
+        return False
+    if _tracer is not None:
+        return True
+    if exporter is None:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.warning("[tracing] falta opentelemetry-exporter-otlp-proto-http: trazas desactivadas")
+            return False
+        exporter = OTLPSpanExporter(endpoint=endpoint.rstrip("/") + "/v1/traces")
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name}),
+        sampler=ParentBased(TraceIdRatioBased(sample_ratio)),
+    )
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = _provider.get_tracer("chatmig")
+    logger.info("[tracing] OTLP → %s · muestreo=%.2f", endpoint, sample_ratio)
+    return True
+
+
+def configure_from_settings(settings: Any) -> bool:
+    return configure(
+        settings.TRACING_ENABLED,
+        settings.OTEL_EXPORTER_OTLP_ENDPOINT,
+        settings.TRACING_SAMPLE_RATIO,
+        settings.OTEL_SERVICE_NAME,
+    )
+
+
+def configure_from_env(default_service: str = "chatmig-api") -> bool:
+    return configure(
+        os.getenv("TRACING_ENABLED", "false").lower() in ("1", "true", "yes"),
+        os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"),
+        float(os.getenv("TRACING_SAMPLE_RATIO", "0.1")),
+        os.getenv("OTEL_SERVICE_NAME", default_service),
+    )
+
+
+def shutdown() -> None:
+    """Vacía el BatchSpanProcessor (lifespan)."""
+    if _provider is not None:
+        _provider.force_flush()
+
+
+class TracingMiddleware:
+    """ASGI puro: span SERVER por request hasta el último byte (incluye streams)."""
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or _tracer is None:
+            await self.app(scope, receive, send)
+            return
+        carrier = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers") or ()}
+        parent = propagate.extract(carrier)
+        sp = _tracer.start_span(
+            f"HTTP {scope['method']}", context=parent, kind=SpanKind.SERVER,
+            attributes={"http.request.method": scope["method"], "url.path": scope["path"]},
+        )
+        token = context.attach(trace.set_span_in_context(sp, parent))
+
+        async def send_status(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                sp.set_attribute("http.response.status_code", message["status"])
+                if message["status"] >= 500:
+                    sp.set_status(Status(StatusCode.ERROR))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        except BaseException as e:
+            sp.record_exception(e)
+            sp.set_status(Status(StatusCode.ERROR, type(e).__name__))
+            raise
+        finally:
+            route = route_of(scope)
+            sp.set_attribute("http.route", route)
+            sp.update_name(f"HTTP {scope['method']} {route}")
+            context.detach(token)
+            sp.end()
@@ -0,0 +1,203 @@
+# services/api/app/vector_index.py
+"""
+Índice vectorial local para RAG (alternativa en proceso al RPC `match_knowledge`).
+
+Formato en disco (un directorio, lo escribe scripts/ingest_knowledge.py):
+  index.json    cabecera: dim, count, model, mode ("flat" | "ivf"), nlist
+  vectors.f32   matriz float32 (count x dim) normalizada, row-major; se abre con memmap
+  meta.jsonl    una línea por fila: {"id", "content", "source"}
+  ivf.npz       solo en modo ivf: centroids (nlist x dim) y offsets (nlist + 1)
+
+Búsqueda:
+  - flat: exacta, producto punto por bloques sobre el memmap + top-k parcial.
+  - ivf: las filas se guardan agrupadas por lista (cluster k-means esférico),
+    así cada lista es un slice contiguo; se exploran las `nprobe` listas más
+    cercanas a la consulta. Aproximada; el recall se mide con
+    scripts/bench_vector_index.py.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger("chatmig.vindex")
+
+BLOCK_ROWS = 32768  # filas por bloque en la búsqueda exacta
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    mat = np.asarray(mat, dtype=np.float32)
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def _topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """Índices de los k mayores de `scores` (1-D), ordenados desc."""
+    if k >= scores.shape[0]:
+        return np.argsort(-scores)
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part])]
+
+
+def kmeans(vectors: np.ndarray, nlist: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """K-means esférico (coseno) simple; entrena sobre una muestra de hasta 256 puntos por lista."""
+    rng = np.random.default_rng(seed)
+    n = vectors.shape[0]
+    sample = vectors[rng.choice(n, size=min(n, 256 * nlist), replace=False)]
+    centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+            else:  # lista vacía: re-siembra con un punto al azar
+                centroids[c] = sample[rng.integers(sample.shape[0])]
+        centroids = _normalize(centroids)
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    out = np.empty(vectors.shape[0], dtype=np.int32)
+    for s in range(0, vectors.shape[0], BLOCK_ROWS):
+        out[s:s + BLOCK_ROWS] = np.argmax(vectors[s:s + BLOCK_ROWS] @ centroids.T, axis=1)
+    return out
+
+
+def build_index(
+    out_dir: str,
+    vectors: np.ndarray,
+    meta: Sequence[Dict[str, Any]],
+    *,
+    model: str = "",
+    mode: str = "flat",
+    nlist: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Escribe el índice en `out_dir` (reemplazo atómico de cada archivo). Devuelve la cabecera."""
+    vectors = _normalize(vectors)
+    n, dim = vectors.shape
+    if n != len(meta):
+        raise ValueError(f"vectors ({n}) y meta ({len(meta)}) no coinciden")
+    os.makedirs(out_dir, exist_ok=True)
+
+    order = np.arange(n)
+    header: Dict[str, Any] = {"dim": dim, "count": n, "model": model, "mode": mode, "nlist": 0}
+    extra: Dict[str, np.ndarray] = {}
+    if mode == "ivf":
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        nlist = min(nlist, n)
+        centroids = kmeans(vectors, nlist)
+        assign = _assign(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=nlist)
+        extra = {"centroids": centroids, "offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)}
+        header["nlist"] = nlist
+    elif mode != "flat":
+        raise ValueError(f"modo de índice desconocido: {mode}")
+
+    def _atomic(name: str, write) -> None:
+        tmp = os.path.join(out_dir, name + ".tmp")
+        write(tmp)
+        os.replace(tmp, os.path.join(out_dir, name))
+
+    _atomic("vectors.f32", lambda p: vectors[order].tofile(p))
+
+    def _write_meta(p: str) -> None:
+        with open(p, "w", encoding="utf-8") as f:
+            for i in order:
+                f.write(json.dumps(meta[i], ensure_ascii=False) + "\n")
+
+    def _write_ivf(p: str) -> None:
+        with open(p, "wb") as f:
+            np.savez(f, **extra)
+
+    def _write_header(p: str) -> None:
+        with open(p, "w", encoding="utf-8") as f:
+            json.dump(header, f)
+
+    _atomic("meta.jsonl", _write_meta)
+    if extra:
+        _atomic("ivf.npz", _write_ivf)
+    _atomic("index.json", _write_header)  # último: el índice solo es visible completo
+    return header
+
+
+class VectorIndex:
+    def __init__(self, path: str, nprobe: int = 8):
+        with open(os.path.join(path, "index.json")) as f:
+            self.header = json.load(f)
+        self.dim = int(self.header["dim"])
+        self.count = int(self.header["count"])
+        self.mode = self.header.get("mode", "flat")
+        self.model = self.header.get("model", "")
+        self.nprobe = nprobe
+        self.vectors = np.memmap(
+            os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(self.count, self.dim)
+        )
+        with open(os.path.join(path, "meta.jsonl"), encoding="utf-8") as f:
+            self.meta: List[Dict[str, Any]] = [json.loads(line) for line in f]
+        if self.mode == "ivf":
+            ivf = np.load(os.path.join(path, "ivf.npz"))
+            self.centroids = ivf["centroids"]
+            self.offsets = ivf["offsets"]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def search_exact(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k exacto para un lote de consultas (Q x dim). Devuelve (ids, scores) de Q x k."""
+        q = _normalize(np.atleast_2d(queries))
+        k = min(k, self.count)
+        best_ids = np.empty((q.shape[0], 0), dtype=np.int64)
+        best_sc = np.empty((q.shape[0], 0), dtype=np.float32)
+        for s in range(0, self.count, BLOCK_ROWS):
+            block = np.asarray(self.vectors[s:s + BLOCK_ROWS])
+            sc = q @ block.T                                   # Q x B
+            kk = min(k, sc.shape[1])
+            part = np.argpartition(-sc, kk - 1, axis=1)[:, :kk]
+            best_ids = np.concatenate([best_ids, part + s], axis=1)
+            best_sc = np.concatenate([best_sc, np.take_along_axis(sc, part, axis=1)], axis=1)
+            if best_ids.shape[1] > k:  # recorta al top-k acumulado
+                keep = np.argpartition(-best_sc, k - 1, axis=1)[:, :k]
+                best_ids = np.take_along_axis(best_ids, keep, axis=1)
+                best_sc = np.take_along_axis(best_sc, keep, axis=1)
+        order = np.argsort(-best_sc, axis=1)
+        return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_sc, order, axis=1)
+
+    def search_ivf(self, query: np.ndarray, k: int, nprobe: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        q = _normalize(query.reshape(-1))
+        lists = _topk(self.centroids @ q, nprobe or self.nprobe)
+        ids = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        if ids.size == 0:
+            return ids, np.empty(0, dtype=np.float32)
+        sc = np.concatenate([np.asarray(self.vectors[self.offsets[l]:self.offsets[l + 1]]) @ q for l in lists])
+        top = _topk(sc, k)
+        return ids[top], sc[top]
+
+    def search(self, query: Sequence[float], k: int) -> List[Dict[str, Any]]:
+        """Misma forma que las filas del RPC match_knowledge: dicts con content/similarity."""
+        q = np.asarray(query, dtype=np.float32)
+        if self.mode == "ivf":
+            ids, sc = self.search_ivf(q, k)
+        else:
+            ids, sc = self.search_exact(q, k)
+            ids, sc = ids[0], sc[0]
+        return [{**self.meta[i], "similarity": float(s)} for i, s in zip(ids.tolist(), sc.tolist())]
+
+
+def load_index(path: Optional[str], nprobe: int = 8) -> Optional[VectorIndex]:
+    """Carga el índice si existe; None (→ fallback Supabase) si no hay o está corrupto."""
+    if not path or not os.path.exists(os.path.join(path, "index.json")):
+        return None
+    try:
+        idx = VectorIndex(path, nprobe=nprobe)
+        logger.info("[vindex] %s cargado · %d vectores · dim=%d · modo=%s", path, idx.count, idx.dim, idx.mode)
+        return idx
+    except Exception as e:
+        logger.warning("[vindex] no se pudo cargar %s: %s", path, e)
+        return None
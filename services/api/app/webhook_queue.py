@@ -0,0 +1,381 @@
+# services/api/app/webhook_queue.py
+"""
+Cola durable de webhooks (Stripe en billing.py, PayPal en payments/paypal.py).
+
+El endpoint solo valida lo barato (firma HMAC de Stripe, firma local de PayPal),
+inserta el evento en SQLite (WEBHOOK_QUEUE_PATH, WAL + synchronous=FULL) y
+responde 200. Un worker en el event loop aplica los eventos por lotes:
+
+  - Dedupe al encolar: UNIQUE(provider, event_id, fingerprint). Los reintentos
+    del proveedor no se vuelven a encolar. `fingerprint` separa copias aún no
+    verificadas (PayPal con PAYPAL_VERIFY_MODE=remote se verifica en el
+    worker): un evento falso con un id real no tapa al verdadero.
+  - Dedupe al procesar: si ya se aplicó ese (provider, event_id), la copia se
+    marca hecha sin llamar al handler.
+  - Orden por `ordering_key` (la suscripción/precio del evento): dentro de la
+    misma clave, por `created` del proveedor y luego orden de llegada. Un
+    evento en reintento bloquea a los posteriores de su clave; claves
+    distintas se procesan en paralelo.
+  - Reintentos con backoff exponencial; tras WEBHOOK_MAX_ATTEMPTS queda como
+    'dead' (se loguea) y la clave se desbloquea. `Reject` (firma inválida)
+    borra la fila.
+  - Varios procesos pueden compartir el archivo: el claim es una transacción
+    IMMEDIATE que pone `next_at` = vencimiento del lease.
+
+Entrega al menos una vez: un corte entre el handler y el commit lo repite,
+así que los handlers deben ser upserts (lo son, salvo `payments` de PayPal).
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("chatmig.webhooks")
+
+
+class Reject(Exception):
+    """El evento no es válido (p. ej. firma): se descarta sin reintentos."""
+
+
+@dataclass
+class WebhookEvent:
+    provider: str
+    event_id: str
+    ordering_key: str
+    payload: Dict[str, Any]
+    created: float = 0.0                                  # timestamp del proveedor (orden dentro de la clave)
+    meta: Dict[str, Any] = field(default_factory=dict)    # p. ej. cabeceras de firma de PayPal
+    fingerprint: str = ""
+    seq: int = 0
+    attempts: int = 0
+    received_at: float = 0.0
+
+
+Handler = Callable[[WebhookEvent], Awaitable[None]]
+
+_SCHEMA = """
+create table if not exists webhook_events (
+  seq integer primary key autoincrement,
+  provider text not null,
+  event_id text not null,
+  fingerprint text not null default '',
+  ordering_key text not null,
+  created real not null,
+  payload text not null,
+  meta text not null default '{}',
+  status text not null default 'pending',   -- pending | running | done | dead
+  attempts integer not null default 0,
+  next_at real not null default 0,          -- pending: no antes de; running: fin del lease
+  last_error text,
+  received_at real not null,
+  done_at real,
+  unique (provider, event_id, fingerprint)
+);
+create index if not exists idx_webhook_ready on webhook_events (status, next_at, created, seq);
+create index if not exists idx_webhook_key on webhook_events (provider, ordering_key, status);
+create index if not exists idx_webhook_applied on webhook_events (provider, event_id, status);
+"""
+
+# listos = pendientes (o lease vencido) sin un evento anterior de su clave en espera o en curso
+_CLAIM = """
+select seq, provider, event_id, fingerprint, ordering_key, created, payload, meta, attempts, received_at
+from webhook_events e
+where e.status in ('pending', 'running') and e.next_at <= :now
+  and not exists (
+    select 1 from webhook_events p
+    where p.provider = e.provider and p.ordering_key = e.ordering_key
+      and p.status in ('pending', 'running') and p.next_at > :now
+      and (p.created < e.created or (p.created = e.created and p.seq < e.seq))
+  )
+order by e.created, e.seq
+limit :n
+"""
+
+
+@dataclass
+class QueueStats:
+    enqueued: int = 0
+    duplicates: int = 0       # reintentos del proveedor ignorados al encolar
+    batches: int = 0
+    processed: int = 0
+    already_applied: int = 0  # copias de un evento ya aplicado (no llamaron al handler)
+    retries: int = 0
+    rejected: int = 0
+    dead: int = 0
+    lag_s_total: float = 0.0  # recepción → aplicado
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "enqueued": self.enqueued,
+            "duplicates": self.duplicates,
+            "batches": self.batches,
+            "processed": self.processed,
+            "already_applied": self.already_applied,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "dead": self.dead,
+            "avg_lag_ms": round(1000 * self.lag_s_total / self.processed, 1) if self.processed else None,
+        }
+
+
+class WebhookQueue:
+    def __init__(
+        self,
+        path: str = "webhook_queue.sqlite3",
+        *,
+        batch_size: int = 50,
+        poll_s: float = 1.0,
+        lease_s: float = 60.0,
+        max_attempts: int = 8,
+        retry_base_s: float = 2.0,
+        keep_done_s: float = 7 * 86400,
+        autostart: bool = True,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_s = poll_s
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.retry_base_s = retry_base_s
+        self.keep_done_s = keep_done_s
+        self.autostart = autostart  # False: sin worker, se procesa con process_batch/drain
+        self._handlers: Dict[str, Handler] = {}
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None  # se abre en el primer uso (arranque en frío)
+        self._wake: Optional[asyncio.Event] = None
+        self._worker: Optional["asyncio.Task[None]"] = None
+        self._last_prune = 0.0
+        self.stats = QueueStats()
+
+    def register(self, provider: str, handler: Handler) -> None:
+        self._handlers[provider] = handler
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # siempre bajo self._lock
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=full")  # el 200 al proveedor implica que el evento está en disco
+            conn.execute("pragma busy_timeout=5000")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    # --------- ingreso ---------
+    def _insert(self, ev: WebhookEvent) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "insert or ignore into webhook_events"
+                " (provider, event_id, fingerprint, ordering_key, created, payload, meta, received_at)"
+                " values (?, ?, ?, ?, ?, ?, ?, ?)",
+                (ev.provider, ev.event_id, ev.fingerprint, ev.ordering_key, ev.created,
+                 json.dumps(ev.payload, ensure_ascii=False), json.dumps(ev.meta), time.time()),
+            )
+            return cur.rowcount == 1
+
+    async def enqueue(self, ev: WebhookEvent) -> bool:
+        """Persiste el evento; False si ya estaba (reintento del proveedor). Despierta al worker."""
+        fresh = await run_in_threadpool(self._insert, ev)
+        if fresh:
+            self.stats.enqueued += 1
+            if self.autostart:
+                self.start()
+                self._wake.set()
+        else:
+            self.stats.duplicates += 1
+        return fresh
+
+    # --------- worker ---------
+    def _claim(self) -> List[WebhookEvent]:
+        now = time.time()
+        with self._lock:
+            self._db.execute("begin immediate")
+            try:
+                rows = self._db.execute(_CLAIM, {"now": now, "n": self.batch_size}).fetchall()
+                self._db.executemany(
+                    "update webhook_events set status = 'running', next_at = ? where seq = ?",
+                    [(now + self.lease_s, r[0]) for r in rows],
+                )
+                self._db.execute("commit")
+            except BaseException:
+                self._db.execute("rollback")
+                raise
+        return [
+            WebhookEvent(provider=r[1], event_id=r[2], fingerprint=r[3], ordering_key=r[4], created=r[5],
+                         payload=json.loads(r[6]), meta=json.loads(r[7]), seq=r[0], attempts=r[8], received_at=r[9])
+            for r in rows
+        ]
+
+    def _applied(self, keys: List[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        if not keys:
+            return set()
+        with self._lock:
+            return {
+                (p, e) for p, e in keys
+                if self._db.execute(
+                    "select 1 from webhook_events where provider = ? and event_id = ? and status = 'done' limit 1",
+                    (p, e),
+                ).fetchone()
+            }
+
+    def _finish(self, done: List[int], retry: List[Tuple[int, int, float, str]],
+                dead: List[Tuple[int, str]], rejected: List[int], released: List[int]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute("begin immediate")
+            try:
+                self._db.executemany(
+                    "update webhook_events set status = 'done', done_at = ?, payload = '{}', meta = '{}' where seq = ?",
+                    [(now, s) for s in done],
+                )
+                self._db.executemany(
+                    "update webhook_events set status = 'pending', attempts = ?, next_at = ?, last_error = ? where seq = ?",
+                    [(a, t, err, s) for s, a, t, err in retry],
+                )
+                self._db.executemany(
+                    "update webhook_events set status = 'dead', attempts = attempts + 1, last_error = ? where seq = ?",
+                    [(err, s) for s, err in dead],
+                )
+                self._db.executemany("delete from webhook_events where seq = ?", [(s,) for s in rejected])
+                self._db.executemany(  # detrás de uno en reintento: vuelven a la cola sin esperar el lease
+                    "update webhook_events set status = 'pending', next_at = 0 where seq = ?",
+                    [(s,) for s in released],
+                )
+                self._db.execute("commit")
+            except BaseException:
+                self._db.execute("rollback")
+                raise
+
+    def _prune(self) -> None:
+        with self._lock:
+            self._db.execute("delete from webhook_events where status = 'done' and done_at < ?",
+                             (time.time() - self.keep_done_s,))
+
+    async def process_batch(self) -> int:
+        """Reclama y aplica hasta `batch_size` eventos listos; devuelve cuántos reclamó."""
+        events = await run_in_threadpool(self._claim)
+        if not events:
+            return 0
+        self.stats.batches += 1
+        applied = await run_in_threadpool(self._applied, list({(e.provider, e.event_id) for e in events}))
+        groups: Dict[Tuple[str, str], List[WebhookEvent]] = {}
+        for ev in events:
+            groups.setdefault((ev.provider, ev.ordering_key), []).append(ev)
+
+        done: List[int] = []
+        retry: List[Tuple[int, int, float, str]] = []
+        dead: List[Tuple[int, str]] = []
+        rejected: List[int] = []
+        released: List[int] = []
+
+        async def run_group(group: List[WebhookEvent]) -> None:
+            for i, ev in enumerate(group):
+                key = (ev.provider, ev.event_id)
+                if key in applied:
+                    self.stats.already_applied += 1
+                    done.append(ev.seq)
+                    continue
+                handler = self._handlers.get(ev.provider)
+                try:
+                    if handler is None:
+                        raise RuntimeError(f"sin handler para {ev.provider}")
+                    await handler(ev)
+                except Reject as e:
+                    logger.warning("[webhooks] %s %s descartado: %s", ev.provider, ev.event_id, e)
+                    self.stats.rejected += 1
+                    rejected.append(ev.seq)
+                    continue
+                except Exception as e:
+                    attempts = ev.attempts + 1
+                    if attempts >= self.max_attempts:
+                        logger.error("[webhooks] %s %s sin aplicar tras %d intentos: %s",
+                                     ev.provider, ev.event_id, attempts, e)
+                        self.stats.dead += 1
+                        dead.append((ev.seq, repr(e)))
+                        continue  # la clave sigue con los siguientes
+                    self.stats.retries += 1
+                    retry.append((ev.seq, attempts, time.time() + self.retry_base_s * 2 ** ev.attempts, repr(e)))
+                    released.extend(later.seq for later in group[i + 1:])  # la clave espera al reintento
+                    return
+                applied.add(key)
+                self.stats.processed += 1
+                self.stats.lag_s_total += time.time() - ev.received_at
+                done.append(ev.seq)
+
+        await asyncio.gather(*(run_group(g) for g in groups.values()))
+        await run_in_threadpool(self._finish, done, retry, dead, rejected, released)
+        if time.monotonic() - self._last_prune > 3600:
+            self._last_prune = time.monotonic()
+            await run_in_threadpool(self._prune)
+        return len(events)
+
+    async def _run(self) -> None:
+        assert self._wake is not None
+        while True:
+            try:
+                if await self.process_batch():
+                    continue
+            except Exception as e:
+                logger.warning("[webhooks] lote falló: %s", e)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_s)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        """Arranca el worker en el loop actual (idempotente). También drena lo que quedó de un reinicio."""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._wake = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+    def depth(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("select status, count(*) from webhook_events group by status").fetchall()
+        return {status: n for status, n in rows}
+
+    async def drain(self) -> None:
+        """Procesa hasta que no queden eventos listos (tests, benchmark, apagado)."""
+        while await self.process_batch():
+            pass
+
+    async def aclose(self) -> None:
+        """Detiene el worker (lo pendiente queda en disco para el próximo arranque)."""
+        if self._worker is not None:
+            self._worker.cancel()
+            if self._worker.get_loop() is asyncio.get_running_loop():
+                try:
+                    await self._worker
+                except (asyncio.CancelledError, Exception):
+                    pass
+            self._worker = None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+@lru_cache(maxsize=1)
+def get_webhook_queue() -> Optional[WebhookQueue]:
+    """Cola compartida por billing.py y payments/paypal.py; None con WEBHOOK_QUEUE_ENABLED=0 (todo inline)."""
+    if os.getenv("WEBHOOK_QUEUE_ENABLED", "1") != "1":
+        return None
+    return WebhookQueue(
+        os.getenv("WEBHOOK_QUEUE_PATH", "webhook_queue.sqlite3"),
+        batch_size=int(os.getenv("WEBHOOK_BATCH_SIZE", "50")),
+        max_attempts=int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8")),
+    )
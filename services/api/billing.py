@@ -2,13 +2,25 @@
 import os, stripe, hmac, hashlib, json, datetime as dt
 from fastapi import APIRouter, HTTPException, Request
 from supabase import create_client, Client
+from starlette.concurrency import run_in_threadpool
+
+from app import tracing
+from app.entitlements import free_plan_summary, get_entitlements
+from app.webhook_queue import WebhookEvent, get_webhook_queue
 
 router = APIRouter(prefix="/billing", tags=["billing"])
 
 stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
 sb: Client = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE"])
+entitlements = get_entitlements()  # /summary: L1 en proceso (+ Redis opcional), invalidado por webhooks
+webhooks = get_webhook_queue()     # /webhook: encola y responde; los eventos se aplican por lotes
 
 # Helpers
+def _write(table: str, op: str, query):
+    # escritura en Supabase con su span (no-op si TRACING_ENABLED=false)
+    with tracing.span(f"supabase.{op}", {"db.system": "postgresql", "db.collection.name": table}):
+        return query.execute()
+
 def _user_id(req: Request) -> str:
     # si usas Supabase Auth JWT en headers:
     uid = req.headers.get("x-sb-user-id")
@@ -28,9 +40,9 @@ async def create_checkout(req: Request, body: dict):
         customer = bc[0]["external_customer_id"]
     else:
         customer = stripe.Customer.create(metadata={"user_id": uid})["id"]
-        sb.table("billing_customers").insert({
+        _write("billing_customers", "insert", sb.table("billing_customers").insert({
             "user_id": uid, "provider":"stripe", "external_customer_id": customer
-        }).execute()
+        }))
 
     session = stripe.checkout.Session.create(
         mode="subscription",
@@ -64,6 +76,34 @@ async def stripe_webhook(request: Request):
     except Exception as e:
         raise HTTPException(400, f"Webhook error: {e}")
 
+    job = _stripe_job(json.loads(payload))
+    if webhooks is None:  # WEBHOOK_QUEUE_ENABLED=0: se aplica antes de responder
+        await handle_stripe_event(job)
+    else:
+        await webhooks.enqueue(job)  # durable; el worker lo aplica en su lote
+    return {"ok": True}
+
+def _stripe_job(event: dict) -> WebhookEvent:
+    # orden por suscripción/precio: created→updated→deleted de la misma sub nunca se adelantan
+    obj = event["data"]["object"]
+    return WebhookEvent(
+        provider="stripe",
+        event_id=event["id"],
+        ordering_key=obj.get("id") or event["id"],
+        payload=event,
+        created=float(event.get("created") or 0),
+    )
+
+async def handle_stripe_event(job: WebhookEvent):
+    # supabase-py es síncrono: las escrituras van al threadpool y el event loop sigue aceptando webhooks
+    uids, plans_changed = await run_in_threadpool(_apply_stripe_event, job.payload)
+    if plans_changed:
+        entitlements.invalidate_plans()
+    for uid in uids:
+        await entitlements.invalidate(uid)
+
+def _apply_stripe_event(event: dict) -> tuple:
+    """Escrituras del evento; devuelve (user_ids a invalidar, ¿cambiaron los planes?)."""
     typ = event["type"]
     data = event["data"]["object"]
 
@@ -71,13 +111,13 @@ async def stripe_webhook(request: Request):
     if typ in ("price.created", "price.updated"):
         price = data
         if not price.get("recurring"):  # solo subs
-            return {"ok": True}
+            return [], False
         plan_id = (price.get("product") or "").lower()  # o mapea con metadata
         # upsert de plan (si lo gestionas en Stripe Product)
-        sb.table("plans").upsert({
+        _write("plans", "upsert", sb.table("plans").upsert({
             "id": plan_id, "name": plan_id.upper(), "is_active": True
-        }).execute()
-        sb.table("plan_prices").upsert({
+        }))
+        _write("plan_prices", "upsert", sb.table("plan_prices").upsert({
             "provider":"stripe",
             "external_price_id": price["id"],
             "plan_id": plan_id,
@@ -85,8 +125,8 @@ async def stripe_webhook(request: Request):
             "unit_amount": price["unit_amount"],
             "interval": price["recurring"]["interval"],
             "is_active": (not price.get("inactive", False))
-        }, on_conflict="external_price_id").execute()
-        return {"ok": True}
+        }, on_conflict="external_price_id"))
+        return [], True
 
     if typ in ("customer.subscription.created","customer.subscription.updated"):
         sub = data
@@ -94,14 +134,14 @@ async def stripe_webhook(request: Request):
         # mapear user_id desde billing_customers
         bc = sb.table("billing_customers").select("user_id").eq("external_customer_id", customer).single().execute().data
         if not bc:
-            return {"ok": True}  # desconocido
+            return [], False  # desconocido
         uid = bc["user_id"]
         plan_id = sub["items"]["data"][0]["price"]["product"].lower()  # o usa metadata/lookup
         status = sub["status"]
         start = dt.datetime.fromtimestamp(sub["current_period_start"], dt.timezone.utc)
         end   = dt.datetime.fromtimestamp(sub["current_period_end"], dt.timezone.utc)
 
-        sb.table("subscriptions").upsert({
+        _write("subscriptions", "upsert", sb.table("subscriptions").upsert({
             "user_id": uid,
             "plan_id": plan_id,
             "provider": "stripe",
@@ -110,31 +150,35 @@ async def stripe_webhook(request: Request):
             "current_period_start": start.isoformat(),
             "current_period_end":   end.isoformat(),
             "cancel_at_period_end": sub.get("cancel_at_period_end", False)
-        }, on_conflict="external_subscription_id").execute()
-        return {"ok": True}
+        }, on_conflict="external_subscription_id"))
+        return [uid], False
 
     if typ == "customer.subscription.deleted":
         sub = data
-        sb.table("subscriptions").update({"status":"canceled"}).eq("external_subscription_id", sub["id"]).execute()
-        return {"ok": True}
+        res = _write("subscriptions", "update",
+                     sb.table("subscriptions").update({"status":"canceled"}).eq("external_subscription_id", sub["id"]))
+        # el update devuelve las filas: user_id sin otra consulta
+        return [row.get("user_id") for row in res.data or []], False
 
-    return {"ok": True}
+    return [], False
+
+if webhooks is not None:
+    webhooks.register("stripe", handle_stripe_event)
+
+# Lecturas síncronas del cliente Supabase: la caché las corre en el threadpool
+def _load_entitlement(uid: str):
+    ent = sb.table("v_entitlements").select("*").eq("user_id", uid).execute().data
+    return ent[0] if ent else None
+
+def _load_free_plan() -> dict:
+    rows = sb.table("plans").select("*").eq("id", "free").limit(1).execute().data
+    return free_plan_summary(rows[0] if rows else None)
 
 @router.get("/summary")
 async def billing_summary(req: Request):
     uid = _user_id(req)
-    ent = sb.table("v_entitlements").select("*").eq("user_id", uid).execute().data
-    # si no hay sub, puedes devolver FREE por defecto (define plan 'free' en plans)
-    if not ent:
-        plan = sb.table("plans").select("*").eq("id","free").single().execute().data
-        return {
-            "plan_id": "free",
-            "plan_name": plan["name"] if plan else "Free",
-            "quota_messages": plan.get("quota_messages"),
-            "quota_tokens": plan.get("quota_tokens"),
-            "remaining_messages": plan.get("quota_messages"),
-            "remaining_tokens": plan.get("quota_tokens"),
-            "model_allowlist": plan.get("model_allowlist") or [],
-            "features": plan.get("features") or {}
-        }
-    return ent[0]
+    ent = await entitlements.get(uid, _load_entitlement)
+    # sin sub → plan FREE (fila 'free' de plans, cargada una vez por proceso)
+    if ent is None:
+        return await entitlements.free_plan(_load_free_plan)
+    return ent
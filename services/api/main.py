@@ -1,12 +1,52 @@
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os, json, httpx, asyncio
 from fastapi import FastAPI
-from payments.paypal import router as paypal_router
+from payments.paypal import router as paypal_router, tokens as paypal_tokens, verifier as paypal_verifier
+from app import metrics, tracing
+from app.entitlements import get_entitlements
+from app.http_clients import registry as http_registry, get_client
+from app.metering import Quota, UsageMeter, enforce, metered
+from app.webhook_queue import get_webhook_queue
+from app.provider_router import ProviderRouter
+from app.prompt_cache import UsageTracker, anthropic_cached_payload, stats as prompt_cache_stats
+from app.rate_limit import AdmissionController, admit, parse_limits
+from app.single_flight import SingleFlight, fan_out, flight_key
+from app.stream_guard import guard_disconnect, stats as stream_stats
+from app.sse import iter_deltas, openai_text, anthropic_text, gemini_text, ndjson_delta, ndjson_done
+from app.settings import get_settings
+from app.tokens import count_message_tokens
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        http_registry.configure_from_settings(get_settings())
+    except Exception:
+        pass  # sin Settings completos (p.ej. sin OPENAI_API_KEY): límites por defecto
+    metrics.preallocate(app, DEFAULT_MODELS.items())
+    webhooks = get_webhook_queue()
+    if webhooks is not None:
+        webhooks.start()  # aplica también lo que quedó encolado antes de un reinicio
+    try:
+        yield
+    finally:
+        if webhooks is not None:
+            await webhooks.aclose()
+        await paypal_tokens.aclose()
+        await http_registry.aclose()
+        await admission.aclose()
+        if meter is not None:
+            await meter.aclose()  # vuelca los contadores pendientes
+        tracing.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(paypal_router, prefix="/api")
+app.add_middleware(metrics.MetricsMiddleware)
+if tracing.configure_from_env():  # TRACING_ENABLED=true + OTEL_EXPORTER_OTLP_ENDPOINT / TRACING_SAMPLE_RATIO
+    app.add_middleware(tracing.TracingMiddleware)
 
 FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "http://localhost:5173")
 app.add_middleware(
@@ -17,6 +57,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    # latencia por ruta, TTFT y tokens/s por proveedor/modelo, streams abiertos, errores upstream
+    return metrics.metrics_response()
+
+@app.get("/healthz/http")
+def http_pool_stats():
+    return http_registry.stats()
+
+@app.get("/healthz/providers")
+def provider_stats():
+    # estado del circuito, EWMA/p95 de TTFT y hedges ganados/perdidos por proveedor
+    return provider_router.stats()
+
+@app.get("/healthz/streams")
+def streams_stats():
+    return stream_stats()
+
+@app.get("/healthz/prompt_cache")
+def prompt_cache():
+    # por ruta:proveedor: tokens leídos de caché, TTFT con/sin hit y ahorro estimado de input
+    return prompt_cache_stats()
+
+@app.get("/healthz/ratelimit")
+def ratelimit_stats():
+    return admission.stats()
+
+@app.get("/healthz/metering")
+def metering_stats():
+    # usage del proveedor vs tokenizer local, 429 por cuota y filas por volcado a usage_counters
+    return meter.stats.as_dict() if meter is not None else {}
+
+@app.get("/healthz/webhooks")
+def webhook_queue_stats():
+    # eventos por estado en la cola (pending/running/done/dead), duplicados ignorados y lag recepción→aplicado
+    webhooks = get_webhook_queue()
+    return {**webhooks.stats.as_dict(), "depth": webhooks.depth()} if webhooks is not None else {}
+
+@app.get("/healthz/paypal_verify")
+def paypal_verify_stats():
+    # firmas verificadas localmente, caídas al verify remoto y hits de la caché de certificados
+    return paypal_verifier.stats.as_dict()
+
+@app.get("/healthz/paypal_token")
+def paypal_token_stats():
+    # renovaciones reales vs tomadas de Redis, anticipadas, callers que esperaron y latencia de /oauth2/token
+    return paypal_tokens.stats.as_dict()
+
+@app.get("/healthz/coalescing")
+def coalescing_stats():
+    # saved_upstream_calls = requests idénticos que se sumaron a un stream en vuelo
+    return flights.stats.as_dict() if flights is not None else {}
+
 OPENAI_API_KEY   = os.getenv("OPENAI_API_KEY", "")
 OPENAI_BASE      = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 OPENAI_MODEL_DEF = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
@@ -36,6 +129,15 @@ GEMINI_BASE       = os.getenv("GEMINI_API_BASE", "https://generativelanguage.goo
 SYSTEM_PROMPT     = os.getenv("CHATMIG_SYSTEM_PROMPT", "Eres ChatMig...")
 MAX_TOKENS        = int(os.getenv("CHATMIG_MAX_TOKENS", "2048"))
 TEMPERATURE       = float(os.getenv("CHATMIG_TEMPERATURE", "0.4"))
+# static_first: system fijo como prefijo cacheable (Anthropic: bloque `system` con cache_control)
+PROMPT_LAYOUT     = os.getenv("PROMPT_LAYOUT", "static_first")
+
+# Enrutado: failover a otro proveedor si el pedido falla antes del primer delta;
+# hedge = además arrancar un backup si el primario tarda más que su p95 de TTFT
+FAILOVER_DEF = os.getenv("CHATMIG_FAILOVER", "1") == "1"
+HEDGE_DEF    = os.getenv("CHATMIG_HEDGE", "0") == "1"
+# requests idénticos en vuelo (mismo proveedor/modelo/mensajes) comparten un solo stream upstream
+flights = SingleFlight() if os.getenv("CHATMIG_SINGLE_FLIGHT", "1") == "1" else None
 
 def _user_msgs(messages):
     # Filtra/normaliza mensajes del front [{role, content}]
@@ -47,54 +149,62 @@ def _user_msgs(messages):
 async def chat_complete_stream(req: Request):
     body = await req.json()
     provider = (body.get("provider") or "openai").lower()    # 'openai' | 'anthropic' | 'mistral' | 'google'
+    provider = "google" if provider == "gemini" else provider
     model = body.get("model")
     messages = body.get("messages", [])
     system, conv = _user_msgs(messages)
+    failover = bool(body.get("failover", FAILOVER_DEF))
+    hedge = bool(body.get("hedge", HEDGE_DEF))
+    key = flight_key(provider, model, messages, failover, hedge)
+    charge = chunks = None
+    if provider in PROVIDERS:
+        prompt_tokens = count_message_tokens(messages)
+        # cuota del usuario (también si se suma a un stream en vuelo); el usage llega por UsageTracker
+        charge = enforce(meter, req, "chat", prompt_tokens, model or DEFAULT_MODELS[provider])
+        if not (flights is not None and flights.in_flight(key)):
+            # admisión contra el primario (los backups del failover/hedge no descuentan de su bucket)
+            await admit(admission, req, provider, model or DEFAULT_MODELS[provider], prompt_tokens + MAX_TOKENS)
+        # sumarse o liderar se decide acá, antes de la respuesta: sin admisión no hay await entre
+        # in_flight() y fan_out() (se suma sí o sí); con admisión, abrir un stream nuevo ya está pago
+        chunks = fan_out(flights, key, lambda: provider_router.stream(
+            provider, conv, model, system, failover=failover, hedge=hedge))
 
     async def ndjson_gen():
         try:
-            if provider == "openai":
-                async for chunk in stream_openai(conv, model or OPENAI_MODEL_DEF, system):
-                    yield chunk
-            elif provider == "anthropic":
-                async for chunk in stream_anthropic(conv, model or ANTHROPIC_MODEL_DEF, system):
-                    yield chunk
-            elif provider == "mistral":
-                async for chunk in stream_mistral(conv, model or MISTRAL_MODEL_DEF, system):
-                    yield chunk
-            elif provider in ("google","gemini"):
-                async for chunk in stream_gemini(conv, model or GEMINI_MODEL_DEF, system):
-                    yield chunk
-            else:
+            if chunks is None:
                 yield _delta("Provider no soportado")
+            else:
+                try:
+                    async for chunk in chunks:
+                        yield chunk
+                finally:
+                    await chunks.aclose()
             yield _done()
         except Exception as e:
             yield _delta(f"[error] {e}")
 
-    return StreamingResponse(ndjson_gen(), media_type="application/x-ndjson")
+    return StreamingResponse(guard_disconnect(req, metered(meter, charge, ndjson_gen()), "chat", max_tokens=MAX_TOKENS),
+                             media_type="application/x-ndjson")
 
-def _delta(text: str) -> str:
-    return json.dumps({"type":"delta","content":text}, ensure_ascii=False) + "\n"
-def _done() -> str:
-    return json.dumps({"type":"done"}) + "\n"
+def _delta(text: str) -> bytes:
+    return ndjson_delta(text)
+def _done() -> bytes:
+    return ndjson_done()
 
 # ===== OpenAI =====
 async def stream_openai(conv, model, system):
     url = f"{OPENAI_BASE}/chat/completions"
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type":"application/json"}
     msgs = ([{"role":"system","content":system}] if system else []) + conv
-    payload = {"model": model, "messages": msgs, "temperature": TEMPERATURE, "stream": True}
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", url, headers=headers, json=payload) as r:
-            async for line in r.aiter_lines():
-                if not line or not line.startswith("data:"): continue
-                data = line[5:].strip()
-                if data == "[DONE]": break
-                try:
-                    obj = json.loads(data)
-                    delta = obj["choices"][0]["delta"].get("content")
-                    if delta: yield _delta(delta)
-                except: pass
+    payload = {"model": model, "messages": msgs, "temperature": TEMPERATURE, "stream": True,
+               "stream_options": {"include_usage": True}}
+    track = UsageTracker("chat", "openai", model)
+    with tracing.span("llm.openai", {"llm.provider": "openai", "llm.model": model}, current=False) as sp:
+        async with get_client(url).stream("POST", url, headers=headers, json=payload) as r:
+            async for text in track.tracked(iter_deltas(r, openai_text, on_event=track.feed)):
+                if track.deltas == 1:
+                    sp.add_event("first_token")
+                yield _delta(text)
 
 # ===== Anthropic (v1/messages stream SSE) =====
 async def stream_anthropic(conv, model, system):
@@ -105,36 +215,25 @@ async def stream_anthropic(conv, model, system):
         "anthropic-version": ANTHROPIC_VERSION
     }
     contents = []
-    if system:
+    if system and PROMPT_LAYOUT != "static_first":
         contents.append({"role":"user","content":[{"type":"text","text":f"[system]\n{system}"}]})
     for m in conv:
         role = "user" if m["role"]=="user" else "assistant"
         contents.append({"role": role, "content":[{"type":"text","text": m["content"]}]})
-    payload = {"model": model, "max_tokens": MAX_TOKENS, "temperature": TEMPERATURE, "stream": True, "messages": contents}
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", url, headers=headers, json=payload) as r:
-            async for line in r.aiter_lines():
-                if not line or not line.startswith("data:"): continue
-                data = line[5:].strip()
-                if data == "[DONE]": break
-                try:
-                    evt = json.loads(data)
-                    # buscamos eventos con delta de texto
-                    delta = evt.get("delta") or evt.get("content_block") or {}
-                    text = None
-                    # formato común: {"type":"content_block_delta","delta":{"type":"text_delta","text":"..."}}
-                    if isinstance(delta, dict):
-                        inner = delta.get("text") or delta.get("delta", {}).get("text")
-                        text = inner
-                    if not text and "message" in evt:
-                        # fallback de eventos message
-                        parts = evt["message"].get("content", [])
-                        for p in parts:
-                            if p.get("type")=="text" and p.get("text"):
-                                yield _delta(p["text"])
-                        continue
-                    if text: yield _delta(text)
-                except: pass
+    payload = {"model": model, "max_tokens": MAX_TOKENS, "temperature": TEMPERATURE, "stream": True}
+    if PROMPT_LAYOUT == "static_first":
+        payload.update(anthropic_cached_payload(system, contents))  # system + historial con cache_control
+    else:
+        payload["messages"] = contents
+    track = UsageTracker("chat", "anthropic", model)
+    with tracing.span("llm.anthropic", {"llm.provider": "anthropic", "llm.model": model}, current=False) as sp:
+        async with get_client(url).stream("POST", url, headers=headers, json=payload) as r:
+            # eventos con texto: {"type":"content_block_delta","delta":{"type":"text_delta","text":"..."}}
+            # usage (cache_read_input_tokens...) en message_start / message_delta
+            async for text in track.tracked(iter_deltas(r, anthropic_text, on_event=track.feed)):
+                if track.deltas == 1:
+                    sp.add_event("first_token")
+                yield _delta(text)
 
 # ===== Mistral (OpenAI-like SSE) =====
 async def stream_mistral(conv, model, system):
@@ -142,17 +241,13 @@ async def stream_mistral(conv, model, system):
     headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}", "Content-Type":"application/json"}
     msgs = ([{"role":"system","content":system}] if system else []) + conv
     payload = {"model": model, "messages": msgs, "temperature": TEMPERATURE, "stream": True}
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", url, headers=headers, json=payload) as r:
-            async for line in r.aiter_lines():
-                if not line or not line.startswith("data:"): continue
-                data = line[5:].strip()
-                if data == "[DONE]": break
-                try:
-                    obj = json.loads(data)
-                    delta = obj["choices"][0]["delta"].get("content")
-                    if delta: yield _delta(delta)
-                except: pass
+    track = UsageTracker("chat", "mistral", model)
+    with tracing.span("llm.mistral", {"llm.provider": "mistral", "llm.model": model}, current=False) as sp:
+        async with get_client(url).stream("POST", url, headers=headers, json=payload) as r:
+            async for text in track.tracked(iter_deltas(r, openai_text, on_event=track.feed)):
+                if track.deltas == 1:
+                    sp.add_event("first_token")
+                yield _delta(text)
 
 # ===== Google Gemini (AI Studio SSE) =====
 def _to_gemini_contents(conv, system):
@@ -167,18 +262,50 @@ def _to_gemini_contents(conv, system):
 async def stream_gemini(conv, model, system):
     url = f"{GEMINI_BASE}/models/{model}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
     payload = {"contents": _to_gemini_contents(conv, system), "generationConfig": {"temperature": TEMPERATURE}}
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream("POST", url, headers={"Content-Type":"application/json"}, json=payload) as r:
-            async for line in r.aiter_lines():
-                if not line or not line.startswith("data:"): continue
-                data = line[5:].strip()
-                if data == "[DONE]": break
-                try:
-                    obj = json.loads(data)
-                    cands = obj.get("candidates") or []
-                    if cands:
-                        parts = cands[0].get("content",{}).get("parts",[])
-                        for p in parts:
-                            txt = p.get("text")
-                            if txt: yield _delta(txt)
-                except: pass
+    track = UsageTracker("chat", "google", model)
+    with tracing.span("llm.google", {"llm.provider": "google", "llm.model": model}, current=False) as sp:
+        async with get_client(url).stream("POST", url, headers={"Content-Type":"application/json"}, json=payload) as r:
+            async for text in track.tracked(iter_deltas(r, gemini_text, on_event=track.feed)):
+                if track.deltas == 1:
+                    sp.add_event("first_token")
+                yield _delta(text)
+
+# ===== Router de proveedores =====
+# (conv, model|None, system) -> stream NDJSON; model=None = modelo por defecto del proveedor
+PROVIDERS = {
+    "openai":    (OPENAI_API_KEY,    lambda conv, model, system: stream_openai(conv, model or OPENAI_MODEL_DEF, system)),
+    "anthropic": (ANTHROPIC_API_KEY, lambda conv, model, system: stream_anthropic(conv, model or ANTHROPIC_MODEL_DEF, system)),
+    "mistral":   (MISTRAL_API_KEY,   lambda conv, model, system: stream_mistral(conv, model or MISTRAL_MODEL_DEF, system)),
+    "google":    (GEMINI_API_KEY,    lambda conv, model, system: stream_gemini(conv, model or GEMINI_MODEL_DEF, system)),
+}
+DEFAULT_MODELS = {"openai": OPENAI_MODEL_DEF, "anthropic": ANTHROPIC_MODEL_DEF, "mistral": MISTRAL_MODEL_DEF, "google": GEMINI_MODEL_DEF}
+# solo los proveedores con API key entran al router (y por tanto al failover/hedge)
+provider_router = ProviderRouter({name: fn for name, (key, fn) in PROVIDERS.items() if key})
+
+# ===== Admisión: RPM/TPM por proveedor:modelo + cola justa por x-sb-user-id =====
+# RATE_LIMITS_JSON='{"openai:*": {"rpm": 500, "tpm": 200000}, "anthropic:*": {...}}'; RATE_LIMIT_BACKEND=redis comparte buckets
+admission = AdmissionController(
+    parse_limits(os.getenv("RATE_LIMITS_JSON", '{"*": {"rpm": 500, "tpm": 200000}}')),
+    per_user=int(os.getenv("RATE_LIMIT_QUEUE_PER_USER", "4")),
+    max_queue=int(os.getenv("RATE_LIMIT_QUEUE_MAX", "200")),
+    max_wait_s=float(os.getenv("RATE_LIMIT_MAX_WAIT_S", "30")),
+    redis_url=os.getenv("REDIS_URL") if os.getenv("RATE_LIMIT_BACKEND") == "redis" else None,
+)
+
+# ===== Medición de tokens + cuotas diarias por x-sb-user-id (app.metering) =====
+# cuota del plan vía v_entitlements/plans; volcado por lotes a usage_counters (RPC usage_increment)
+@lru_cache(maxsize=1)
+def _supabase():
+    url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE")
+    if not (url and key):
+        return None
+    from supabase import create_client
+    return create_client(url, key)
+
+meter = UsageMeter(
+    Quota(int(os.getenv("QUOTA_DAILY_TOKENS", "0")), int(os.getenv("QUOTA_DAILY_MESSAGES", "0"))),
+    supabase=_supabase,
+    entitlements=get_entitlements(),
+    flush_s=float(os.getenv("METERING_FLUSH_S", "5")),
+    redis_url=os.getenv("REDIS_URL") if os.getenv("METERING_BACKEND") == "redis" else None,
+) if os.getenv("METERING_ENABLED", "1") == "1" else None
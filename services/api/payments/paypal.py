@@ -1,8 +1,14 @@
 # services/api/payments/paypal.py
 from fastapi import APIRouter, Request, HTTPException
 from pydantic import BaseModel
-import os, time, json
-import httpx
+import os, time, json, datetime as dt
+
+from app import tracing
+from app.entitlements import get_entitlements
+from app.http_clients import get_client
+from app.oauth_tokens import TokenManager
+from app.paypal_verify import DEFAULT_CERT_HOSTS, LocalVerifyUnavailable, PayPalVerifier
+from app.webhook_queue import Reject, WebhookEvent, get_webhook_queue
 
 # === ENV ===
 ENV = (os.getenv("PAYPAL_ENV") or "sandbox").lower()
@@ -10,33 +16,40 @@ BASE = "https://api-m.paypal.com" if ENV == "live" else "https://api-m.sandbox.p
 CID  = os.getenv("PAYPAL_CLIENT_ID", "")
 SEC  = os.getenv("PAYPAL_CLIENT_SECRET", "")
 WEBHOOK_ID = os.getenv("PAYPAL_WEBHOOK_ID", "")
+# local: firma verificada acá con el certificado cacheado; remote: verify-webhook-signature por evento
+VERIFY_MODE = (os.getenv("PAYPAL_VERIFY_MODE") or "local").lower()
+CERT_HOSTS = (os.getenv("PAYPAL_CERT_HOSTS") or ",".join(DEFAULT_CERT_HOSTS)).split(",")
 
 # === Supabase (service role) ===
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE", "")  # SECRETO
 
 router = APIRouter(prefix="/paypal", tags=["paypal"])
+webhooks = get_webhook_queue()  # compartida con billing.py (WEBHOOK_QUEUE_ENABLED=0: webhook inline)
+
+# access_token: single-flight, renovación anticipada y (opcional) compartido vía Redis
+async def _fetch_token():
+    client = get_client(BASE)
+    r = await client.post(
+        f"{BASE}/v1/oauth2/token",
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+        data="grant_type=client_credentials",
+        auth=(CID, SEC),
+        timeout=20,
+    )
+    if r.status_code != 200:
+        raise HTTPException(502, f"OAuth PayPal fallo: {r.text}")
+    data = r.json()
+    return data["access_token"], int(data.get("expires_in", 300))
 
-# Cache simple de access_token
-_token_cache = {"value": None, "exp": 0}
+tokens = TokenManager(
+    "paypal", _fetch_token,
+    refresh_ahead_s=float(os.getenv("PAYPAL_TOKEN_REFRESH_AHEAD_S", "300")),
+    redis_url=os.getenv("REDIS_URL") if os.getenv("PAYPAL_TOKEN_BACKEND", "memory") == "redis" else None,
+)
 
 async def get_token():
-    now = time.time()
-    if _token_cache["value"] and now < _token_cache["exp"]:
-        return _token_cache["value"]
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{BASE}/v1/oauth2/token",
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data="grant_type=client_credentials",
-            auth=(CID, SEC),
-        )
-        if r.status_code != 200:
-            raise HTTPException(502, f"OAuth PayPal fallo: {r.text}")
-        data = r.json()
-        _token_cache["value"] = data["access_token"]
-        _token_cache["exp"] = now + int(data.get("expires_in", 300)) - 30
-        return _token_cache["value"]
+    return await tokens.get()
 
 # === Modelos de entrada ===
 class CreateOrderIn(BaseModel):
@@ -52,18 +65,19 @@ class CaptureIn(BaseModel):
 async def insert_payment(row: dict):
     if not (SUPABASE_URL and SUPABASE_KEY):
         return  # si no hay credenciales, solo omite persistencia
-    async with httpx.AsyncClient(timeout=20) as client:
-        url = f"{SUPABASE_URL}/rest/v1/payments"
-        h = {
-            "apikey": SUPABASE_KEY,
-            "Authorization": f"Bearer {SUPABASE_KEY}",
-            "Content-Type": "application/json",
-            "Prefer": "return=minimal",
-        }
-        r = await client.post(url, headers=h, content=json.dumps(row))
-        # No levantamos error si falla DB; puedes loguear:
-        if r.status_code not in (200, 201, 204):
-            print("WARN insert_payment:", r.status_code, r.text)
+    client = get_client(SUPABASE_URL)
+    url = f"{SUPABASE_URL}/rest/v1/payments"
+    h = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal",
+    }
+    with tracing.span("supabase.insert", {"db.system": "postgresql", "db.collection.name": "payments"}):
+        r = await client.post(url, headers=h, content=json.dumps(row), timeout=20)
+    # No levantamos error si falla DB; puedes loguear:
+    if r.status_code not in (200, 201, 204):
+        print("WARN insert_payment:", r.status_code, r.text)
 
 # === ENDPOINTS ===
 
@@ -80,15 +94,16 @@ async def create_order(body: CreateOrderIn):
         # Opcional si usaras aprobaciones por redirect (no Smart Buttons)
         # "application_context": {"return_url": "...", "cancel_url": "..."}
     }
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{BASE}/v2/checkout/orders",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json",
-            },
-            content=json.dumps(payload),
-        )
+    client = get_client(BASE)
+    r = await client.post(
+        f"{BASE}/v2/checkout/orders",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        },
+        content=json.dumps(payload),
+        timeout=20,
+    )
     if r.status_code not in (200, 201):
         raise HTTPException(400, f"create_order fallo: {r.text}")
     data = r.json()
@@ -106,14 +121,15 @@ async def create_order(body: CreateOrderIn):
 @router.post("/capture")
 async def capture_order(body: CaptureIn):
     token = await get_token()
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(
-            f"{BASE}/v2/checkout/orders/{body.orderID}/capture",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json",
-            },
-        )
+    client = get_client(BASE)
+    r = await client.post(
+        f"{BASE}/v2/checkout/orders/{body.orderID}/capture",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        },
+        timeout=30,
+    )
     if r.status_code not in (200, 201):
         raise HTTPException(400, f"capture fallo: {r.text}")
     data = r.json()
@@ -143,11 +159,19 @@ async def capture_order(body: CaptureIn):
 
     return data
 
-# === Webhook opcional: verificación con verify-webhook-signature ===
+# === Webhook: firma local (o verify-webhook-signature en el worker), se encola y se responde ===
+_SIG_HEADERS = ("paypal-transmission-id", "paypal-transmission-time", "paypal-cert-url",
+                "paypal-auth-algo", "paypal-transmission-sig")
+
+async def _fetch_cert(url: str) -> bytes:
+    r = await get_client(url).get(url, timeout=10)
+    r.raise_for_status()
+    return r.content
+
+verifier = PayPalVerifier(_fetch_cert, allowed_hosts=CERT_HOSTS)
+
 @router.post("/webhook")
 async def webhook(request: Request):
-    token = await get_token()
-    headers = request.headers
     try:
         body_bytes = await request.body()
         body_str = body_bytes.decode("utf-8")
@@ -155,29 +179,82 @@ async def webhook(request: Request):
     except Exception:
         raise HTTPException(400, "payload inválido")
 
-    # Verifica firma
+    sig_headers = {h: request.headers.get(h) for h in _SIG_HEADERS}
+    if VERIFY_MODE == "local":
+        try:
+            if not await verifier.verify(sig_headers, body_bytes, WEBHOOK_ID):
+                raise HTTPException(400, "firma webhook inválida")
+            sig_headers["verified"] = "local"
+        except LocalVerifyUnavailable as e:
+            print("WARN paypal verify local:", e)  # queda sin marcar: verificación remota
+
+    job = _paypal_job(event, sig_headers)
+    if webhooks is None:  # WEBHOOK_QUEUE_ENABLED=0: verificación y efectos antes de responder
+        try:
+            await handle_paypal_event(job)
+        except Reject as e:
+            raise HTTPException(400, str(e))
+    else:
+        await webhooks.enqueue(job)  # sin "verified": la firma se comprueba (remoto) en el worker
+    return {"ok": True}
+
+def _paypal_job(event: dict, sig_headers: dict) -> WebhookEvent:
+    resource = event.get("resource") or {}
+    # orden por suscripción (BILLING.SUBSCRIPTION.*: resource.id; pagos de una sub: billing_agreement_id)
+    if (event.get("event_type") or "").startswith("BILLING.SUBSCRIPTION."):
+        key = resource.get("id")
+    else:
+        key = resource.get("billing_agreement_id") or resource.get("id")
+    try:
+        created = dt.datetime.fromisoformat((event.get("create_time") or "").replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        created = 0.0
+    return WebhookEvent(
+        provider="paypal",
+        event_id=event.get("id") or sig_headers.get("paypal-transmission-id") or "",
+        ordering_key=key or event.get("id") or "",
+        payload=event,
+        created=created,
+        meta=sig_headers,
+        fingerprint=sig_headers.get("paypal-transmission-sig") or "",  # copias sin verificar no se tapan entre sí
+    )
+
+async def verify_webhook(event: dict, sig_headers: dict):
+    token = await get_token()
     verify_payload = {
-        "transmission_id": headers.get("paypal-transmission-id"),
-        "transmission_time": headers.get("paypal-transmission-time"),
-        "cert_url": headers.get("paypal-cert-url"),
-        "auth_algo": headers.get("paypal-auth-algo"),
-        "transmission_sig": headers.get("paypal-transmission-sig"),
+        "transmission_id": sig_headers.get("paypal-transmission-id"),
+        "transmission_time": sig_headers.get("paypal-transmission-time"),
+        "cert_url": sig_headers.get("paypal-cert-url"),
+        "auth_algo": sig_headers.get("paypal-auth-algo"),
+        "transmission_sig": sig_headers.get("paypal-transmission-sig"),
         "webhook_id": WEBHOOK_ID,
         "webhook_event": event,
     }
-    async with httpx.AsyncClient(timeout=20) as client:
-        vr = await client.post(
-            f"{BASE}/v1/notifications/verify-webhook-signature",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-            content=json.dumps(verify_payload),
-        )
-    if vr.status_code != 200 or vr.json().get("verification_status") != "SUCCESS":
-        raise HTTPException(400, f"firma webhook inválida: {vr.text}")
+    client = get_client(BASE)
+    vr = await client.post(
+        f"{BASE}/v1/notifications/verify-webhook-signature",
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        content=json.dumps(verify_payload),
+        timeout=20,
+    )
+    if vr.status_code != 200:
+        raise RuntimeError(f"verify-webhook-signature {vr.status_code}: {vr.text}")  # se reintenta
+    if vr.json().get("verification_status") != "SUCCESS":
+        raise Reject(f"firma webhook inválida: {vr.text}")
+
+async def handle_paypal_event(job: WebhookEvent):
+    event = job.payload
+    if not job.meta.get("verified"):
+        await verify_webhook(event, job.meta)
 
     # Manejo básico de eventos útiles
     et = event.get("event_type")
     resource = event.get("resource") or {}
 
+    if (et or "").startswith("BILLING.SUBSCRIPTION."):
+        # custom_id = user_id de Supabase (se fija al crear la suscripción): /billing/summary al día
+        await get_entitlements().invalidate(resource.get("custom_id"))
+
     if et in ("PAYMENT.CAPTURE.COMPLETED", "CHECKOUT.ORDER.APPROVED", "CHECKOUT.ORDER.COMPLETED"):
         order_id = (resource.get("supplementary_data") or {}).get("related_ids", {}).get("order_id") or resource.get("id")
         capture_id = resource.get("id") if "CAPTURE" in (resource.get("status") or "") or "capture" in (resource.get("intent") or "").lower() else None
@@ -195,7 +272,8 @@ async def webhook(request: Request):
             "raw": event,
         })
 
-    return {"ok": True}
+if webhooks is not None:
+    webhooks.register("paypal", handle_paypal_event)
 
 # --- SUSCRIPCIONES / PLANES ---
 
@@ -205,29 +283,31 @@ from fastapi import Body
 async def insert_subscription(row: dict):
     if not (SUPABASE_URL and SUPABASE_KEY):
         return
-    async with httpx.AsyncClient(timeout=20) as client:
-        url = f"{SUPABASE_URL}/rest/v1/subscriptions"
-        h = {
-            "apikey": SUPABASE_KEY,
-            "Authorization": f"Bearer {SUPABASE_KEY}",
-            "Content-Type": "application/json",
-            "Prefer": "return=minimal",
-        }
-        r = await client.post(url, headers=h, content=json.dumps(row))
-        if r.status_code not in (200, 201, 204):
-            print("WARN insert_subscription:", r.status_code, r.text)
+    client = get_client(SUPABASE_URL)
+    url = f"{SUPABASE_URL}/rest/v1/subscriptions"
+    h = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal",
+    }
+    with tracing.span("supabase.insert", {"db.system": "postgresql", "db.collection.name": "subscriptions"}):
+        r = await client.post(url, headers=h, content=json.dumps(row), timeout=20)
+    if r.status_code not in (200, 201, 204):
+        print("WARN insert_subscription:", r.status_code, r.text)
 
 @router.post("/subs/create-product")
 async def create_product(name: str = Body(...), description: str | None = Body(None)):
     token = await get_token()
     payload = {"name": name, "type": "SERVICE"}
     if description: payload["description"] = description
-    async with httpx.AsyncClient(timeout=20) as client:
-      r = await client.post(
-        f"{BASE}/v1/catalogs/products",
-        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-        content=json.dumps(payload),
-      )
+    client = get_client(BASE)
+    r = await client.post(
+      f"{BASE}/v1/catalogs/products",
+      headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+      content=json.dumps(payload),
+      timeout=20,
+    )
     if r.status_code not in (200, 201):
         raise HTTPException(400, r.text)
     return r.json()
@@ -255,24 +335,26 @@ async def create_plan(
         }],
         "payment_preferences": {"auto_bill_outstanding": True, "setup_fee_failure_action": "CONTINUE"},
     }
-    async with httpx.AsyncClient(timeout=20) as client:
-      r = await client.post(
-        f"{BASE}/v1/billing/plans",
-        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-        content=json.dumps(payload),
-      )
+    client = get_client(BASE)
+    r = await client.post(
+      f"{BASE}/v1/billing/plans",
+      headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+      content=json.dumps(payload),
+      timeout=20,
+    )
     if r.status_code not in (200, 201):
         raise HTTPException(400, r.text)
     return r.json()
 
 @router.post("/subscriptions/verify")
-async def verify_subscription(subscriptionID: str = Body(..., embed=True)):
+async def verify_subscription(request: Request, subscriptionID: str = Body(..., embed=True)):
     token = await get_token()
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.get(
-            f"{BASE}/v1/billing/subscriptions/{subscriptionID}",
-            headers={"Authorization": f"Bearer {token}"},
-        )
+    client = get_client(BASE)
+    r = await client.get(
+        f"{BASE}/v1/billing/subscriptions/{subscriptionID}",
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=20,
+    )
     if r.status_code != 200:
         raise HTTPException(400, f"verify subs fallo: {r.text}")
     data = r.json()
@@ -291,17 +373,20 @@ async def verify_subscription(subscriptionID: str = Body(..., embed=True)):
         "payer_name": payer_name,
         "raw": data,
     })
+    # el usuario que verifica (header de Supabase Auth, como billing.py) o el custom_id de la suscripción
+    await get_entitlements().invalidate(request.headers.get("x-sb-user-id") or data.get("custom_id"))
     return data
 
 @router.post("/subscriptions/{subscription_id}/cancel")
 async def cancel_subscription(subscription_id: str, reason: str = Body("BY_MERCHANT", embed=True)):
     token = await get_token()
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(
-            f"{BASE}/v1/billing/subscriptions/{subscription_id}/cancel",
-            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-            content=json.dumps({"reason": reason}),
-        )
+    client = get_client(BASE)
+    r = await client.post(
+        f"{BASE}/v1/billing/subscriptions/{subscription_id}/cancel",
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        content=json.dumps({"reason": reason}),
+        timeout=20,
+    )
     if r.status_code not in (204, 200):
         raise HTTPException(400, f"cancel fallo: {r.text}")
     return {"ok": True}
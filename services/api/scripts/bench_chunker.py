@@ -0,0 +1,103 @@
+# services/api/scripts/bench_chunker.py
+"""
+Throughput (MB/s) y RSS pico del chunker: `chunk_text` anterior (todo el archivo
+en un string + slicing por caracteres + lista) vs app.chunking (streaming por
+líneas, oraciones, tokens).
+
+Cada implementación corre en un subproceso propio para medir su RSS pico
+(ru_maxrss) sin contaminación de la otra.
+
+Uso:
+    python scripts/bench_chunker.py --mb 200
+    python scripts/bench_chunker.py --file knowledge_src/grande.md
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import time
+
+
+def legacy_chunk_text(t: str, max_chars=1200, overlap=200):
+    """Copia de la implementación previa de scripts/ingest_knowledge.py (con el fin de bucle corregido)."""
+    t = " ".join(t.split())
+    chunks = []
+    i = 0
+    while i < len(t):
+        j = min(i + max_chars, len(t))
+        chunks.append(t[i:j])
+        if j == len(t):
+            break
+        i = j - overlap
+        if i < 0: i = 0
+    return chunks
+
+
+def make_corpus(path: str, mb: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    words = ("visa estudiante España requisitos pasaporte costos tiempos consulado seguro médico "
+             "fondos apostilla antecedentes cita residencia trabajo permiso NIE empadronamiento").split()
+    target = mb * 1024 * 1024
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            block = [f"## Sección {written}\n"]
+            for _ in range(rng.randint(3, 8)):
+                sent = [" ".join(rng.choice(words) for _ in range(rng.randint(6, 25))) + "." for _ in range(rng.randint(2, 6))]
+                block.append(" ".join(sent) + "\n\n")
+            text = "".join(block)
+            f.write(text)
+            written += len(text.encode("utf-8"))
+
+
+def run_one(impl: str, path: str) -> None:
+    t0 = time.perf_counter()
+    if impl == "old":
+        with open(path, "r", encoding="utf-8") as f:
+            n = len(legacy_chunk_text(f.read()))
+    else:
+        from app.chunking import chunk_file
+        n = sum(1 for _ in chunk_file(path))
+    elapsed = time.perf_counter() - t0
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: KB
+    mb = os.path.getsize(path) / (1024 * 1024)
+    print(f"  {impl:<4} chunks={n:8d}  {mb / elapsed:7.2f} MB/s  ({elapsed:6.2f}s)  RSS pico={rss_mb:8.1f} MB")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--file", default=None)
+    ap.add_argument("--mb", type=int, default=100, help="tamaño del corpus sintético si no hay --file")
+    ap.add_argument("--run", choices=["old", "new"], default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        run_one(args.run, args.file)
+        return
+
+    tmp = None
+    path = args.file
+    if not path:
+        tmp = tempfile.NamedTemporaryFile(suffix=".md", delete=False)
+        tmp.close()
+        path = tmp.name
+        make_corpus(path, args.mb)
+    try:
+        print(f"corpus {os.path.getsize(path) / (1024 * 1024):.1f} MB · {path}")
+        for impl in ("old", "new"):
+            subprocess.run([sys.executable, __file__, "--run", impl, "--file", path], check=True)
+    finally:
+        if tmp:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
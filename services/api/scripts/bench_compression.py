@@ -0,0 +1,230 @@
+# services/api/scripts/bench_compression.py
+"""
+Latencia entre tokens y bytes en el cable de un stream NDJSON, con uvicorn
+real en localhost (cada `send` del ASGI es un write al socket), por variante:
+
+  identity         : sin compresión
+  gzip-buffered    : GZipMiddleware de Starlette < 0.46 (fastapi==0.114 del
+                     requirements): GzipFile sin flush, replicado acá
+  gzip-starlette   : GZipMiddleware de la Starlette instalada
+  compression      : app.compression.CompressionMiddleware (flush por evento)
+  compression-off  : ídem con `X-Stream-Encoding: identity`
+
+El servidor emite `--deltas` deltas cada `--interval-ms` y anota cuándo; el
+cliente descomprime incrementalmente y anota cuándo cada línea queda
+legible. lag = legible - emitido (p50/p95/máx). Bytes = cuerpo crudo (sin
+headers ni framing chunked).
+
+Al final, tamaño y costo de compresión de un JSON grande por codec.
+
+Uso:
+    python scripts/bench_compression.py --deltas 200 --interval-ms 10
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import random
+import socket
+import statistics
+import threading
+import time
+import zlib
+
+import httpx
+import starlette
+import uvicorn
+from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+
+from app import compression
+from app.compression import CompressionMiddleware
+from app.sse import ndjson_delta
+
+WORDS = ("para", "la", "visa", "de", "estudiante", "necesitas", "carta", "aceptación", "solvencia", "económica",
+         "y", "seguro", "médico", "cita", "consulado", "pasaporte", "vigente", "formulario", "DS-160", "pago",
+         "tasa", "entrevista", "documentos", "originales", "traducción", "certificada", "residencia", "permiso",
+         "trabajo", "meses", "antes", "del", "viaje", "reserva", "vuelo", "alojamiento", "antecedentes", "penales")
+RNG = random.Random(7)
+TEXT = [RNG.choice(WORDS) + RNG.choice((" ", " ", " ", ", ", ". ")) for _ in range(5000)]  # ~tokens de un LLM
+EMITS: dict = {}  # run_id → [perf_counter de cada delta emitido]
+DELTAS = 200
+INTERVAL_S = 0.01
+
+
+class BufferedGZipMiddleware:
+    """GZipMiddleware de Starlette 0.38 (rama de streaming): GzipFile.write sin flush."""
+
+    def __init__(self, app, minimum_size: int = 800):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or b"gzip" not in dict(scope["headers"]).get(b"accept-encoding", b""):
+            await self.app(scope, receive, send)
+            return
+        buf = io.BytesIO()
+        gz = gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=9)
+        state = {"start": None, "started": False}
+
+        async def wrapped(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            body, more = message.get("body", b""), message.get("more_body", False)
+            if not state["started"]:
+                state["started"] = True
+                start = state["start"]
+                if len(body) < self.minimum_size and not more:
+                    await send(start)
+                    await send(message)
+                    return
+                headers = [(k, v) for k, v in start["headers"] if k != b"content-length"]
+                start["headers"] = headers + [(b"content-encoding", b"gzip"), (b"vary", b"Accept-Encoding")]
+                await send(start)
+            gz.write(body)
+            if not more:
+                gz.close()
+            out = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            await send({"type": "http.response.body", "body": out, "more_body": more})
+
+        await self.app(scope, receive, wrapped)
+
+
+def stream_app(middleware=None, **kw) -> FastAPI:
+    app = FastAPI()
+    if middleware is not None:
+        app.add_middleware(middleware, **kw)
+
+    @app.get("/stream/{run_id}")
+    async def stream(run_id: str):
+        emits = EMITS.setdefault(run_id, [])
+
+        async def gen():
+            for i in range(DELTAS):
+                await asyncio.sleep(INTERVAL_S)
+                emits.append(time.perf_counter())
+                yield ndjson_delta(TEXT[i % len(TEXT)])
+
+        return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+    return app
+
+
+VARIANTS = (
+    ("identity", "/identity", {}),
+    ("gzip-buffered", "/gzip-buffered", {"Accept-Encoding": "gzip"}),
+    ("gzip-starlette", "/gzip-starlette", {"Accept-Encoding": "gzip"}),
+    ("compression", "/compression", {"Accept-Encoding": "gzip, deflate, br, zstd"}),
+    ("compression-off", "/compression", {"Accept-Encoding": "gzip, deflate, br, zstd", "X-Stream-Encoding": "identity"}),
+)
+
+
+def build_root() -> FastAPI:
+    root = FastAPI()
+    root.mount("/identity", stream_app())
+    root.mount("/gzip-buffered", BufferedGZipMiddleware(stream_app()))
+    root.mount("/gzip-starlette", stream_app(GZipMiddleware, minimum_size=800))
+    root.mount("/compression", stream_app(CompressionMiddleware, minimum_size=800))
+    return root
+
+
+async def measure(client: httpx.AsyncClient, url: str, headers: dict, run_id: str) -> tuple:
+    arrivals, wire = [], 0
+    pending = b""
+    async with client.stream("GET", f"{url}/stream/{run_id}", headers=headers) as r:
+        gz = r.headers.get("content-encoding") == "gzip"
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS) if gz else None
+        async for raw in r.aiter_raw():
+            now = time.perf_counter()
+            wire += len(raw)
+            pending += d.decompress(raw) if d else raw
+            *lines, pending = pending.split(b"\n")
+            arrivals.extend(now for line in lines if line)
+    emits = EMITS.pop(run_id)
+    assert len(arrivals) == len(emits) == DELTAS, (len(arrivals), len(emits))
+    return [a - e for a, e in zip(arrivals, emits)], wire
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_streams(rounds: int) -> None:
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(build_root(), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    async def run():
+        lags = {name: [] for name, _, _ in VARIANTS}
+        wire = {}
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            for r in range(rounds):  # variantes intercaladas
+                for name, prefix, headers in VARIANTS:
+                    lag, n = await measure(client, prefix, headers, f"{name}-{r}")
+                    lags[name].extend(lag)
+                    wire[name] = n
+        return lags, wire
+
+    lags, wire = asyncio.run(run())
+    server.should_exit = True
+    print(f"stream NDJSON: {DELTAS} deltas cada {INTERVAL_S * 1e3:.0f} ms · {rounds} rondas · starlette {starlette.__version__}")
+    print(f"  {'variante':<16} {'lag p50':>9} {'lag p95':>9} {'lag máx':>9} {'bytes':>8} {'vs identity':>12}")
+    base = wire["identity"]
+    for name, _, _ in VARIANTS:
+        xs = sorted(lags[name])
+        p95 = xs[int(0.95 * (len(xs) - 1))]
+        print(f"  {name:<16} {1e3 * statistics.median(xs):7.2f}ms {1e3 * p95:7.2f}ms {1e3 * xs[-1]:7.1f}ms "
+              f"{wire[name]:8,d} {100 * wire[name] / base:11.0f}%")
+
+
+def bench_json(n: int) -> None:
+    body = json.dumps({
+        "summary": "Plan express para la entrevista consular " * 4,
+        "steps": [{"id": i, "title": f"Paso {i}", "detail": "".join(TEXT[i * 40:(i + 1) * 40]), "ok": i % 2 == 0}
+                  for i in range(60)],
+    }, ensure_ascii=False).encode()
+    print(f"\nJSON de {len(body):,d} bytes (codecs disponibles: {', '.join(compression.CODECS)}):")
+    for name, fn in compression.CODECS.items():
+        out = fn(body)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn(body)
+        us = 1e6 * (time.perf_counter() - t0) / n
+        print(f"  {name:<5} {len(out):7,d} bytes ({100 * len(out) / len(body):4.1f}%)  {us:7.1f} µs")
+    legacy = gzip.compress(body, compresslevel=9)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        gzip.compress(body, compresslevel=9)
+    us = 1e6 * (time.perf_counter() - t0) / n
+    print(f"  gzip9 {len(legacy):7,d} bytes ({100 * len(legacy) / len(body):4.1f}%)  {us:7.1f} µs  (GZipMiddleware)")
+
+
+def main():
+    global DELTAS, INTERVAL_S
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--deltas", type=int, default=200)
+    ap.add_argument("--interval-ms", type=float, default=10.0)
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+    DELTAS, INTERVAL_S = args.deltas, args.interval_ms / 1000
+    bench_streams(args.rounds)
+    bench_json(500)
+
+
+if __name__ == "__main__":
+    main()
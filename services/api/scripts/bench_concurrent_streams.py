@@ -0,0 +1,152 @@
+# services/api/scripts/bench_concurrent_streams.py
+"""
+Benchmark de capacidad de requests LLM concurrentes contra la API real
+(app.main:app servida por uvicorn en otro proceso), con scripts/fake_openai.py
+como OpenAI:
+
+  /plan                  JSON (completion sin stream)
+  /llm/complete/stream   NDJSON (embedding → índice local → stream)
+  /chat/complete_stream  texto plano
+
+Por endpoint se lanzan `--streams` requests a la vez y se mide el tiempo hasta
+el primer byte de cuerpo, el total y el pico de completions en vuelo en el
+servidor falso. Con los endpoints sobre AsyncOpenAI el pico ≈ `--streams`;
+cuando eran `def` con el cliente síncrono quedaba topado por el threadpool de
+Starlette (40). Para comparar con otra versión de la API, `--app-dir` apunta a
+otro checkout de services/api (p. ej. `git worktree add /tmp/antes <commit>`).
+
+Caché semántica, admisión, single-flight y medición se apagan: cada request
+llega al modelo. El índice vectorial es uno chico generado al vuelo.
+
+Uso:
+    python scripts/bench_concurrent_streams.py --streams 400 --deltas 50 --delay 0.02
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+from app.vector_index import build_index
+from scripts.fake_openai import serve_in_subprocess
+
+ENDPOINTS = [
+    # markdown: el texto del modelo falso no es JSON
+    ("/plan", lambda i: {"goal": f"plan de visa de estudiante para España #{i}", "format": "markdown"}),
+    ("/llm/complete/stream", lambda i: {"query": f"requisitos visa estudiante España #{i}"}),
+    ("/chat/complete_stream", lambda i: {"query": f"requisitos visa estudiante España #{i}"}),
+]
+
+
+def make_index(path: str, dim: int = 8, n: int = 64) -> None:
+    """Índice local del tamaño de los embeddings de fake_openai (dim 8)."""
+    vecs = np.random.default_rng(0).random((n, dim), dtype=np.float32)
+    meta = [{"id": f"kb{i}", "content": f"Fragmento {i} sobre visados y residencia.", "source": "bench.md"}
+            for i in range(n)]
+    build_index(path, vecs, meta, model="fake")
+
+
+def serve_api(app_dir: Path, port: int, env: dict, log: Path) -> subprocess.Popen:
+    """uvicorn en otro proceso (no comparte GIL con el cliente); sus logs van a `log`."""
+    with open(log, "wb") as out:
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+            cwd=app_dir, env=env, stdout=out, stderr=subprocess.STDOUT,
+        )
+    for _ in range(1000):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/healthz", timeout=0.2)
+            return proc
+        except httpx.HTTPError:
+            if proc.poll() is not None:
+                raise RuntimeError(f"la API no arrancó:\n{log.read_text(errors='replace')[-2000:]}")
+            time.sleep(0.02)
+    proc.terminate()
+    raise RuntimeError("la API no arrancó")
+
+
+async def bench(api: str, fake: str, path: str, body, n: int) -> dict:
+    limits = httpx.Limits(max_connections=n, max_keepalive_connections=n)
+    async with httpx.AsyncClient(base_url=api, limits=limits, timeout=300) as client:
+        await client.post(f"{fake}/stats/reset")
+        first, total, errors = [], [], 0
+
+        async def one(i: int) -> None:
+            nonlocal errors
+            t0 = time.perf_counter()
+            async with client.stream("POST", path, json=body(i)) as r:
+                ttfb = None
+                async for chunk in r.aiter_bytes():
+                    if chunk and ttfb is None:
+                        ttfb = time.perf_counter() - t0
+                if r.status_code != 200:
+                    errors += 1
+                    return
+            first.append(ttfb or 0.0)
+            total.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        elapsed = time.perf_counter() - t0
+        peak = (await client.get(f"{fake}/stats")).json()["peak"]
+    first.sort()
+    p99 = first[int(0.99 * (len(first) - 1))] if first else 0.0
+    return {"elapsed": elapsed, "peak": peak, "errors": errors,
+            "ttfb_p50": statistics.median(first) if first else 0.0, "ttfb_p99": p99}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--port", type=int, default=8765, help="fake OpenAI")
+    ap.add_argument("--api-port", type=int, default=8766)
+    ap.add_argument("--app-dir", type=Path, default=ROOT, help="services/api a medir (otro checkout para comparar)")
+    ap.add_argument("--streams", type=int, default=400)
+    ap.add_argument("--deltas", type=int, default=50)
+    ap.add_argument("--delay", type=float, default=0.02)
+    args = ap.parse_args()
+
+    fake = f"http://127.0.0.1:{args.port}"
+    api = f"http://127.0.0.1:{args.api_port}"
+    ideal = args.deltas * args.delay
+    with tempfile.TemporaryDirectory() as tmp:
+        make_index(str(Path(tmp) / "index"))
+        env = dict(
+            os.environ,
+            OPENAI_API_KEY="sk-fake",
+            OPENAI_BASE_URL=f"{fake}/v1",
+            VECTOR_INDEX_PATH=str(Path(tmp) / "index"),
+            RAG_BACKEND="auto",
+            DATABASE_URL=f"sqlite:///{tmp}/bench.db",
+            SEMANTIC_CACHE_ENABLED="false",
+            RATE_LIMIT_ENABLED="false",
+            SINGLE_FLIGHT_ENABLED="false",
+            METERING_ENABLED="false",
+        )
+        upstream = serve_in_subprocess(args.port, deltas=args.deltas, delay=args.delay)
+        server = serve_api(args.app_dir, args.api_port, env, Path(tmp) / "api.log")
+        print(f"{args.streams} requests concurrentes · {args.deltas} deltas · {args.delay * 1000:.0f} ms/delta "
+              f"(ideal {ideal:.2f}s/request) · API en {args.app_dir}")
+        print(f"  {'endpoint':<24} {'total':>8} {'req/s':>7} {'1er byte p50':>13} {'p99':>8} {'pico upstream':>14} {'errores':>8}")
+        try:
+            for path, body in ENDPOINTS:
+                r = asyncio.run(bench(api, fake, path, body, args.streams))
+                print(f"  {path:<24} {r['elapsed']:7.2f}s {args.streams / r['elapsed']:7.1f} "
+                      f"{1e3 * r['ttfb_p50']:11.0f}ms {1e3 * r['ttfb_p99']:6.0f}ms {r['peak']:14d} {r['errors']:8d}")
+        finally:
+            server.terminate()
+            upstream.terminate()
+
+
+if __name__ == "__main__":
+    main()
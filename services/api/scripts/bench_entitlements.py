@@ -0,0 +1,191 @@
+# services/api/scripts/bench_entitlements.py
+"""
+GET /billing/summary bajo carga de páginas (el frontend lo consulta en cada
+carga), con Supabase simulado: cada `execute()` bloquea `--db-ms` (el cliente
+supabase-py es síncrono). Variantes:
+
+  legacy    : handler anterior: v_entitlements (+ plans si es free) en el
+              event loop, bloqueándolo
+  sin-cache : EntitlementCache con TTL 0: lecturas en el threadpool, plan
+              free precargado, sin L1
+  cache     : EntitlementCache por defecto (TTL 30 s)
+
+Usuarios con distribución Zipf (unos pocos recargan mucho), `--free-pct` sin
+suscripción y un webhook de suscripción cada `--invalidate-every` requests
+que invalida a un usuario al azar. Llegadas abiertas a `--rps`: la latencia
+se mide desde el instante programado, así que incluye la cola que arma un
+event loop bloqueado. Reporta consultas a Supabase, hit rate y p50/p99.
+
+Uso:
+    python scripts/bench_entitlements.py --requests 6000 --rps 400
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE", "bench")
+
+import httpx
+from fastapi import FastAPI, Request
+
+import billing
+from app.entitlements import EntitlementCache
+
+DB_S = 0.004
+QUERIES = [0]
+
+
+class FakeSupabase:
+    """Encadena select/eq/limit/single como supabase-py; execute() duerme DB_S (bloqueante)."""
+
+    def __init__(self, subs: dict):
+        self.subs = subs
+
+    def table(self, name: str):
+        return _Query(self, name)
+
+
+class _Query:
+    def __init__(self, sb: FakeSupabase, table: str):
+        self.sb, self.table, self.filters, self.one = sb, table, {}, False
+
+    def select(self, *_):
+        return self
+
+    def limit(self, _):
+        return self
+
+    def eq(self, col, val):
+        self.filters[col] = val
+        return self
+
+    def single(self):
+        self.one = True
+        return self
+
+    def execute(self):
+        QUERIES[0] += 1
+        time.sleep(DB_S)
+        if self.table == "plans":
+            row = {"id": "free", "name": "Free", "quota_messages": 50, "quota_tokens": 50000}
+            data = row if self.one else [row]
+        else:
+            ent = self.sb.subs.get(self.filters.get("user_id"))
+            data = [ent] if ent else []
+        return type("Res", (), {"data": data})()
+
+
+def legacy_app() -> FastAPI:
+    """billing_summary antes de la caché (copiado tal cual)."""
+    app = FastAPI()
+    sb = billing.sb
+
+    @app.get("/billing/summary")
+    async def billing_summary(req: Request):
+        uid = billing._user_id(req)
+        ent = sb.table("v_entitlements").select("*").eq("user_id", uid).execute().data
+        if not ent:
+            plan = sb.table("plans").select("*").eq("id", "free").single().execute().data
+            return {
+                "plan_id": "free",
+                "plan_name": plan["name"] if plan else "Free",
+                "quota_messages": plan.get("quota_messages"),
+                "quota_tokens": plan.get("quota_tokens"),
+                "remaining_messages": plan.get("quota_messages"),
+                "remaining_tokens": plan.get("quota_tokens"),
+                "model_allowlist": plan.get("model_allowlist") or [],
+                "features": plan.get("features") or {},
+            }
+        return ent[0]
+
+    return app
+
+
+def cached_app(cache: EntitlementCache) -> FastAPI:
+    billing.entitlements = cache
+    app = FastAPI()
+    app.include_router(billing.router)
+    return app
+
+
+def zipf_users(n_users: int, n: int, rng: random.Random) -> list:
+    weights = [1 / (i + 1) for i in range(n_users)]
+    return rng.choices([f"u{i}" for i in range(n_users)], weights=weights, k=n)
+
+
+async def run(app: FastAPI, cache, users: list, rps: float, invalidate_every: int, rng: random.Random) -> tuple:
+    """Llegadas abiertas a `rps`: latencia = fin - instante programado (incluye la cola del event loop)."""
+    lat = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(due: float, uid: str):
+            r = await client.get("/billing/summary", headers={"x-sb-user-id": uid})
+            lat.append(time.perf_counter() - due)
+            assert r.status_code == 200, r.text
+
+        t0 = time.perf_counter()
+        tasks = []
+        for i, uid in enumerate(users):
+            due = t0 + i / rps
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if cache is not None and invalidate_every and i % invalidate_every == 0:
+                await cache.invalidate(rng.choice(users))  # webhook customer.subscription.updated
+            tasks.append(asyncio.ensure_future(one(due, uid)))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - t0
+    return lat, wall
+
+
+def main():
+    global DB_S
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--requests", type=int, default=6000)
+    ap.add_argument("--rps", type=float, default=400.0, help="llegadas por segundo (carga abierta)")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--free-pct", type=float, default=80.0)
+    ap.add_argument("--db-ms", type=float, default=4.0)
+    ap.add_argument("--invalidate-every", type=int, default=50)
+    args = ap.parse_args()
+    DB_S = args.db_ms / 1000
+
+    rng = random.Random(7)
+    subs = {f"u{i}": {"user_id": f"u{i}", "plan_id": "pro", "remaining_messages": 900}
+            for i in range(args.users) if rng.random() * 100 >= args.free_pct}
+    billing.sb = FakeSupabase(subs)
+    users = zipf_users(args.users, args.requests, rng)
+
+    print(f"{args.requests} requests a {args.rps:.0f}/s · {args.users} usuarios (Zipf, "
+          f"{args.free_pct:.0f}% free) · Supabase {args.db_ms:.1f} ms/consulta · "
+          f"invalidación cada {args.invalidate_every}")
+    print(f"  {'variante':<10} {'p50':>8} {'p99':>8} {'req/s':>7} {'consultas':>10} {'hit rate':>9}")
+    for name in ("legacy", "sin-cache", "cache"):
+        cache = None
+        if name == "legacy":
+            app = legacy_app()
+        else:
+            cache = EntitlementCache(ttl_s=0 if name == "sin-cache" else 30)
+            app = cached_app(cache)
+        QUERIES[0] = 0
+        lat, wall = asyncio.run(run(app, cache, users, args.rps, args.invalidate_every, random.Random(11)))
+        lat.sort()
+        p99 = lat[int(0.99 * (len(lat) - 1))]
+        hit = cache.stats.as_dict()["hit_rate"] if cache is not None else None
+        print(f"  {name:<10} {1e3 * statistics.median(lat):6.1f}ms {1e3 * p99:6.1f}ms {len(lat) / wall:7.0f} "
+              f"{QUERIES[0]:10,d} {'-' if hit is None else f'{100 * hit:.1f}%':>9}")
+
+
+if __name__ == "__main__":
+    main()
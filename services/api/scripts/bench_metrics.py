@@ -0,0 +1,166 @@
+# services/api/scripts/bench_metrics.py
+"""
+Overhead de app.metrics en el hot path, llamando a la app ASGI directamente
+(sin red ni servidor): un endpoint JSON y un stream de `--chunks` deltas con
+guard_disconnect + UsageTracker, como los routers reales.
+
+  off        : METRICS_ENABLED=false (middleware de paso, hijos no-op)
+  on         : middleware + histogramas por ruta / TTFT / tokens/s + gauge de streams
+  ingenuo    : como `on` pero observando por chunk con `.labels(...)` (lo que se evita)
+
+El end-to-end tiene ruido del orden del propio overhead, así que antes se
+mide el costo aislado de cada primitiva (ns/op) por request, stream y chunk.
+
+Uso:
+    python scripts/bench_metrics.py --requests 5000 --chunks 200 --rounds 5
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from app import metrics
+from app.prompt_cache import UsageTracker
+from app.sse import ndjson_delta
+from app.stream_guard import guard_disconnect
+
+NAIVE = False
+CHUNKS = 200
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    @app.post("/stream")
+    async def stream(request: Request):
+        async def upstream():
+            track = UsageTracker("bench", "openai", "gpt-bench")
+            for i in range(CHUNKS):
+                track.first_token()
+                if NAIVE:
+                    metrics.llm_tps.metric.labels("openai", "gpt-bench").observe(1.0)
+                yield ndjson_delta("tok ")
+            track.done()
+
+        return StreamingResponse(guard_disconnect(request, upstream(), "bench"), media_type="application/x-ndjson")
+
+    metrics.preallocate(app, [("openai", "gpt-bench")])
+    return app
+
+
+def _scope(method: str, path: str) -> dict:
+    return {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": method, "path": path, "raw_path": path.encode(), "root_path": "", "scheme": "http",
+        "query_string": b"", "headers": [], "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+
+
+async def call(app, method: str, path: str) -> int:
+    got = {"body": 0}
+    sent = False
+    never = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await never.wait()
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            got["body"] += len(message.get("body", b""))
+
+    await app(_scope(method, path), receive, send)
+    return got["body"]
+
+
+def _ns(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return 1e9 * (time.perf_counter() - t0) / n
+
+
+def micro(app, n: int) -> None:
+    scope = _scope("GET", "/ping")
+    scope["endpoint"] = next(r.endpoint for r in app.routes if getattr(r, "path", None) == "/ping")
+    track = UsageTracker("bench", "openai", "gpt-bench")
+    gauge = metrics.streams_in_flight("bench")
+
+    def per_request():
+        metrics.http_duration(metrics.route_of(scope), "GET", "2xx").observe(0.001)
+
+    def per_stream():
+        gauge.inc()
+        gauge.dec()
+        metrics.observe_stream("openai", "gpt-bench", 0.2, 200, 2.0)
+
+    def naive_chunk():
+        metrics.llm_tps.metric.labels("openai", "gpt-bench").observe(1.0)
+
+    print("primitivas (ns/op):")
+    print(f"  por request  histograma de ruta        {_ns(per_request, n):7.0f}")
+    print(f"  por stream   gauge ± + TTFT/tokens/s   {_ns(per_stream, n):7.0f}")
+    print(f"  por chunk    UsageTracker.first_token  {_ns(track.first_token, n):7.0f}")
+    print(f"  por chunk    .labels().observe()       {_ns(naive_chunk, n):7.0f}  (ingenuo)")
+
+
+async def run(app, method: str, path: str, n: int) -> float:
+    for _ in range(min(100, n)):  # warm-up
+        await call(app, method, path)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await call(app, method, path)
+    return (time.perf_counter() - t0) / n
+
+
+def main():
+    global NAIVE, CHUNKS
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--chunks", type=int, default=200)
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+    CHUNKS = args.chunks
+    if not metrics.HAS_PROMETHEUS:
+        sys.exit("prometheus_client no instalado: pip install prometheus-client")
+
+    app = build_app()
+    metrics.configure(True)
+    micro(app, 200_000)
+
+    variants = (("off", False, False), ("on", True, False), ("ingenuo", True, True))
+    results = {name: (float("inf"), float("inf")) for name, _, _ in variants}
+    for _ in range(args.rounds):  # variantes intercaladas; el mínimo por variante filtra el ruido
+        for name, on, naive in variants:
+            metrics.configure(on)
+            NAIVE = naive
+            ping = asyncio.run(run(app, "GET", "/ping", args.requests))
+            stream = asyncio.run(run(app, "POST", "/stream", max(1, args.requests // 10)))
+            results[name] = (min(results[name][0], ping), min(results[name][1], stream))
+
+    base_ping, base_stream = results["off"]
+    print(f"{args.requests:,d} requests JSON · {max(1, args.requests // 10):,d} streams de {args.chunks} chunks")
+    for name, (ping, stream) in results.items():
+        print(f"  {name:<8} /ping {1e6 * ping:7.1f} µs ({1e6 * (ping - base_ping):+6.1f})   "
+              f"/stream {1e6 * stream:8.1f} µs ({1e6 * (stream - base_stream):+7.1f}, "
+              f"{1e9 * (stream - base_stream) / args.chunks:+6.0f} ns/chunk)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# services/api/scripts/bench_paypal_verify.py
+"""
+Latencia de verificar la firma de un webhook de PayPal:
+
+  remote : verify-webhook-signature (payments/paypal.py::verify_webhook) contra
+           un PayPal simulado con `--rtt-ms` de ida y vuelta (+ OAuth la primera vez)
+  local  : app.paypal_verify.PayPalVerifier con un certificado generado; la
+           primera verificación descarga el certificado (`--rtt-ms`), el resto
+           usa la caché
+
+Firma real RSA-2048/SHA256 sobre `transmission_id|time|webhook_id|crc32(body)`.
+Reporta p50/p99 por verificación y las llamadas de red hechas.
+
+Uso:
+    python scripts/bench_paypal_verify.py --events 2000 --rtt-ms 180
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import base64
+import datetime as dt
+import json
+import statistics
+import time
+
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+
+from payments import paypal
+from app.paypal_verify import PayPalVerifier, signed_message
+
+CERT_URL = "https://api.paypal.com/v1/notifications/certs/CERT-360caa42-fca2a594-bench"
+WEBHOOK_ID = "8PT597110X687430LKGECATA"
+RTT_S = 0.18
+NET_CALLS = [0]
+
+
+def make_cert():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "messageverificationcerts.paypal.com")])
+    now = dt.datetime.now(dt.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - dt.timedelta(days=1)).not_valid_after(now + dt.timedelta(days=365))
+        .sign(key, hashes.SHA256())
+    )
+    return key, cert.public_bytes(serialization.Encoding.PEM)
+
+
+def make_events(key, n: int) -> list:
+    out = []
+    for i in range(n):
+        body = json.dumps({"id": f"WH-{i}", "event_type": "PAYMENT.CAPTURE.COMPLETED",
+                           "resource": {"id": f"CAP-{i}", "amount": {"value": "5.00"}}}).encode()
+        tid, ttime = f"tid-{i}", "2024-08-18T16:00:05Z"
+        sig = key.sign(signed_message(tid, ttime, WEBHOOK_ID, body), padding.PKCS1v15(), hashes.SHA256())
+        out.append((body, {
+            "paypal-transmission-id": tid,
+            "paypal-transmission-time": ttime,
+            "paypal-cert-url": CERT_URL,
+            "paypal-auth-algo": "SHA256withRSA",
+            "paypal-transmission-sig": base64.b64encode(sig).decode(),
+        }))
+    return out
+
+
+def fake_paypal(pem: bytes) -> httpx.AsyncClient:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        NET_CALLS[0] += 1
+        await asyncio.sleep(RTT_S)
+        if request.url.path.endswith("/oauth2/token"):
+            return httpx.Response(200, json={"access_token": "A21-bench", "expires_in": 32400})
+        if request.url.path.endswith("/verify-webhook-signature"):
+            return httpx.Response(200, json={"verification_status": "SUCCESS"})
+        return httpx.Response(200, content=pem)
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+async def timed(fn, events: list) -> list:
+    lat = []
+    for body, headers in events:
+        t0 = time.perf_counter()
+        await fn(body, headers)
+        lat.append(time.perf_counter() - t0)
+    return lat
+
+
+def report(name: str, lat: list) -> None:
+    lat = sorted(lat)
+    p99 = lat[int(0.99 * (len(lat) - 1))]
+    print(f"  {name:<7} {1e3 * statistics.median(lat):8.3f}ms {1e3 * p99:8.3f}ms {1e3 * lat[0]:8.3f}ms "
+          f"{1e3 * lat[-1]:8.1f}ms {NET_CALLS[0]:8d}")
+
+
+async def main_async(args) -> None:
+    key, pem = make_cert()
+    client = fake_paypal(pem)
+    paypal.get_client = lambda url: client
+    events = make_events(key, args.events)
+
+    print(f"{args.events} webhooks · RTT PayPal {1e3 * RTT_S:.0f} ms")
+    print(f"  {'modo':<7} {'p50':>10} {'p99':>10} {'min':>10} {'max':>10} {'red':>8}")
+
+    NET_CALLS[0] = 0
+    async def remote(body, headers):
+        await paypal.verify_webhook(json.loads(body), headers)
+    report("remote", await timed(remote, events[: args.remote_events]))
+
+    NET_CALLS[0] = 0
+
+    async def fetch(url: str) -> bytes:
+        r = await client.get(url)
+        return r.content
+
+    verifier = PayPalVerifier(fetch)
+
+    async def local(body, headers):
+        assert await verifier.verify(headers, body, WEBHOOK_ID)
+    report("local", await timed(local, events))
+    print(f"  local · {verifier.stats.as_dict()}")
+    await client.aclose()
+
+
+def main():
+    global RTT_S
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--events", type=int, default=2000)
+    ap.add_argument("--remote-events", type=int, default=50, help="el remoto es lento: menos muestras")
+    ap.add_argument("--rtt-ms", type=float, default=180.0)
+    args = ap.parse_args()
+    RTT_S = args.rtt_ms / 1000
+    paypal.WEBHOOK_ID = WEBHOOK_ID
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# services/api/scripts/bench_prompts.py
+"""
+Costo por request de armar los prompts (sin red): estilo + system + mensajes.
+
+  antes : json.loads(DEFAULT_STYLE_JSON) + StyleConfig(...) + f-string en /plan;
+          _style_block línea a línea en /llm, /chat/complete_stream y el agente
+  ahora : app.prompts (plantillas cargadas al arrancar + LRU por estilo)
+
+Los requests se reparten entre `--styles` estilos distintos (un front real
+usa unos pocos presets). Antes de medir se comprueba que ambos caminos dan
+exactamente el mismo texto.
+
+Uso:
+    python scripts/bench_prompts.py --requests 200000 --styles 8
+"""
+from pathlib import Path
+import os
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")  # Settings lo exige; aquí no hay red
+
+import argparse
+import json
+import time
+
+from app import prompts
+from app.routers.chat import StyleConfig, build_style, build_system
+from app.routers.chat_stream import StyleIn, _style_block as chat_style_block
+from app.routers.llm import _style_block as llm_style_block
+from app.routers.agent_chatmig import build_messages
+from app.settings import get_settings
+
+settings = get_settings()
+
+
+# ---------- implementación anterior (copiada tal cual de los routers) ----------
+def legacy_build_style() -> StyleConfig:
+    try:
+        base = json.loads(settings.DEFAULT_STYLE_JSON)
+    except Exception:
+        base = {}
+    return StyleConfig(**base)
+
+
+def legacy_build_system(style: StyleConfig) -> str:
+    return f"""
+Eres ChatSed, un {style.persona}.
+Filosofía: empático, directo, sin manipulación, respeto y consentimiento. Lenguaje claro y breve.
+Tono: {style.tone}. Dialecto: {style.dialect}. Emojis: {"pocos y pertinentes" if style.use_emojis else "no usar"}.
+
+FORMATO:
+- Si format=json: responde SOLO JSON con llaves: summary (<= {style.summary_words} palabras), steps (lista {style.max_bullets} bullets, cada bullet corto), script (<= {style.script_words} palabras), ab (obj con A y B, 1 línea cada uno), flags (obj con verde/amarillo/rojo), metric_of_the_day, task, p_success (0-1), drivers (lista corta).
+- Si format=markdown: Encabezado “Plan”, bullets (máx {style.max_bullets}), “Script”, “A/B” y “Banderas”. Nada de preámbulos innecesarios.
+
+Evita clichés y presión. Sé práctico y amable. No des consejos médicos/legales. 
+"""
+
+
+def legacy_style_block(s, default_length=None, risk=prompts.RISK_RESPECT) -> str:
+    lines: list[str] = []
+    length = s.length_words or default_length
+    if length:
+        lines.append(f"Extensión objetivo: ~{length} palabras (±20%).")
+    if s.format:
+        lines.append(f"Estructura: usa {s.format}; evita relleno y repeticiones.")
+    if s.tone:
+        lines.append(f"Tono: {s.tone}.")
+    if s.audience:
+        lines.append(f"Audiencia: {s.audience}.")
+    if s.language:
+        lines.append(f"Idioma: {s.language}.")
+    if s.use_emojis is not None:
+        lines.append("Incluye emojis con moderación." if s.use_emojis else "No incluyas emojis.")
+    if s.guidelines:
+        lines.append(s.guidelines)
+    lines.append("Explica el porqué de cada paso y da 1–2 ejemplos concretos.")
+    lines.append(risk)
+    return "\n".join(lines)
+
+
+def legacy_agent_style(style: dict) -> str:
+    tone = style.get("tone") or "claro, empático y directo"
+    audience = style.get("audience") or "principiante"
+    length_words = style.get("length_words") or 300
+    guidelines = style.get("guidelines") or (
+        "Da pasos claros, menciona requisitos/documentos, sugiere tiempos y costos aproximados. "
+        "Usa «» para 1 cita útil. Evita relleno."
+    )
+    return (
+        f"Estilo: tono={tone}; audiencia={audience}; largo≈{length_words} palabras. "
+        f"Instrucciones: {guidelines}"
+    )
+
+
+def legacy_request(s: StyleIn, agent_style: dict) -> int:
+    n = len(legacy_build_system(legacy_build_style()))
+    n += len(legacy_style_block(s))
+    n += len(legacy_style_block(s, 1000, prompts.RISK_OFFICIAL))
+    return n + len(legacy_agent_style(agent_style))
+
+
+def new_request(s: StyleIn, agent_style: dict) -> int:
+    n = len(build_system(build_style()))
+    n += len(llm_style_block(s))
+    n += len(chat_style_block(s))
+    return n + len(build_messages([], "hola", agent_style)[1]["content"])
+
+
+def make_styles(k: int):
+    tones = ["cálido", "directo", "formal", "cercano"]
+    out = []
+    for i in range(k):
+        s = StyleIn(tone=tones[i % 4], use_emojis=bool(i % 2), length_words=300 + 100 * i,
+                    format=["sections", "bullets", "paragraphs"][i % 3], audience="principiante")
+        out.append((s, {"tone": s.tone, "length_words": s.length_words}))
+    return out
+
+
+def check(styles) -> None:
+    assert build_system(build_style()) == legacy_build_system(legacy_build_style())
+    for s, a in styles:
+        assert llm_style_block(s) == legacy_style_block(s)
+        assert chat_style_block(s) == "Guías de estilo:\n" + legacy_style_block(s, 1000, prompts.RISK_OFFICIAL)
+        assert build_messages([], "hola", a)[1]["content"] == legacy_agent_style(a)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--requests", type=int, default=200_000)
+    ap.add_argument("--styles", type=int, default=8)
+    args = ap.parse_args()
+
+    styles = make_styles(args.styles)
+    check(styles)
+    print(f"{args.requests:,d} requests · {args.styles} estilos · prompts idénticos ✓")
+    for name, fn in (("antes", legacy_request), ("app.prompts", new_request)):
+        t0 = time.perf_counter()
+        for i in range(args.requests):
+            s, a = styles[i % len(styles)]
+            fn(s, a)
+        dt = time.perf_counter() - t0
+        print(f"  {name:<12} {1e6 * dt / args.requests:7.2f} µs/request  ({dt:.2f}s)")
+    print(f"  LRU: {prompts.stats()}")
+
+
+if __name__ == "__main__":
+    main()
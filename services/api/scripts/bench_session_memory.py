@@ -0,0 +1,89 @@
+# services/api/scripts/bench_session_memory.py
+"""
+RSS del proceso al crear millones de sesiones distintas: el dict `_MEM` anterior
+(sin desalojo) vs MemorySessionMemory (LRU con máximo de sesiones + TTL).
+
+Cada implementación corre en un subproceso propio; se muestrea el RSS actual
+(/proc/self/statm) cada `--every` sesiones. Con el LRU la curva se aplana en
+cuanto se alcanza AGENT_MEMORY_MAX_SESSIONS.
+
+Uso:
+    python scripts/bench_session_memory.py --sessions 2000000 --max-sessions 10000
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import time
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:  # fuera de Linux: pico en vez de actual
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _turn(i: int) -> list:
+    return [
+        {"role": "user", "content": f"¿Qué requisitos pide la visa de estudiante? #{i}"},
+        {"role": "assistant", "content": "Pasaporte vigente, carta de admisión, fondos y seguro médico. " * 3},
+    ]
+
+
+async def run_one(impl: str, sessions: int, every: int, max_sessions: int) -> None:
+    if impl == "old":
+        mem: dict = {}
+
+        async def append(sid: str, msgs: list) -> None:  # remember() anterior
+            conv = mem.setdefault(sid, [])
+            conv.extend(msgs)
+            if len(conv) > 24:
+                mem[sid] = conv[-24:]
+
+        size = lambda: len(mem)
+    else:
+        from app.session_memory import MemorySessionMemory
+
+        store = MemorySessionMemory(max_sessions=max_sessions, max_messages=40, ttl_s=86400)
+        append = store.append
+        size = lambda: len(store)
+
+    base = rss_mb()
+    t0 = time.perf_counter()
+    print(f"  {impl}")
+    for i in range(1, sessions + 1):
+        await append(f"sess-{i}", _turn(i))
+        if i % every == 0:
+            print(f"    {i:>9,d} sesiones  vivas={size():>9,d}  ΔRSS={rss_mb() - base:8.1f} MB")
+    print(f"    {sessions / (time.perf_counter() - t0):,.0f} appends/s")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sessions", type=int, default=1_000_000)
+    ap.add_argument("--every", type=int, default=200_000)
+    ap.add_argument("--max-sessions", type=int, default=10_000)
+    ap.add_argument("--run", choices=["old", "new"], default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        asyncio.run(run_one(args.run, args.sessions, args.every, args.max_sessions))
+        return
+
+    print(f"{args.sessions:,d} session_id distintos · max_sessions={args.max_sessions:,d}")
+    for impl in ("old", "new"):
+        subprocess.run([sys.executable, __file__, "--run", impl, "--sessions", str(args.sessions),
+                        "--every", str(args.every), "--max-sessions", str(args.max_sessions)], check=True)
+
+
+if __name__ == "__main__":
+    main()
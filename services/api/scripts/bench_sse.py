@@ -0,0 +1,129 @@
+# services/api/scripts/bench_sse.py
+"""
+Costo por evento de parsear un stream SSE de OpenAI y re-emitirlo como NDJSON.
+
+  agente (antes)   : líneas de texto + httpx.Response(200, content=...).json() + repr()
+  main.py (antes)  : líneas de texto + json.loads + json.dumps
+  app.sse (ahora)  : SSEDecoder sobre bytes + loads/dumps de app.sse (orjson si está)
+
+El stream se trocea en chunks de tamaño aleatorio para simular la red.
+
+Uso:
+    python scripts/bench_sse.py --events 200000
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import codecs
+import json
+import random
+import time
+
+import httpx
+
+from app.sse import SSEDecoder, _loads, ndjson_delta, openai_text
+
+
+def make_stream(n: int) -> bytes:
+    out = []
+    for i in range(n):
+        obj = {"id": "chatcmpl-x", "object": "chat.completion.chunk", "created": 1, "model": "gpt-4o-mini",
+               "choices": [{"index": 0, "delta": {"content": f"tok{i} ñ "}, "finish_reason": None}]}
+        out.append(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n")
+    out.append("data: [DONE]\n\n")
+    return "".join(out).encode("utf-8")
+
+
+def chunked(payload: bytes, seed: int = 0):
+    rng = random.Random(seed)
+    i = 0
+    while i < len(payload):
+        j = i + rng.randint(64, 4096)
+        yield payload[i:j]
+        i = j
+
+
+def _lines(chunks):
+    """Equivalente a aiter_lines(): decodifica a str y parte en líneas."""
+    dec = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    for c in chunks:
+        buf += dec.decode(c)
+        *lines, buf = buf.split("\n")
+        yield from lines
+
+
+def legacy_agent(chunks) -> int:
+    n = 0
+    for line in _lines(chunks):
+        if not line:
+            continue
+        chunk = line[6:].strip() if line.startswith("data: ") else line.strip()
+        if chunk == "[DONE]":
+            continue
+        try:
+            obj = httpx.Response(200, content=chunk).json()
+        except Exception:
+            continue
+        for choice in obj.get("choices", []):
+            delta = choice.get("delta", {}).get("content")
+            if delta:
+                f'{{"type":"delta","content":{delta.__repr__()}}}\n'
+                n += 1
+    return n
+
+
+def legacy_main(chunks) -> int:
+    n = 0
+    for line in _lines(chunks):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            continue
+        try:
+            obj = json.loads(data)
+            delta = obj["choices"][0]["delta"].get("content")
+            if delta:
+                json.dumps({"type": "delta", "content": delta}, ensure_ascii=False) + "\n"
+                n += 1
+        except Exception:
+            pass
+    return n
+
+
+def shared(chunks) -> int:
+    n = 0
+    dec = SSEDecoder()
+    for c in chunks:
+        for evt in dec.feed(c):
+            if evt.data == "[DONE]":
+                continue
+            text = openai_text(evt.event, _loads(evt.data))
+            if text:
+                ndjson_delta(text)
+                n += 1
+    return n
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--events", type=int, default=200_000)
+    args = ap.parse_args()
+
+    payload = make_stream(args.events)
+    chunks = list(chunked(payload))
+    print(f"{args.events:,d} eventos · {len(payload) / 1e6:.1f} MB · {len(chunks):,d} chunks")
+    for name, fn in (("agente (antes)", legacy_agent), ("main.py (antes)", legacy_main), ("app.sse (ahora)", shared)):
+        t0 = time.perf_counter()
+        n = fn(chunks)
+        dt = time.perf_counter() - t0
+        print(f"  {name:<16} {1e6 * dt / n:7.2f} µs/evento  ({n:,d} deltas, {dt:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# services/api/scripts/bench_startup.py
+"""
+Arranque en frío del entry point serverless (index.py → app.main): cada
+ronda es un proceso nuevo de Python, como una instancia fría de Vercel.
+
+  import     : `import index` (suma de `python -X importtime`)
+  lifespan   : startup del lifespan de FastAPI (pools, memoria, admisión)
+  pesados    : qué dependencias caras quedaron cargadas al terminar el import
+               (openai, supabase, sqlalchemy, numpy, tiktoken deberían faltar:
+               se cargan con el primer request que las usa, ver app.deps)
+
+También lista los módulos de mayor costo acumulado para ver qué queda.
+Para comparar contra otra versión, correrlo desde ese checkout (--api-dir).
+
+Uso:
+    python scripts/bench_startup.py --rounds 7 --top 12
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+
+HEAVY = ("openai", "supabase", "sqlalchemy", "numpy", "tiktoken", "stripe")
+
+# corre en el proceso hijo: mide el lifespan y reporta qué quedó importado
+CHILD = f"""
+import asyncio, json, sys, time
+import index
+t0 = time.perf_counter()
+async def boot():
+    async with index.app.router.lifespan_context(index.app):
+        pass
+asyncio.run(boot())
+print(json.dumps({{"lifespan_s": time.perf_counter() - t0,
+                  "heavy": [m for m in {HEAVY!r} if m in sys.modules]}}))
+"""
+
+
+def parse_importtime(stderr: str) -> dict:
+    """{módulo: µs acumulados} de la salida de -X importtime."""
+    out = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            out[name.strip()] = int(cumulative)
+    return out
+
+
+def one_round(api_dir: Path) -> tuple:
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "sk-bench")
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        cwd=api_dir, env=env, capture_output=True, text=True, check=True,
+    )
+    modules = parse_importtime(p.stderr)
+    child = json.loads(p.stdout.strip().splitlines()[-1])
+    return modules.get("index", 0) / 1e6, child["lifespan_s"], child["heavy"], modules
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rounds", type=int, default=7)
+    ap.add_argument("--top", type=int, default=12)
+    ap.add_argument("--api-dir", type=Path, default=ROOT, help="services/api de la versión a medir")
+    args = ap.parse_args()
+
+    one_round(args.api_dir)  # calienta la caché de bytecode (.pyc) y del disco
+    imports, lifespans, heavy, last = [], [], [], {}
+    for _ in range(args.rounds):
+        imp, life, heavy, last = one_round(args.api_dir)
+        imports.append(imp)
+        lifespans.append(life)
+
+    print(f"{args.api_dir} · {args.rounds} procesos fríos")
+    print(f"  import index   mediana {1e3 * statistics.median(imports):7.1f} ms   mín {1e3 * min(imports):7.1f} ms")
+    print(f"  lifespan       mediana {1e3 * statistics.median(lifespans):7.1f} ms   mín {1e3 * min(lifespans):7.1f} ms")
+    print(f"  pesados cargados al arrancar: {', '.join(heavy) or 'ninguno'}")
+    print(f"  top {args.top} por costo acumulado (última ronda):")
+    for name, us in sorted(last.items(), key=lambda kv: -kv[1])[1:args.top + 1]:
+        print(f"    {us / 1e3:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# services/api/scripts/bench_webhooks.py
+"""
+Replay de webhooks de Stripe y PayPal grabados (scripts/fixtures/webhook_events.jsonl)
+contra POST /billing/webhook y /paypal/webhook, con Supabase y la verificación
+de PayPal simulados:
+
+  inline : WEBHOOK_QUEUE_ENABLED=0, el handler hace todo antes del 200
+           (upserts de Supabase, verify-webhook-signature de PayPal)
+  cola   : app.webhook_queue: encola en SQLite y responde; el worker aplica
+           por lotes
+
+Cada fixture se clona `--subs` veces (ids de evento/suscripción nuevos) y un
+`--dup-pct` de las entregas se repite, como los reintentos del proveedor en
+horas lentas. Llegadas abiertas a `--rps`: la latencia del ack se mide desde
+el instante programado. Reporta p50/p99 del ack, eventos aplicados por
+segundo (hasta vaciar la cola) y cuántas veces se corrió un handler de más.
+
+Uso:
+    python scripts/bench_webhooks.py --subs 200 --rps 300 --db-ms 15 --verify-ms 250
+"""
+from pathlib import Path
+import sys
+ROOT = Path(__file__).resolve().parents[1]  # .../services/api
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+os.environ.setdefault("STRIPE_WEBHOOK_SECRET", "whsec_bench")
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE", "bench")
+os.environ["WEBHOOK_QUEUE_ENABLED"] = "0"  # cada variante instala la suya
+os.environ.setdefault("PAYPAL_VERIFY_MODE", "remote")  # acá se mide el verify remoto (simulado)
+
+import httpx
+from fastapi import FastAPI
+
+import billing
+from payments import paypal
+from app.webhook_queue import WebhookQueue
+
+FIXTURES = ROOT / "scripts" / "fixtures" / "webhook_events.jsonl"
+DB_S = 0.015
+VERIFY_S = 0.25
+CALLS = [0]
+
+
+class FakeSupabase:
+    """Encadena select/eq/single/upsert/update como supabase-py; execute() duerme DB_S (bloqueante)."""
+
+    def table(self, name: str):
+        return _Query(name)
+
+
+class _Query:
+    def __init__(self, table: str):
+        self.table, self.filters = table, {}
+
+    def select(self, *_):
+        return self
+
+    def upsert(self, *_, **__):
+        return self
+
+    def update(self, *_):
+        return self
+
+    def single(self):
+        return self
+
+    def eq(self, col, val):
+        self.filters[col] = val
+        return self
+
+    def execute(self):
+        time.sleep(DB_S)
+        if self.table == "billing_customers":
+            data = {"user_id": f"user-{self.filters.get('external_customer_id')}"}
+        elif self.table == "subscriptions":
+            data = [{"user_id": f"user-{self.filters.get('external_subscription_id')}"}]
+        else:
+            data = []
+        return type("Res", (), {"data": data})()
+
+
+async def fake_verify(event: dict, sig_headers: dict):
+    await asyncio.sleep(VERIFY_S)  # round trip a /v1/notifications/verify-webhook-signature
+
+
+async def fake_insert_payment(row: dict):
+    await asyncio.sleep(DB_S)
+
+
+def counted(handler):
+    async def run(job):
+        CALLS[0] += 1
+        await handler(job)
+    return run
+
+
+def load_fixtures() -> list:
+    with open(FIXTURES, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def clone(fx: dict, i: int) -> dict:
+    """Misma forma que la fixture con ids propios del clon i (otra suscripción/orden)."""
+    raw = json.dumps(fx["body"])
+    for old in ("sub_1PqSub01", "cus_QhA01", "in_1PqInv01", "I-BW452GLLEP1G", "5O190127TN364715T",
+                "80021663DE681814L", "7TK53561MB803214N", "price_1PqPro"):
+        raw = raw.replace(old, f"{old}_{i}")
+    body = json.loads(raw)
+    body["id"] = f"{body['id']}_{i}"
+    return {"provider": fx["provider"], "body": body}
+
+
+def deliveries(fixtures: list, subs: int, dup_pct: float, rng: random.Random) -> list:
+    out = []
+    for i in range(subs):
+        for fx in fixtures:
+            ev = clone(fx, i)
+            payload = json.dumps(ev["body"]).encode()
+            if ev["provider"] == "stripe":
+                t = int(time.time())
+                sig = hmac.new(os.environ["STRIPE_WEBHOOK_SECRET"].encode(), f"{t}.".encode() + payload,
+                               hashlib.sha256).hexdigest()
+                path, headers = "/billing/webhook", {"stripe-signature": f"t={t},v1={sig}"}
+            else:
+                tid = hashlib.sha1(payload).hexdigest()[:16]
+                path, headers = "/paypal/webhook", {
+                    "paypal-transmission-id": tid,
+                    "paypal-transmission-time": "2024-08-18T16:00:05Z",
+                    "paypal-cert-url": "https://api.paypal.com/v1/notifications/certs/CERT-360caa42",
+                    "paypal-auth-algo": "SHA256withRSA",
+                    "paypal-transmission-sig": f"sig-{tid}",
+                }
+            out.append((path, headers, payload))
+            if rng.random() * 100 < dup_pct:
+                out.append((path, headers, payload))  # reintento del proveedor, mismo cuerpo y firma
+    rng.shuffle(out)
+    return out
+
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(billing.router)
+    app.include_router(paypal.router)
+    return app
+
+
+async def run(queue, reqs: list, rps: float) -> tuple:
+    billing.webhooks = paypal.webhooks = queue
+    lat = []
+    transport = httpx.ASGITransport(app=make_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        async def one(due: float, path: str, headers: dict, payload: bytes):
+            r = await client.post(path, headers=headers, content=payload)
+            lat.append(time.perf_counter() - due)
+            assert r.status_code == 200, r.text
+
+        t0 = time.perf_counter()
+        tasks = []
+        for i, (path, headers, payload) in enumerate(reqs):
+            due = t0 + i / rps
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(one(due, path, headers, payload)))
+        await asyncio.gather(*tasks)
+        acked = time.perf_counter() - t0
+        if queue is not None:
+            while any(k in queue.depth() for k in ("pending", "running")):
+                await asyncio.sleep(0.01)
+            await queue.aclose()
+        applied = time.perf_counter() - t0
+    return lat, acked, applied
+
+
+def main():
+    global DB_S, VERIFY_S
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--subs", type=int, default=200, help="clones de las fixtures (suscripciones/órdenes)")
+    ap.add_argument("--rps", type=float, default=300.0, help="entregas por segundo (carga abierta)")
+    ap.add_argument("--dup-pct", type=float, default=20.0)
+    ap.add_argument("--db-ms", type=float, default=15.0)
+    ap.add_argument("--verify-ms", type=float, default=250.0)
+    ap.add_argument("--batch", type=int, default=50)
+    args = ap.parse_args()
+    DB_S, VERIFY_S = args.db_ms / 1000, args.verify_ms / 1000
+
+    billing.sb = FakeSupabase()
+    paypal.verify_webhook = fake_verify
+    paypal.insert_payment = fake_insert_payment
+    billing.handle_stripe_event = counted(billing.handle_stripe_event)
+    paypal.handle_paypal_event = counted(paypal.handle_paypal_event)
+
+    fixtures = load_fixtures()
+    reqs = deliveries(fixtures, args.subs, args.dup_pct, random.Random(7))
+    unique = args.subs * len(fixtures)
+    print(f"{len(reqs)} entregas ({unique} eventos únicos, {len(fixtures)} fixtures × {args.subs}) a {args.rps:.0f}/s · "
+          f"Supabase {args.db_ms:.0f} ms · verify PayPal {args.verify_ms:.0f} ms")
+    print(f"  {'variante':<8} {'ack p50':>9} {'ack p99':>9} {'acks/s':>7} {'aplicados/s':>12} {'handlers de más':>16}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("inline", "cola"):
+            queue = None
+            if name == "cola":
+                queue = WebhookQueue(str(Path(tmp) / "bench.sqlite3"), batch_size=args.batch, poll_s=0.05)
+                queue.register("stripe", billing.handle_stripe_event)
+                queue.register("paypal", paypal.handle_paypal_event)
+            CALLS[0] = 0
+            lat, acked, applied = asyncio.run(run(queue, reqs, args.rps))
+            lat.sort()
+            p99 = lat[int(0.99 * (len(lat) - 1))]
+            print(f"  {name:<8} {1e3 * statistics.median(lat):7.1f}ms {1e3 * p99:7.1f}ms {len(lat) / acked:7.0f} "
+                  f"{unique / applied:12.0f} {CALLS[0] - unique:16d}")
+            if queue is not None:
+                print(f"           cola · {queue.stats.as_dict()}")
+                queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# services/api/scripts/fake_openai.py
+"""
+Servidor OpenAI falso para benchmarks locales (sin red ni API key).
+
+Implementa lo mínimo que usa la API:
+  - POST /v1/chat/completions  (stream SSE o JSON)
+  - POST /v1/embeddings
+Cada stream emite N deltas con un retardo fijo entre ellos (sin stream: la
+respuesta tarda lo mismo), y el servidor lleva la cuenta de completions en
+vuelo (actual y pico) en GET /stats.
+El bloque `usage` imita el prompt caching de OpenAI: cached_tokens = prefijo
+común más largo con un prompt anterior (≈4 chars/token, desde 1024 tokens,
+en pasos de 128); en stream solo con stream_options.include_usage.
+
+Uso:
+    python scripts/fake_openai.py --port 8765 --deltas 50 --delay 0.02
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(deltas: int = 50, delay: float = 0.02, dim: int = 8) -> FastAPI:
+    app = FastAPI()
+    app.state.in_flight = 0
+    app.state.peak = 0
+    app.state.served = 0
+
+    def _chunk(content: str | None, finish: str | None = None) -> str:
+        obj = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [{"index": 0, "delta": {"content": content} if content else {}, "finish_reason": finish}],
+        }
+        return f"data: {json.dumps(obj)}\n\n"
+
+    app.state.prompts = []  # prompts vistos (serializados), para simular la caché de prefijos
+
+    def _usage(messages: list, completion: int) -> dict:
+        raw = json.dumps(messages, ensure_ascii=False)
+        common = 0
+        for prev in app.state.prompts:
+            lo, hi = 0, min(len(raw), len(prev))  # búsqueda binaria del prefijo común
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if raw[:mid] == prev[:mid]:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            common = max(common, lo)
+        app.state.prompts = (app.state.prompts + [raw])[-50:]
+        prompt_tokens = (len(raw) + 3) // 4
+        cached = (common // 4) // 128 * 128
+        cached = cached if cached >= 1024 else 0
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion,
+                "total_tokens": prompt_tokens + completion, "prompt_tokens_details": {"cached_tokens": cached}}
+
+    @app.post("/v1/chat/completions")
+    async def completions(req: Request):
+        body = await req.json()
+        usage = _usage(body.get("messages") or [], deltas)
+        if not body.get("stream"):
+            app.state.in_flight += 1
+            app.state.peak = max(app.state.peak, app.state.in_flight)
+            try:
+                await asyncio.sleep(delay * deltas)
+            finally:
+                app.state.in_flight -= 1
+            app.state.served += 1
+            return JSONResponse({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "fake",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok " * deltas}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        async def gen():
+            app.state.in_flight += 1
+            app.state.peak = max(app.state.peak, app.state.in_flight)
+            try:
+                for i in range(deltas):
+                    await asyncio.sleep(delay)
+                    yield _chunk(f"tok{i} ")
+                yield _chunk(None, "stop")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    yield f"data: {json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                app.state.in_flight -= 1
+                app.state.served += 1
+
+        return StreamingResponse(gen(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(req: Request):
+        body = await req.json()
+        inputs = body.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        data = []
+        for i, text in enumerate(inputs):
+            h = hashlib.sha256(str(text).encode("utf-8")).digest()
+            data.append({"object": "embedding", "index": i, "embedding": [b / 255.0 for b in h[:dim]]})
+        return JSONResponse({"object": "list", "data": data, "model": "fake", "usage": {"prompt_tokens": 1, "total_tokens": 1}})
+
+    @app.get("/stats")
+    async def stats():
+        return {"in_flight": app.state.in_flight, "peak": app.state.peak, "served": app.state.served}
+
+    @app.post("/stats/reset")
+    async def reset():
+        app.state.peak = app.state.in_flight
+        app.state.served = 0
+        return {"ok": True}
+
+    return app
+
+
+def serve_in_thread(port: int, **kwargs) -> uvicorn.Server:
+    """Arranca el servidor falso en un hilo daemon y espera a que esté listo."""
+    config = uvicorn.Config(create_app(**kwargs), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def serve_in_subprocess(port: int, deltas: int = 50, delay: float = 0.02) -> subprocess.Popen:
+    """Igual que serve_in_thread pero en otro proceso (no comparte GIL con el cliente)."""
+    import httpx
+
+    proc = subprocess.Popen([
+        sys.executable, __file__, "--port", str(port), "--deltas", str(deltas), "--delay", str(delay),
+    ])
+    for _ in range(500):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=0.2)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.02)
+    proc.terminate()
+    raise RuntimeError("fake_openai no arrancó")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--deltas", type=int, default=50)
+    ap.add_argument("--delay", type=float, default=0.02)
+    args = ap.parse_args()
+    uvicorn.run(create_app(args.deltas, args.delay), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
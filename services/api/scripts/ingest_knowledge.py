@@ -1,30 +1,132 @@
+# services/api/scripts/ingest_knowledge.py
+"""
+Ingesta incremental de knowledge_src/ → embeddings → índice local (+ Supabase).
 
+- Chunks por oraciones/encabezados medidos en tokens (app.chunking).
+- Cada chunk se identifica por hash de (modelo de embeddings, contenido): si ya
+  está en el índice local no se vuelve a embeber.
+- Los chunks nuevos se agrupan en requests acotados por tokens y se envían con
+  N workers concurrentes, con reintentos y backoff exponencial.
+- El índice local (VECTOR_INDEX_PATH) es el estado de la ingesta: siempre se
+  reescribe. Con --sink supabase|both además se hace upsert por lotes en la
+  tabla `knowledge` y se borran los chunks que ya no existen.
 
+Re-ejecutar sobre un corpus sin cambios no hace llamadas a la API ni escribe nada.
+"""
 from pathlib import Path
 import sys
 ROOT = Path(__file__).resolve().parents[1]  # .../services/api
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
-import os, glob
-from pydantic import BaseModel
+import os, glob, argparse, asyncio, hashlib, random, time
+from typing import Dict, List, Optional
+import numpy as np
+from app.chunking import chunk_file
 from app.settings import get_settings
-from openai import OpenAI
-
-def chunk_text(t: str, max_chars=1200, overlap=200):
-    t = " ".join(t.split())
-    chunks = []
-    i = 0
-    while i < len(t):
-        j = min(i + max_chars, len(t))
-        chunks.append(t[i:j])
-        i = j - overlap
-        if i < 0: i = 0
-    return chunks
+from app.tokens import token_counter
+from app.vector_index import VectorIndex, build_index, load_index
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+RETRYABLE = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+MAX_INPUTS_PER_REQUEST = 2048  # límite de la API de embeddings
+
+def chunk_id(model: str, content: str) -> str:
+    return hashlib.sha256(f"{model}\x00{content}".encode("utf-8")).hexdigest()[:32]
+
+def collect_chunks(files: List[str], model: str, max_tokens: int = 300, overlap_tokens: int = 50) -> List[dict]:
+    """Chunks de todos los archivos, deduplicados por id (contenido idéntico = un solo vector)."""
+    seen, out = set(), []
+    count = token_counter(model)
+    for fp in sorted(files):
+        name = os.path.basename(fp)
+        for chunk in chunk_file(fp, max_tokens, overlap_tokens, count):
+            cid = chunk_id(model, chunk)
+            if cid in seen:
+                continue
+            seen.add(cid)
+            out.append({"id": cid, "content": chunk, "source": name})
+    return out
+
+def previous_vectors(index: Optional[VectorIndex], model: str) -> Dict[str, int]:
+    """id → fila en el índice existente (solo si se construyó con el mismo modelo)."""
+    if index is None or index.model != model:
+        return {}
+    return {m["id"]: row for row, m in enumerate(index.meta)}
+
+def make_batches(chunks: List[dict], max_tokens: int, count) -> List[List[dict]]:
+    batches, cur, cur_tokens = [], [], 0
+    for c in chunks:
+        n = count(c["content"])
+        if cur and (cur_tokens + n > max_tokens or len(cur) >= MAX_INPUTS_PER_REQUEST):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(c)
+        cur_tokens += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+async def embed_batches(
+    client: AsyncOpenAI, model: str, batches: List[List[dict]], workers: int, max_retries: int
+) -> Dict[str, List[float]]:
+    sem = asyncio.Semaphore(workers)
+    out: Dict[str, List[float]] = {}
+    calls = 0
+
+    async def one(n: int, batch: List[dict]) -> None:
+        nonlocal calls
+        async with sem:
+            for attempt in range(max_retries + 1):
+                try:
+                    calls += 1
+                    resp = await client.embeddings.create(model=model, input=[c["content"] for c in batch])
+                    break
+                except RETRYABLE as e:
+                    if attempt == max_retries:
+                        raise
+                    wait = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                    print(f"  lote {n + 1}: {type(e).__name__}, reintento {attempt + 1} en {wait:.1f}s")
+                    await asyncio.sleep(wait)
+            for c, d in zip(batch, sorted(resp.data, key=lambda d: d.index)):
+                out[c["id"]] = d.embedding
+            print(f"  lote {n + 1}/{len(batches)} OK ({len(batch)} chunks)")
+
+    await asyncio.gather(*(one(n, b) for n, b in enumerate(batches)))
+    print(f"Embeddings: {len(out)} chunks nuevos en {calls} llamadas")
+    return out
+
+def upsert_supabase(settings, rows: List[dict], stale_ids: List[str], batch: int = 500) -> None:
+    from supabase import create_client
+
+    if not (settings.SUPABASE_URL and settings.SUPABASE_SERVICE_ROLE_KEY):
+        raise SystemExit("SUPABASE_URL/SUPABASE_SERVICE_ROLE_KEY requeridos para --sink supabase")
+    sb = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_ROLE_KEY)
+    table = sb.table("knowledge")
+    for i in range(0, len(rows), batch):
+        table.upsert(rows[i:i + batch], on_conflict="id").execute()
+    for i in range(0, len(stale_ids), batch):
+        table.delete().in_("id", stale_ids[i:i + batch]).execute()
+    print(f"Supabase: {len(rows)} upserts, {len(stale_ids)} borrados")
 
 def main():
+    ap = argparse.ArgumentParser(description="Embebe knowledge_src/ (incremental) y construye el índice vectorial local.")
+    ap.add_argument("--src-dir", default=None, help="corpus (default: knowledge_src/)")
+    ap.add_argument("--index-dir", default=None, help="destino del índice (default: VECTOR_INDEX_PATH)")
+    ap.add_argument("--mode", choices=["flat", "ivf"], default="flat", help="ivf para corpus grandes")
+    ap.add_argument("--nlist", type=int, default=None, help="listas IVF (default 4·sqrt(n))")
+    ap.add_argument("--chunk-tokens", type=int, default=300, help="tamaño máx. de chunk en tokens")
+    ap.add_argument("--overlap-tokens", type=int, default=50, help="solape entre chunks vecinos")
+    ap.add_argument("--sink", choices=["local", "supabase", "both"], default="local")
+    ap.add_argument("--workers", type=int, default=4, help="requests de embeddings concurrentes")
+    ap.add_argument("--batch-tokens", type=int, default=100_000, help="tokens máx. por request")
+    ap.add_argument("--max-retries", type=int, default=5)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
     settings = get_settings()
-    src_dir = os.path.join(os.path.dirname(__file__), "..", "knowledge_src")
+    model = settings.EMBED_MODEL
+    src_dir = args.src_dir or os.path.join(os.path.dirname(__file__), "..", "knowledge_src")
     src_dir = os.path.abspath(src_dir)
     if not os.path.isdir(src_dir):
         os.makedirs(src_dir, exist_ok=True)
@@ -34,19 +136,46 @@ def main():
         print("No hay archivos en knowledge_src/")
         return
 
-    client = OpenAI(api_key=settings.OPENAI_API_KEY)
+    index_dir = args.index_dir or settings.VECTOR_INDEX_PATH or "knowledge_index"
+    if not os.path.isabs(index_dir):
+        index_dir = str(ROOT / index_dir)
+
+    chunks = collect_chunks(files, model, args.chunk_tokens, args.overlap_tokens)
+    if not chunks:
+        print("knowledge_src/ no tiene texto")
+        return
+    index = load_index(index_dir)
+    prev = previous_vectors(index, model)
+    new = [c for c in chunks if c["id"] not in prev]
+    current_ids = {c["id"] for c in chunks}
+    stale_ids = [i for i in prev if i not in current_ids]
+    print(f"{len(files)} archivos · {len(chunks)} chunks · {len(new)} nuevos · {len(stale_ids)} eliminados")
+
+    unchanged = not new and not stale_ids and index is not None and index.mode == args.mode
+    if unchanged:
+        print(f"Sin cambios ({time.perf_counter() - t0:.2f}s, 0 llamadas a la API)")
+        return
+
+    fresh: Dict[str, List[float]] = {}
+    if new:
+        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+        batches = make_batches(new, args.batch_tokens, token_counter(model))
+        fresh = asyncio.run(embed_batches(client, model, batches, args.workers, args.max_retries))
+
+    # copia en RAM de lo reutilizado antes de reescribir vectors.f32
+    dim = index.dim if prev else len(next(iter(fresh.values())))
+    vectors = np.empty((len(chunks), dim), dtype=np.float32)
+    for row, c in enumerate(chunks):
+        vectors[row] = index.vectors[prev[c["id"]]] if c["id"] in prev else fresh[c["id"]]
+
+    header = build_index(index_dir, vectors, chunks, model=model, mode=args.mode, nlist=args.nlist)
+    print(f"Índice {header['mode']}: {header['count']} chunks en {index_dir}")
 
-    total_chunks = 0
-    for fp in files:
-        with open(fp, "r", encoding="utf-8") as f:
-            txt = f.read()
-        chunks = chunk_text(txt)
-        total_chunks += len(chunks)
-        # ejemplo de embeddings (no sube a DB todavía)
-        _ = client.embeddings.create(model=settings.EMBED_MODEL, input=chunks)
-        print(f"Embeddings OK: {os.path.basename(fp)} -> {len(chunks)} chunks")
+    if args.sink in ("supabase", "both"):
+        rows = [{**c, "embedding": fresh[c["id"]]} for c in new]
+        upsert_supabase(settings, rows, stale_ids)
 
-    print(f"Listo. Chunks totales: {total_chunks}")
+    print(f"Listo en {time.perf_counter() - t0:.2f}s")
 
 if __name__ == "__main__":
     main()
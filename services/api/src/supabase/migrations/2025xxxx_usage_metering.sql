@@ -0,0 +1,31 @@
+-- USAGE COUNTERS: desglose prompt/completion y mensajes (app.metering)
+alter table public.usage_counters
+  add column if not exists prompt_tokens int not null default 0,
+  add column if not exists completion_tokens int not null default 0,
+  add column if not exists messages_used int not null default 0;
+
+-- Volcado por lotes desde la API: un RPC con N filas (user_id, day, prompt_tokens,
+-- completion_tokens, messages) que SUMA sobre lo existente. No es idempotente:
+-- la API solo reintenta los lotes cuyo RPC falló.
+create or replace function public.usage_increment(rows jsonb)
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+  insert into public.usage_counters as uc
+    (user_id, day, tokens_used, prompt_tokens, completion_tokens, messages_used, updated_at)
+  select r.user_id, r.day,
+         r.prompt_tokens + r.completion_tokens, r.prompt_tokens, r.completion_tokens, r.messages, now()
+  from jsonb_to_recordset(rows)
+    as r(user_id uuid, day date, prompt_tokens int, completion_tokens int, messages int)
+  on conflict (user_id, day) do update set
+    tokens_used       = uc.tokens_used + excluded.tokens_used,
+    prompt_tokens     = uc.prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = uc.completion_tokens + excluded.completion_tokens,
+    messages_used     = uc.messages_used + excluded.messages_used,
+    updated_at        = now();
+$$;
+
+-- Solo service role (la API); los usuarios siguen leyendo lo suyo vía usage_select_own
+revoke all on function public.usage_increment(jsonb) from public, anon, authenticated;
@@ -0,0 +1,53 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from app.chunking import chunk_file, chunk_lines  # noqa: E402
+from scripts.ingest_knowledge import collect_chunks  # noqa: E402
+
+DOC = """# Visas de trabajo
+
+La visa de trabajo exige contrato firmado. El empleador la tramita ante el consulado. El trámite tarda
+entre cuatro y ocho semanas según el país. Conviene llevar copias apostilladas de todos los documentos.
+
+## Residencia
+
+Tras dos años se puede pedir la residencia permanente. Hace falta certificado de antecedentes.
+"""
+
+
+def words(text):
+    return len(text.split())
+
+
+def test_same_corpus_gives_same_chunk_ids(tmp_path):
+    (tmp_path / "visas.md").write_text(DOC, encoding="utf-8")
+    (tmp_path / "copia.md").write_text(DOC, encoding="utf-8")
+    files = [str(tmp_path / "visas.md"), str(tmp_path / "copia.md")]
+    first = collect_chunks(files, "text-embedding-3-small", max_tokens=20, overlap_tokens=5)
+    second = collect_chunks(list(reversed(files)), "text-embedding-3-small", max_tokens=20, overlap_tokens=5)
+    assert [c["id"] for c in first] == [c["id"] for c in second]
+    assert len({c["id"] for c in first}) == len(first)  # contenido idéntico entre archivos: un solo id
+    other_model = collect_chunks(files, "text-embedding-3-large", max_tokens=20, overlap_tokens=5)
+    assert {c["id"] for c in first}.isdisjoint(c["id"] for c in other_model)
+
+
+def test_chunks_respect_budget_and_headings(tmp_path):
+    path = tmp_path / "visas.md"
+    path.write_text(DOC, encoding="utf-8")
+    chunks = list(chunk_file(str(path), max_tokens=20, overlap_tokens=5, count=words))
+    assert chunks == list(chunk_file(str(path), max_tokens=20, overlap_tokens=5, count=words))
+    assert all(words(c) <= 20 for c in chunks)
+    assert chunks[0].startswith("# Visas de trabajo")
+    residencia = [c for c in chunks if c.startswith("## Residencia")]
+    assert len(residencia) == 1 and "apostilladas" not in residencia[0]  # sin solape entre secciones
+
+
+def test_long_sentence_is_split_on_word_boundaries():
+    sentence = " ".join(f"palabra{i}" for i in range(25)) + "."
+    chunks = list(chunk_lines([sentence], max_tokens=10, overlap_tokens=0, count=words))
+    assert [words(c) for c in chunks] == [10, 10, 5]
+    assert " ".join(chunks) == sentence
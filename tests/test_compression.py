@@ -0,0 +1,116 @@
+import asyncio
+import gzip
+import json
+import os
+import sys
+import zlib
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+
+from app import compression  # noqa: E402
+from app.compression import CompressionMiddleware, negotiate  # noqa: E402
+
+EVENTS = [json.dumps({"type": "delta", "content": f"tok{i} "}) + "\n" for i in range(20)]
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=800)
+
+    @app.get("/big")
+    async def big():
+        return {"items": [{"id": i, "text": "respuesta larga " * 4} for i in range(200)]}
+
+    @app.get("/small")
+    async def small():
+        return {"ok": True}
+
+    @app.get("/stream")
+    async def stream():
+        async def gen():
+            for e in EVENTS:
+                yield e
+        return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+    return app
+
+
+def test_negotiate_prefers_server_order_and_honours_q():
+    assert negotiate("gzip, deflate", ("zstd", "br", "gzip")) == "gzip"
+    assert negotiate("gzip, br;q=0.5, zstd", ("zstd", "br", "gzip")) == "zstd"
+    assert negotiate("br;q=0, gzip", ("br", "gzip")) == "gzip"
+    assert negotiate("identity", ("br", "gzip")) is None
+    assert negotiate("*", ("br", "gzip")) == "br"
+    assert negotiate("", ("gzip",)) is None
+
+
+def call(path, headers):
+    """ASGI directo: cuerpo crudo (sin la decodificación automática del cliente HTTP)."""
+    messages = []
+
+    async def run():
+        scope = {"type": "http", "method": "GET", "path": path, "raw_path": path.encode(), "root_path": "",
+                 "scheme": "http", "query_string": b"", "headers": [(k.lower(), v) for k, v in headers.items()],
+                 "server": ("t", 80), "client": ("t", 1), "http_version": "1.1", "asgi": {"version": "3.0"}}
+        sent = asyncio.Event()
+
+        async def receive():
+            if not sent.is_set():
+                sent.set()
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.Event().wait()  # sin desconexión
+
+        async def send(message):
+            messages.append(message)
+
+        await build_app()(scope, receive, send)
+
+    asyncio.run(run())
+    return dict(messages[0]["headers"]), [m["body"] for m in messages[1:] if m["type"] == "http.response.body"]
+
+
+def decode(codec, body):
+    if codec == "br":
+        import brotli
+        return brotli.decompress(body)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(body)
+    return gzip.decompress(body)
+
+
+@pytest.mark.parametrize("codec", list(compression.CODECS))
+def test_large_json_uses_negotiated_codec(codec):
+    headers, bodies = call("/big", {b"accept-encoding": codec.encode()})
+    assert headers[b"content-encoding"] == codec.encode()
+    assert b"accept-encoding" in headers[b"vary"].lower()
+    assert int(headers[b"content-length"]) == len(bodies[0])
+    assert len(json.loads(decode(codec, bodies[0]))["items"]) == 200
+
+
+def test_small_json_is_not_compressed():
+    headers, bodies = call("/small", {b"accept-encoding": b"gzip"})
+    assert b"content-encoding" not in headers
+    assert json.loads(bodies[0]) == {"ok": True}
+
+
+def test_stream_flushes_every_event():
+    headers, bodies = call("/stream", {b"accept-encoding": b"gzip, br"})
+    assert headers[b"content-encoding"] == b"gzip"
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for event, body in zip(EVENTS, bodies):
+        assert d.decompress(body).decode() == event  # cada evento se decodifica sin esperar al siguiente
+    assert gzip.decompress(b"".join(bodies)).decode() == "".join(EVENTS)
+
+
+def test_stream_opt_out_header_sends_identity():
+    headers, bodies = call("/stream", {b"accept-encoding": b"gzip", b"x-stream-encoding": b"identity"})
+    assert b"content-encoding" not in headers
+    assert b"".join(bodies).decode() == "".join(EVENTS)
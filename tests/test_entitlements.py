@@ -0,0 +1,104 @@
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.entitlements import EntitlementCache  # noqa: E402
+
+
+def test_hit_until_invalidated():
+    cache = EntitlementCache(ttl_s=30)
+    calls = []
+
+    def loader(uid):
+        calls.append(uid)
+        return {"user_id": uid, "plan_id": "pro"}
+
+    async def run():
+        a = await cache.get("u1", loader)
+        b = await cache.get("u1", loader)
+        await cache.invalidate("u1")
+        c = await cache.get("u1", loader)
+        return a, b, c
+
+    a, b, c = asyncio.run(run())
+    assert a == b == c == {"user_id": "u1", "plan_id": "pro"}
+    assert calls == ["u1", "u1"]
+    st = cache.stats.as_dict()
+    assert st["hits"] == 1 and st["loads"] == 2 and st["invalidations"] == 1
+
+
+def test_no_subscription_is_cached_and_ttl_expires():
+    cache = EntitlementCache(ttl_s=0.05)
+    calls = []
+
+    def loader(uid):
+        calls.append(uid)
+        return None
+
+    async def run():
+        assert await cache.get("u1", loader) is None
+        assert await cache.get("u1", loader) is None
+        await asyncio.sleep(0.06)
+        assert await cache.get("u1", loader) is None
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_concurrent_misses_share_one_load():
+    cache = EntitlementCache()
+    calls = []
+
+    def loader(uid):
+        calls.append(uid)
+        time.sleep(0.02)
+        return {"user_id": uid}
+
+    async def run():
+        return await asyncio.gather(*(cache.get("u1", loader) for _ in range(5)))
+
+    assert asyncio.run(run()) == [{"user_id": "u1"}] * 5
+    assert len(calls) == 1
+
+
+def test_load_crossing_invalidation_is_not_stored():
+    cache = EntitlementCache()
+    started = threading.Event()
+    plans = iter(["free", "pro"])
+
+    def loader(uid):
+        started.set()
+        time.sleep(0.05)
+        return {"plan_id": next(plans)}
+
+    async def run():
+        first = asyncio.ensure_future(cache.get("u1", loader))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        await cache.invalidate("u1")  # webhook mientras la lectura vieja está en vuelo
+        assert (await first)["plan_id"] == "free"
+        return await cache.get("u1", loader)
+
+    assert asyncio.run(run())["plan_id"] == "pro"
+    assert cache.stats.stale_loads == 1
+
+
+def test_free_plan_loaded_once():
+    cache = EntitlementCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return {"plan_id": "free"}
+
+    async def run():
+        for _ in range(3):
+            assert (await cache.free_plan(loader))["plan_id"] == "free"
+        cache.invalidate_plans()
+        await cache.free_plan(loader)
+
+    asyncio.run(run())
+    assert len(calls) == 2
@@ -0,0 +1,80 @@
+import asyncio
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.http_clients import HTTPClientRegistry, PoolStats, _MeteredTransport  # noqa: E402
+
+
+class Ok(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive: la segunda request reutiliza la conexión
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origins():
+    servers = [ThreadingHTTPServer(("127.0.0.1", 0), Ok) for _ in range(2)]
+    for s in servers:
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+    yield [f"http://127.0.0.1:{s.server_address[1]}" for s in servers]
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+
+def test_sequential_requests_reuse_the_pooled_connection(origins):
+    reg = HTTPClientRegistry()
+    reg.configure(http2=False)
+    a, b = origins
+
+    async def run():
+        try:
+            for _ in range(2):
+                assert (await reg.client(a).get(a + "/x")).text == "ok"
+            await reg.client(b).get(b + "/y")
+            return reg.client(a + "/otra/ruta"), reg.client(a), reg.client(b)
+        finally:
+            await reg.aclose()
+
+    same1, same2, other = asyncio.run(run())
+    assert same1 is same2 and other is not same1  # un cliente por origin, no por URL
+    stats = reg.stats()
+    assert stats[a]["requests"] == 2 and stats[a]["misses"] == 1 and stats[a]["hits"] == 1
+    assert stats[b]["requests"] == 1 and stats[b]["misses"] == 1 and stats[b]["hits"] == 0
+
+
+def test_metered_transport_counts_failed_requests_and_keeps_upstream_trace():
+    seen = []
+
+    async def handler(request):
+        await request.extensions["trace"]("connection.connect_tcp.started", {})
+        raise httpx.ConnectError("refused", request=request)
+
+    async def upstream_trace(name, info):
+        seen.append(name)
+
+    stats = PoolStats()
+    transport = _MeteredTransport(httpx.MockTransport(handler), stats)
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as c:
+            with pytest.raises(httpx.ConnectError):
+                await c.get("http://x/", extensions={"trace": upstream_trace})
+
+    asyncio.run(run())
+    assert seen == ["connection.connect_tcp.started"]
+    assert stats.as_dict()["requests"] == 1 and stats.misses == 1 and stats.hits == 0
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+API = Path(__file__).resolve().parents[1] / "services" / "api"
+sys.path.insert(0, str(API))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from starlette.datastructures import State  # noqa: E402
+
+from app import deps  # noqa: E402
+
+
+def test_cold_import_skips_heavy_dependencies(tmp_path):
+    code = (
+        "import sys, index; "
+        "print(','.join(m for m in ('openai', 'supabase', 'sqlalchemy', 'numpy', 'tiktoken') if m in sys.modules))"
+    )
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path}/t.db")
+    out = subprocess.run([sys.executable, "-c", code], cwd=API, env=env, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == ""
+    assert not (tmp_path / "t.db").exists()  # el import no crea tablas (python -m app.migrate)
+
+
+def test_lazy_state_builds_once():
+    state = State()
+    state.settings = SimpleNamespace(RAG_BACKEND="supabase")
+    assert deps.vector_index(state) is None
+    calls = []
+    assert deps._lazy(state, "x", lambda: calls.append(1) or "v") == "v"
+    assert deps._lazy(state, "x", lambda: calls.append(1) or "w") == "v"
+    assert calls == [1]
+
+
+def test_first_log_creates_schema_without_migrate(tmp_path):
+    code = (
+        "from fastapi import FastAPI; from fastapi.testclient import TestClient; "
+        "from app.routers.progress import router; app = FastAPI(); app.include_router(router); "
+        "c = TestClient(app); print(c.post('/log', json={'kpi': {'visas': 1}}).status_code, c.post('/log', json={'kpi': {'visas': 1}}).json()['id'])"
+    )
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path}/t.db")
+    out = subprocess.run([sys.executable, "-c", code], cwd=API, env=env, capture_output=True, text=True, check=True)
+    assert out.stdout.split() == ["200", "2"]
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app import metering  # noqa: E402
+from app.metering import Charge, Quota, QuotaExceeded, UsageMeter, metered  # noqa: E402
+from app.prompt_cache import Usage  # noqa: E402
+
+U1, U2, U3 = (str(uuid.UUID(int=i)) for i in (1, 2, 3))
+
+
+class FakeSupabase:
+    def __init__(self, fail=0, poison=None):
+        self.fail = fail
+        self.poison = poison  # user_id cuya fila siempre rompe el RPC
+        self.calls = []
+
+    def rpc(self, name, params):
+        sb = self
+
+        class Call:
+            def execute(self):
+                if sb.fail:
+                    sb.fail -= 1
+                    raise RuntimeError("boom")
+                if any(r["user_id"] == sb.poison for r in params["rows"]):
+                    raise RuntimeError("violates foreign key constraint")
+                sb.calls.append((name, params["rows"]))
+
+        return Call()
+
+
+def test_quota_rejects_after_settle_without_io():
+    meter = UsageMeter(Quota(tokens=100))
+
+    async def run():
+        meter.check("u1")
+        await meter.settle(Charge("u1", "llm", usage=Usage(prompt_tokens=70, completion_tokens=40)))
+        with pytest.raises(QuotaExceeded) as e:
+            meter.check("u1")
+        await meter.aclose()
+        return e.value
+
+    err = asyncio.run(run())
+    assert 0 < err.retry_after <= 86400
+    st = meter.stats.as_dict()
+    assert st["rejected"] == 1 and st["provider_usage"] == 1 and st["prompt_tokens"] == 70
+
+
+def test_message_quota_and_settle_once():
+    meter = UsageMeter(Quota(messages=1))
+    charge = Charge("u1", "agent", prompt_tokens=5)
+
+    async def run():
+        await meter.settle(charge)
+        await meter.settle(charge)
+        with pytest.raises(QuotaExceeded):
+            meter.check("u1")
+        await meter.aclose()
+
+    asyncio.run(run())
+    assert meter.stats.settled == 1
+
+
+def test_report_prefers_provider_usage_over_tokenizer():
+    charge = Charge("u1", "chat", prompt_tokens=999)
+    token = metering._CURRENT.set(charge)
+    try:
+        metering.report(Usage(prompt_tokens=12, completion_tokens=3))
+    finally:
+        metering._CURRENT.reset(token)
+    charge.add("texto largo que no se cuenta")
+    assert charge.tokens() == (12, 3)
+
+
+def test_stream_fallback_counts_only_ndjson_deltas():
+    meter = UsageMeter()
+    charge = Charge("u1", "llm_stream", prompt_tokens=10)
+    lines = [
+        json.dumps({"type": "sources", "items": ["x" * 400]}).encode() + b"\n",
+        json.dumps({"type": "delta", "content": "hola mundo"}).encode() + b"\n",
+        json.dumps({"type": "done"}).encode() + b"\n",
+    ]
+
+    async def source():
+        for line in lines:
+            yield line
+
+    async def run():
+        out = [item async for item in metered(meter, charge, source())]
+        await meter.aclose()
+        return out
+
+    assert asyncio.run(run()) == lines
+    assert charge.settled
+    prompt, completion = charge.tokens()
+    assert prompt == 10 and 0 < completion < 10
+    assert meter.stats.estimated == 1
+
+
+def test_flush_batches_rows_and_retries_failures():
+    sb = FakeSupabase(fail=1)
+    meter = UsageMeter(supabase=lambda: sb, flush_s=60, max_batch=2)
+
+    async def run():
+        for user in (U1, U2, U3, U1):
+            await meter.settle(Charge(user, "llm", usage=Usage(prompt_tokens=4, completion_tokens=1)))
+        assert await meter.flush() == 0  # primer RPC falla: todo vuelve al pendiente
+        written = await meter.flush()
+        await meter.aclose()
+        return written
+
+    assert asyncio.run(run()) == 3
+    assert [len(rows) for _, rows in sb.calls] == [1, 1, 1]  # tras un lote fallido, de a una fila
+    rows = {r["user_id"]: r for _, batch in sb.calls for r in batch}
+    assert rows[U1]["prompt_tokens"] == 8 and rows[U1]["messages"] == 2
+    st = meter.stats.as_dict()
+    assert st["flush_errors"] == 1 and st["flushes"] == 3
+
+
+def test_failing_row_is_isolated_and_dropped():
+    sb = FakeSupabase(poison=U2)
+    meter = UsageMeter(supabase=lambda: sb, flush_s=60, max_batch=10, max_flush_attempts=3)
+
+    async def run():
+        for user in (U1, U2, U3):
+            await meter.settle(Charge(user, "llm", usage=Usage(prompt_tokens=1)))
+        for _ in range(4):
+            await meter.flush()
+        await meter.aclose()
+
+    asyncio.run(run())
+    assert sorted(r["user_id"] for _, rows in sb.calls for r in rows) == [U1, U3]
+    assert meter.stats.dropped_rows == 1 and meter._pending == {} and meter._failures == {}
+
+
+def test_outage_requeues_without_counting_attempts():
+    sb = FakeSupabase(fail=100)
+    meter = UsageMeter(supabase=lambda: sb, flush_s=60, max_flush_attempts=2)
+
+    async def run():
+        for user in (U1, U2, U3):
+            await meter.settle(Charge(user, "llm", usage=Usage(prompt_tokens=1)))
+        for _ in range(5):
+            await meter.flush()
+        sb.fail = 0
+        written = await meter.flush()
+        await meter.aclose()
+        return written
+
+    assert asyncio.run(run()) == 3
+    assert meter.stats.dropped_rows == 0
+
+
+def test_non_uuid_user_header_is_metered_by_ip():
+    from starlette.requests import Request
+
+    def request(user):
+        return Request({"type": "http", "headers": [(b"x-sb-user-id", user.encode())], "client": ("9.9.9.9", 1)})
+
+    assert metering.meter_key(request(U1)) == U1
+    assert metering.meter_key(request("../admin")) == "ip:9.9.9.9"
+    assert metering.meter_key(request(str(uuid.uuid4()) + "x")) == "ip:9.9.9.9"
+
+
+def test_counters_are_bounded_and_pruned_without_persistence():
+    meter = UsageMeter(Quota(tokens=10), max_users=3, prune_s=0)
+
+    async def run():
+        for i in range(10):
+            meter.check(f"ip:10.0.0.{i}")
+        meter._used["ip:10.0.0.9"][0] = "2000-01-01"  # día viejo
+        meter._quotas["ip:10.0.0.8"] = (0.0, Quota())
+        meter.check("ip:10.0.0.7")
+        await meter.aclose()
+
+    asyncio.run(run())
+    assert list(meter._used) == ["ip:10.0.0.8", "ip:10.0.0.7"]
+    assert "ip:10.0.0.8" not in meter._quotas
+
+
+def test_anonymous_users_are_limited_but_not_persisted():
+    sb = FakeSupabase()
+    meter = UsageMeter(Quota(messages=1), supabase=lambda: sb)
+
+    async def run():
+        await meter.settle(Charge("ip:1.2.3.4", "chat"))
+        with pytest.raises(QuotaExceeded):
+            meter.check("ip:1.2.3.4")
+        await meter.aclose()
+
+    asyncio.run(run())
+    assert sb.calls == []
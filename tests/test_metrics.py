@@ -0,0 +1,111 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+pytest.importorskip("prometheus_client")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import metrics  # noqa: E402
+from app.prompt_cache import UsageTracker  # noqa: E402
+from app.session_memory import MemorySessionMemory  # noqa: E402
+from app.sse import ProviderStreamError  # noqa: E402
+from app.summarizer import RollingSummarizer  # noqa: E402
+
+
+def sample(name, **labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_error_kind_is_bounded():
+    req = httpx.Request("POST", "http://x")
+    assert metrics.error_kind(httpx.ReadTimeout("t", request=req)) == "timeout"
+    assert metrics.error_kind(httpx.ConnectError("c", request=req)) == "connect"
+    resp = httpx.Response(503, request=req)
+    assert metrics.error_kind(httpx.HTTPStatusError("e", request=req, response=resp)) == "http_5xx"
+    assert metrics.error_kind(ProviderStreamError("HTTP 429: slow down")) == "rate_limit"
+    assert metrics.error_kind(ProviderStreamError("{'type': 'overloaded'}")) == "stream"
+    assert metrics.error_kind(KeyError("x")) == "other"
+
+
+def test_middleware_labels_route_template():
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    metrics.preallocate(app)
+    name = "chatmig_http_request_duration_seconds_count"
+    before = sample(name, route="/items/{item_id}", method="GET", status="2xx")
+    with TestClient(app) as c:
+        assert c.get("/items/1").status_code == 200
+        assert c.get("/items/2").status_code == 200
+        assert c.get("/missing").status_code == 404
+    assert sample(name, route="/items/{item_id}", method="GET", status="2xx") == before + 2
+    assert sample(name, route=metrics.UNMATCHED, method="GET", status="4xx") >= 1
+
+
+def test_tracker_feeds_ttft_and_tokens_per_second():
+    labels = dict(provider="openai", model="m-test")
+    before = sample("chatmig_llm_ttft_seconds_count", **labels)
+    track = UsageTracker("t_metrics", "openai", "m-test")
+    for _ in range(5):
+        track.first_token()
+    track.done()
+    assert sample("chatmig_llm_ttft_seconds_count", **labels) == before + 1
+    assert sample("chatmig_llm_completion_tokens_total", **labels) >= 5
+
+
+def test_summarizer_feeds_saved_tokens_and_folds():
+    mem = MemorySessionMemory(max_sessions=10, max_messages=100, ttl_s=60)
+
+    def words(text):
+        return len(text.split())
+
+    async def complete(messages):
+        return "resumen corto"
+
+    summ = RollingSummarizer(mem, complete, words, trigger_tokens=50, keep_tokens=20)
+    before = {k: sample("chatmig_summary_prompt_tokens_total", kind=k) for k in ("sent", "saved")}
+    folds = sample("chatmig_summary_folds_total", result="ok")
+
+    async def run():
+        await mem.append("s1", [{"role": "user", "content": "x " * 40}, {"role": "assistant", "content": "y " * 40}])
+        await summ.maybe_fold("s1")
+        prompt = await mem.history("s1")
+        summ.record("s1", prompt, await mem.summary("s1"))
+
+    asyncio.run(run())
+    st = summ.stats
+    assert sample("chatmig_summary_folds_total", result="ok") == folds + 1 == folds + st.folds
+    assert sample("chatmig_summary_prompt_tokens_total", kind="sent") == before["sent"] + st.prompt_tokens
+    assert sample("chatmig_summary_prompt_tokens_total", kind="saved") == before["saved"] + st.saved_tokens > 0
+
+
+def test_disabled_metrics_are_noops():
+    metrics.configure(False)
+    try:
+        assert metrics.streams_in_flight("x") is metrics._NOOP
+        metrics.upstream_error("openai", KeyError("x"))
+        families = [v for v in vars(metrics).values() if isinstance(v, metrics._Family)]
+        assert families and all(f.off for f in families)
+    finally:
+        metrics.configure(True)
+    assert sample("chatmig_upstream_errors_total", provider="openai", kind="other") == 0
+
+
+def test_session_memory_usage():
+    mem = MemorySessionMemory(max_sessions=10, max_messages=4, ttl_s=60)
+    asyncio.run(mem.append("a", [{"role": "user", "content": "hola"}, {"role": "assistant", "content": "qué tal"}]))
+    asyncio.run(mem.append("b", [{"role": "user", "content": "x"}]))
+    assert mem.usage() == (2, 3, len("hola") + len("qué tal") + 1)
@@ -0,0 +1,116 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.oauth_tokens import Token, TokenManager  # noqa: E402
+
+
+class FakeRedis:
+    """get/set(nx, px)/delete en memoria, compartido entre "réplicas"."""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[1] <= time.monotonic():
+            return None
+        return item[0]
+
+    async def set(self, key, value, nx=False, px=None):
+        if nx and await self.get(key) is not None:
+            return None
+        self.data[key] = (value, time.monotonic() + (px or 10**9) / 1000)
+        return True
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+def counting_fetch(calls, expires_in=3600, delay=0.02):
+    async def fetch():
+        calls.append(time.monotonic())
+        await asyncio.sleep(delay)  # el /oauth2/token tarda: todos llegan mientras está en vuelo
+        return f"tok-{len(calls)}", expires_in
+    return fetch
+
+
+def test_thousand_callers_at_expiry_cause_one_refresh():
+    calls = []
+    mgr = TokenManager("paypal", counting_fetch(calls))
+    mgr._token = Token("viejo", time.time() - 1, time.time() - 100)  # recién vencido
+
+    async def run():
+        return await asyncio.gather(*(mgr.get() for _ in range(1000)))
+
+    tokens = asyncio.run(run())
+    assert len(calls) == 1
+    assert set(tokens) == {"tok-1"}
+    st = mgr.stats.as_dict()
+    assert st["refreshes"] == 1 and st["waited"] == 999 and st["refresh_ms_avg"] >= 20
+
+
+def test_proactive_refresh_serves_current_token_meanwhile():
+    calls = []
+    mgr = TokenManager("paypal", counting_fetch(calls), refresh_ahead_s=300)
+    now = time.time()
+    mgr._token = Token("vigente", now + 200, now - 1)  # dentro de la ventana de renovación
+
+    async def run():
+        first = await asyncio.gather(*(mgr.get() for _ in range(50)))
+        await asyncio.sleep(0.05)
+        return first, await mgr.get()
+
+    first, after = asyncio.run(run())
+    assert set(first) == {"vigente"}  # nadie esperó a la renovación
+    assert after == "tok-1" and len(calls) == 1
+    assert mgr.stats.proactive == 1
+
+
+def test_short_lived_token_is_not_refreshed_in_a_loop():
+    calls = []
+    mgr = TokenManager("paypal", counting_fetch(calls, expires_in=120, delay=0), refresh_ahead_s=300)
+
+    async def run():
+        for _ in range(20):
+            await mgr.get()
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert len(calls) == 1  # refresh_at = mitad de la vida, no "ya"
+
+
+def test_fetch_failure_propagates_and_next_get_retries():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("OAuth PayPal fallo")
+        return "tok-ok", 3600
+
+    mgr = TokenManager("paypal", flaky)
+    with pytest.raises(RuntimeError):
+        asyncio.run(mgr.get())
+    assert asyncio.run(mgr.get()) == "tok-ok"
+    assert mgr.stats.failures == 1
+
+
+def test_replicas_share_one_refresh_through_redis():
+    calls = []
+    redis = FakeRedis()
+    replicas = [TokenManager("paypal", counting_fetch(calls, delay=0.05)) for _ in range(4)]
+    for mgr in replicas:
+        mgr._r = redis
+
+    async def run():
+        return await asyncio.gather(*(mgr.get() for mgr in replicas for _ in range(100)))
+
+    tokens = asyncio.run(run())
+    assert len(calls) == 1 and set(tokens) == {"tok-1"}
+    assert sum(m.stats.shared for m in replicas) == 3
@@ -0,0 +1,123 @@
+import asyncio
+import base64
+import datetime as dt
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import padding, rsa  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+from app.paypal_verify import LocalVerifyUnavailable, PayPalVerifier, signed_message  # noqa: E402
+
+CERT_URL = "https://api.sandbox.paypal.com/v1/notifications/certs/CERT-360caa42-fca2a594-test"
+WEBHOOK_ID = "8PT597110X687430LKGECATA"
+BODY = b'{"id":"WH-1","event_type":"BILLING.SUBSCRIPTION.ACTIVATED","resource":{"id":"I-1"}}'
+
+
+def make_cert(days_valid=30, expired=False):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "messageverificationcerts.paypal.com")])
+    now = dt.datetime.now(dt.timezone.utc)
+    start = now - dt.timedelta(days=days_valid + 2) if expired else now - dt.timedelta(days=1)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(start).not_valid_after(start + dt.timedelta(days=days_valid))
+        .sign(key, hashes.SHA256())
+    )
+    return key, cert.public_bytes(serialization.Encoding.PEM)
+
+
+def headers_for(key, body=BODY, cert_url=CERT_URL, algo="SHA256withRSA"):
+    tid, ttime = "69cd13f0-d67a-11e5-baa3-778b53f4ae55", "2024-08-18T16:00:05Z"
+    sig = key.sign(signed_message(tid, ttime, WEBHOOK_ID, body), padding.PKCS1v15(), hashes.SHA256())
+    return {
+        "paypal-transmission-id": tid,
+        "paypal-transmission-time": ttime,
+        "paypal-cert-url": cert_url,
+        "paypal-auth-algo": algo,
+        "paypal-transmission-sig": base64.b64encode(sig).decode(),
+    }
+
+
+def fetcher(pem, calls):
+    async def fetch(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return pem
+    return fetch
+
+
+def test_valid_signature_and_cert_cached():
+    key, pem = make_cert()
+    calls = []
+    v = PayPalVerifier(fetcher(pem, calls))
+    h = headers_for(key)
+
+    async def run():
+        return await asyncio.gather(*(v.verify(h, BODY, WEBHOOK_ID) for _ in range(20)))
+
+    assert all(asyncio.run(run()))
+    assert calls == [CERT_URL]  # concurrentes: una sola descarga
+    assert v.stats.verified == 20 and v.stats.cert_fetches == 1
+
+
+def test_tampered_body_or_webhook_id_is_invalid():
+    key, pem = make_cert()
+    v = PayPalVerifier(fetcher(pem, []))
+    h = headers_for(key)
+    assert asyncio.run(v.verify(h, BODY.replace(b"I-1", b"I-2"), WEBHOOK_ID)) is False
+    assert asyncio.run(v.verify(h, BODY, "OTRO_WEBHOOK")) is False
+    assert v.stats.invalid == 2
+
+
+def test_cert_url_outside_allowlist_is_never_fetched():
+    key, pem = make_cert()
+    calls = []
+    v = PayPalVerifier(fetcher(pem, calls))
+    for url in ("https://evil.example.com/cert.pem", "http://api.paypal.com/cert.pem",
+                "https://api.paypal.com.evil.example/cert.pem", "https://api.paypal.com:8443/cert.pem"):
+        assert asyncio.run(v.verify(headers_for(key, cert_url=url), BODY, WEBHOOK_ID)) is False
+    assert calls == [] and v.stats.rejected_hosts == 4
+
+
+def test_expired_cert_is_rejected():
+    key, pem = make_cert(days_valid=1, expired=True)
+    v = PayPalVerifier(fetcher(pem, []))
+    assert asyncio.run(v.verify(headers_for(key), BODY, WEBHOOK_ID)) is False
+
+
+def test_unknown_algo_and_fetch_errors_fall_back_to_remote():
+    key, pem = make_cert()
+    v = PayPalVerifier(fetcher(pem, []))
+    with pytest.raises(LocalVerifyUnavailable):
+        asyncio.run(v.verify(headers_for(key, algo="ECDSAwithSHA384"), BODY, WEBHOOK_ID))
+
+    async def broken(url):
+        raise OSError("timeout")
+
+    v = PayPalVerifier(broken)
+    with pytest.raises(LocalVerifyUnavailable):
+        asyncio.run(v.verify(headers_for(key), BODY, WEBHOOK_ID))
+    assert v.stats.unavailable == 1
+
+
+def test_cert_cache_is_bounded():
+    key, pem = make_cert()
+    calls = []
+    v = PayPalVerifier(fetcher(pem, calls), max_certs=2)
+    urls = [f"https://api.paypal.com/v1/notifications/certs/CERT-{i}" for i in range(3)]
+
+    async def run():
+        for url in urls + urls[-1:]:
+            assert await v.verify(headers_for(key, cert_url=url), BODY, WEBHOOK_ID)
+
+    asyncio.run(run())
+    assert len(v._certs) == 2 and len(calls) == 3
@@ -0,0 +1,66 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from app import prompt_cache  # noqa: E402
+from app.prompt_cache import (  # noqa: E402
+    UsageTracker,
+    anthropic_cached_payload,
+    anthropic_usage,
+    openai_usage,
+)
+
+
+def test_openai_usage_reads_cached_tokens():
+    u = openai_usage({"prompt_tokens": 2000, "completion_tokens": 50,
+                      "prompt_tokens_details": {"cached_tokens": 1536}})
+    assert (u.prompt_tokens, u.cached_tokens, u.completion_tokens) == (2000, 1536, 50)
+    assert openai_usage({"prompt_tokens": 10}).cached_tokens == 0
+    assert openai_usage(None) is None
+
+
+def test_anthropic_usage_counts_cache_reads_and_writes_as_input():
+    u = anthropic_usage({"input_tokens": 20, "cache_read_input_tokens": 1800,
+                         "cache_creation_input_tokens": 300, "output_tokens": 7})
+    assert (u.prompt_tokens, u.cached_tokens, u.cache_write_tokens) == (2120, 1800, 300)
+
+
+def test_tracker_records_anthropic_stream_usage():
+    prompt_cache._STATS.pop("t_anthropic:anthropic", None)
+    tr = UsageTracker("t_anthropic", "anthropic")
+    tr.feed("message_start", {"type": "message_start", "message": {"usage": {
+        "input_tokens": 100, "cache_read_input_tokens": 900, "output_tokens": 1}}})
+    tr.first_token()
+    tr.feed("message_delta", {"type": "message_delta", "usage": {"output_tokens": 42}})
+    tr.done()
+    st = prompt_cache.stats()["t_anthropic:anthropic"]
+    assert st["cache_hits"] == 1 and st["cached_tokens"] == 900 and st["completion_tokens"] == 42
+    assert st["cached_ratio"] == 0.9
+    assert st["avg_ttft_ms_hit"] is not None and st["avg_ttft_ms_miss"] is None
+
+
+def test_anthropic_payload_marks_system_and_previous_turn():
+    contents = [
+        {"role": "user", "content": [{"type": "text", "text": "hola"}]},
+        {"role": "assistant", "content": [{"type": "text", "text": "¿qué trámite?"}]},
+        {"role": "user", "content": [{"type": "text", "text": "visa"}]},
+    ]
+    payload = anthropic_cached_payload("reglas fijas", contents)
+    assert payload["system"][0]["cache_control"] == {"type": "ephemeral"}
+    msgs = payload["messages"]
+    assert msgs[1]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert "cache_control" not in msgs[2]["content"][-1]
+    assert "cache_control" not in msgs[0]["content"][-1]
+
+
+def test_plan_static_first_splits_rules_from_style():
+    from app.prompts import PLAN_RULES, plan_style
+    from app.routers.chat import build_style
+
+    style = build_style()
+    assert "{" not in PLAN_RULES
+    assert style.persona in plan_style(style)
+    assert style.persona not in PLAN_RULES
@@ -0,0 +1,54 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from app import prompts  # noqa: E402
+from app.prompts import Template, load_template  # noqa: E402
+
+
+def test_all_templates_compile_with_expected_fields():
+    assert prompts.TEMPLATES["llm_system"].fields == frozenset()
+    assert prompts.TEMPLATES["plan_system"].fields == {
+        "persona", "tone", "dialect", "emojis", "summary_words", "script_words", "max_bullets"
+    }
+    assert prompts.LLM_SYSTEM.startswith("Eres ChatSed") and not prompts.LLM_SYSTEM.endswith("\n")
+
+
+def test_template_rejects_format_specs(tmp_path):
+    (tmp_path / "bad.txt").write_text("Hola {nombre!r}\n", encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_template("bad", tmp_path)
+    assert Template("ok", "Hola {nombre}").render(nombre="Ana") == "Hola Ana"
+
+
+def test_style_blocks_are_memoized_and_stable():
+    from app.routers.chat_stream import _style_block as chat_block
+    from app.routers.llm import StyleIn, _style_block as llm_block
+
+    s = StyleIn(tone="cálido", length_words=300, use_emojis=False)
+    first = llm_block(s)
+    assert first == (
+        "Extensión objetivo: ~300 palabras (±20%).\nTono: cálido.\nIdioma: es.\nNo incluyas emojis.\n"
+        "Explica el porqué de cada paso y da 1–2 ejemplos concretos.\n" + prompts.RISK_RESPECT
+    )
+    assert llm_block(StyleIn(tone="cálido", length_words=300, use_emojis=False)) is first  # mismo objeto: LRU
+    assert llm_block(None) == ""
+    assert chat_block(None).startswith("Guías de estilo:\nExtensión objetivo: ~1000 palabras")
+    assert chat_block(None).endswith(prompts.RISK_OFFICIAL)
+
+
+def test_plan_system_renders_style_and_default_is_shared():
+    from app.routers.chat import build_style, build_system
+
+    style = build_style()
+    assert build_style() is style  # DEFAULT_STYLE_JSON parseado una vez
+    text = build_system(style)
+    assert f"Eres ChatSed, un {style.persona}." in text
+    assert f"bullets (máx {style.max_bullets})" in text
+    off = build_system(style.model_copy(update={"use_emojis": False}))
+    assert "Emojis: no usar." in off and "Emojis: pocos y pertinentes." in text
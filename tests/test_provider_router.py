@@ -0,0 +1,183 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.provider_router import NoProviderAvailable, ProviderRouter  # noqa: E402
+
+
+class FakeProvider:
+    """Proveedor local: latencia hasta el primer delta, fallo inyectado antes o a mitad del stream."""
+
+    def __init__(self, name, ttft=0.0, deltas=3, gap=0.0, fail_before=False, fail_after=None):
+        self.name, self.ttft, self.deltas, self.gap = name, ttft, deltas, gap
+        self.fail_before, self.fail_after = fail_before, fail_after
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self, conv, model, system):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.ttft)
+            if self.fail_before:
+                raise RuntimeError(f"{self.name} 503")
+            for i in range(self.deltas):
+                if self.fail_after is not None and i == self.fail_after:
+                    raise RuntimeError(f"{self.name} cortó el stream")
+                yield f"{self.name}:{i}"
+                await asyncio.sleep(self.gap)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+def collect(router, primary, **kw):
+    async def run():
+        return [x async for x in router.stream(primary, [], None, "", **kw)]
+    return asyncio.run(run())
+
+
+def test_primary_healthy_no_failover():
+    a, b = FakeProvider("a"), FakeProvider("b")
+    router = ProviderRouter({"a": a, "b": b})
+    assert collect(router, "a") == ["a:0", "a:1", "a:2"]
+    assert b.calls == 0
+    assert router.stats()["a"]["successes"] == 1
+
+
+def test_failover_before_first_delta():
+    a, b = FakeProvider("a", fail_before=True), FakeProvider("b")
+    router = ProviderRouter({"a": a, "b": b})
+    assert collect(router, "a") == ["b:0", "b:1", "b:2"]
+    assert router.stats()["a"]["failures"] == 1
+
+
+def test_no_switch_after_first_delta():
+    a, b = FakeProvider("a", fail_after=1), FakeProvider("b")
+    router = ProviderRouter({"a": a, "b": b})
+
+    async def run():
+        got = []
+        with pytest.raises(RuntimeError):
+            async for x in router.stream("a", [], None, ""):
+                got.append(x)
+        return got
+
+    assert asyncio.run(run()) == ["a:0"]
+    assert b.calls == 0
+
+
+def test_failover_disabled_raises():
+    a, b = FakeProvider("a", fail_before=True), FakeProvider("b")
+    router = ProviderRouter({"a": a, "b": b})
+    with pytest.raises(RuntimeError):
+        collect(router, "a", failover=False)
+    assert b.calls == 0
+
+
+def test_circuit_opens_then_half_open_probe():
+    a, b = FakeProvider("a", fail_before=True), FakeProvider("b")
+    router = ProviderRouter({"a": a, "b": b}, failure_threshold=2, open_s=0.05)
+    collect(router, "a")
+    collect(router, "a")
+    assert router.stats()["a"]["state"] == "open"
+    collect(router, "a")
+    assert a.calls == 2  # circuito abierto: ni se intenta
+    asyncio.run(asyncio.sleep(0.06))
+    a.fail_before = False
+    assert collect(router, "a") == ["a:0", "a:1", "a:2"]  # half-open: el intento de prueba cierra el circuito
+    assert router.stats()["a"]["state"] == "closed"
+
+
+def test_hedge_backup_wins_and_primary_is_cancelled():
+    a, b = FakeProvider("a", ttft=1.0), FakeProvider("b", ttft=0.01)
+    router = ProviderRouter({"a": a, "b": b}, hedge_default_s=0.05)
+    out = collect(router, "a", hedge=True)
+    assert out == ["b:0", "b:1", "b:2"]
+    assert a.cancelled == 1
+    stats = router.stats()
+    assert stats["b"]["hedges_won"] == 1 and stats["a"]["hedges_lost"] == 1
+
+
+def test_hedge_not_triggered_when_primary_is_fast():
+    a, b = FakeProvider("a", ttft=0.0), FakeProvider("b")
+    router = ProviderRouter({"a": a, "b": b}, hedge_default_s=0.2)
+    assert collect(router, "a", hedge=True) == ["a:0", "a:1", "a:2"]
+    assert b.calls == 0
+
+
+def test_hedge_deadline_tracks_p95():
+    a = FakeProvider("a")
+    router = ProviderRouter({"a": a}, hedge_min_s=0.0)
+    for t in [0.1] * 19 + [0.5]:
+        router.health["a"].record_ttft(t)
+    assert router.hedge_deadline("a") == pytest.approx(0.5)
+
+
+def test_failover_prefers_lowest_ewma():
+    a, b, c = FakeProvider("a", fail_before=True), FakeProvider("b"), FakeProvider("c")
+    router = ProviderRouter({"a": a, "b": b, "c": c})
+    router.health["b"].record_ttft(0.9)
+    router.health["c"].record_ttft(0.1)
+    assert collect(router, "a")[0] == "c:0"
+
+
+def test_unconfigured_primary():
+    router = ProviderRouter({"a": FakeProvider("a")})
+    with pytest.raises(NoProviderAvailable):
+        collect(router, "zzz")
+
+
+def test_slow_reader_applies_backpressure_to_provider():
+    produced = []
+
+    async def chatty(conv, model, system):
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    router = ProviderRouter({"a": chatty}, queue_size=8)
+
+    async def run():
+        out = []
+        async for item in router.stream("a", [], None, ""):
+            out.append(item)
+            if len(out) == 5:
+                await asyncio.sleep(0.01)  # cliente lento: el bombeo no debe adelantarse más que la cola
+                ahead = len(produced) - len(out)
+        return out, ahead
+
+    out, ahead = asyncio.run(run())
+    assert out == list(range(1000))
+    assert ahead <= 8 + 2
+
+
+def test_client_4xx_does_not_open_circuit_or_fail_over():
+    from app.sse import ProviderStreamError
+
+    async def bad_model(conv, model, system):
+        raise ProviderStreamError("HTTP 400: model not found", status_code=400)
+        yield  # pragma: no cover
+
+    backup = FakeProvider("b")
+    router = ProviderRouter({"a": bad_model, "b": backup}, failure_threshold=2)
+    for _ in range(5):
+        with pytest.raises(ProviderStreamError):
+            collect(router, "a")
+    assert router.health["a"].state == "closed" and router.health["a"].failures == 0
+    assert backup.calls == 0
+
+
+def test_429_and_5xx_still_count_and_fail_over():
+    from app.sse import ProviderStreamError
+
+    async def throttled(conv, model, system):
+        raise ProviderStreamError("HTTP 429: slow down", status_code=429)
+        yield  # pragma: no cover
+
+    router = ProviderRouter({"a": throttled, "b": FakeProvider("b")}, failure_threshold=2)
+    assert collect(router, "a") == ["b:0", "b:1", "b:2"]
+    assert router.health["a"].failures == 1
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from fastapi import HTTPException  # noqa: E402
+
+from app.rate_limit import AdmissionController, Lane, Limits, LocalBuckets, RateLimited, admit  # noqa: E402
+
+
+def empty_lane(rpm=1200, tpm=1_000_000, per_user=4, max_queue=200, max_wait_s=30.0):
+    buckets = LocalBuckets(Limits(rpm, tpm))
+    buckets._r = buckets._t = 0.0  # sin ráfaga disponible: todo pasa por la cola
+    return Lane("openai:test", buckets, per_user, max_queue, max_wait_s)
+
+
+def test_fast_path_admits_without_queue():
+    lane = Lane("openai:test", LocalBuckets(Limits(60, 10_000)), 4, 200, 30.0)
+
+    async def run():
+        return [await lane.acquire("u1", 100) for _ in range(3)]
+
+    assert asyncio.run(run()) == [0.0, 0.0, 0.0]
+    st = lane.stats()
+    assert st["admitted"] == 3 and st["queued"] == 0
+
+
+def test_round_robin_between_users():
+    lane = empty_lane()
+    order = []
+
+    async def req(user, i):
+        await lane.acquire(user, 10)
+        order.append(f"{user}{i}")
+
+    async def run():
+        tasks = []
+        for user, i in [("a", 1), ("a", 2), ("a", 3), ("b", 1)]:
+            tasks.append(asyncio.create_task(req(user, i)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["a1", "b1", "a2", "a3"]  # la ráfaga de "a" no deja a "b" al final
+    st = lane.stats()
+    assert st["queued"] == 4 and st["queue"] == 0 and st["max_wait_ms"] > 0
+
+
+def test_per_user_queue_full_rejects():
+    lane = empty_lane(per_user=2)
+
+    async def run():
+        waiters = [asyncio.create_task(lane.acquire("a", 10)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(RateLimited) as exc:
+            await lane.acquire("a", 10)
+        await lane.acquire("b", 10)  # otro usuario sí entra
+        await asyncio.gather(*waiters)
+        return exc.value
+
+    err = asyncio.run(run())
+    assert err.retry_after >= 1
+    assert lane.stats()["rejected"] == 1
+
+
+def test_estimated_wait_over_limit_rejects_with_retry_after():
+    lane = empty_lane(rpm=60, tpm=1000, max_wait_s=5.0)
+
+    async def run():
+        with pytest.raises(RateLimited) as exc:
+            await lane.acquire("a", 500)  # TPM: 500 tokens a 1000/min ≈ 30s
+        return exc.value
+
+    err = asyncio.run(run())
+    assert err.retry_after == pytest.approx(30, abs=1)
+
+
+def test_cancelled_waiter_is_skipped():
+    lane = empty_lane()
+
+    async def run():
+        gone = asyncio.create_task(lane.acquire("a", 10))
+        await asyncio.sleep(0)
+        stays = asyncio.create_task(lane.acquire("b", 10))
+        await asyncio.sleep(0)
+        gone.cancel()  # el cliente se fue mientras esperaba
+        await stays
+        assert lane.stats()["queue"] == 0
+
+    asyncio.run(run())
+    assert lane.stats()["admitted"] == 1
+
+
+def test_admit_maps_to_429_with_retry_after():
+    ctl = AdmissionController({"openai:*": {"rpm": 60, "tpm": 1000}}, max_wait_s=5.0)
+
+    class FakeRequest:
+        headers = {"x-sb-user-id": "u1"}
+        client = None
+
+    async def run():
+        await admit(ctl, FakeRequest(), "openai", "gpt-4o-mini", 900)
+        with pytest.raises(HTTPException) as exc:
+            await admit(ctl, FakeRequest(), "openai", "gpt-4o-mini", 900)
+        assert await admit(ctl, FakeRequest(), "anthropic", "haiku", 10**6) == 0.0  # sin entrada → sin límite
+        return exc.value
+
+    err = asyncio.run(run())
+    assert err.status_code == 429
+    assert int(err.headers["Retry-After"]) >= 45
+    assert ctl.stats()["openai:*"]["rejected"] == 1
+
+
+def test_made_up_models_share_the_wildcard_lane():
+    ctl = AdmissionController({"openai:gpt-4o": {"rpm": 60, "tpm": 10**6}, "openai:*": {"rpm": 2, "tpm": 10**6}},
+                              max_wait_s=0.5)
+
+    class FakeRequest:
+        headers = {"x-sb-user-id": "u1"}
+        client = None
+
+    async def run():
+        await admit(ctl, FakeRequest(), "openai", "modelo-1", 1)
+        await admit(ctl, FakeRequest(), "openai", "modelo-2", 1)
+        with pytest.raises(HTTPException):
+            await admit(ctl, FakeRequest(), "openai", "modelo-3", 1)  # otro nombre no da buckets nuevos
+        await admit(ctl, FakeRequest(), "openai", "gpt-4o", 1)  # entrada exacta: su propio carril
+
+    asyncio.run(run())
+    assert sorted(ctl.stats()) == ["openai:*", "openai:gpt-4o"]
+
+
+def test_invalid_limits_json_means_no_limits():
+    from app.rate_limit import parse_limits
+
+    assert parse_limits('{"*": {"rpm": 5, "tpm": 100}}') == {"*": {"rpm": 5, "tpm": 100}}
+    for raw in ("{no es json", '["*"]', '{"*": {"rpm": 5}}', '{"*": 3}'):
+        assert parse_limits(raw) == {}
+    assert AdmissionController(parse_limits("{roto")).stats() == {}
+
+
+def test_stream_cache_hit_is_served_without_admission(monkeypatch):
+    """Un hit de la caché semántica no consume cupo ni recibe 429; un miss sí pasa por admit()."""
+    from starlette.requests import Request
+
+    from app.routers import llm
+    from app.semantic_cache import MemorySemanticCache
+
+    class Full:
+        async def acquire(self, provider, model, user, tokens):
+            raise RateLimited(5.0, "tpm")
+
+    async def embed(client, q):
+        return [1.0, 0.0]
+
+    monkeypatch.setattr(llm, "_embed_query", embed)
+    cache = MemorySemanticCache(threshold=0.9, ttl_s=60, max_entries=10)
+    request = Request({"type": "http", "method": "POST", "path": "/llm/complete/stream", "headers": []})
+    body = llm.ChatIn(query="requisitos visa")
+
+    async def run():
+        await cache.put([1.0, 0.0], llm._namespace(llm._style_block(None), body.top_k), "en caché", [])
+        resp = await llm.complete_stream(body, request, client=None, cache=cache, index=None,
+                                         admission=Full(), flights=None, meter=None)
+        with pytest.raises(HTTPException) as exc:
+            await llm.complete_stream(llm.ChatIn(query="otra", top_k=3), request, client=None, cache=cache,
+                                      index=None, admission=Full(), flights=None, meter=None)
+        return resp, exc.value
+
+    resp, err = asyncio.run(run())
+    assert resp.status_code == 200 and err.status_code == 429
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
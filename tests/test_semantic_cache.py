@@ -0,0 +1,180 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app import semantic_cache  # noqa: E402
+from app.semantic_cache import MemorySemanticCache, RedisSemanticCache, SemanticCache  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(semantic_cache.time, "time", c.time)
+    return c
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        SemanticCache(0.9, 60, 10)
+
+
+def test_threshold_and_namespace(clock):
+    cache = MemorySemanticCache(threshold=0.95, ttl_s=60, max_entries=10)
+
+    async def run():
+        await cache.put([1.0, 0.0, 0.0], "ns1", "respuesta", [{"id": "c1"}])
+        return (
+            await cache.get([1.0, 0.1, 0.0], "ns1"),   # coseno ≈ 0.995
+            await cache.get([1.0, 0.5, 0.0], "ns1"),   # coseno ≈ 0.894
+            await cache.get([1.0, 0.0, 0.0], "ns2"),
+        )
+
+    near, far, other_ns = asyncio.run(run())
+    assert near.answer == "respuesta" and near.retrieved == [{"id": "c1"}] and near.similarity > 0.99
+    assert far is None and other_ns is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 0.3333}
+
+
+def test_expired_entry_does_not_shadow_a_live_one(clock):
+    cache = MemorySemanticCache(threshold=0.8, ttl_s=10, max_entries=10)
+
+    async def run():
+        await cache.put([1.0, 0.0], "ns", "vieja", [])
+        assert (await cache.get([1.0, 0.0], "ns")).answer == "vieja"
+        clock.now += 8
+        await cache.put([1.0, 0.3], "ns", "nueva", [])
+        clock.now += 4  # "vieja" venció, "nueva" no
+        hit = await cache.get([1.0, 0.0], "ns")
+        clock.now += 10
+        return hit, await cache.get([1.0, 0.0], "ns")
+
+    hit, gone = asyncio.run(run())
+    assert hit.answer == "nueva"
+    assert gone is None and len(cache) == 0 and cache._pools == {}
+
+
+def test_writes_reuse_preallocated_slots_and_lru_eviction_keeps_them_consistent(clock):
+    cache = MemorySemanticCache(threshold=0.99, ttl_s=60, max_entries=3)
+
+    async def run():
+        await cache.put([1.0, 0.0, 0.0], "ns", "a", [])
+        mat = cache._pools["ns"].mat
+        await cache.put([0.0, 1.0, 0.0], "ns", "b", [])
+        await cache.put([0.0, 0.0, 1.0], "ns", "c", [])
+        await cache.get([1.0, 0.0, 0.0], "ns")      # "a" pasa a ser la más reciente
+        await cache.put([0.7, 0.0, 0.7], "ns", "d", [])  # desaloja "b" y reutiliza su fila
+        assert cache._pools["ns"].mat is mat
+        return [await cache.get(v, "ns") for v in ([1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [0.7, 0.0, 0.7])]
+
+    a, b, c, d = asyncio.run(run())
+    assert (a.answer, b, c.answer, d.answer) == ("a", None, "c", "d")
+    pool = cache._pools["ns"]
+    assert pool.mat.shape == (3, 3) and pool.size == int(pool.valid.sum()) == 3 and not pool.free
+
+
+def test_slots_grow_past_initial_capacity(clock):
+    cache = MemorySemanticCache(threshold=0.99, ttl_s=60, max_entries=100)
+    vecs = [[1.0, float(i) / 10, 0.0] for i in range(70)]
+
+    async def run():
+        for i, v in enumerate(vecs):
+            await cache.put(v, "ns", str(i), [])
+        return [await cache.get(v, "ns") for v in (vecs[0], vecs[69])]
+
+    first, last = asyncio.run(run())
+    assert (first.answer, last.answer) == ("0", "69")
+    assert 70 <= cache._pools["ns"].mat.shape[0] <= 100
+
+
+class FakeRedis:
+    """Lo justo de redis.asyncio para RedisSemanticCache (sin TTL)."""
+
+    def __init__(self):
+        self.zsets, self.hashes = {}, {}
+
+    async def zrange(self, key, start, end):
+        return [m.encode() for m, _ in sorted(self.zsets.get(key, {}).items(), key=lambda kv: kv[1])]
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    async def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+    async def zpopmin(self, key, n):
+        z = self.zsets.get(key, {})
+        out = sorted(z.items(), key=lambda kv: kv[1])[:n]
+        for m, _ in out:
+            del z[m]
+        return [(m.encode(), sc) for m, sc in out]
+
+    async def hmget(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return [h.get(f) for f in fields]
+
+    async def delete(self, *keys):
+        for k in keys:
+            self.hashes.pop(k, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, r):
+        self.r, self.ops = r, []
+
+    def hget(self, key, field):
+        self.ops.append(lambda: self.r.hashes.get(key, {}).get(field))
+
+    def hset(self, key, mapping):
+        enc = {f: v if isinstance(v, bytes) else str(v).encode() for f, v in mapping.items()}
+        self.ops.append(lambda: self.r.hashes.setdefault(key, {}).update(enc))
+
+    def expire(self, key, ttl):
+        self.ops.append(lambda: True)
+
+    def zadd(self, key, mapping):
+        self.ops.append(lambda: self.r.zsets.setdefault(key, {}).update(mapping))
+
+    def zcard(self, key):
+        self.ops.append(lambda: len(self.r.zsets.get(key, {})))
+
+    async def execute(self):
+        return [op() for op in self.ops]
+
+
+def test_redis_reuses_stacked_matrix_until_the_namespace_changes(clock, monkeypatch):
+    cache = RedisSemanticCache("redis://localhost:6379/0", threshold=0.99, ttl_s=60, max_entries=2)
+    cache._r = FakeRedis()
+    stacks = []
+    real_stack = semantic_cache.np.stack
+    monkeypatch.setattr(semantic_cache.np, "stack", lambda xs: stacks.append(1) or real_stack(xs))
+
+    async def run():
+        await cache.put([1.0, 0.0], "ns", "a", [])
+        await cache.put([0.0, 1.0], "ns", "b", [])
+        hits = []
+        for v in ([1.0, 0.0], [0.0, 1.0], [1.0, 0.0]):
+            clock.now += 1
+            hits.append(await cache.get(v, "ns"))
+        assert len(stacks) == 1  # los hits reordenan el ZSET pero no rearman la matriz
+        await cache.put([1.0, 1.0], "ns", "c", [])  # desaloja "b" (la menos reciente)
+        hits += [await cache.get([0.0, 1.0], "ns"), await cache.get([1.0, 1.0], "ns")]
+        assert len(stacks) == 2
+        return hits
+
+    a1, b, a2, gone, c = asyncio.run(run())
+    assert (a1.answer, b.answer, a2.answer, gone, c.answer) == ("a", "b", "a", None, "c")
@@ -0,0 +1,102 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app import session_memory  # noqa: E402
+from app.session_memory import MemorySessionMemory, SessionMemory, trim_to_budget  # noqa: E402
+
+
+def words(text):
+    return len(text.split())
+
+
+def msg(role, n_words, tag=""):
+    return {"role": role, "content": (tag + " " + "w " * n_words).strip()}
+
+
+def test_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        SessionMemory(10, 60)
+
+
+def test_trim_keeps_newest_within_budget():
+    msgs = [msg("user", 6, "u0"), msg("assistant", 6, "a0"), msg("user", 6, "u1"), msg("assistant", 6, "a1")]
+    # cada mensaje ≈ 4 + 7 = 11 tokens
+    assert trim_to_budget(msgs, 22, words) == msgs[2:]
+    assert trim_to_budget(msgs, 1000, words) == msgs
+    assert trim_to_budget(msgs, 5, words) == []
+
+
+def test_trim_never_starts_with_orphan_assistant():
+    msgs = [msg("user", 20, "u0"), msg("assistant", 6, "a0"), msg("user", 6, "u1"), msg("assistant", 6, "a1")]
+    # entran a0, u1, a1 (33 tokens), pero a0 sin su pregunta se descarta
+    assert trim_to_budget(msgs, 33, words) == msgs[2:]
+    assert trim_to_budget([msg("assistant", 1), msg("assistant", 1)], 100, words) == []
+
+
+def test_lru_evicts_least_recently_used_session():
+    mem = MemorySessionMemory(max_sessions=2, max_messages=10, ttl_s=60)
+
+    async def run():
+        await mem.append("a", [msg("user", 1)])
+        await mem.append("b", [msg("user", 1)])
+        await mem.append("a", [msg("assistant", 1)])  # "a" pasa a ser la más reciente
+        await mem.append("c", [msg("user", 1)])
+        return [len(await mem.history(s)) for s in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == [2, 0, 1]
+    assert mem.evicted == 1 and len(mem) == 2
+
+
+def test_ttl_expires_idle_sessions_and_caps_messages(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(session_memory.time, "time", lambda: now[0])
+    mem = MemorySessionMemory(max_sessions=10, max_messages=3, ttl_s=60)
+
+    async def run():
+        await mem.append("a", [msg("user", 1, str(i)) for i in range(5)])
+        capped = [m["content"].split()[0] for m in await mem.history("a")]
+        await mem.append("b", [msg("user", 1)])
+        now[0] += 61
+        expired = await mem.history("a"), await mem.summary("a")
+        await mem.append("c", [msg("user", 1)])  # el desalojo también limpia "b", vencida
+        return capped, expired
+
+    capped, expired = asyncio.run(run())
+    assert capped == ["2", "3", "4"]
+    assert expired == ([], None)
+    assert len(mem) == 1 and mem.evicted == 2
+
+
+def test_sql_summary_lives_as_long_as_an_active_session(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from app import db
+
+    engine = create_engine(f"sqlite:///{tmp_path}/mem.db")
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "SessionLocal", sessionmaker(bind=engine))
+    now = [1000.0]
+    monkeypatch.setattr(session_memory.time, "time", lambda: now[0])
+    mem = session_memory.SQLSessionMemory(max_messages=10, ttl_s=60, purge_every_s=0)
+
+    async def run():
+        await mem.append("s", [msg("user", 1, "viejo"), msg("assistant", 1, "viejo")])
+        old = await mem.history("s")
+        assert await mem.fold("s", old, session_memory.Summary("resumen", folded_messages=2))
+        for _ in range(5):  # sesión activa mucho más que ttl_s después del pliegue
+            now[0] += 40
+            await mem.append("s", [msg("user", 1, "nuevo")])
+        active = await mem.summary("s")
+        now[0] += 61
+        await mem.append("otra", [msg("user", 1)])  # dispara la purga
+        return active, await mem.summary("s"), await mem.history("s")
+
+    active, expired, history = asyncio.run(run())
+    assert active is not None and active.text == "resumen"
+    assert expired is None and history == []  # inactiva más que el TTL: se va todo junto
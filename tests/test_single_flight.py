@@ -0,0 +1,173 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.single_flight import SingleFlight, flight_key  # noqa: E402
+
+
+def test_key_depends_on_built_prompt():
+    msgs = [{"role": "user", "content": "hola"}]
+    assert flight_key("m", msgs, 0.4) == flight_key("m", [{"content": "hola", "role": "user"}], 0.4)
+    assert flight_key("m", msgs, 0.4) != flight_key("m", msgs, 0.5)
+
+
+def test_concurrent_calls_share_one_upstream():
+    flights = SingleFlight()
+    calls = []
+
+    async def upstream():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return "respuesta"
+
+    async def run():
+        return await asyncio.gather(*(flights.do("k", upstream) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["respuesta"] * 5
+    assert len(calls) == 1
+    st = flights.stats.as_dict()
+    assert st["calls"] == 1 and st["coalesced"] == 4 and st["saved_upstream_calls"] == 4
+
+
+def test_error_is_shared_and_not_remembered():
+    flights = SingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("429 upstream")
+
+    async def run():
+        res = await asyncio.gather(*(flights.do("k", failing) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in res)
+        with pytest.raises(RuntimeError):
+            await flights.do("k", failing)  # ya terminó: llamada nueva
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_leader_disconnect_does_not_cancel_followers():
+    flights = SingleFlight()
+
+    async def upstream():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def run():
+        leader = asyncio.create_task(flights.do("k", upstream))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.do("k", upstream))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(run()) == "ok"
+
+
+def test_stream_fans_out_with_replay_for_late_joiners():
+    flights = SingleFlight()
+    opened = []
+
+    async def upstream():
+        opened.append(1)
+        for i in range(5):
+            yield f"d{i}"
+            await asyncio.sleep(0.01)
+
+    async def collect(delay):
+        await asyncio.sleep(delay)
+        return [x async for x in flights.stream("k", upstream)]
+
+    async def run():
+        return await asyncio.gather(collect(0), collect(0), collect(0.025))
+
+    out = asyncio.run(run())
+    assert out == [["d0", "d1", "d2", "d3", "d4"]] * 3
+    assert len(opened) == 1
+    assert flights.stats.as_dict()["joined"] == 2
+
+
+def test_stream_cancelled_when_all_subscribers_leave():
+    flights = SingleFlight()
+    closed = []
+
+    async def upstream():
+        try:
+            for i in range(1000):
+                yield i
+                await asyncio.sleep(0.001)
+        finally:
+            closed.append(True)
+
+    async def run():
+        subs = [flights.stream("k", upstream) for _ in range(2)]
+        for s in subs:
+            await s.__anext__()
+        await subs[0].aclose()
+        assert not closed  # queda un suscriptor
+        await subs[1].aclose()
+        await asyncio.sleep(0.01)
+        assert not flights.in_flight("k")
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_subscriber_closed_before_first_item_still_counts_down():
+    flights = SingleFlight()
+    closed = []
+
+    async def upstream():
+        try:
+            for i in range(1000):
+                yield i
+                await asyncio.sleep(0.001)
+        finally:
+            closed.append(True)
+
+    async def run():
+        idle = flights.stream("k", upstream)    # todavía sin iterar
+        reader = flights.stream("k", upstream)
+        await reader.__anext__()
+        await reader.aclose()
+        await asyncio.sleep(0.01)
+        assert not closed  # `idle` sigue contando: el upstream no se corta
+        assert await idle.__anext__() == 0
+        await idle.aclose()
+        await asyncio.sleep(0.01)
+        assert not flights.in_flight("k")
+
+        never = flights.stream("k2", upstream)
+        await never.aclose()                    # cerrado sin un solo __anext__
+        await asyncio.sleep(0.01)
+        assert not flights.in_flight("k2")
+
+    asyncio.run(run())
+    assert closed == [True]  # el de "k2" se canceló antes de arrancar
+
+
+def test_stream_error_reaches_every_subscriber():
+    flights = SingleFlight()
+
+    async def upstream():
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise RuntimeError("stream cortado")
+
+    async def consume():
+        got = []
+        with pytest.raises(RuntimeError):
+            async for x in flights.stream("k", upstream):
+                got.append(x)
+        return got
+
+    async def run():
+        return await asyncio.gather(consume(), consume())
+
+    assert asyncio.run(run()) == [["a"], ["a"]]
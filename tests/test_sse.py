@@ -0,0 +1,55 @@
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.sse import SSEDecoder, SSEEvent  # noqa: E402
+
+_TEXTS = ["hola", "¿qué tal?", "visa 🇪🇸 estudiante", "a:b", " espacio", "", "ñandú €", '{"x": 1}']
+
+
+def _random_stream(rng: random.Random):
+    """Eventos aleatorios + su serialización SSE con finales de línea mezclados."""
+    events, out = [], []
+    for _ in range(rng.randint(1, 12)):
+        eol = rng.choice(["\n", "\r\n", "\r"])
+        if rng.random() < 0.2:
+            out.append(": keep-alive" + eol)
+        name = rng.choice([None, "message", "content_block_delta"])
+        lines = [rng.choice(_TEXTS) for _ in range(rng.randint(1, 3))]
+        if name:
+            out.append(f"event: {name}{eol}")
+        for line in lines:
+            # el decoder quita un solo espacio tras "data:"; con " espacio" sin separador se pierde
+            sep = rng.choice(["", " "]) if not line.startswith(" ") else " "
+            out.append(f"data:{sep}{line}" + eol)
+        out.append(eol)
+        events.append(SSEEvent(name or "message", "\n".join(lines)))
+    return events, "".join(out).encode("utf-8")
+
+
+def _decode(payload: bytes, cuts):
+    dec, got, prev = SSEDecoder(), [], 0
+    for cut in [*cuts, len(payload)]:
+        got += dec.feed(payload[prev:cut])
+        prev = cut
+    got += dec.flush()
+    return [SSEEvent(e.event, e.data) for e in got]
+
+
+def test_sse_decoder_split_boundaries_fuzz():
+    rng = random.Random(1234)
+    for _ in range(2000):
+        events, payload = _random_stream(rng)
+        # cortes en cualquier byte: dentro de UTF-8 multibyte, entre \r y \n, chunks vacíos
+        cuts = sorted(rng.randint(0, len(payload)) for _ in range(rng.randint(0, 12)))
+        assert _decode(payload, cuts) == events
+        assert _decode(payload, range(1, len(payload))) == events  # byte a byte
+
+
+def test_sse_decoder_multiline_data_and_eof_without_blank_line():
+    dec = SSEDecoder()
+    got = dec.feed(b"data: uno\ndata: dos\n\nid: 7\ndata: {\"a\":1}")
+    assert got == [SSEEvent("message", "uno\ndos")]
+    assert dec.flush() == [SSEEvent("message", '{"a":1}', "7")]
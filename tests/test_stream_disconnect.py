@@ -0,0 +1,105 @@
+import os
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+uvicorn = pytest.importorskip("uvicorn")
+httpx = pytest.importorskip("httpx")
+
+API = Path(__file__).resolve().parents[1] / "services" / "api"
+sys.path.insert(0, str(API))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+@pytest.fixture(scope="module")
+def servers(tmp_path_factory):
+    fake_port, api_port = _free_port(), _free_port()
+    os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{fake_port}/v1"
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tmp_path_factory.mktemp('db')}/test.db")
+    from scripts.fake_openai import create_app
+    from app.main import app
+
+    fake = _serve(create_app(deltas=400, delay=0.01), fake_port)  # ~4s por stream
+    api = _serve(app, api_port)
+    yield f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{api_port}"
+    api.should_exit = fake.should_exit = True
+
+
+def _wait_idle(fake_base: str, timeout: float = 1.0) -> float:
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if httpx.get(f"{fake_base}/stats").json()["in_flight"] == 0:
+            return time.monotonic() - t0
+        time.sleep(0.02)
+    raise AssertionError("el stream upstream siguió abierto tras desconectar el cliente")
+
+
+@pytest.mark.parametrize("path,body,route", [
+    ("/agent/complete/stream", {"query": "requisitos visa"}, "agent"),
+    ("/chat/complete_stream", {"query": "requisitos visa"}, "chat_stream"),
+])
+def test_client_abort_cancels_upstream(servers, path, body, route):
+    from app import stream_guard
+
+    fake_base, api_base = servers
+    before = stream_guard.route_stats(route).cancelled
+    with httpx.Client(timeout=10) as client:
+        with client.stream("POST", api_base + path, json=body) as r:
+            assert r.status_code == 200
+            for i, _ in enumerate(r.iter_bytes()):
+                if i >= 3:
+                    break  # el cliente cierra la pestaña
+    _wait_idle(fake_base)
+    st = stream_guard.route_stats(route)
+    assert st.cancelled == before + 1
+    assert st.tokens_before_cancel > 0
+
+
+def test_guard_closes_source_on_disconnect_without_server_cancel():
+    """Servidores ASGI que no cancelan el generador: el corte lo hace is_disconnected()."""
+    import asyncio
+
+    from app.stream_guard import guard_disconnect, route_stats
+
+    class FakeRequest:
+        def __init__(self, after):
+            self.checks, self.after = 0, after
+
+        async def is_disconnected(self):
+            self.checks += 1
+            return self.checks > self.after
+
+    closed = []
+
+    async def upstream():
+        try:
+            for i in range(4096):
+                yield f"tok{i}"
+        finally:
+            closed.append(True)
+
+    async def run():
+        return [c async for c in guard_disconnect(FakeRequest(after=3), upstream(), "unit", max_tokens=4096)]
+
+    assert asyncio.run(run()) == ["tok0", "tok1", "tok2"]
+    assert closed == [True]
+    st = route_stats("unit")
+    assert st.cancelled == 1 and st.tokens_before_cancel == 3 and st.avoided_tokens == 4093
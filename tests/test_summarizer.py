@@ -0,0 +1,80 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.session_memory import MemorySessionMemory  # noqa: E402
+from app.summarizer import RollingSummarizer  # noqa: E402
+
+
+def words(text):
+    return len(text.split())
+
+
+def turns(n, start=0):
+    out = []
+    for i in range(start, start + n):
+        out += [{"role": "user", "content": f"pregunta {i} " + "x " * 20},
+                {"role": "assistant", "content": f"respuesta {i} " + "y " * 20}]
+    return out
+
+
+def test_maybe_fold_replaces_old_turns_with_summary():
+    mem = MemorySessionMemory(max_sessions=10, max_messages=100, ttl_s=60)
+    prompts = []
+
+    async def complete(messages):
+        prompts.append(messages)
+        return "- usuario va de Chile a España"
+
+    summ = RollingSummarizer(mem, complete, words, trigger_tokens=150, keep_tokens=60)
+
+    async def run():
+        await mem.append("s1", turns(4))
+        await summ.maybe_fold("s1")
+        return await mem.history("s1"), await mem.summary("s1")
+
+    history, summary = asyncio.run(run())
+    assert [m["content"].split()[1] for m in history] == ["3", "3"]  # quedan los últimos turnos, completos
+    assert summary.text.startswith("- usuario") and summary.folded_messages == 6
+    assert "pregunta 0" in prompts[0][1]["content"]
+    assert summ.stats.folds == 1
+
+
+def test_fold_is_skipped_if_history_moved_while_summarizing():
+    mem = MemorySessionMemory(max_sessions=10, max_messages=8, ttl_s=60)
+
+    async def run():
+        async def complete(messages):
+            await mem.append("s1", turns(1, start=4))  # turno concurrente: el cap descarta los 2 más viejos
+            return "resumen"
+
+        summ = RollingSummarizer(mem, complete, words, trigger_tokens=150, keep_tokens=60)
+        await mem.append("s1", turns(4))
+        await summ.maybe_fold("s1")
+        return summ, await mem.history("s1"), await mem.summary("s1")
+
+    summ, history, summary = asyncio.run(run())
+    assert summary is None and len(history) == 8  # nada recortado de más
+    assert history[0]["content"].startswith("pregunta 1")
+    assert summ.stats.fold_conflicts == 1 and summ.stats.folds == 0
+
+
+def test_below_trigger_does_not_call_llm():
+    mem = MemorySessionMemory(max_sessions=10, max_messages=100, ttl_s=60)
+    calls = []
+
+    async def complete(messages):
+        calls.append(messages)
+        return "resumen"
+
+    summ = RollingSummarizer(mem, complete, words, trigger_tokens=10_000)
+
+    async def run():
+        await mem.append("s1", turns(2))
+        await summ.maybe_fold("s1")
+        await summ.maybe_fold(None)
+
+    asyncio.run(run())
+    assert calls == []
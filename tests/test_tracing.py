@@ -0,0 +1,72 @@
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from app import tracing  # noqa: E402
+
+
+def test_disabled_tracing_is_a_shared_noop():
+    assert not tracing.configure(False)
+    assert not tracing.enabled()
+    with tracing.span("x", {"a": 1}) as sp:
+        sp.set_attribute("b", 2)
+        sp.add_event("first_token")
+    assert tracing.span("y") is tracing.NOOP_SPAN
+
+
+@pytest.fixture
+def exporter():
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exp = InMemorySpanExporter()
+    assert tracing.configure(True, sample_ratio=1.0, exporter=exp)
+    try:
+        yield exp
+    finally:
+        tracing.shutdown()
+        tracing._tracer = tracing._provider = None
+
+
+class FakeEmbeddings:
+    async def create(self, model, input):
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0, 0.0, 0.0])])
+
+
+def test_retrieve_context_phases_nest_under_request_span(exporter, tmp_path):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from app.routers.llm import _retrieve_context
+    from app.vector_index import build_index, load_index
+
+    build_index(str(tmp_path), np.eye(4, dtype=np.float32), [{"content": f"doc{i}"} for i in range(4)])
+    index = load_index(str(tmp_path))
+    client = SimpleNamespace(embeddings=FakeEmbeddings())
+
+    app = FastAPI()
+    app.add_middleware(tracing.TracingMiddleware)
+
+    @app.get("/rag/{q}")
+    async def rag(q: str):
+        rows, context = await _retrieve_context(client, q, 2, None, index)
+        return {"n": len(rows)}
+
+    with TestClient(app) as c:
+        r = c.get("/rag/visa", headers={"traceparent": "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"})
+        assert r.json() == {"n": 2}
+    tracing.shutdown()
+
+    spans = {s.name: s for s in exporter.get_finished_spans()}
+    server = spans["HTTP GET /rag/{q}"]
+    assert format(server.context.trace_id, "032x") == "0af7651916cd43dd8448eb211c80319c"
+    for name in ("rag.embed", "rag.search", "rag.context"):
+        assert spans[name].parent.span_id == server.context.span_id
+    assert spans["rag.search"].attributes["rag.backend"] == "local"
@@ -0,0 +1,61 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app import vector_index  # noqa: E402
+from app.vector_index import build_index, load_index  # noqa: E402
+
+
+def corpus(n=500, dim=16, seed=3):
+    rng = np.random.default_rng(seed)
+    vecs = rng.normal(size=(n, dim)).astype(np.float32)
+    meta = [{"id": f"c{i}", "content": f"chunk {i}", "source": "kb.md"} for i in range(n)]
+    return vecs, meta
+
+
+def brute_force(vecs, q, k):
+    unit = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    sc = unit @ (q / np.linalg.norm(q))
+    top = np.argsort(-sc)[:k]
+    return [f"c{i}" for i in top], sc[top]
+
+
+@pytest.mark.parametrize("block_rows", [32768, 64])
+def test_flat_search_matches_brute_force(tmp_path, monkeypatch, block_rows):
+    monkeypatch.setattr(vector_index, "BLOCK_ROWS", block_rows)  # 64: top-k acumulado entre bloques
+    vecs, meta = corpus()
+    build_index(str(tmp_path), vecs, meta, model="m")
+    idx = load_index(str(tmp_path))
+    rng = np.random.default_rng(9)
+    for q in rng.normal(size=(10, 16)).astype(np.float32):
+        ids, sc = brute_force(vecs, q, 5)
+        hits = idx.search(q, 5)
+        assert [h["id"] for h in hits] == ids
+        np.testing.assert_allclose([h["similarity"] for h in hits], sc, rtol=1e-5)
+        assert hits[0]["content"] == meta[int(ids[0][1:])]["content"]
+
+
+def test_ivf_probing_all_lists_is_exact_and_finds_itself(tmp_path):
+    vecs, meta = corpus()
+    header = build_index(str(tmp_path), vecs, meta, model="m", mode="ivf", nlist=8)
+    idx = load_index(str(tmp_path), nprobe=8)
+    assert header["nlist"] == 8 and idx.offsets[-1] == len(vecs)
+    rng = np.random.default_rng(11)
+    for q in rng.normal(size=(10, 16)).astype(np.float32):
+        assert [h["id"] for h in idx.search(q, 5)] == brute_force(vecs, q, 5)[0]
+    idx.nprobe = 1  # aproximado, pero un vector de la colección se encuentra en su propia lista
+    for i in (0, 123, 499):
+        assert idx.search(vecs[i], 1)[0]["id"] == f"c{i}"
+
+
+def test_k_larger_than_index_and_missing_index(tmp_path):
+    vecs, meta = corpus(n=3)
+    build_index(str(tmp_path / "i"), vecs, meta)
+    assert len(load_index(str(tmp_path / "i")).search(vecs[0], 10)) == 3
+    assert load_index(str(tmp_path / "nada")) is None
+    with pytest.raises(ValueError):
+        build_index(str(tmp_path / "x"), vecs, meta[:2])
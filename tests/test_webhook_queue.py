@@ -0,0 +1,129 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "services" / "api"))
+
+from app.webhook_queue import Reject, WebhookEvent, WebhookQueue  # noqa: E402
+
+
+def make_queue(tmp_path, **kw):
+    return WebhookQueue(str(tmp_path / "q.sqlite3"), autostart=False, retry_base_s=0, **kw)
+
+
+def ev(event_id, key, created, provider="stripe", fingerprint=""):
+    return WebhookEvent(provider, event_id, key, {"id": event_id}, created=created, fingerprint=fingerprint)
+
+
+def test_duplicate_deliveries_are_enqueued_once(tmp_path):
+    q = make_queue(tmp_path)
+    seen = []
+
+    async def handler(job):
+        seen.append(job.event_id)
+
+    q.register("stripe", handler)
+
+    async def run():
+        fresh = [await q.enqueue(ev("evt_1", "sub_1", 1)) for _ in range(3)]
+        await q.drain()
+        return fresh
+
+    assert asyncio.run(run()) == [True, False, False]
+    assert seen == ["evt_1"]
+    assert q.stats.duplicates == 2
+    assert q.depth() == {"done": 1}
+    q.close()
+
+
+def test_per_key_order_survives_retries(tmp_path):
+    q = make_queue(tmp_path)
+    seen = []
+    fail = {"evt_a1": 1}
+
+    async def handler(job):
+        if fail.get(job.event_id):
+            fail[job.event_id] -= 1
+            raise RuntimeError("supabase caído")
+        seen.append(job.event_id)
+
+    q.register("stripe", handler)
+
+    async def run():
+        # llegan desordenados: el orden dentro de la clave sale de `created`
+        await q.enqueue(ev("evt_a2", "sub_a", 20))
+        await q.enqueue(ev("evt_a1", "sub_a", 10))
+        await q.enqueue(ev("evt_b1", "sub_b", 15))
+        await q.drain()
+
+    asyncio.run(run())
+    assert seen.index("evt_a1") < seen.index("evt_a2")
+    assert sorted(seen) == ["evt_a1", "evt_a2", "evt_b1"]
+    assert q.stats.retries == 1 and q.stats.processed == 3
+    q.close()
+
+
+def test_batches_and_dead_letter(tmp_path):
+    q = make_queue(tmp_path, batch_size=10, max_attempts=2)
+    calls = []
+
+    async def handler(job):
+        calls.append(job.event_id)
+        if job.event_id == "bad":
+            raise RuntimeError("siempre falla")
+
+    q.register("stripe", handler)
+
+    async def run():
+        for i in range(25):
+            await q.enqueue(ev(f"evt_{i}", f"sub_{i}", i))
+        await q.enqueue(ev("bad", "sub_bad", 0))
+        await q.drain()
+
+    asyncio.run(run())
+    assert q.stats.processed == 25 and q.stats.dead == 1
+    assert q.stats.batches >= 3
+    assert calls.count("bad") == 2
+    assert q.depth() == {"done": 25, "dead": 1}
+    q.close()
+
+
+def test_rejected_copy_does_not_mask_real_event(tmp_path):
+    q = make_queue(tmp_path)
+    applied = []
+
+    async def handler(job):
+        if job.fingerprint != "real-sig":
+            raise Reject("firma inválida")
+        applied.append(job.event_id)
+
+    q.register("paypal", handler)
+
+    async def run():
+        await q.enqueue(ev("WH-1", "I-SUB", 1, "paypal", "forged"))
+        await q.enqueue(ev("WH-1", "I-SUB", 1, "paypal", "real-sig"))
+        await q.enqueue(ev("WH-1", "I-SUB", 1, "paypal", "real-sig"))  # reintento de PayPal
+        await q.drain()
+
+    asyncio.run(run())
+    assert applied == ["WH-1"]
+    assert q.stats.rejected == 1 and q.stats.duplicates == 1
+    assert q.depth() == {"done": 1}
+    q.close()
+
+
+def test_pending_events_survive_restart(tmp_path):
+    first = make_queue(tmp_path)
+    asyncio.run(first.enqueue(ev("evt_1", "sub_1", 1)))
+    first.close()
+
+    second = make_queue(tmp_path)
+    seen = []
+
+    async def handler(job):
+        seen.append(job.event_id)
+
+    second.register("stripe", handler)
+    asyncio.run(second.drain())
+    assert seen == ["evt_1"]
+    second.close()